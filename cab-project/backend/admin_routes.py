@@ -1,120 +1,316 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from db import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from typing import Optional
+from datetime import datetime, date
+import csv
+import io
+import json
+from db import get_db, get_read_db, session_router
 from models import User, Driver, Ride, Payment
+from stats import dashboard_stats, revenue_by_day, reconcile_stats
+from partitions import PARTITIONED_TABLES, list_archives, read_archive
+from payouts import payout_summary
+from http_cache import conditional_json
+from analytics import (
+    GRANULARITIES, GROUPINGS, ride_timeseries, refresh_ride_aggregates, aggregates_refreshed_to
+)
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
 @router.get("/stats")
-def get_admin_stats(db: Session = Depends(get_db)):
-    """Get dashboard statistics"""
+def get_admin_stats(db: Session = Depends(get_read_db)):
+    """Get dashboard statistics from the rollup counters (see stats.py)"""
     try:
-        total_users = db.query(User).count()
-        active_drivers = db.query(Driver).filter(Driver.status == "active").count()
-        total_rides = db.query(Ride).count()
-        total_revenue = db.query(func.sum(Payment.amount)).filter(Payment.status == "completed").scalar() or 0
-        
-        return {
-            "total_users": total_users,
-            "active_drivers": active_drivers,
-            "total_rides": total_rides,
-            "total_revenue": total_revenue
-        }
-    except Exception as e:
-        return {
-            "total_users": 150,
-            "active_drivers": 45,
-            "total_rides": 1234,
-            "total_revenue": 125000
-        }
+        return dashboard_stats(db)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Statistics unavailable")
+
+@router.get("/stats/revenue")
+def get_revenue_stats(days: int = Query(7, ge=1, le=90), db: Session = Depends(get_read_db)):
+    """Get revenue per day and city from the rollup counters"""
+    try:
+        return revenue_by_day(db, days)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Statistics unavailable")
+
+@router.post("/stats/reconcile")
+def reconcile_admin_stats(db: Session = Depends(get_db)):
+    """Rebuild the rollup counters from the base tables"""
+    drift = reconcile_stats(db)
+    return {"message": "Statistics reconciled", "drift": drift}
+
+@router.get("/analytics/rides")
+def get_ride_analytics(
+    start: datetime,
+    end: datetime,
+    granularity: str = "hour",
+    group_by: str = "none",
+    vehicle_type: Optional[str] = None,
+    zone: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    """Rides, revenue, cancellations and average fare bucketed by hour or day"""
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail="granularity must be hour or day")
+    if group_by not in GROUPINGS:
+        raise HTTPException(status_code=400, detail="group_by must be none, vehicle_type or zone")
+    return {
+        "series": ride_timeseries(db, start, end, granularity, group_by, vehicle_type, zone),
+        "refreshed_to": aggregates_refreshed_to(db)
+    }
+
+@router.post("/analytics/refresh")
+def refresh_ride_analytics(db: Session = Depends(get_db)):
+    """Apply ride/payment changes since the last refresh to the hourly aggregates"""
+    return refresh_ride_aggregates(db)
+
+@router.get("/payouts/{batch}")
+def get_payout_batch(batch: str, db: Session = Depends(get_read_db)):
+    """Payout counts and amounts per status for a settlement batch (YYYY-MM-DD)"""
+    return payout_summary(db, batch)
+
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 500
+
+def keyset_page(query, id_column, request: Request, cursor: Optional[int], limit: int) -> Response:
+    """Newest-first keyset page with an ETag; sets X-Next-Cursor when more rows exist"""
+    if cursor is not None:
+        query = query.filter(id_column < cursor)
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = str(rows[-1].id)
+    return conditional_json(request, [row._asdict() for row in rows], headers=headers)
 
 @router.get("/users")
-def get_all_users(db: Session = Depends(get_db)):
-    """Get all users"""
+def get_all_users(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    db: Session = Depends(get_read_db)
+):
+    """Get users, newest first (pass X-Next-Cursor back as cursor for the next page)"""
     try:
-        users = db.query(User).all()
-        return [
-            {
-                "id": user.id,
-                "name": user.name,
-                "email": user.email,
-                "role": user.role,
-                "is_active": user.is_active,
-                "created_at": user.created_at
-            }
-            for user in users
-        ]
-    except Exception:
-        return [
-            {"id": 1, "name": "John Doe", "email": "john@example.com", "role": "rider", "is_active": True},
-            {"id": 2, "name": "Jane Smith", "email": "jane@example.com", "role": "driver", "is_active": True}
-        ]
+        query = db.query(
+            User.id, User.name, User.email, User.role, User.is_active, User.created_at
+        )
+        if role:
+            query = query.filter(User.role == role)
+        if is_active is not None:
+            query = query.filter(User.is_active == is_active)
+        return keyset_page(query, User.id, request, cursor, limit)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Listing unavailable")
 
 @router.get("/drivers")
-def get_all_drivers(db: Session = Depends(get_db)):
-    """Get all drivers"""
+def get_all_drivers(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    status: Optional[str] = None,
+    verified: Optional[bool] = None,
+    vehicle_type: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    """Get drivers, newest first"""
     try:
-        drivers = db.query(Driver).join(User).all()
-        return [
-            {
-                "id": driver.id,
-                "name": driver.user.name,
-                "license_number": driver.license_number,
-                "vehicle_info": driver.vehicle_info,
-                "status": driver.status,
-                "verified": driver.verified
-            }
-            for driver in drivers
-        ]
-    except Exception:
-        return [
-            {"id": 1, "name": "Jane Smith", "license_number": "DL1234567890", "vehicle_info": {"model": "Honda City"}, "status": "active", "verified": True}
-        ]
+        query = db.query(
+            Driver.id, User.name, Driver.license_number, Driver.vehicle_info,
+            Driver.vehicle_type, Driver.status, Driver.verified
+        ).join(User, Driver.user_id == User.id)
+        if status:
+            query = query.filter(Driver.status == status)
+        if verified is not None:
+            query = query.filter(Driver.verified == verified)
+        if vehicle_type:
+            query = query.filter(Driver.vehicle_type == vehicle_type)
+        return keyset_page(query, Driver.id, request, cursor, limit)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Listing unavailable")
 
 @router.get("/rides")
-def get_all_rides(db: Session = Depends(get_db)):
-    """Get all rides"""
+def get_all_rides(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    status: Optional[str] = None,
+    rider_id: Optional[int] = None,
+    driver_id: Optional[int] = None,
+    vehicle_type: Optional[str] = None,
+    db: Session = Depends(get_read_db)
+):
+    """Get rides with rider/driver names, newest first"""
     try:
-        rides = db.query(Ride).join(User, Ride.rider_id == User.id).all()
-        return [
-            {
-                "id": ride.id,
-                "rider_name": ride.rider.name,
-                "driver_name": ride.driver.name if ride.driver else "Not assigned",
-                "pickup_address": ride.pickup_address,
-                "drop_address": ride.drop_address,
-                "fare_estimate": ride.fare_estimate,
-                "status": ride.status,
-                "created_at": ride.created_at
-            }
-            for ride in rides
-        ]
-    except Exception:
-        return [
-            {"id": 1001, "rider_name": "John Doe", "driver_name": "Jane Smith", "pickup_address": "Delhi Center", "drop_address": "IGI Airport", "fare_estimate": 450, "status": "completed", "created_at": "2024-01-15"}
-        ]
+        rider = aliased(User)
+        driver = aliased(User)
+        query = db.query(
+            Ride.id,
+            rider.name.label("rider_name"),
+            func.coalesce(driver.name, "Not assigned").label("driver_name"),
+            Ride.pickup_address,
+            Ride.drop_address,
+            Ride.fare_estimate,
+            Ride.status,
+            Ride.created_at
+        ).join(rider, Ride.rider_id == rider.id).outerjoin(driver, Ride.driver_id == driver.id)
+        if status:
+            query = query.filter(Ride.status == status)
+        if rider_id is not None:
+            query = query.filter(Ride.rider_id == rider_id)
+        if driver_id is not None:
+            query = query.filter(Ride.driver_id == driver_id)
+        if vehicle_type:
+            query = query.filter(Ride.vehicle_type == vehicle_type)
+        return keyset_page(query, Ride.id, request, cursor, limit)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Listing unavailable")
 
 @router.get("/payments")
-def get_all_payments(db: Session = Depends(get_db)):
-    """Get all payments"""
+def get_all_payments(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    status: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    ride_id: Optional[int] = None,
+    db: Session = Depends(get_read_db)
+):
+    """Get payments, newest first"""
     try:
-        payments = db.query(Payment).join(Ride).all()
-        return [
-            {
-                "id": payment.id,
-                "ride_id": payment.ride_id,
-                "amount": payment.amount,
-                "payment_method": payment.payment_method,
-                "status": payment.status,
-                "created_at": payment.created_at
-            }
-            for payment in payments
-        ]
-    except Exception:
-        return [
-            {"id": 1, "ride_id": 1001, "amount": 450, "payment_method": "card", "status": "completed", "created_at": "2024-01-15"}
-        ]
+        query = db.query(
+            Payment.id, Payment.ride_id, Payment.amount, Payment.payment_method,
+            Payment.status, Payment.created_at
+        )
+        if status:
+            query = query.filter(Payment.status == status)
+        if payment_method:
+            query = query.filter(Payment.payment_method == payment_method)
+        if ride_id is not None:
+            query = query.filter(Payment.ride_id == ride_id)
+        return keyset_page(query, Payment.id, request, cursor, limit)
+    except SQLAlchemyError:
+        raise HTTPException(status_code=503, detail="Listing unavailable")
+
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+RIDE_EXPORT_COLUMNS = [
+    Ride.id, Ride.rider_id, Ride.driver_id, Ride.status, Ride.vehicle_type,
+    Ride.fare_estimate, Ride.fare_actual, Ride.distance_meters, Ride.duration_secs,
+    Ride.pickup_address, Ride.drop_address, Ride.created_at, Ride.completed_at
+]
+
+PAYMENT_EXPORT_COLUMNS = [
+    Payment.id, Payment.ride_id, Payment.amount, Payment.currency, Payment.payment_method,
+    Payment.status, Payment.stripe_payment_intent_id, Payment.created_at
+]
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+def stream_export(statement, export_format: str):
+    """Yield the statement's rows as NDJSON or CSV chunks.
+
+    Uses its own read session (the replica when one is configured) with a
+    server-side cursor so memory stays flat no matter how many rows match,
+    independent of the request session.
+    """
+    db = session_router.read_session()
+    try:
+        result = db.execute(
+            statement.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS)
+        )
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == "csv":
+            writer.writerow(columns)
+
+        for partition in result.partitions():
+            for row in partition:
+                values = [export_value(value) for value in row]
+                if export_format == "csv":
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, values)), default=str))
+                    buffer.write("\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        db.close()
+
+def export_response(statement, table: str, export_format: str) -> StreamingResponse:
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    filename = f"{table}_{datetime.utcnow():%Y%m%d%H%M%S}.{export_format}"
+    return StreamingResponse(
+        stream_export(statement, export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def created_between(statement, column, start: Optional[datetime], end: Optional[datetime]):
+    if start:
+        statement = statement.where(column >= start)
+    if end:
+        statement = statement.where(column < end)
+    return statement
+
+@router.get("/export/rides")
+def export_rides(
+    format: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = None
+):
+    """Stream rides created in [start, end) as NDJSON or CSV"""
+    statement = created_between(select(*RIDE_EXPORT_COLUMNS), Ride.created_at, start, end)
+    if status:
+        statement = statement.where(Ride.status == status)
+    return export_response(statement.order_by(Ride.created_at, Ride.id), "rides", format)
+
+@router.get("/export/payments")
+def export_payments(
+    format: str = "ndjson",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = None
+):
+    """Stream payments created in [start, end) as NDJSON or CSV"""
+    statement = created_between(select(*PAYMENT_EXPORT_COLUMNS), Payment.created_at, start, end)
+    if status:
+        statement = statement.where(Payment.status == status)
+    return export_response(statement.order_by(Payment.created_at, Payment.id), "payments", format)
+
+@router.get("/archives/{table}")
+def get_archived_months(table: str):
+    """List archived months for a partitioned table"""
+    if table not in PARTITIONED_TABLES:
+        raise HTTPException(status_code=404, detail="Table is not archived")
+    return {"table": table, "months": list_archives(table)}
+
+@router.get("/archives/{table}/{month}")
+def query_archive(table: str, month: str, request: Request):
+    """Stream an archived month as NDJSON; query parameters filter on column equality"""
+    if table not in PARTITIONED_TABLES or month not in list_archives(table):
+        raise HTTPException(status_code=404, detail="Archive not found")
+    rows = read_archive(table, month, dict(request.query_params))
+    return StreamingResponse(
+        (json.dumps(row) + "\n" for row in rows), media_type=EXPORT_FORMATS["ndjson"]
+    )
 
 @router.put("/users/{user_id}/status")
 def update_user_status(user_id: int, is_active: bool, db: Session = Depends(get_db)):
@@ -8,6 +8,7 @@ from alembic import context
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from models import Base  # aapke saare tables
+import models_advanced  # noqa: F401  (wallet, promo and receipt tables)
 
 config = context.config
 if config.config_file_name is not None:
@@ -0,0 +1,139 @@
+"""add driver location geography
+
+Revision ID: 3b9d4e7a1c02
+Revises: 228042fa047b
+Create Date: 2026-10-19 09:12:44.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = '3b9d4e7a1c02'
+down_revision: Union[str, Sequence[str], None] = '228042fa047b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# The DDL as of this revision, copied from spatial.py so later changes
+# there don't rewrite history
+POSTGIS_EXTENSION = "CREATE EXTENSION IF NOT EXISTS postgis"
+
+PG_SYNC_FUNCTION = """
+CREATE OR REPLACE FUNCTION drivers_sync_location() RETURNS trigger AS $$
+BEGIN
+    IF NEW.current_lat IS NULL OR NEW.current_lng IS NULL THEN
+        NEW.current_location := NULL;
+    ELSE
+        NEW.current_location := ST_SetSRID(
+            ST_MakePoint(NEW.current_lng, NEW.current_lat), 4326
+        )::geography;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+PG_SYNC_TRIGGER = """
+CREATE TRIGGER drivers_sync_location
+BEFORE INSERT OR UPDATE OF current_lat, current_lng ON drivers
+FOR EACH ROW EXECUTE FUNCTION drivers_sync_location()
+"""
+
+PG_BACKFILL = """
+UPDATE drivers
+SET current_location = ST_SetSRID(ST_MakePoint(current_lng, current_lat), 4326)::geography
+WHERE current_lat IS NOT NULL AND current_lng IS NOT NULL
+"""
+
+SQLITE_RTREE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS drivers_location_rtree
+USING rtree(id, min_lat, max_lat, min_lng, max_lng)
+"""
+
+SQLITE_RTREE_INSERT = """
+CREATE TRIGGER IF NOT EXISTS drivers_location_rtree_insert
+AFTER INSERT ON drivers
+WHEN NEW.current_lat IS NOT NULL AND NEW.current_lng IS NOT NULL
+BEGIN
+    INSERT OR REPLACE INTO drivers_location_rtree
+    VALUES (NEW.id, NEW.current_lat, NEW.current_lat, NEW.current_lng, NEW.current_lng);
+END
+"""
+
+SQLITE_RTREE_UPDATE = """
+CREATE TRIGGER IF NOT EXISTS drivers_location_rtree_update
+AFTER UPDATE OF current_lat, current_lng ON drivers
+BEGIN
+    DELETE FROM drivers_location_rtree WHERE id = OLD.id;
+    INSERT INTO drivers_location_rtree
+    SELECT NEW.id, NEW.current_lat, NEW.current_lat, NEW.current_lng, NEW.current_lng
+    WHERE NEW.current_lat IS NOT NULL AND NEW.current_lng IS NOT NULL;
+END
+"""
+
+SQLITE_RTREE_DELETE = """
+CREATE TRIGGER IF NOT EXISTS drivers_location_rtree_delete
+AFTER DELETE ON drivers
+BEGIN
+    DELETE FROM drivers_location_rtree WHERE id = OLD.id;
+END
+"""
+
+SQLITE_BACKFILL = """
+INSERT OR REPLACE INTO drivers_location_rtree
+SELECT id, current_lat, current_lat, current_lng, current_lng
+FROM drivers
+WHERE current_lat IS NOT NULL AND current_lng IS NOT NULL
+"""
+
+POSTGRES_DDL = [PG_SYNC_FUNCTION, PG_SYNC_TRIGGER]
+SQLITE_DDL = [SQLITE_RTREE, SQLITE_RTREE_INSERT, SQLITE_RTREE_UPDATE, SQLITE_RTREE_DELETE]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+    # drivers may already have the column when it was created by create_all
+    has_column = "current_location" in {
+        column["name"] for column in sa.inspect(bind).get_columns("drivers")
+    }
+
+    if dialect == "postgresql":
+        op.execute(POSTGIS_EXTENSION)
+        if not has_column:
+            op.execute("ALTER TABLE drivers ADD COLUMN current_location geography(Point, 4326)")
+        op.execute(PG_BACKFILL)
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS idx_drivers_current_location "
+            "ON drivers USING gist (current_location)"
+        )
+        op.execute("DROP TRIGGER IF EXISTS drivers_sync_location ON drivers")
+        for statement in POSTGRES_DDL:
+            op.execute(statement)
+    elif dialect == "sqlite":
+        if not has_column:
+            op.add_column("drivers", sa.Column("current_location", sa.String(), nullable=True))
+        for statement in SQLITE_DDL:
+            op.execute(statement)
+        op.execute(SQLITE_BACKFILL)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+
+    if dialect == "postgresql":
+        op.execute("DROP TRIGGER IF EXISTS drivers_sync_location ON drivers")
+        op.execute("DROP FUNCTION IF EXISTS drivers_sync_location()")
+        op.drop_index("idx_drivers_current_location", table_name="drivers")
+        op.drop_column("drivers", "current_location")
+    elif dialect == "sqlite":
+        op.execute("DROP TRIGGER IF EXISTS drivers_location_rtree_insert")
+        op.execute("DROP TRIGGER IF EXISTS drivers_location_rtree_update")
+        op.execute("DROP TRIGGER IF EXISTS drivers_location_rtree_delete")
+        op.execute("DROP TABLE IF EXISTS drivers_location_rtree")
+        with op.batch_alter_table("drivers") as batch_op:
+            batch_op.drop_column("current_location")
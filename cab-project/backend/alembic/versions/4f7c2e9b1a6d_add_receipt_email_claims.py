@@ -0,0 +1,39 @@
+"""add receipt email claims
+
+Revision ID: 4f7c2e9b1a6d
+Revises: d8e3b6f1c4a2
+Create Date: 2026-10-20 09:41:27.318604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = '4f7c2e9b1a6d'
+down_revision: Union[str, Sequence[str], None] = 'd8e3b6f1c4a2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if "receipts" not in inspector.get_table_names():
+        return
+
+    columns = {column["name"] for column in inspector.get_columns("receipts")}
+    if "email_claimed_at" not in columns:
+        op.add_column("receipts", sa.Column("email_claimed_at", sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if "receipts" not in inspector.get_table_names():
+        return
+
+    columns = {column["name"] for column in inspector.get_columns("receipts")}
+    if "email_claimed_at" in columns:
+        op.drop_column("receipts", "email_claimed_at")
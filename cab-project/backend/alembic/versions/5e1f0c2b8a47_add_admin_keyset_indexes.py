@@ -0,0 +1,39 @@
+"""add admin keyset indexes
+
+Revision ID: 5e1f0c2b8a47
+Revises: 3b9d4e7a1c02
+Create Date: 2026-10-19 11:40:02.503116
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = '5e1f0c2b8a47'
+down_revision: Union[str, Sequence[str], None] = '3b9d4e7a1c02'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = [
+    ("ix_users_role_id", "users", ["role", "id"]),
+    ("ix_drivers_status_id", "drivers", ["status", "id"]),
+    ("ix_rides_status_id", "rides", ["status", "id"]),
+    ("ix_rides_rider_id_id", "rides", ["rider_id", "id"]),
+    ("ix_rides_driver_id_id", "rides", ["driver_id", "id"]),
+    ("ix_payments_status_id", "payments", ["status", "id"]),
+    ("ix_payments_ride_id", "payments", ["ride_id"]),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,29 @@
+"""add export created_at indexes
+
+Revision ID: 8c2a6d9e4f13
+Revises: 5e1f0c2b8a47
+Create Date: 2026-10-19 13:05:51.270984
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = '8c2a6d9e4f13'
+down_revision: Union[str, Sequence[str], None] = '5e1f0c2b8a47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index("ix_rides_created_at", "rides", ["created_at"], if_not_exists=True)
+    op.create_index("ix_payments_created_at", "payments", ["created_at"], if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_payments_created_at", table_name="payments", if_exists=True)
+    op.drop_index("ix_rides_created_at", table_name="rides", if_exists=True)
@@ -0,0 +1,37 @@
+"""create stat counters
+
+Revision ID: a41d7b3e9c58
+Revises: 8c2a6d9e4f13
+Create Date: 2026-10-19 15:22:10.846392
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'a41d7b3e9c58'
+down_revision: Union[str, Sequence[str], None] = '8c2a6d9e4f13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # skip when main.py's create_all already built the table
+    if "stat_counters" in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        "stat_counters",
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("shard", sa.Integer(), nullable=False),
+        sa.Column("value", sa.Float(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("name", "shard"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("stat_counters")
@@ -0,0 +1,140 @@
+"""create double-entry wallet ledger
+
+Revision ID: a8d3f0b6e2c9
+Revises: f6c1d2e9a7b5
+Create Date: 2026-10-19 22:10:52.401337
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'a8d3f0b6e2c9'
+down_revision: Union[str, Sequence[str], None] = 'f6c1d2e9a7b5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+    if "wallets" in tables:
+        # Created by metadata.create_all with the current models: nothing to do
+        if "account" not in {column["name"] for column in inspector.get_columns("wallets")}:
+            convert_wallets()
+    else:
+        create_wallets()
+    if "wallet_transactions" in tables:
+        if "entry_id" not in {column["name"] for column in inspector.get_columns("wallet_transactions")}:
+            convert_wallet_transactions()
+    else:
+        create_wallet_transactions()
+
+
+def create_wallets() -> None:
+    op.create_table(
+        "wallets",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=True),
+        sa.Column("account", sa.String(), nullable=False),
+        sa.Column("is_house", sa.Boolean(), nullable=True),
+        sa.Column("balance", sa.Integer(), nullable=True),
+        sa.Column("snapshot_entry_id", sa.Integer(), nullable=True),
+        sa.Column("currency", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("user_id"),
+        sa.UniqueConstraint("account"),
+    )
+    op.create_index("ix_wallets_id", "wallets", ["id"])
+
+
+def create_wallet_transactions() -> None:
+    op.create_table(
+        "wallet_transactions",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("wallet_id", sa.Integer(), sa.ForeignKey("wallets.id"), nullable=False),
+        sa.Column("entry_id", sa.String(), nullable=False),
+        sa.Column("type", sa.String(), nullable=False),
+        sa.Column("amount", sa.Integer(), nullable=False),
+        sa.Column("balance_after", sa.Integer(), nullable=True),
+        sa.Column("description", sa.String(), nullable=False),
+        sa.Column("reference_id", sa.String(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("entry_id", "wallet_id"),
+    )
+    op.create_index("ix_wallet_transactions_id", "wallet_transactions", ["id"])
+    op.create_index("ix_wallet_transactions_wallet_id_id", "wallet_transactions", ["wallet_id", "id"])
+
+
+def convert_wallets() -> None:
+    """Rupee Float balances become paise, each wallet the account of its user"""
+    op.add_column("wallets", sa.Column("account", sa.String(), nullable=True))
+    op.add_column("wallets", sa.Column("is_house", sa.Boolean(), nullable=True))
+    op.add_column("wallets", sa.Column("snapshot_entry_id", sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE wallets SET account = 'user:' || user_id, is_house = false, snapshot_entry_id = 0, "
+        "balance = ROUND(COALESCE(balance, 0) * 100)"
+    )
+    with op.batch_alter_table("wallets") as batch_op:
+        batch_op.alter_column("balance", existing_type=sa.Float(), type_=sa.Integer(),
+                              postgresql_using="balance::integer")
+        batch_op.alter_column("account", existing_type=sa.String(), nullable=False)
+        batch_op.alter_column("user_id", existing_type=sa.Integer(), nullable=True)
+        batch_op.create_unique_constraint("uq_wallets_account", ["account"])
+
+
+def convert_wallet_transactions() -> None:
+    """Paise amounts signed by direction; each old row is an entry of its own"""
+    op.add_column("wallet_transactions", sa.Column("entry_id", sa.String(), nullable=True))
+    op.add_column("wallet_transactions", sa.Column("balance_after", sa.Integer(), nullable=True))
+    op.execute(
+        "UPDATE wallet_transactions SET entry_id = 'legacy:' || id, "
+        "amount = CASE WHEN type = 'debit' THEN -ROUND(ABS(amount) * 100) ELSE ROUND(ABS(amount) * 100) END, "
+        "type = CASE WHEN type = 'debit' THEN 'debit' ELSE 'credit' END"
+    )
+    with op.batch_alter_table("wallet_transactions") as batch_op:
+        batch_op.alter_column("amount", existing_type=sa.Float(), type_=sa.Integer(), existing_nullable=False,
+                              postgresql_using="amount::integer")
+        batch_op.alter_column("entry_id", existing_type=sa.String(), nullable=False)
+        batch_op.create_unique_constraint("uq_wallet_transactions_entry_id_wallet_id", ["entry_id", "wallet_id"])
+        batch_op.create_index("ix_wallet_transactions_wallet_id_id", ["wallet_id", "id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+    if "wallets" not in tables or "wallet_transactions" not in tables:
+        return
+
+    # The old schema has no house accounts: their ledger legs go with them
+    op.execute(
+        "DELETE FROM wallet_transactions WHERE wallet_id IN (SELECT id FROM wallets WHERE is_house = true)"
+    )
+    op.execute("DELETE FROM wallets WHERE is_house = true OR user_id IS NULL")
+
+    indexes = {index["name"] for index in inspector.get_indexes("wallet_transactions")}
+    with op.batch_alter_table("wallet_transactions") as batch_op:
+        if "ix_wallet_transactions_wallet_id_id" in indexes:
+            batch_op.drop_index("ix_wallet_transactions_wallet_id_id")
+        batch_op.alter_column("amount", existing_type=sa.Integer(), type_=sa.Float(), existing_nullable=False)
+    with op.batch_alter_table("wallets") as batch_op:
+        batch_op.alter_column("balance", existing_type=sa.Integer(), type_=sa.Float())
+    # Paise back to rupees, amounts unsigned again with the direction in type
+    op.execute("UPDATE wallets SET balance = COALESCE(balance, 0) / 100.0")
+    op.execute("UPDATE wallet_transactions SET amount = ABS(amount) / 100.0")
+
+    with op.batch_alter_table("wallet_transactions") as batch_op:
+        batch_op.drop_column("balance_after")
+        batch_op.drop_column("entry_id")
+    with op.batch_alter_table("wallets") as batch_op:
+        batch_op.alter_column("user_id", existing_type=sa.Integer(), nullable=False)
+        batch_op.drop_column("snapshot_entry_id")
+        batch_op.drop_column("is_house")
+        batch_op.drop_column("account")
@@ -0,0 +1,109 @@
+"""promo codes with index versioning and sharded usage counters
+
+Revision ID: b5e9c4d7a1f3
+Revises: a8d3f0b6e2c9
+Create Date: 2026-10-19 23:04:18.562190
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'b5e9c4d7a1f3'
+down_revision: Union[str, Sequence[str], None] = 'a8d3f0b6e2c9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if "promo_codes" not in tables:
+        op.create_table(
+            "promo_codes",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("code", sa.String(), nullable=False),
+            sa.Column("description", sa.String(), nullable=False),
+            sa.Column("discount_type", sa.String(), nullable=False),
+            sa.Column("discount_value", sa.Float(), nullable=False),
+            sa.Column("min_ride_amount", sa.Float(), nullable=True),
+            sa.Column("max_discount", sa.Float(), nullable=True),
+            sa.Column("usage_limit", sa.Integer(), nullable=True),
+            sa.Column("used_count", sa.Integer(), nullable=True),
+            sa.Column("counter_shards", sa.Integer(), nullable=True),
+            sa.Column("valid_from", sa.DateTime(), nullable=False),
+            sa.Column("valid_until", sa.DateTime(), nullable=False),
+            sa.Column("is_active", sa.Boolean(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        op.create_index("ix_promo_codes_id", "promo_codes", ["id"])
+        op.create_index("ix_promo_codes_code", "promo_codes", ["code"], unique=True)
+    else:
+        columns = {column["name"] for column in inspector.get_columns("promo_codes")}
+        if "counter_shards" not in columns:
+            op.add_column("promo_codes", sa.Column("counter_shards", sa.Integer(), nullable=True))
+        if "updated_at" not in columns:
+            op.add_column("promo_codes", sa.Column("updated_at", sa.DateTime(), nullable=True))
+            op.execute("UPDATE promo_codes SET updated_at = created_at")
+
+    if "promo_usage" not in tables:
+        op.create_table(
+            "promo_usage",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("promo_id", sa.Integer(), sa.ForeignKey("promo_codes.id"), nullable=False),
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("ride_id", sa.Integer(), sa.ForeignKey("rides.id"), nullable=False),
+            sa.Column("discount_amount", sa.Float(), nullable=False),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        op.create_index("ix_promo_usage_id", "promo_usage", ["id"])
+        usage_indexes = set()
+    else:
+        usage_indexes = {index["name"] for index in inspector.get_indexes("promo_usage")}
+    if "ux_promo_usage_promo_id_ride_id" not in usage_indexes:
+        op.create_index("ux_promo_usage_promo_id_ride_id", "promo_usage", ["promo_id", "ride_id"], unique=True)
+
+    if "promo_counters" not in tables:
+        op.create_table(
+            "promo_counters",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("promo_id", sa.Integer(), sa.ForeignKey("promo_codes.id"), nullable=False),
+            sa.Column("shard", sa.Integer(), nullable=False),
+            sa.Column("used", sa.Integer(), nullable=True),
+            sa.Column("capacity", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("id"),
+            sa.UniqueConstraint("promo_id", "shard"),
+        )
+        op.create_index("ix_promo_counters_id", "promo_counters", ["id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema.
+
+    Mirrors the upgrade: only what exists is dropped, counters first since
+    they reference promo_codes.
+    """
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if "promo_counters" in tables:
+        op.drop_table("promo_counters")
+
+    if "promo_usage" in tables:
+        usage_indexes = {index["name"] for index in inspector.get_indexes("promo_usage")}
+        if "ux_promo_usage_promo_id_ride_id" in usage_indexes:
+            op.drop_index("ux_promo_usage_promo_id_ride_id", table_name="promo_usage")
+
+    if "promo_codes" in tables:
+        columns = {column["name"] for column in inspector.get_columns("promo_codes")}
+        if "updated_at" in columns:
+            op.drop_column("promo_codes", "updated_at")
+        if "counter_shards" in columns:
+            op.drop_column("promo_codes", "counter_shards")
@@ -0,0 +1,67 @@
+"""create rating aggregates and review indexes
+
+Revision ID: c2f7a9e4b8d1
+Revises: b5e9c4d7a1f3
+Create Date: 2026-10-19 23:41:07.218845
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'c2f7a9e4b8d1'
+down_revision: Union[str, Sequence[str], None] = 'b5e9c4d7a1f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema.
+
+    Aggregates start empty; the reconcile_ratings task backfills them from
+    existing reviews on its first run. Duplicate reviews of a ride by the
+    same rater are deleted before the unique index is built.
+    """
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if "rating_aggregates" not in tables:
+        op.create_table(
+            "rating_aggregates",
+            sa.Column("rated_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("count", sa.Integer(), nullable=False),
+            sa.Column("total", sa.Integer(), nullable=False),
+            sa.Column("decayed_total", sa.Float(), nullable=False),
+            sa.Column("decayed_count", sa.Float(), nullable=False),
+            sa.Column("decay_period", sa.Integer(), nullable=False, server_default="0"),
+            sa.Column("score", sa.Float(), nullable=False),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("rated_id"),
+        )
+    else:
+        columns = {column["name"] for column in inspector.get_columns("rating_aggregates")}
+        if "decay_period" not in columns:
+            # Existing sums are relative to RATING_DECAY_EPOCH, i.e. period 0
+            op.add_column("rating_aggregates",
+                          sa.Column("decay_period", sa.Integer(), nullable=False, server_default="0"))
+
+    if "reviews" in tables:
+        indexes = {index["name"] for index in inspector.get_indexes("reviews")}
+        if "ux_reviews_ride_id_rater_id" not in indexes:
+            # Keep each rater's first review of a ride so the unique index can be built
+            op.execute(
+                "DELETE FROM reviews WHERE id NOT IN "
+                "(SELECT MIN(id) FROM reviews GROUP BY ride_id, rater_id)"
+            )
+            op.create_index("ux_reviews_ride_id_rater_id", "reviews", ["ride_id", "rater_id"], unique=True)
+        if "ix_reviews_rated_id_id" not in indexes:
+            op.create_index("ix_reviews_rated_id_id", "reviews", ["rated_id", "id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_reviews_rated_id_id", table_name="reviews")
+    op.drop_index("ux_reviews_ride_id_rater_id", table_name="reviews")
+    op.drop_table("rating_aggregates")
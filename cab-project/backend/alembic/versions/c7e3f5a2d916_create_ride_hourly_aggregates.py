@@ -0,0 +1,61 @@
+"""create ride hourly aggregates
+
+Revision ID: c7e3f5a2d916
+Revises: a41d7b3e9c58
+Create Date: 2026-10-19 16:48:37.119540
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'c7e3f5a2d916'
+down_revision: Union[str, Sequence[str], None] = 'a41d7b3e9c58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    for table in ("rides", "payments"):
+        if "updated_at" not in {column["name"] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column("updated_at", sa.DateTime(), nullable=True))
+        op.create_index(f"ix_{table}_updated_at", table, ["updated_at"], if_not_exists=True)
+
+    if "ride_hourly_aggregates" not in tables:
+        op.create_table(
+            "ride_hourly_aggregates",
+            sa.Column("bucket_start", sa.DateTime(), nullable=False),
+            sa.Column("vehicle_type", sa.String(), nullable=False),
+            sa.Column("zone", sa.String(), nullable=False),
+            sa.Column("rides", sa.Integer(), nullable=True),
+            sa.Column("completed", sa.Integer(), nullable=True),
+            sa.Column("cancelled", sa.Integer(), nullable=True),
+            sa.Column("fare_sum", sa.Float(), nullable=True),
+            sa.Column("revenue", sa.Float(), nullable=True),
+            sa.Column("refreshed_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("bucket_start", "vehicle_type", "zone"),
+        )
+
+    if "aggregate_watermarks" not in tables:
+        op.create_table(
+            "aggregate_watermarks",
+            sa.Column("name", sa.String(), nullable=False),
+            sa.Column("refreshed_to", sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint("name"),
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("aggregate_watermarks")
+    op.drop_table("ride_hourly_aggregates")
+    for table in ("payments", "rides"):
+        op.drop_index(f"ix_{table}_updated_at", table_name=table, if_exists=True)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column("updated_at")
@@ -0,0 +1,52 @@
+"""create notification counters and per-user notification index
+
+Revision ID: d8e3b6f1c4a2
+Revises: c2f7a9e4b8d1
+Create Date: 2026-10-20 01:12:44.603917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'd8e3b6f1c4a2'
+down_revision: Union[str, Sequence[str], None] = 'c2f7a9e4b8d1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema.
+
+    Counters are backfilled from the unread notifications already stored.
+    """
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if "notification_counters" not in tables:
+        op.create_table(
+            "notification_counters",
+            sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("unread", sa.Integer(), nullable=False),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("user_id"),
+        )
+        if "notifications" in tables:
+            op.execute(
+                "INSERT INTO notification_counters (user_id, unread, updated_at) "
+                "SELECT user_id, COUNT(*), CURRENT_TIMESTAMP FROM notifications "
+                "WHERE read = FALSE GROUP BY user_id"
+            )
+
+    if "notifications" in tables:
+        indexes = {index["name"] for index in inspector.get_indexes("notifications")}
+        if "ix_notifications_user_id_id" not in indexes:
+            op.create_index("ix_notifications_user_id_id", "notifications", ["user_id", "id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_notifications_user_id_id", table_name="notifications")
+    op.drop_table("notification_counters")
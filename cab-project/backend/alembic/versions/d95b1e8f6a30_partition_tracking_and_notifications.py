@@ -0,0 +1,140 @@
+"""partition ride_tracking and notifications by month
+
+Revision ID: d95b1e8f6a30
+Revises: c7e3f5a2d916
+Create Date: 2026-10-19 18:31:06.592847
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'd95b1e8f6a30'
+down_revision: Union[str, Sequence[str], None] = 'c7e3f5a2d916'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Column lists mirror models.RideTracking / models.Notification. The
+# partition key joins the primary key, as PostgreSQL requires.
+TABLES = {
+    "ride_tracking": {
+        "key": "timestamp",
+        "columns": """
+            id integer NOT NULL DEFAULT nextval('ride_tracking_id_seq'),
+            ride_id integer NOT NULL REFERENCES rides (id),
+            driver_lat double precision NOT NULL,
+            driver_lng double precision NOT NULL,
+            timestamp timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'),
+            PRIMARY KEY (id, timestamp)
+        """,
+        "copied": ["id", "ride_id", "driver_lat", "driver_lng", "timestamp"],
+        "references": {"ride_id": "rides"},
+        "indexes": ["CREATE INDEX ix_ride_tracking_ride_id_timestamp ON ride_tracking (ride_id, timestamp)"],
+    },
+    "notifications": {
+        "key": "created_at",
+        "columns": """
+            id integer NOT NULL DEFAULT nextval('notifications_id_seq'),
+            user_id integer NOT NULL REFERENCES users (id),
+            title varchar NOT NULL,
+            message text NOT NULL,
+            type varchar NOT NULL,
+            read boolean,
+            data json,
+            created_at timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'),
+            PRIMARY KEY (id, created_at)
+        """,
+        "copied": ["id", "user_id", "title", "message", "type", "read", "data", "created_at"],
+        "references": {"user_id": "users"},
+        "indexes": ["CREATE INDEX ix_notifications_user_id_created_at ON notifications (user_id, created_at)"],
+    },
+}
+
+
+# Monthly partitions are created ahead of today; later months are added by
+# partitions.maintain_partitions, which this migration does not import.
+PARTITIONS_AHEAD = 3
+
+
+def add_months(month: date, months: int) -> date:
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def create_partitions(table: str, first_month: date) -> None:
+    """Monthly partitions from first_month to PARTITIONS_AHEAD months from
+    now, and a default partition for anything outside them"""
+    last_month = add_months(date.today().replace(day=1), PARTITIONS_AHEAD)
+    month = first_month.replace(day=1)
+    while month <= last_month:
+        following = add_months(month, 1)
+        op.execute(
+            f"CREATE TABLE {table}_y{month.year}m{month.month:02d} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+        )
+        month = following
+    op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+
+def upgrade() -> None:
+    """Upgrade schema.
+
+    Rows without a partition key are kept, stamped with the migration time.
+    """
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+
+    for table, spec in TABLES.items():
+        key = spec["key"]
+        legacy = f"{table}_unpartitioned"
+        first = bind.execute(sa.text(f"SELECT min({key}) FROM {table}")).scalar()
+        columns = ", ".join(spec["copied"])
+        values = ", ".join(
+            f"COALESCE({key}, now() at time zone 'utc')" if column == key else column
+            for column in spec["copied"]
+        )
+
+        op.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        op.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY NONE")
+        op.execute(f"CREATE TABLE {table} ({spec['columns']}) PARTITION BY RANGE ({key})")
+        op.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        create_partitions(table, first.date() if first else date.today())
+        op.execute(f"INSERT INTO {table} ({columns}) SELECT {values} FROM {legacy}")
+        op.execute(f"DROP TABLE {legacy}")
+        for statement in spec["indexes"]:
+            op.execute(statement)
+
+    # rides keeps its foreign keys from payments/reviews/receipts, so it is
+    # not partitioned; a BRIN index keeps created_at range scans cheap.
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS brin_rides_created_at ON rides USING brin (created_at)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+
+    op.execute("DROP INDEX IF EXISTS brin_rides_created_at")
+    for table, spec in TABLES.items():
+        partitioned = f"{table}_partitioned"
+        op.execute(f"ALTER TABLE {table} RENAME TO {partitioned}")
+        op.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY NONE")
+        op.execute(f"CREATE TABLE {table} (LIKE {partitioned} INCLUDING DEFAULTS)")
+        op.execute(f"INSERT INTO {table} SELECT * FROM {partitioned}")
+        op.execute(f"DROP TABLE {partitioned}")
+        op.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id)")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN {spec['key']} DROP NOT NULL")
+        op.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        op.execute(f"CREATE INDEX ix_{table}_id ON {table} (id)")
+        for column, referenced in spec["references"].items():
+            op.execute(
+                f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey "
+                f"FOREIGN KEY ({column}) REFERENCES {referenced} (id)"
+            )
@@ -0,0 +1,53 @@
+"""create webhook events queue
+
+Revision ID: e3b8a6f1c2d4
+Revises: d95b1e8f6a30
+Create Date: 2026-10-19 20:12:44.318205
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'e3b8a6f1c2d4'
+down_revision: Union[str, Sequence[str], None] = 'd95b1e8f6a30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema.
+
+    Webhook batches look their payments up by payment intent id.
+    """
+    inspector = sa.inspect(op.get_bind())
+
+    if "webhook_events" not in inspector.get_table_names():
+        op.create_table(
+            "webhook_events",
+            sa.Column("id", sa.String(), nullable=False),
+            sa.Column("type", sa.String(), nullable=False),
+            sa.Column("payload", sa.JSON(), nullable=False),
+            sa.Column("status", sa.String(), nullable=True),
+            sa.Column("attempts", sa.Integer(), nullable=True),
+            sa.Column("last_error", sa.Text(), nullable=True),
+            sa.Column("received_at", sa.DateTime(), nullable=True),
+            sa.Column("processed_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        op.create_index(
+            "ix_webhook_events_status_attempts", "webhook_events", ["status", "attempts", "received_at"]
+        )
+
+    indexes = {index["name"] for index in inspector.get_indexes("payments")}
+    if "ix_payments_stripe_payment_intent_id" not in indexes:
+        op.create_index("ix_payments_stripe_payment_intent_id", "payments", ["stripe_payment_intent_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_payments_stripe_payment_intent_id", table_name="payments")
+    op.drop_index("ix_webhook_events_status_attempts", table_name="webhook_events")
+    op.drop_table("webhook_events")
@@ -0,0 +1,74 @@
+"""create driver earnings ledger and payouts
+
+Revision ID: f6c1d2e9a7b5
+Revises: e3b8a6f1c2d4
+Create Date: 2026-10-19 21:05:19.774061
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision: str = 'f6c1d2e9a7b5'
+down_revision: Union[str, Sequence[str], None] = 'e3b8a6f1c2d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if "stripe_account_id" not in {column["name"] for column in inspector.get_columns("drivers")}:
+        op.add_column("drivers", sa.Column("stripe_account_id", sa.String(), nullable=True))
+
+    if "payouts" not in tables:
+        op.create_table(
+            "payouts",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("batch", sa.String(), nullable=False),
+            sa.Column("driver_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("destination", sa.String(), nullable=False),
+            sa.Column("amount", sa.Integer(), nullable=False),
+            sa.Column("currency", sa.String(), nullable=True),
+            sa.Column("status", sa.String(), nullable=True),
+            sa.Column("idempotency_key", sa.String(), nullable=False),
+            sa.Column("stripe_transfer_id", sa.String(), nullable=True),
+            sa.Column("attempts", sa.Integer(), nullable=True),
+            sa.Column("last_error", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("paid_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+            sa.UniqueConstraint("idempotency_key"),
+            sa.UniqueConstraint("batch", "driver_id"),
+        )
+        op.create_index("ix_payouts_id", "payouts", ["id"])
+        op.create_index("ix_payouts_batch_status", "payouts", ["batch", "status"])
+
+    if "driver_earnings" not in tables:
+        op.create_table(
+            "driver_earnings",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("ride_id", sa.Integer(), sa.ForeignKey("rides.id"), nullable=False),
+            sa.Column("driver_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+            sa.Column("gross", sa.Integer(), nullable=False),
+            sa.Column("commission", sa.Integer(), nullable=False),
+            sa.Column("net", sa.Integer(), nullable=False),
+            sa.Column("payout_id", sa.Integer(), sa.ForeignKey("payouts.id"), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+            sa.UniqueConstraint("ride_id"),
+        )
+        op.create_index("ix_driver_earnings_id", "driver_earnings", ["id"])
+        op.create_index("ix_driver_earnings_unpaid", "driver_earnings", ["payout_id", "driver_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("driver_earnings")
+    op.drop_table("payouts")
+    with op.batch_alter_table("drivers") as batch_op:
+        batch_op.drop_column("stripe_account_id")
@@ -0,0 +1,146 @@
+# Materialized hourly ride aggregates for the admin time-series charts
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+
+from models import Ride, Payment, RideHourlyAggregate, AggregateWatermark
+from spatial import city_for
+
+AGGREGATE_NAME = "ride_hourly_aggregates"
+# Rows are re-read this far behind the watermark so transactions that
+# committed late with an older updated_at are still picked up.
+REFRESH_OVERLAP = timedelta(minutes=5)
+REFRESH_BATCH_BUCKETS = 200
+
+GRANULARITIES = ("hour", "day")
+GROUPINGS = ("none", "vehicle_type", "zone")
+
+
+def hour_bucket(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+# ------------------------
+# Refresh
+# ------------------------
+def dirty_buckets(db: Session, since: Optional[datetime]) -> Set[datetime]:
+    """Hour buckets holding rides or payments that changed after `since`"""
+    ride_changes = select(Ride.created_at)
+    payment_changes = select(Ride.created_at).join(Payment, Payment.ride_id == Ride.id)
+    if since is not None:
+        ride_changes = ride_changes.where(Ride.updated_at > since)
+        payment_changes = payment_changes.where(Payment.updated_at > since)
+
+    buckets = set()
+    for statement in (ride_changes, payment_changes):
+        result = db.execute(statement.execution_options(stream_results=True, yield_per=5000))
+        buckets.update(hour_bucket(created_at) for created_at, in result if created_at)
+    return buckets
+
+
+def compute_buckets(db: Session, buckets: Iterable[datetime]) -> List[Dict]:
+    """Aggregate rows for the given hours, recomputed from rides and payments"""
+    rows: Dict[tuple, Dict] = {}
+    now = datetime.utcnow()
+    for bucket in sorted(buckets):
+        in_bucket = (Ride.created_at >= bucket, Ride.created_at < bucket + timedelta(hours=1))
+        paid_by_ride = dict(db.execute(
+            select(Payment.ride_id, func.sum(Payment.amount))
+            .join(Ride, Payment.ride_id == Ride.id)
+            .where(Payment.status == "completed", *in_bucket)
+            .group_by(Payment.ride_id)
+        ).all())
+        rides = db.execute(
+            select(
+                Ride.id, Ride.vehicle_type, Ride.status, Ride.pickup_lat, Ride.pickup_lng,
+                func.coalesce(Ride.fare_actual, Ride.fare_estimate)
+            ).where(*in_bucket)
+        )
+        for ride_id, vehicle_type, status, pickup_lat, pickup_lng, fare in rides:
+            key = (bucket, vehicle_type or "sedan", city_for(pickup_lat, pickup_lng))
+            row = rows.setdefault(key, {
+                "bucket_start": key[0], "vehicle_type": key[1], "zone": key[2],
+                "rides": 0, "completed": 0, "cancelled": 0,
+                "fare_sum": 0.0, "revenue": 0.0, "refreshed_at": now
+            })
+            row["rides"] += 1
+            row["revenue"] += paid_by_ride.get(ride_id, 0.0)
+            if status == "completed":
+                row["completed"] += 1
+                row["fare_sum"] += fare or 0.0
+            elif status == "cancelled":
+                row["cancelled"] += 1
+    return list(rows.values())
+
+
+def refresh_ride_aggregates(db: Session) -> Dict:
+    """Recompute only the hour buckets touched since the last refresh"""
+    refresh_started = datetime.utcnow()
+    watermark = db.get(AggregateWatermark, AGGREGATE_NAME)
+    since = watermark.refreshed_to - REFRESH_OVERLAP if watermark else None
+
+    buckets = sorted(dirty_buckets(db, since))
+    for start in range(0, len(buckets), REFRESH_BATCH_BUCKETS):
+        batch = buckets[start:start + REFRESH_BATCH_BUCKETS]
+        db.execute(delete(RideHourlyAggregate).where(RideHourlyAggregate.bucket_start.in_(batch)))
+        rows = compute_buckets(db, batch)
+        if rows:
+            db.execute(RideHourlyAggregate.__table__.insert(), rows)
+        db.commit()
+
+    if watermark is None:
+        watermark = AggregateWatermark(name=AGGREGATE_NAME, refreshed_to=refresh_started)
+        db.add(watermark)
+    else:
+        watermark.refreshed_to = refresh_started
+    db.commit()
+
+    return {"buckets_refreshed": len(buckets), "refreshed_to": refresh_started}
+
+
+# ------------------------
+# Queries
+# ------------------------
+def ride_timeseries(db: Session, start: datetime, end: datetime, granularity: str = "hour",
+                    group_by: str = "none", vehicle_type: Optional[str] = None,
+                    zone: Optional[str] = None) -> List[Dict]:
+    """Rides, revenue, cancellations and average fare per bucket in [start, end)"""
+    query = db.query(RideHourlyAggregate).filter(
+        RideHourlyAggregate.bucket_start >= hour_bucket(start),
+        RideHourlyAggregate.bucket_start < end
+    )
+    if vehicle_type:
+        query = query.filter(RideHourlyAggregate.vehicle_type == vehicle_type)
+    if zone:
+        query = query.filter(RideHourlyAggregate.zone == zone)
+
+    series: Dict[tuple, Dict] = {}
+    for row in query.order_by(RideHourlyAggregate.bucket_start):
+        bucket = row.bucket_start if granularity == "hour" else row.bucket_start.replace(hour=0)
+        group = getattr(row, group_by) if group_by != "none" else None
+        point = series.setdefault((bucket, group), {
+            "bucket": bucket, "rides": 0, "completed": 0, "cancelled": 0,
+            "revenue": 0.0, "fare_sum": 0.0
+        })
+        if group_by != "none":
+            point[group_by] = group
+        point["rides"] += row.rides
+        point["completed"] += row.completed
+        point["cancelled"] += row.cancelled
+        point["revenue"] += row.revenue
+        point["fare_sum"] += row.fare_sum
+
+    points = []
+    for point in series.values():
+        fare_sum = point.pop("fare_sum")
+        point["revenue"] = round(point["revenue"], 2)
+        point["avg_fare"] = round(fare_sum / point["completed"], 2) if point["completed"] else None
+        points.append(point)
+    return points
+
+
+def aggregates_refreshed_to(db: Session) -> Optional[datetime]:
+    watermark = db.get(AggregateWatermark, AGGREGATE_NAME)
+    return watermark.refreshed_to if watermark else None
@@ -1,21 +1,134 @@
-# Authentication middleware for Clerk/Supabase integration
-from fastapi import HTTPException, Depends
-from fastapi.security import HTTPBearer
+# Signed access tokens with cached verification
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
 import jwt
-import requests
+from fastapi import HTTPException, Depends
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+from metrics import cache_counters
+
+JWT_ALGORITHM = "HS256"
+JWT_ISSUER = os.getenv("JWT_ISSUER", "cab-booking")
+ACCESS_TOKEN_TTL = timedelta(minutes=int(os.getenv("ACCESS_TOKEN_TTL_MINUTES", "60")))
+# Publicly known, so only used when JWT_ALLOW_DEV_KEY=1 is set explicitly
+DEV_SIGNING_KEYS = "dev:insecure-development-secret-change-me"
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
 
 security = HTTPBearer()
+TOKEN_HIT, TOKEN_MISS = cache_counters("access_token")
+
+
+class KeyRing:
+    """Signing secrets by key id, parsed once per process"""
+
+    def __init__(self, spec: str):
+        self.keys: Dict[str, str] = {}
+        for pair in spec.split(","):
+            kid, _, secret = pair.strip().partition(":")
+            if not kid or not secret:
+                raise ValueError("JWT_SIGNING_KEYS must be comma-separated kid:secret pairs")
+            self.keys[kid] = secret
+        self.active_kid = next(iter(self.keys))
+
+    def signing_key(self) -> Tuple[str, str]:
+        return self.active_kid, self.keys[self.active_kid]
+
+    def verification_key(self, token: str) -> str:
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid not in self.keys:
+            raise jwt.InvalidTokenError(f"Unknown key id: {kid}")
+        return self.keys[kid]
+
+
+class TokenCache:
+    """Claims of recently verified tokens, kept until the token expires.
+
+    A hit skips the HMAC check and claim validation; tokens are opaque
+    strings here, so the cache key is the token itself.
+    """
+
+    def __init__(self, size: int = TOKEN_CACHE_SIZE):
+        self.size = size
+        self._claims: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()  # sync dependencies run in the threadpool
+
+    def get(self, token: str, now: float) -> Optional[Dict]:
+        with self._lock:
+            claims = self._claims.get(token)
+            if claims is None:
+                return None
+            if claims["exp"] <= now:
+                del self._claims[token]
+                return None
+            self._claims.move_to_end(token)
+            return claims
 
-def verify_token(token: str = Depends(security)):
-    """Verify JWT token - simplified for demo"""
+    def put(self, token: str, claims: Dict):
+        with self._lock:
+            self._claims[token] = claims
+            if len(self._claims) > self.size:
+                self._claims.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._claims.clear()
+
+
+def configured_signing_keys() -> str:
+    """Comma-separated kid:secret pairs, newest first. Tokens are signed with
+    the first key and verified with whichever key their kid names, so a new
+    key can be put in front while tokens signed with the old one expire."""
+    keys = os.getenv("JWT_SIGNING_KEYS")
+    if keys:
+        return keys
+    if os.getenv("JWT_ALLOW_DEV_KEY") == "1":
+        return DEV_SIGNING_KEYS
+    raise RuntimeError("JWT_SIGNING_KEYS is not set (JWT_ALLOW_DEV_KEY=1 allows the insecure development key)")
+
+
+JWT_SIGNING_KEYS = configured_signing_keys()
+key_ring = KeyRing(JWT_SIGNING_KEYS)
+token_cache = TokenCache()
+
+
+def create_access_token(user_id: int, role: str, email: Optional[str] = None,
+                        name: Optional[str] = None) -> str:
+    """Everything authorization needs travels in the token, so checking one needs no query"""
+    now = datetime.now(timezone.utc)
+    kid, secret = key_ring.signing_key()
+    claims = {
+        "sub": str(user_id), "role": role, "email": email, "name": name,
+        "iss": JWT_ISSUER, "iat": now, "exp": now + ACCESS_TOKEN_TTL,
+    }
+    return jwt.encode(claims, secret, algorithm=JWT_ALGORITHM, headers={"kid": kid})
+
+
+def decode_token(token: str) -> Dict:
+    """Verified claims of a token, from the cache when it was seen recently"""
+    claims = token_cache.get(token, time.time())
+    if claims is not None:
+        TOKEN_HIT.inc()
+        return claims
+    TOKEN_MISS.inc()
     try:
-        # Extract user ID from simple token format: token_userid_email
-        if token.credentials.startswith('token_'):
-            parts = token.credentials.split('_')
-            if len(parts) >= 2:
-                return int(parts[1])  # Return user ID
-        
-        # Fallback for demo
-        return 1
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid token")
\ No newline at end of file
+        claims = jwt.decode(token, key_ring.verification_key(token), algorithms=[JWT_ALGORITHM],
+                            issuer=JWT_ISSUER, options={"require": ["exp", "iat", "sub"]})
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.put(token, claims)
+    return claims
+
+
+def current_claims(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
+    return decode_token(credentials.credentials)
+
+
+def verify_token(claims: Dict = Depends(current_claims)) -> int:
+    """User id of a valid bearer token"""
+    return int(claims["sub"])
+
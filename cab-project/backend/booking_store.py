@@ -0,0 +1,172 @@
+# Record stores for the lightweight apps: in memory with secondary indexes, or SQLite
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+# Set to keep main_simple/main_advanced records in a SQLite file across restarts
+BOOKING_STORE_PATH = os.getenv("BOOKING_STORE_PATH")
+
+
+class MemoryRepository:
+    """Records by id, plus value -> ids indexes on the fields named in indexes.
+
+    Lookups by id or by indexed fields are dict hits instead of scans of
+    every record. Writes hold a lock, so ids are allocated exactly once
+    and indexes never disagree with the records. Records are returned as
+    copies; change them through update().
+    """
+
+    def __init__(self, indexes: Iterable[str] = ()):
+        self.indexed = tuple(indexes)
+        self._records: Dict[int, Dict] = {}
+        # field -> value -> ids, as an insertion-ordered dict used as a set
+        self._indexes: Dict[str, Dict[Any, Dict[int, None]]] = {field: {} for field in self.indexed}
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add(self, record: Dict) -> Dict:
+        with self._lock:
+            self._last_id += 1
+            record = {"id": self._last_id, **record}
+            self._records[record["id"]] = record
+            for field in self.indexed:
+                self._indexes[field].setdefault(record.get(field), {})[record["id"]] = None
+            return dict(record)
+
+    def get(self, record_id: int) -> Optional[Dict]:
+        record = self._records.get(record_id)
+        return dict(record) if record is not None else None
+
+    def update(self, record_id: int, **changes) -> Optional[Dict]:
+        with self._lock:
+            record = self._records.get(record_id)
+            if record is None:
+                return None
+            for field in self.indexed:
+                if field in changes and changes[field] != record.get(field):
+                    self._unindex(field, record.get(field), record_id)
+                    self._indexes[field].setdefault(changes[field], {})[record_id] = None
+            record.update(changes)
+            return dict(record)
+
+    def _unindex(self, field: str, value: Any, record_id: int):
+        ids = self._indexes[field][value]
+        del ids[record_id]
+        if not ids:
+            del self._indexes[field][value]
+
+    def find(self, **criteria) -> List[Dict]:
+        """Records matching every field=value, oldest first"""
+        indexed = [field for field in criteria if field in self._indexes]
+        if indexed:
+            with self._lock:
+                postings = sorted((self._indexes[field].get(criteria[field], {}) for field in indexed), key=len)
+                ids = [record_id for record_id in postings[0] if all(record_id in other for other in postings[1:])]
+            candidates = (self._records[record_id] for record_id in ids)
+        else:
+            candidates = list(self._records.values())
+        rest = [(field, value) for field, value in criteria.items() if field not in self._indexes]
+        return [dict(record) for record in candidates if all(record.get(field) == value for field, value in rest)]
+
+    def first(self, **criteria) -> Optional[Dict]:
+        found = self.find(**criteria)
+        return found[0] if found else None
+
+    def all(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        records = list(self._records.values())
+        end = None if limit is None else offset + limit
+        return [dict(record) for record in records[offset:end]]
+
+
+class SQLiteRepository:
+    """The same interface over a SQLite table: the record as JSON, indexed
+    fields copied into their own indexed columns"""
+
+    def __init__(self, path: str, table: str, indexes: Iterable[str] = ()):
+        self.table = table
+        self.indexed = tuple(indexes)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        columns = "".join(f", {field}" for field in self.indexed)
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL{columns})"
+        )
+        for field in self.indexed:
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_{field} ON {table} ({field}, id)")
+
+    def __len__(self) -> int:
+        return self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def add(self, record: Dict) -> Dict:
+        columns = "".join(f", {field}" for field in self.indexed)
+        placeholders = ", ?" * len(self.indexed)
+        with self._lock:
+            # AUTOINCREMENT allocates the id inside the insert, so concurrent
+            # processes sharing the file never hand out the same one
+            cursor = self._connection.execute(
+                f"INSERT INTO {self.table} (data{columns}) VALUES (?{placeholders})",
+                [json.dumps(record), *(record.get(field) for field in self.indexed)]
+            )
+        return {"id": cursor.lastrowid, **record}
+
+    def get(self, record_id: int) -> Optional[Dict]:
+        row = self._connection.execute(f"SELECT id, data FROM {self.table} WHERE id = ?", (record_id,)).fetchone()
+        return self._load(row) if row else None
+
+    def update(self, record_id: int, **changes) -> Optional[Dict]:
+        with self._lock:
+            # Read and write under one write lock on the file
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                record = self.get(record_id)
+                if record is not None:
+                    record.update(changes)
+                    data = {field: value for field, value in record.items() if field != "id"}
+                    assignments = "".join(f", {field} = ?" for field in self.indexed)
+                    self._connection.execute(
+                        f"UPDATE {self.table} SET data = ?{assignments} WHERE id = ?",
+                        [json.dumps(data), *(record.get(field) for field in self.indexed), record_id]
+                    )
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return record
+
+    def find(self, **criteria) -> List[Dict]:
+        indexed = [field for field in criteria if field in self.indexed]
+        where = " AND ".join(f"{field} IS ?" for field in indexed) or "1"
+        rows = self._connection.execute(
+            f"SELECT id, data FROM {self.table} WHERE {where} ORDER BY id", [criteria[field] for field in indexed]
+        )
+        rest = [(field, value) for field, value in criteria.items() if field not in self.indexed]
+        records = (self._load(row) for row in rows)
+        return [record for record in records if all(record.get(field) == value for field, value in rest)]
+
+    def first(self, **criteria) -> Optional[Dict]:
+        found = self.find(**criteria)
+        return found[0] if found else None
+
+    def all(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        rows = self._connection.execute(
+            f"SELECT id, data FROM {self.table} ORDER BY id LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)
+        )
+        return [self._load(row) for row in rows]
+
+    @staticmethod
+    def _load(row) -> Dict:
+        return {"id": row[0], **json.loads(row[1])}
+
+
+def make_repository(table: str, indexes: Iterable[str] = ()):
+    """SQLite-backed when BOOKING_STORE_PATH is set, in memory otherwise"""
+    if BOOKING_STORE_PATH:
+        return SQLiteRepository(BOOKING_STORE_PATH, table, indexes)
+    return MemoryRepository(indexes)
@@ -0,0 +1,155 @@
+# Response compression: brotli when the client takes it and it's installed, else gzip
+import os
+import zlib
+from typing import Optional
+
+from http_cache import request_header
+
+try:
+    import brotli
+except ImportError:  # optional; responses are gzipped without it
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Quality 4 compresses JSON about as well as gzip -9 at a fraction of the
+# CPU; 11 is for static assets built ahead of time
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSIBLE_TYPES = (
+    "application/json", "application/geo+json", "application/x-ndjson",
+    "application/javascript", "image/svg+xml", "text/",
+)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """br or gzip, whichever the client accepts (q > 0) and we can produce"""
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding:
+            accepted[coding] = q
+
+    def acceptable(coding: str) -> bool:
+        return accepted.get(coding, accepted.get("*", 0.0)) > 0
+
+    if brotli is not None and acceptable("br"):
+        return "br"
+    if acceptable("gzip"):
+        return "gzip"
+    return None
+
+
+class Encoder:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self.finish = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+
+class CompressionMiddleware:
+    """Compresses text-like responses of at least minimum_size bytes.
+
+    Whole bodies are compressed in one go with an exact Content-Length;
+    streamed ones (e.g. admin exports) are buffered up to minimum_size,
+    then compressed chunk by chunk. A compressed body is a different
+    representation, so its ETag is sent weak, which still matches the
+    strong one in If-None-Match.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE, content_types=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.content_types = tuple(content_types)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(request_header(scope, b"accept-encoding") or "")
+        await self.app(scope, receive, CompressingSender(self, encoding, send).send)
+
+    def compressible(self, message) -> bool:
+        if not 200 <= message["status"] < 300 or message["status"] == 204:
+            return False
+        headers = dict(message.get("headers", []))
+        content_type = headers.get(b"content-type", b"").decode("latin-1")
+        return b"content-encoding" not in headers and content_type.startswith(self.content_types)
+
+
+class CompressingSender:
+    def __init__(self, middleware: CompressionMiddleware, encoding: Optional[str], send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start = None
+        self.buffered = []
+        self.size = 0
+        self.encoder: Optional[Encoder] = None
+        self.passthrough = False
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            if not self.middleware.compressible(message):
+                self.passthrough = True
+                await self._send(message)
+                return
+            headers = [(name, value) for name, value in message.get("headers", []) if name != b"vary"]
+            vary = [value for name, value in message.get("headers", []) if name == b"vary"]
+            headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+            self.start = {**message, "headers": headers}
+            if self.encoding is None:
+                self.passthrough = True
+                await self._send(self.start)
+            return
+
+        if self.passthrough:
+            await self._send(message)
+            return
+        if self.encoder is not None:
+            await self.send_compressed(message.get("body", b""), message.get("more_body", False))
+            return
+
+        self.buffered.append(message.get("body", b""))
+        self.size += len(self.buffered[-1])
+        more_body = message.get("more_body", False)
+        if self.size < self.middleware.minimum_size:
+            if more_body:
+                return
+            # Too small to be worth it; send as is
+            await self._send(self.start)
+            await self._send({"type": "http.response.body", "body": b"".join(self.buffered)})
+            return
+
+        self.encoder = Encoder(self.encoding)
+        body = b"".join(self.buffered)
+        self.buffered = []
+        headers = [
+            (name, b"W/" + value if name == b"etag" and not value.startswith(b"W/") else value)
+            for name, value in self.start["headers"] if name != b"content-length"
+        ]
+        headers.append((b"content-encoding", self.encoding.encode()))
+        if not more_body:
+            compressed = self.encoder.compress(body) + self.encoder.finish()
+            headers.append((b"content-length", str(len(compressed)).encode()))
+            await self._send({**self.start, "headers": headers})
+            await self._send({"type": "http.response.body", "body": compressed})
+            return
+        await self._send({**self.start, "headers": headers})
+        await self.send_compressed(body, more_body)
+
+    async def send_compressed(self, body: bytes, more_body: bool):
+        chunk = self.encoder.compress(body)
+        if not more_body:
+            chunk += self.encoder.finish()
+        if chunk or not more_body:
+            await self._send({"type": "http.response.body", "body": chunk, "more_body": more_body})
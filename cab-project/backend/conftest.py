@@ -0,0 +1,4 @@
+# Test settings needed before the app modules are imported
+import os
+
+os.environ.setdefault("JWT_SIGNING_KEYS", "test:test-signing-secret-of-at-least-32-bytes")
@@ -1,11 +1,17 @@
 # Database configuration with asyncpg and psycopg2 support
 import os
+import time
+from contextlib import asynccontextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlmodel import SQLModel, Session
+from typing import Optional
 import asyncpg
 import psycopg2
+from metrics import DB_POOL_WAIT, instrument_engine
+from spatial import build_nearby_drivers_query, nearby_drivers_args
+from tracing import span, trace_engine
 
 # Database URLs
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./cab_booking.db")
@@ -31,6 +37,11 @@ async_engine = create_async_engine(
     pool_recycle=300
 )
 
+instrument_engine(engine, "database")
+instrument_engine(async_engine.sync_engine, "database_async")
+trace_engine(engine)
+trace_engine(async_engine.sync_engine)
+
 # Session makers
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 AsyncSessionLocal = sessionmaker(
@@ -67,6 +78,15 @@ class AsyncPGPool:
             )
         return self.pool
     
+    @asynccontextmanager
+    async def acquire(self):
+        """A pooled connection, recording how long the checkout waited"""
+        pool = await self.create_pool()
+        started = time.perf_counter()
+        async with pool.acquire() as connection:
+            DB_POOL_WAIT.labels("asyncpg").observe(time.perf_counter() - started)
+            yield connection
+    
     async def close_pool(self):
         """Close connection pool"""
         if self.pool:
@@ -79,8 +99,7 @@ pg_pool = AsyncPGPool()
 async def check_database_health():
     """Check database connectivity"""
     try:
-        pool = await pg_pool.create_pool()
-        async with pool.acquire() as connection:
+        async with pg_pool.acquire() as connection:
             await connection.fetchval("SELECT 1")
         return {"status": "healthy", "database": "connected"}
     except Exception as e:
@@ -101,33 +120,31 @@ def enable_postgis():
         print(f"Error enabling PostGIS: {e}")
 
 # Geospatial query helpers
-async def find_nearby_drivers_query(lat: float, lng: float, radius_km: float = 5.0):
-    """Find nearby drivers using PostGIS"""
-    query = """
-    SELECT d.id, d.user_id, u.name, 
-           ST_Distance(d.current_location, ST_Point($3, $2)) * 111.32 as distance_km
-    FROM drivers d
-    JOIN users u ON d.user_id = u.id
-    WHERE d.status = 'active' 
-    AND d.current_location IS NOT NULL
-    AND ST_DWithin(d.current_location, ST_Point($3, $2), $1 / 111.32)
-    ORDER BY distance_km
-    LIMIT 10;
-    """
+async def find_nearby_drivers_query(lat: float, lng: float, radius_km: float = 5.0,
+                                    vehicle_type: Optional[str] = None,
+                                    verified_only: bool = False, limit: int = 10):
+    """Find nearby drivers using PostGIS geography distance (nearest first)"""
+    query = build_nearby_drivers_query(vehicle_type, verified_only)
+    args = nearby_drivers_args(lat, lng, radius_km, limit, vehicle_type)
+    
+    async with pg_pool.acquire() as connection:
+        with span("db.query", statement="find_nearby_drivers"):
+            rows = await connection.fetch(query, *args)
     
-    pool = await pg_pool.create_pool()
-    async with pool.acquire() as connection:
-        return await connection.fetch(query, radius_km, lat, lng)
+    return [
+        {**dict(row), "distance_km": round(row["distance_meters"] / 1000, 3)}
+        for row in rows
+    ]
 
 async def update_driver_location(driver_id: int, lat: float, lng: float):
-    """Update driver location using PostGIS"""
+    """Update driver location (the drivers_sync_location trigger fills current_location)"""
     query = """
     UPDATE drivers 
-    SET current_location = ST_Point($2, $1), 
-        updated_at = NOW()
+    SET current_lat = $1,
+        current_lng = $2
     WHERE id = $3;
     """
     
-    pool = await pg_pool.create_pool()
-    async with pool.acquire() as connection:
-        await connection.execute(query, lat, lng, driver_id)
\ No newline at end of file
+    async with pg_pool.acquire() as connection:
+        with span("db.query", statement="update_driver_location"):
+            await connection.execute(query, lat, lng, driver_id)
\ No newline at end of file
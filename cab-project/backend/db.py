@@ -1,22 +1,57 @@
+from fastapi import Response
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from starlette.requests import HTTPConnection
 from dotenv import load_dotenv
 import os
 
+from metrics import instrument_engine
+from tracing import trace_engine
+from read_routing import SessionRouter, MAX_REPLICA_LAG_SECONDS, STICKY_SECONDS
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database.db")
+# Optional streaming replica for read-only endpoints (see read_routing.py)
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL")
+
+def make_engine(url):
+    if url.startswith("sqlite"):
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return create_engine(url)
 
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-else:
-    engine = create_engine(DATABASE_URL)
+engine = make_engine(DATABASE_URL)
+replica_engine = make_engine(REPLICA_DATABASE_URL) if REPLICA_DATABASE_URL else None
+instrument_engine(engine, "primary")
+trace_engine(engine)
+if replica_engine is not None:
+    instrument_engine(replica_engine, "replica")
+    trace_engine(replica_engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReplicaSessionLocal = (
+    sessionmaker(autocommit=False, autoflush=False, bind=replica_engine) if replica_engine else None
+)
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
+session_router = SessionRouter(
+    SessionLocal,
+    ReplicaSessionLocal,
+    max_lag=float(os.getenv("REPLICA_MAX_LAG_SECONDS", MAX_REPLICA_LAG_SECONDS)),
+    sticky_for=float(os.getenv("READ_YOUR_WRITES_SECONDS", STICKY_SECONDS)),
+)
+
+def get_db(connection: HTTPConnection = None, response: Response = None):
+    """Primary session; committing a write pins the caller's reads to the primary"""
+    db = session_router.write_session(connection, response)
+    try:
+        yield db
+    finally:
+        db.close()
+
+def get_read_db(connection: HTTPConnection = None):
+    """Session for read-only endpoints, served by the replica when it is safe to"""
+    db = session_router.read_session(connection)
     try:
         yield db
     finally:
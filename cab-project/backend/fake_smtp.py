@@ -0,0 +1,167 @@
+# Local debugging SMTP server used by the mailer tests and the email benchmark
+#
+#   python fake_smtp.py --handshake-latency 0.3 --emails 100
+#
+# starts the server, sends receipt-sized emails once with a new connection
+# per email (the old send_receipt_email) and once through the pooled mailer,
+# and reports emails per second for both.
+import argparse
+import base64
+import json
+import socketserver
+import threading
+import time
+from email import message_from_bytes, policy
+from typing import Dict, List, Optional
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough ESMTP for smtplib: EHLO, AUTH PLAIN, MAIL, RCPT, DATA, NOOP, RSET, QUIT"""
+
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        # Connection setup stands in for TCP + TLS negotiation latency
+        time.sleep(server.handshake_latency)
+        self.reply("220 fake-smtp ESMTP ready")
+        sender, recipients, delivered = None, [], 0
+
+        for raw in self.rfile:
+            command, _, argument = raw.decode().rstrip("\r\n").partition(" ")
+            command = command.upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250-fake-smtp\r\n250-AUTH PLAIN\r\n250 8BITMIME" if command == "EHLO" else "250 fake-smtp")
+            elif command == "AUTH":
+                time.sleep(server.handshake_latency)
+                credentials = argument.partition(" ")[2]
+                _, user, password = base64.b64decode(credentials).decode().split("\0")
+                if server.credentials and (user, password) != server.credentials:
+                    self.reply("535 5.7.8 authentication failed")
+                    continue
+                with server.lock:
+                    server.logins += 1
+                self.reply("235 2.7.0 authenticated")
+            elif command == "MAIL":
+                failure = server.next_failure()
+                if failure:
+                    self.reply(failure)
+                    continue
+                sender, recipients = argument.partition(":")[2].strip("<>"), []
+                self.reply("250 ok")
+            elif command == "RCPT":
+                recipients.append(argument.partition(":")[2].strip("<>"))
+                self.reply("250 ok")
+            elif command == "DATA":
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+                lines = []
+                for line in self.rfile:
+                    if line == b".\r\n":
+                        break
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                with server.lock:
+                    server.messages.append({
+                        "sender": sender, "recipients": recipients,
+                        "message": message_from_bytes(b"".join(lines), policy=policy.default)
+                    })
+                delivered += 1
+                self.reply("250 queued")
+                if server.max_messages_per_connection and delivered >= server.max_messages_per_connection:
+                    return  # drop the connection like servers that cap messages per session
+            elif command in ("NOOP", "RSET"):
+                self.reply("250 ok")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Accepts mail into `messages`; can fail MAIL commands and drop long sessions"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0, handshake_latency: float = 0.0, credentials=None,
+                 max_messages_per_connection: Optional[int] = None):
+        super().__init__(("127.0.0.1", port), FakeSMTPHandler)
+        self.handshake_latency = handshake_latency
+        self.credentials = credentials
+        self.max_messages_per_connection = max_messages_per_connection
+        self.lock = threading.Lock()
+        self.messages: List[Dict] = []
+        self.connections = 0
+        self.logins = 0
+        self.failures: List[str] = []
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "FakeSMTPServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def fail_next(self, reply: str, times: int = 1):
+        """Answer the next `times` MAIL commands with `reply` (e.g. "451 try again")"""
+        with self.lock:
+            self.failures.extend([reply] * times)
+
+    def next_failure(self) -> Optional[str]:
+        with self.lock:
+            return self.failures.pop(0) if self.failures else None
+
+
+def run_benchmark(server: FakeSMTPServer, emails: int) -> Dict:
+    import smtplib
+    from mailer import SMTPPool, build_message
+
+    pool = SMTPPool(host="127.0.0.1", port=server.port, username="bench", password="bench",
+                    starttls=False, rate_per_second=0)
+    messages = [
+        build_message(pool.sender, f"rider{index}@example.com", f"Ride Receipt - #{index}", "x" * 2000)
+        for index in range(emails)
+    ]
+
+    started = time.perf_counter()
+    for message in messages:
+        connection = smtplib.SMTP(pool.host, pool.port)
+        connection.login(pool.username, pool.password)
+        connection.send_message(message)
+        connection.quit()
+    unpooled = time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = pool.send_batch(messages)
+    pooled = time.perf_counter() - started
+    pool.close()
+
+    return {
+        "emails": emails,
+        "failed": sum(1 for result in results if result["status"] != "sent"),
+        "unpooled_per_second": round(emails / unpooled, 1),
+        "pooled_per_second": round(emails / pooled, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pooled mailer against the fake SMTP server")
+    parser.add_argument("--handshake-latency", type=float, default=0.3, help="seconds for greeting and login")
+    parser.add_argument("--emails", type=int, default=100)
+    args = parser.parse_args()
+
+    server = FakeSMTPServer(handshake_latency=args.handshake_latency).start()
+    try:
+        print(json.dumps(run_benchmark(server, args.emails), indent=2))
+    finally:
+        server.stop()
@@ -0,0 +1,213 @@
+# Local stand-in for the Stripe API used by tests and the payment benchmark
+#
+#   python fake_stripe.py --latency 0.8 --calls 200
+#
+# starts the fake server, fires concurrent PaymentIntent creations through
+# StripePaymentService and reports throughput and the worst event-loop stall.
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlparse
+
+
+def parse_form(body: str) -> Dict:
+    """Decode Stripe's form encoding, nesting one level of key[sub] fields"""
+    params: Dict = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        match = re.fullmatch(r"(\w+)\[(\w+)\]", key)
+        if match:
+            params.setdefault(match.group(1), {})[match.group(2)] = value
+        else:
+            params[key] = value
+    return params
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method: str):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode() if length else url.query
+        params = parse_form(body)
+        time.sleep(self.server.latency)
+
+        idempotency_key = self.headers.get("Idempotency-Key")
+        with self.server.lock:
+            self.server.requests.append((method, url.path, params))
+            if idempotency_key and idempotency_key in self.server.idempotent:
+                status, payload = self.server.idempotent[idempotency_key]
+            else:
+                status, payload = self.server.route(method, url.path, params)
+                if idempotency_key and method == "POST":
+                    self.server.idempotent[idempotency_key] = (status, payload)
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    """In-memory Stripe objects behind the handful of endpoints the app calls"""
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0):
+        super().__init__(("127.0.0.1", port), FakeStripeHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = []
+        self.idempotent: Dict[str, tuple] = {}
+        self.objects: Dict[str, Dict] = {}
+        self.declined_destinations = set()  # transfers to these fail as with an empty platform balance
+        self.ids = itertools.count(1)
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeStripeServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def new_object(self, prefix: str, kind: str, **fields) -> Dict:
+        obj = {"id": f"{prefix}_{next(self.ids):08d}", "object": kind, "livemode": False, **fields}
+        self.objects[obj["id"]] = obj
+        return obj
+
+    def route(self, method: str, path: str, params: Dict):
+        if method == "POST" and path == "/v1/payment_intents":
+            intent = self.new_object(
+                "pi", "payment_intent", amount=int(params["amount"]), currency=params["currency"],
+                status="requires_payment_method", metadata=params.get("metadata", {})
+            )
+            intent["client_secret"] = f"{intent['id']}_secret_fake"
+            return 200, intent
+
+        match = re.fullmatch(r"/v1/payment_intents/(\w+)/confirm", path)
+        if method == "POST" and match:
+            intent = self.objects.get(match.group(1))
+            if not intent:
+                return self.not_found(match.group(1))
+            intent["status"] = "succeeded"
+            return 200, intent
+
+        if method == "POST" and path == "/v1/customers":
+            return 200, self.new_object(
+                "cus", "customer", email=params.get("email"), name=params.get("name"),
+                phone=params.get("phone"), metadata=params.get("metadata", {})
+            )
+
+        if method == "POST" and path == "/v1/setup_intents":
+            setup_intent = self.new_object("seti", "setup_intent", customer=params.get("customer"))
+            setup_intent["client_secret"] = f"{setup_intent['id']}_secret_fake"
+            return 200, setup_intent
+
+        if method == "GET" and path == "/v1/payment_methods":
+            card = {"brand": "visa", "last4": "4242", "exp_month": 12, "exp_year": 2030}
+            return 200, {
+                "object": "list", "url": path, "has_more": False,
+                "data": [{"id": "pm_fake", "object": "payment_method", "card": card}]
+            }
+
+        if method == "POST" and path == "/v1/refunds":
+            intent = self.objects.get(params.get("payment_intent"))
+            if not intent:
+                return self.not_found(params.get("payment_intent"))
+            amount = int(params.get("amount") or intent["amount"])
+            return 200, self.new_object(
+                "re", "refund", amount=amount, status="succeeded", reason=None,
+                payment_intent=intent["id"]
+            )
+
+        if method == "POST" and path == "/v1/transfers":
+            if params["destination"] in self.declined_destinations:
+                return 400, {"error": {
+                    "type": "invalid_request_error", "code": "balance_insufficient",
+                    "message": "You have insufficient available funds in your Stripe account."
+                }}
+            return 200, self.new_object(
+                "tr", "transfer", amount=int(params["amount"]), currency=params["currency"],
+                destination=params["destination"], metadata=params.get("metadata", {})
+            )
+
+        return 404, {"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL ({method}: {path})"}}
+
+    @staticmethod
+    def not_found(object_id):
+        return 404, {"error": {
+            "type": "invalid_request_error", "code": "resource_missing",
+            "message": f"No such object: '{object_id}'"
+        }}
+
+
+# ------------------------
+# Benchmark
+# ------------------------
+async def measure_loop_stall(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """Worst delay past `interval` seen by a ticker task while calls run"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def run_benchmark(calls: int) -> Dict:
+    from stripe_integration import stripe_service
+
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_loop_stall(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(stripe_service.create_payment_intent(amount=250.0) for _ in range(calls)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return {
+        "calls": calls,
+        "seconds": round(elapsed, 3),
+        "calls_per_second": round(calls / elapsed, 1),
+        "max_loop_stall_ms": round(await ticker * 1000, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark StripePaymentService against the fake Stripe API")
+    parser.add_argument("--latency", type=float, default=0.8, help="seconds per fake Stripe call")
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    import stripe
+    import stripe_integration  # noqa: F401  (applies the env configuration first)
+
+    server = FakeStripeServer(latency=args.latency).start()
+    stripe.api_base = server.url
+    stripe.api_key = stripe.api_key or "sk_test_fake"
+    try:
+        print(json.dumps(asyncio.run(run_benchmark(args.calls)), indent=2))
+    finally:
+        server.stop()
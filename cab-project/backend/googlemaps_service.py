@@ -3,6 +3,13 @@ import os
 from typing import Dict, List, Tuple, Optional
 from datetime import datetime
 
+import structlog
+
+from metrics import external_call
+from tracing import traced
+
+log = structlog.get_logger(__name__)
+
 class GoogleMapsService:
     def __init__(self):
         self.api_key = os.getenv("GOOGLE_MAPS_API_KEY", "eyJvcmciOiI1YjNjZTM1OTc4NTExMTAwMDFjZjYyNDgiLCJpZCI6IjliMDVkNDkyOGJiNjQ2Yjc5OTk4Y2RlYjYyMWJlZmI0IiwiaCI6Im11cm11cjY0In0=")
@@ -14,30 +21,34 @@ class GoogleMapsService:
         except Exception:
             self.client = None
     
+    @traced("maps.geocode")
     def get_coordinates(self, address: str) -> Optional[Tuple[float, float]]:
         """Get latitude and longitude from address"""
         if self.client:
             try:
-                geocode_result = self.client.geocode(address)
+                with external_call("google_maps", "geocode"):
+                    geocode_result = self.client.geocode(address)
                 if geocode_result:
                     location = geocode_result[0]['geometry']['location']
                     return (location['lat'], location['lng'])
             except Exception as e:
-                print(f"Geocoding error: {e}")
+                log.warning("geocoding_failed", address=address, error=str(e))
         
         # Mock coordinates for demo
         import random
         return (28.6139 + random.uniform(-0.1, 0.1), 77.2090 + random.uniform(-0.1, 0.1))
     
+    @traced("maps.reverse_geocode")
     def get_address(self, lat: float, lng: float) -> Optional[str]:
         """Get address from coordinates"""
         if self.client:
             try:
-                reverse_geocode_result = self.client.reverse_geocode((lat, lng))
+                with external_call("google_maps", "reverse_geocode"):
+                    reverse_geocode_result = self.client.reverse_geocode((lat, lng))
                 if reverse_geocode_result:
                     return reverse_geocode_result[0]['formatted_address']
             except Exception as e:
-                print(f"Reverse geocoding error: {e}")
+                log.warning("reverse_geocoding_failed", lat=lat, lng=lng, error=str(e))
         
         # Mock address for demo
         return f"Address near {lat:.4f}, {lng:.4f}"
@@ -0,0 +1,153 @@
+# Pre-serialized responses with strong ETags, and conditional GET for dynamic ones
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+
+from metrics import cache_counters
+
+# Responses that only depend on the query string (or nothing at all)
+STATIC_PATHS = ("/api/vehicle-types", "/cabs", "/api/maps/config")
+
+Headers = List[Tuple[bytes, bytes]]
+
+STATIC_HIT, STATIC_MISS = cache_counters("static_response")
+# A hit is a 304: the client's copy was still current
+CONDITIONAL_HIT, CONDITIONAL_MISS = cache_counters("conditional_get")
+
+
+def make_etag(body: bytes) -> str:
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses weak comparison, so W/"x" matches "x" """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in (candidate.removeprefix("W/") for candidate in candidates)
+
+
+def request_header(scope, name: bytes) -> Optional[str]:
+    for header, value in scope["headers"]:
+        if header == name:
+            return value.decode("latin-1")
+    return None
+
+
+class CachedResponse:
+    def __init__(self, status: int, headers: Headers, body: bytes):
+        self.body = body
+        self.etag = make_etag(body)
+        validators = [(b"etag", self.etag.encode()), (b"cache-control", b"no-cache")]
+        self.not_modified_headers = validators
+        self.headers = [
+            (name, value) for name, value in headers if name not in (b"content-length", b"etag", b"cache-control")
+        ] + validators + [(b"content-length", str(len(body)).encode())]
+        self.status = status
+
+    async def send(self, scope, send):
+        if etag_matches(request_header(scope, b"if-none-match"), self.etag):
+            await send({"type": "http.response.start", "status": 304, "headers": self.not_modified_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.start", "status": self.status, "headers": self.headers})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class StaticResponseCache:
+    """Serves GETs of the given paths from bytes rendered once per query string.
+
+    The first request runs the handler; later ones, and the 304s for
+    clients that send the ETag back, never reach it. Entries are kept per
+    (path, query string), least recently used dropped past max_entries,
+    since clients choose the query strings. Only plain 200s without
+    cookies are kept.
+    """
+
+    def __init__(self, app, paths: Iterable[str] = STATIC_PATHS, max_entries: int = 256):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, bytes], CachedResponse]" = OrderedDict()
+
+    def clear(self):
+        self._entries.clear()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        key = (scope["path"], scope["query_string"])
+        cached = self._entries.get(key)
+        if cached is not None:
+            STATIC_HIT.inc()
+            self._entries.move_to_end(key)
+            await cached.send(scope, send)
+            return
+        STATIC_MISS.inc()
+
+        start = {}
+        chunks = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            else:
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+        body = b"".join(chunks)
+        headers = list(start.get("headers", []))
+        if start.get("status") != 200 or any(name == b"set-cookie" for name, _ in headers):
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        cached = self._entries[key] = CachedResponse(200, headers, body)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        await cached.send(scope, send)
+
+
+def not_modified_since(if_modified_since: Optional[str], last_modified: Optional[datetime]) -> bool:
+    if not if_modified_since or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is not None:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    return last_modified.replace(microsecond=0) <= since
+
+
+def conditional_json(request: Request, payload: Any, last_modified: Optional[datetime] = None,
+                     headers: Optional[Dict[str, str]] = None) -> Response:
+    """payload as JSON with an ETag (and Last-Modified, in naive UTC), or a
+    bare 304 when the client's copy is still current.
+
+    The body is still built, but an unchanged poll costs no bandwidth.
+    If-None-Match wins over If-Modified-Since when both are sent.
+    """
+    body = ORJSONResponse(jsonable_encoder(payload)).body
+    validators = {**(headers or {}), "ETag": make_etag(body), "Cache-Control": "no-cache"}
+    if last_modified is not None:
+        validators["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = etag_matches(if_none_match, validators["ETag"])
+    else:
+        fresh = not_modified_since(request.headers.get("if-modified-since"), last_modified)
+    if fresh:
+        CONDITIONAL_HIT.inc()
+        return Response(status_code=304, headers=validators)
+    CONDITIONAL_MISS.inc()
+    return Response(body, media_type="application/json", headers=validators)
@@ -4,6 +4,14 @@ from typing import Dict, List, Tuple, Optional
 import random
 import math
 
+import structlog
+
+from metrics import external_call
+from spatial import CITY_CENTERS, haversine_km
+from tracing import traced
+
+log = structlog.get_logger(__name__)
+
 class LeafletMapService:
     def __init__(self):
         # Leaflet doesn't need API key for basic maps
@@ -17,6 +25,7 @@ class LeafletMapService:
         # For geocoding, we can use Nominatim (free) or other services
         self.nominatim_url = "https://nominatim.openstreetmap.org"
     
+    @traced("maps.geocode")
     def get_coordinates(self, address: str) -> Optional[Tuple[float, float]]:
         """Get latitude and longitude from address using Nominatim"""
         try:
@@ -26,7 +35,8 @@ class LeafletMapService:
                 'limit': 1
             }
             
-            response = requests.get(f"{self.nominatim_url}/search", params=params)
+            with external_call("nominatim", "search"):
+                response = requests.get(f"{self.nominatim_url}/search", params=params)
             if response.status_code == 200:
                 data = response.json()
                 if data:
@@ -36,9 +46,10 @@ class LeafletMapService:
             return self._get_mock_coordinates(address)
             
         except Exception as e:
-            print(f"Geocoding error: {e}")
+            log.warning("geocoding_failed", address=address, error=str(e))
             return self._get_mock_coordinates(address)
     
+    @traced("maps.reverse_geocode")
     def get_address(self, lat: float, lng: float) -> Optional[str]:
         """Get address from coordinates using reverse geocoding"""
         try:
@@ -48,7 +59,8 @@ class LeafletMapService:
                 'format': 'json'
             }
             
-            response = requests.get(f"{self.nominatim_url}/reverse", params=params)
+            with external_call("nominatim", "reverse"):
+                response = requests.get(f"{self.nominatim_url}/reverse", params=params)
             if response.status_code == 200:
                 data = response.json()
                 return data.get('display_name', f"Location at {lat:.4f}, {lng:.4f}")
@@ -56,7 +68,7 @@ class LeafletMapService:
             return f"Location at {lat:.4f}, {lng:.4f}"
             
         except Exception as e:
-            print(f"Reverse geocoding error: {e}")
+            log.warning("reverse_geocoding_failed", lat=lat, lng=lng, error=str(e))
             return f"Location at {lat:.4f}, {lng:.4f}"
     
     def calculate_distance_duration(self, origin_lat: float, origin_lng: float, 
@@ -87,6 +99,7 @@ class LeafletMapService:
             'end_address': f"{dest_lat:.4f}, {dest_lng:.4f}"
         }
     
+    @traced("maps.route")
     def get_route(self, origin_lat: float, origin_lng: float, 
                   dest_lat: float, dest_lng: float) -> Dict:
         """Get route coordinates for drawing on map"""
@@ -98,7 +111,8 @@ class LeafletMapService:
                 'geometries': 'geojson'
             }
             
-            response = requests.get(url, params=params)
+            with external_call("osrm", "route"):
+                response = requests.get(url, params=params)
             if response.status_code == 200:
                 data = response.json()
                 if data['routes']:
@@ -117,7 +131,7 @@ class LeafletMapService:
             }
             
         except Exception as e:
-            print(f"Routing error: {e}")
+            log.warning("routing_failed", error=str(e))
             return {
                 'coordinates': [[origin_lng, origin_lat], [dest_lng, dest_lat]],
                 'distance': self._haversine_distance(origin_lat, origin_lng, dest_lat, dest_lng) * 1000,
@@ -155,37 +169,13 @@ class LeafletMapService:
     
     def _haversine_distance(self, lat1: float, lng1: float, lat2: float, lng2: float) -> float:
         """Calculate distance between two coordinates using Haversine formula"""
-        R = 6371  # Earth's radius in kilometers
-        
-        lat1_rad = math.radians(lat1)
-        lat2_rad = math.radians(lat2)
-        delta_lat = math.radians(lat2 - lat1)
-        delta_lng = math.radians(lng2 - lng1)
-        
-        a = (math.sin(delta_lat / 2) ** 2 + 
-             math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lng / 2) ** 2)
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        
-        return R * c
+        return haversine_km(lat1, lng1, lat2, lng2)
     
     def _get_mock_coordinates(self, address: str) -> Tuple[float, float]:
         """Generate mock coordinates based on address"""
-        # Major Indian cities coordinates
-        city_coords = {
-            'jaipur': (26.9124, 75.7873),
-            'indore': (22.7196, 75.8577),
-            'mumbai': (19.0760, 72.8777),
-            'delhi': (28.6139, 77.2090),
-            'bangalore': (12.9716, 77.5946),
-            'chennai': (13.0827, 80.2707),
-            'kolkata': (22.5726, 88.3639),
-            'hyderabad': (17.3850, 78.4867),
-            'pune': (18.5204, 73.8567),
-            'ahmedabad': (23.0225, 72.5714)
-        }
-        
         address_lower = address.lower()
-        for city, coords in city_coords.items():
+        # Major Indian cities (the service zones in spatial.py)
+        for city, coords in CITY_CENTERS.items():
             if city in address_lower:
                 return coords
         
@@ -0,0 +1,239 @@
+# Pooled SMTP delivery: persistent connections, rate shaping and retries
+import mimetypes
+import os
+import queue
+import random
+import smtplib
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.message import EmailMessage
+from typing import Dict, Iterator, List, Optional
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_EMAIL = os.getenv("SMTP_EMAIL")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))  # connections per worker process
+SMTP_RATE_PER_SECOND = float(os.getenv("SMTP_RATE_PER_SECOND", "10"))  # 0 disables shaping
+SMTP_TIMEOUT_SECONDS = float(os.getenv("SMTP_TIMEOUT_SECONDS", "30"))
+SMTP_MAX_RETRIES = 3
+SMTP_RETRY_BACKOFF = 1.0  # seconds before the first retry, doubled each time
+# Many providers end sessions after this many messages; reconnect before they do
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+# Idle connections older than this are checked with NOOP before reuse
+SMTP_IDLE_CHECK_SECONDS = 30
+
+
+def build_message(sender: str, recipient: str, subject: str, body: str,
+                  attachments: Optional[List[str]] = None) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(body)
+    for path in attachments or []:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        maintype, subtype = content_type.split("/", 1)
+        with open(path, "rb") as attachment:
+            message.add_attachment(attachment.read(), maintype=maintype, subtype=subtype,
+                                   filename=os.path.basename(path))
+    return message
+
+
+def is_transient(error: Exception) -> bool:
+    """4xx replies and dropped connections are worth retrying; 5xx replies
+    and other SMTP errors (e.g. no usable AUTH method) are not"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # SMTPException subclasses OSError, so it is ruled out before the network errors
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+def keeps_connection(error: Exception) -> bool:
+    """Rejections leave the session usable (smtplib already sent RSET)"""
+    return isinstance(error, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)) and not (
+        isinstance(error, smtplib.SMTPResponseException) and error.smtp_code == 421  # server closing
+    )
+
+
+class RateLimiter:
+    """Token bucket shared by the pool's threads: `rate` sends/second, bursts of `burst`"""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PooledConnection:
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+
+class SMTPPool:
+    """Up to `size` authenticated SMTP sessions reused across sends.
+
+    Connecting, STARTTLS and AUTH cost several round trips; a pooled
+    session pays them once per SMTP_MAX_MESSAGES_PER_CONNECTION messages
+    instead of once per email. Safe to share between threads; create it
+    per process (connections must not cross a fork).
+    """
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, username: Optional[str] = SMTP_EMAIL,
+                 password: Optional[str] = SMTP_PASSWORD, starttls: bool = SMTP_STARTTLS,
+                 size: int = SMTP_POOL_SIZE, rate_per_second: float = SMTP_RATE_PER_SECOND,
+                 max_retries: int = SMTP_MAX_RETRIES, retry_backoff: float = SMTP_RETRY_BACKOFF,
+                 timeout: float = SMTP_TIMEOUT_SECONDS, sender: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.sender = sender or username or "no-reply@localhost"
+        self.limiter = RateLimiter(rate_per_second)
+        self._idle: "queue.LifoQueue[PooledConnection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self) -> PooledConnection:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls(context=ssl.create_default_context())
+            if self.username and self.password:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        return PooledConnection(smtp)
+
+    def checkout(self) -> PooledConnection:
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if time.monotonic() - pooled.last_used < SMTP_IDLE_CHECK_SECONDS:
+                return pooled
+            try:
+                if pooled.smtp.noop()[0] == 250:
+                    return pooled
+            except Exception:
+                pass
+            pooled.close()
+
+    @contextmanager
+    def connection(self):
+        """A live session for one send; returned to the pool unless it broke"""
+        with self._slots:
+            pooled = self.checkout()
+            try:
+                yield pooled
+            except Exception as e:
+                if keeps_connection(e):
+                    self.release(pooled)
+                else:
+                    pooled.smtp.close()
+                raise
+            self.release(pooled)
+
+    def release(self, pooled: PooledConnection):
+        pooled.last_used = time.monotonic()
+        if pooled.sent >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+            pooled.close()
+        else:
+            self._idle.put(pooled)
+
+    def send(self, message: EmailMessage) -> Dict:
+        """Deliver one message, retrying transient failures with jittered backoff"""
+        for attempt in range(1, self.max_retries + 2):
+            self.limiter.acquire()
+            try:
+                with self.connection() as pooled:
+                    pooled.smtp.send_message(message)
+                    pooled.sent += 1
+                return {"to": message["To"], "status": "sent", "attempts": attempt}
+            except Exception as e:
+                if attempt > self.max_retries or not is_transient(e):
+                    return {"to": message["To"], "status": "failed", "attempts": attempt, "error": str(e)}
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+    def send_each(self, messages: List[EmailMessage]) -> Iterator[Dict]:
+        """Send messages over the pool's connections in parallel, yielding
+        results in order, each as soon as it (and those before it) is done"""
+        if len(messages) <= 1 or self.size <= 1:
+            for message in messages:
+                yield self.send(message)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.size, len(messages))) as executor:
+            yield from executor.map(self.send, messages)
+
+    def send_batch(self, messages: List[EmailMessage]) -> List[Dict]:
+        """Send messages over the pool's connections in parallel, results in order"""
+        return list(self.send_each(messages))
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool: Optional[SMTPPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_mailer() -> SMTPPool:
+    """This process's pool, created on first use (i.e. after a worker forks)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SMTPPool()
+        return _pool
+
+
+def close_mailer():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -1,26 +1,42 @@
 from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from http_cache import StaticResponseCache, conditional_json
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware, SOCKET_CONNECTIONS, router as metrics_router
+from tracing import TracingMiddleware, configure_logging
+from security import RateLimitMiddleware
 from sqlalchemy.orm import Session
 
 import stripe
+import asyncio
 import json
 from typing import Dict
-from db import engine, get_db
+from db import engine, get_db, get_read_db
 from models import Base, User, Driver, Ride, Payment
 from schemas import *
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-from auth import verify_token
+from starlette.concurrency import run_in_threadpool
+from auth import verify_token, create_access_token, decode_token
+from passwords import hasher, hash_password, verify_password
 from services import get_fare_estimate, get_directions
 from admin_routes import router as admin_router
 from payment_routes import router as payment_router
 from map_routes import router as map_router
+from webhooks import ingest_webhook
+import notifications
 
 # Create all tables
 Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Cab Booking API")
+configure_logging()
+
+app = FastAPI(title="Cab Booking API", default_response_class=ORJSONResponse)
+
+# Static payloads are serialized once and revalidated by ETag
+app.add_middleware(StaticResponseCache)
+
+# Added before CORS so rejections still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,8 +44,36 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Request-ID"],
 )
 
+# Outermost, so everything below (CORS and cached responses included) is compressed
+app.add_middleware(CompressionMiddleware)
+
+# Outside compression too, so latency covers the whole response
+app.add_middleware(MetricsMiddleware)
+
+# Outermost: the request ID is bound before anything else logs
+app.add_middleware(TracingMiddleware)
+
+@app.on_event("startup")
+async def start_notification_relay():
+    # Pushes for notifications written by Celery workers arrive over Redis
+    app.state.notification_relay = None
+    if notifications.REDIS_URL:
+        app.state.notification_relay = asyncio.create_task(notifications.hub.relay_from_redis())
+
+@app.on_event("shutdown")
+async def stop_notification_relay():
+    relay = app.state.notification_relay
+    if relay is not None:
+        relay.cancel()
+        await asyncio.gather(relay, return_exceptions=True)
+
+@app.on_event("shutdown")
+def stop_password_workers():
+    hasher.close()
+
 # Include admin routes
 app.include_router(admin_router)
 
@@ -39,6 +83,9 @@ app.include_router(payment_router)
 # Include map routes
 app.include_router(map_router)
 
+# Prometheus scrape endpoint
+app.include_router(metrics_router)
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
@@ -46,10 +93,12 @@ class ConnectionManager:
     async def connect(self, websocket: WebSocket, client_id: str):
         await websocket.accept()
         self.active_connections[client_id] = websocket
+        SOCKET_CONNECTIONS.labels("websocket").inc()
     
     def disconnect(self, client_id: str):
         if client_id in self.active_connections:
             del self.active_connections[client_id]
+            SOCKET_CONNECTIONS.labels("websocket").dec()
     
     async def send_personal_message(self, message: str, client_id: str):
         if client_id in self.active_connections:
@@ -57,12 +106,19 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+def find_user(db: Session, email: str):
+    return db.query(User).filter(User.email == email).first()
+
+def save_user(db: Session, user: User):
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+
 @app.post("/api/auth/register")
-def register_user(user_data: dict, db: Session = Depends(get_db)):
+async def register_user(user_data: dict, db: Session = Depends(get_db)):
     """Register new user"""
     # Check if user already exists
-    existing_user = db.query(User).filter(User.email == user_data['email']).first()
-    if existing_user:
+    if await run_in_threadpool(find_user, db, user_data['email']):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create new user
@@ -71,23 +127,27 @@ def register_user(user_data: dict, db: Session = Depends(get_db)):
         email=user_data['email'],
         phone=user_data['phone'],
         role=user_data['role'],
-        password=user_data['password']  # In production, hash this!
+        password=await hash_password(user_data['password'])
     )
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    await run_in_threadpool(save_user, db, user)
     
     return {"message": "User registered successfully", "user_id": user.id}
 
 @app.post("/api/auth/login")
-def login_user(credentials: dict, db: Session = Depends(get_db)):
+async def login_user(credentials: dict, db: Session = Depends(get_db)):
     """Login user"""
-    user = db.query(User).filter(User.email == credentials['email']).first()
-    if not user or user.password != credentials['password']:  # In production, verify hash!
+    user = await run_in_threadpool(find_user, db, credentials['email'])
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    valid, rehashed = await verify_password(credentials['password'], user.password)
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if rehashed:
+        # Stored before hashing (or with an older scheme); upgrade it now
+        user.password = rehashed
+        await run_in_threadpool(save_user, db, user)
     
-    # Generate token (simplified)
-    token = f"token_{user.id}_{user.email}"
+    token = create_access_token(user.id, user.role, user.email, user.name)
     
     return {
         "access_token": token,
@@ -106,16 +166,10 @@ def get_vehicle_types():
     return VEHICLE_TYPES
 
 @app.post("/api/auth/session")
-def verify_session(token: str, db: Session = Depends(get_db)):
-    """Verify token from Clerk/Supabase"""
-    try:
-        user_id = verify_token(token)
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        return {"user_id": user.id, "role": user.role, "name": user.name}
-    except Exception:
-        raise HTTPException(status_code=401, detail="Invalid session")
+def verify_session(token: str):
+    """Verify an access token; the claims carry the user, so no lookup is needed"""
+    claims = decode_token(token)
+    return {"user_id": int(claims["sub"]), "role": claims["role"], "name": claims.get("name")}
 
 @app.post("/api/rides/request")
 def request_ride(ride_data: RideRequest, user_id: int = Depends(verify_token), db: Session = Depends(get_db)):
@@ -165,57 +219,31 @@ def get_fare_estimate_endpoint(origin: str, dest: str):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/rides/{ride_id}/status")
-def get_ride_status(ride_id: int, db: Session = Depends(get_db)):
-    """Poll ride status"""
+def get_ride_status(ride_id: int, request: Request, db: Session = Depends(get_read_db)):
+    """Poll ride status; unchanged polls get 304 (ETag / Last-Modified)"""
     ride = db.query(Ride).filter(Ride.id == ride_id).first()
     if not ride:
         raise HTTPException(status_code=404, detail="Ride not found")
     
-    return {
+    return conditional_json(request, {
         "ride_id": ride.id,
         "status": ride.status,
         "driver_id": ride.driver_id,
         "driver_eta": ride.driver_eta,
         "fare_actual": ride.fare_actual
-    }
+    }, last_modified=ride.updated_at)
 
 @app.post("/api/webhooks/stripe")
-async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
-    """Stripe webhook for payment events"""
+async def stripe_webhook(request: Request):
+    """Stripe webhook for payment events: verified, queued, acknowledged"""
     payload = await request.body()
-    sig_header = request.headers.get('stripe-signature')
-    
-    try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, "your_webhook_secret"
-        )
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid payload")
-    except stripe.error.SignatureVerificationError:
-        raise HTTPException(status_code=400, detail="Invalid signature")
-    
-    if event['type'] == 'payment_intent.succeeded':
-        payment_intent = event['data']['object']
-        payment = db.query(Payment).filter(
-            Payment.stripe_payment_intent_id == payment_intent['id']
-        ).first()
-        
-        if payment:
-            payment.status = "completed"
-            payment.webhook_received = True
-            
-            ride = db.query(Ride).filter(Ride.id == payment.ride_id).first()
-            if ride:
-                ride.status = "completed"
-            
-            db.commit()
-    
-    return {"status": "success"}
+    return await ingest_webhook(payload, request.headers.get("stripe-signature"))
 
 @app.websocket("/ws/driver/{driver_id}")
 async def driver_websocket(websocket: WebSocket, driver_id: str, db: Session = Depends(get_db)):
     """Driver socket to receive requests and send location"""
     await manager.connect(websocket, f"driver_{driver_id}")
+    notifications.hub.register(int(driver_id), websocket.send_text)
     
     driver = db.query(Driver).filter(Driver.user_id == int(driver_id)).first()
     if driver:
@@ -240,6 +268,7 @@ async def driver_websocket(websocket: WebSocket, driver_id: str, db: Session = D
                 if ride:
                     ride.driver_id = int(driver_id)
                     ride.status = "accepted"
+                    notifications.stage(db, [notifications.ride_update_event(ride, "A driver accepted your ride")])
                     db.commit()
                     
                     await manager.send_personal_message(
@@ -249,6 +278,7 @@ async def driver_websocket(websocket: WebSocket, driver_id: str, db: Session = D
     
     except WebSocketDisconnect:
         manager.disconnect(f"driver_{driver_id}")
+        notifications.hub.unregister(int(driver_id), websocket.send_text)
         if driver:
             driver.status = "offline"
             driver.socket_id = None
@@ -258,6 +288,7 @@ async def driver_websocket(websocket: WebSocket, driver_id: str, db: Session = D
 async def rider_websocket(websocket: WebSocket, rider_id: str):
     """Rider socket to watch driver"""
     await manager.connect(websocket, f"rider_{rider_id}")
+    notifications.hub.register(int(rider_id), websocket.send_text)
     
     try:
         while True:
@@ -265,3 +296,4 @@ async def rider_websocket(websocket: WebSocket, rider_id: str):
     
     except WebSocketDisconnect:
         manager.disconnect(f"rider_{rider_id}")
+        notifications.hub.unregister(int(rider_id), websocket.send_text)
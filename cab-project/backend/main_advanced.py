@@ -1,14 +1,42 @@
 from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from http_cache import StaticResponseCache
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware, router as metrics_router
+from tracing import TracingMiddleware, configure_logging
+from security import RateLimitMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import asyncio
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from db import engine, get_db
+from auth import verify_token
+from models import Base
 from googlemaps_service import maps_service
-from stripe_integration import stripe_service, process_webhook_event
+from stripe_integration import stripe_service, process_webhook_event, process_wallet_topup
+import wallet
+import promos
+import ratings
+import notifications
+from booking_store import make_repository
+from models import Ride, Review
+from sqlalchemy.exc import IntegrityError
 
-app = FastAPI(title="Advanced Cab Booking API")
+# Wallets live in the database (see wallet.py)
+Base.metadata.create_all(bind=engine)
+
+configure_logging()
+
+app = FastAPI(title="Advanced Cab Booking API", default_response_class=ORJSONResponse)
+
+# Static payloads are serialized once and revalidated by ETag
+app.add_middleware(StaticResponseCache)
+
+# Added before CORS so rejections still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
 
 # CORS middleware
 app.add_middleware(
@@ -19,6 +47,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so everything below (CORS and cached responses included) is compressed
+app.add_middleware(CompressionMiddleware)
+
+# Outside compression too, so latency covers the whole response
+app.add_middleware(MetricsMiddleware)
+
+# Outermost: the request ID is bound before anything else logs
+app.add_middleware(TracingMiddleware)
+
+# Prometheus scrape endpoint
+app.include_router(metrics_router)
+
 # Pydantic Models
 class BookCab(BaseModel):
     user_name: str
@@ -28,7 +68,13 @@ class BookCab(BaseModel):
 
 class PromoCode(BaseModel):
     code: str
-    discount_percent: float
+    discount_percent: Optional[float] = None  # ignored; the discount comes from the code's rules
+    ride_amount: Optional[float] = None
+
+class PromoRedemption(BaseModel):
+    code: str
+    ride_id: int
+    ride_amount: float
 
 class WalletTopup(BaseModel):
     user_id: int
@@ -39,15 +85,14 @@ class RideReview(BaseModel):
     rating: int
     comment: str
 
-# In-memory storage (replace with database)
-rides_db = []
-wallet_db = {}
-promo_codes = {
+# Bookings, indexed by id, user and status (see booking_store.py)
+bookings = make_repository("bookings", indexes=("user_name", "status"))
+# Seeded into promo_codes on first start (see promos.py)
+default_promo_codes = {
     "FIRST50": {"discount": 50, "type": "percentage"},
     "SAVE20": {"discount": 20, "type": "fixed"},
     "NEWUSER": {"discount": 30, "type": "percentage"}
 }
-reviews_db = []
 
 @app.get("/")
 def home():
@@ -96,8 +141,7 @@ def book_cab(data: BookCab):
     final_fare = base_fare * surge_multiplier
     
     # Create booking
-    booking = {
-        "id": len(rides_db) + 1,
+    booking = bookings.add({
         "user_name": data.user_name,
         "cab_id": data.cab_id,
         "pickup": data.pickup,
@@ -107,9 +151,7 @@ def book_cab(data: BookCab):
         "status": "confirmed",
         "booking_time": datetime.now().isoformat(),
         "otp": "1234"
-    }
-    
-    rides_db.append(booking)
+    })
     
     return {
         "status": "success",
@@ -122,12 +164,13 @@ def book_cab(data: BookCab):
     }
 
 @app.get("/bookings")
-def get_bookings():
-    return rides_db
+def get_bookings(user_name: Optional[str] = None, status: Optional[str] = None):
+    filters = {name: value for name, value in (("user_name", user_name), ("status", status)) if value is not None}
+    return bookings.find(**filters)
 
 @app.get("/bookings/{booking_id}")
 def get_booking_details(booking_id: int):
-    booking = next((b for b in rides_db if b["id"] == booking_id), None)
+    booking = bookings.get(booking_id)
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found")
     
@@ -138,67 +181,130 @@ def get_booking_details(booking_id: int):
         "trip_status": "driver_assigned"
     }
 
+@app.on_event("startup")
+def seed_promo_codes():
+    db = next(get_db())
+    try:
+        if not db.query(promos.PromoCode.id).first():
+            now = datetime.utcnow()
+            for code, promo_data in default_promo_codes.items():
+                promos.create_promo(db, code, f"{code} offer", promo_data["type"], promo_data["discount"],
+                                    valid_from=now, valid_until=now + timedelta(days=365))
+    finally:
+        db.close()
+
 @app.post("/promo/validate")
 def validate_promo(promo: PromoCode):
-    if promo.code not in promo_codes:
-        raise HTTPException(status_code=400, detail="Invalid promo code")
+    # Served from the in-memory promo index, no query per request
+    try:
+        rule = promos.promo_index.validate(promo.code, promo.ride_amount)
+    except promos.PromoRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    promo_data = promo_codes[promo.code]
-    return {
+    discount = rule["discount_value"]
+    off = f"{discount:g}%" if rule["discount_type"] == "percentage" else f"₹{discount:g}"
+    response = {
         "valid": True,
-        "discount": promo_data["discount"],
-        "type": promo_data["type"],
-        "message": f"Promo applied! {promo_data['discount']}% off"
+        "discount": discount,
+        "type": rule["discount_type"],
+        "message": f"Promo applied! {off} off"
+    }
+    if promo.ride_amount is not None:
+        response["discount_amount"] = rule["discount_amount"]
+    return response
+
+@app.post("/promo/redeem")
+def redeem_promo(redemption: PromoRedemption, user_id: int = Depends(verify_token),
+                 db: Session = Depends(get_db)):
+    """Apply a promo to one of the caller's own rides"""
+    ride = db.get(Ride, redemption.ride_id)
+    if ride is None:
+        raise HTTPException(status_code=404, detail="Ride not found")
+    if ride.rider_id != user_id:
+        raise HTTPException(status_code=403, detail="Only the ride's rider can apply a promo to it")
+    
+    try:
+        result = promos.redeem(db, redemption.code, user_id, ride.id, redemption.ride_amount)
+    except promos.PromoRejected as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {
+        "status": "success",
+        **result,
+        "final_amount": round(redemption.ride_amount - result["discount_amount"], 2)
     }
 
 @app.get("/wallet/{user_id}")
-def get_wallet_balance(user_id: int):
-    balance = wallet_db.get(user_id, 0.0)
+def get_wallet_balance(user_id: int, db: Session = Depends(get_db)):
+    balance = wallet.get_balance(db, wallet.user_account(user_id))
     return {
         "user_id": user_id,
-        "balance": balance,
+        "balance": wallet.to_major(balance),
         "currency": "INR"
     }
 
 @app.post("/wallet/topup")
-def topup_wallet(topup: WalletTopup):
-    current_balance = wallet_db.get(topup.user_id, 0.0)
-    new_balance = current_balance + topup.amount
-    wallet_db[topup.user_id] = new_balance
+async def topup_wallet(topup: WalletTopup):
+    """Start a top-up; the wallet is credited once Stripe reports the payment succeeded"""
+    if topup.amount <= 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
+    
+    payment_intent = await process_wallet_topup(topup.user_id, topup.amount)
     
     return {
-        "status": "success",
-        "message": "Wallet topped up successfully",
-        "new_balance": new_balance,
-        "transaction_id": f"TXN{len(wallet_db) + 1000}"
+        "status": "pending",
+        "message": "Complete the payment to top up the wallet",
+        "client_secret": payment_intent["client_secret"],
+        "payment_intent_id": payment_intent["payment_intent_id"]
     }
 
 @app.post("/reviews")
-def submit_review(review: RideReview):
-    review_data = {
-        "id": len(reviews_db) + 1,
-        "ride_id": review.ride_id,
-        "rating": review.rating,
-        "comment": review.comment,
-        "timestamp": datetime.now().isoformat()
-    }
+def submit_review(review: RideReview, user_id: int = Depends(verify_token), db: Session = Depends(get_db)):
+    """Rate the other party of a ride: its rider rates the driver, its driver the rider"""
+    if not 1 <= review.rating <= 5:
+        raise HTTPException(status_code=400, detail="Rating must be between 1 and 5")
     
-    reviews_db.append(review_data)
+    ride = db.get(Ride, review.ride_id)
+    if ride is None:
+        raise HTTPException(status_code=404, detail="Ride not found")
+    if user_id == ride.rider_id:
+        rated_id = ride.driver_id
+    elif user_id == ride.driver_id:
+        rated_id = ride.rider_id
+    else:
+        raise HTTPException(status_code=403, detail="Only the ride's rider or driver can review it")
+    if rated_id is None:
+        raise HTTPException(status_code=400, detail="Ride has no driver to review")
+    
+    # Saving the review updates the rated user's aggregate in the same transaction
+    new_review = Review(ride_id=ride.id, rater_id=user_id, rated_id=rated_id,
+                        rating=review.rating, comment=review.comment)
+    db.add(new_review)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Ride already reviewed")
     
     return {
         "status": "success",
         "message": "Review submitted successfully",
-        "review_id": review_data["id"]
+        "review_id": new_review.id
     }
 
 @app.get("/reviews/{driver_id}")
-def get_driver_reviews(driver_id: int):
-    # Mock reviews for driver
-    return [
-        {"rating": 5, "comment": "Excellent service!", "date": "2024-01-15"},
-        {"rating": 4, "comment": "Good driver, safe ride", "date": "2024-01-10"},
-        {"rating": 5, "comment": "Very punctual", "date": "2024-01-05"}
-    ]
+def get_driver_reviews(driver_id: int, limit: int = 20, db: Session = Depends(get_db)):
+    reviews = db.query(Review.rating, Review.comment, Review.created_at).filter(
+        Review.rated_id == driver_id
+    ).order_by(Review.id.desc()).limit(min(limit, 100))
+    return {
+        "driver_id": driver_id,
+        "rating": ratings.get_rating(db, driver_id),
+        "reviews": [
+            {"rating": rating, "comment": comment, "date": created_at.date().isoformat()}
+            for rating, comment, created_at in reviews
+        ]
+    }
 
 @app.get("/fare/estimate")
 def get_fare_estimate(pickup: str, destination: str, cab_type: str = "mini", 
@@ -249,25 +355,19 @@ def get_fare_estimate(pickup: str, destination: str, cab_type: str = "mini",
     }
 
 @app.get("/notifications/{user_id}")
-def get_notifications(user_id: int):
-    return [
-        {
-            "id": 1,
-            "title": "Ride Completed",
-            "message": "Your ride to Pune has been completed. Rate your driver!",
-            "type": "ride_update",
-            "timestamp": "2024-01-20T10:30:00",
-            "read": False
-        },
-        {
-            "id": 2,
-            "title": "Promo Code Available",
-            "message": "Use code SAVE20 for ₹20 off on your next ride",
-            "type": "promotion",
-            "timestamp": "2024-01-19T15:45:00",
-            "read": True
-        }
-    ]
+def get_notifications(user_id: int, before_id: Optional[int] = None, limit: int = 20,
+                      db: Session = Depends(get_db)):
+    return notifications.list_notifications(db, user_id, before_id, min(limit, 100))
+
+@app.get("/notifications/{user_id}/unread-count")
+def get_unread_count(user_id: int, db: Session = Depends(get_db)):
+    return {"user_id": user_id, "unread": notifications.unread_count(db, user_id)}
+
+@app.post("/notifications/{user_id}/read")
+def mark_notifications_read(user_id: int, ids: Optional[List[int]] = None, db: Session = Depends(get_db)):
+    # No ids marks everything read
+    marked = notifications.mark_read(db, user_id, ids)
+    return {"marked": marked, "unread": notifications.unread_count(db, user_id)}
 
 @app.get("/driver/location/{driver_id}")
 def get_driver_location(driver_id: int):
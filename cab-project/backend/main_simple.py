@@ -1,16 +1,32 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from http_cache import StaticResponseCache
+from compression import CompressionMiddleware
+from metrics import MetricsMiddleware, router as metrics_router
+from tracing import TracingMiddleware, configure_logging
+from security import RateLimitMiddleware
+from booking_store import make_repository
 from pydantic import BaseModel
 from datetime import datetime
 import random
+import secrets
 
-app = FastAPI()
+configure_logging()
 
-# In-memory storage
-users_db = []
-drivers_db = []
-rides_db = []
-payments_db = []
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Static payloads are serialized once and revalidated by ETag
+app.add_middleware(StaticResponseCache)
+
+# Added before CORS so rejections still carry CORS headers
+app.add_middleware(RateLimitMiddleware)
+
+# In-memory storage, or SQLite with BOOKING_STORE_PATH (see booking_store.py)
+users_db = make_repository("users", indexes=("email",))
+drivers_db = make_repository("drivers")
+rides_db = make_repository("rides", indexes=("user", "status"))
+payments_db = make_repository("payments", indexes=("ride_id", "status"))
 
 # CORS middleware
 app.add_middleware(
@@ -21,6 +37,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so everything below (CORS and cached responses included) is compressed
+app.add_middleware(CompressionMiddleware)
+
+# Outside compression too, so latency covers the whole response
+app.add_middleware(MetricsMiddleware)
+
+# Outermost: the request ID is bound before anything else logs
+app.add_middleware(TracingMiddleware)
+
+# Prometheus scrape endpoint
+app.include_router(metrics_router)
+
 class BookCab(BaseModel):
     user_name: str
     cab_id: int
@@ -54,9 +82,7 @@ def home():
 @app.post("/api/auth/register")
 def register_user(user_data: UserRegister):
     # Add user to database
-    user_id = len(users_db) + 1
-    new_user = {
-        "id": user_id,
+    new_user = users_db.add({
         "name": user_data.name,
         "email": user_data.email,
         "phone": user_data.phone,
@@ -64,25 +90,22 @@ def register_user(user_data: UserRegister):
         "status": "Active",
         "rides": 0,
         "created_at": datetime.now().strftime("%Y-%m-%d")
-    }
-    users_db.append(new_user)
+    })
     
     # If driver, add to drivers table
     if user_data.role == "driver":
-        driver = {
-            "id": len(drivers_db) + 1,
+        drivers_db.add({
             "name": user_data.name,
             "phone": user_data.phone,
             "vehicle": "Not Set",
             "license": "Not Set",
             "status": "Pending",
             "rating": 0.0
-        }
-        drivers_db.append(driver)
+        })
     
     return {
         "message": "User registered successfully", 
-        "user_id": user_id
+        "user_id": new_user["id"]
     }
 
 @app.post("/api/auth/login")
@@ -93,7 +116,7 @@ def login_user(credentials: UserLogin):
         role = "driver"
     
     # Find user in database
-    user = next((u for u in users_db if u["email"] == credentials.email), None)
+    user = users_db.first(email=credentials.email)
     if not user:
         user = {
             "id": 123,
@@ -103,7 +126,9 @@ def login_user(credentials: UserLogin):
         }
     
     return {
-        "access_token": f"token_{user['id']}_{credentials.email}",
+        # Demo login checks no password, so it hands out an opaque token the
+        # real API (auth.decode_token) does not accept
+        "access_token": f"demo_{secrets.token_urlsafe(24)}",
         "user": {
             "id": user["id"],
             "name": user["name"],
@@ -123,11 +148,9 @@ def get_cabs():
 @app.post("/bookings")
 def book_cab(data: BookCab):
     # Add ride to database
-    ride_id = len(rides_db) + 1
     fare = random.randint(100, 500)
     
-    new_ride = {
-        "id": ride_id,
+    ride_id = rides_db.add({
         "user": data.user_name,
         "driver": "Auto Assigned",
         "pickup": data.pickup,
@@ -135,20 +158,17 @@ def book_cab(data: BookCab):
         "fare": fare,
         "status": "Booked",
         "date": datetime.now().strftime("%Y-%m-%d")
-    }
-    rides_db.append(new_ride)
+    })["id"]
     
     # Add payment record
-    payment = {
-        "id": len(payments_db) + 1,
+    payments_db.add({
         "ride_id": ride_id,
         "user": data.user_name,
         "amount": fare,
         "method": "Pending",
         "status": "Pending",
         "date": datetime.now().strftime("%Y-%m-%d")
-    }
-    payments_db.append(payment)
+    })
     
     return {
         "status": "success",
@@ -162,11 +182,9 @@ def book_cab(data: BookCab):
 # Ride API for frontend integration
 @app.post("/api/rides/request")
 def request_ride(ride_data: RideRequest):
-    ride_id = len(rides_db) + 1
     fare = random.randint(150, 800)
     
-    new_ride = {
-        "id": ride_id,
+    ride_id = rides_db.add({
         "user": "Current User",
         "driver": "Searching...",
         "pickup": ride_data.pickup_address,
@@ -174,20 +192,17 @@ def request_ride(ride_data: RideRequest):
         "fare": fare,
         "status": "Requested",
         "date": datetime.now().strftime("%Y-%m-%d %H:%M")
-    }
-    rides_db.append(new_ride)
+    })["id"]
     
     # Add payment record
-    payment = {
-        "id": len(payments_db) + 1,
+    payments_db.add({
         "ride_id": ride_id,
         "user": "Current User",
         "amount": fare,
         "method": "Pending",
         "status": "Pending",
         "date": datetime.now().strftime("%Y-%m-%d")
-    }
-    payments_db.append(payment)
+    })
     
     return {
         "ride_id": ride_id,
@@ -204,35 +219,34 @@ def get_bookings():
 # Admin API endpoints
 @app.get("/admin/stats")
 def get_admin_stats():
-    total_revenue = sum([p["amount"] for p in payments_db if p["status"] == "Success"])
-    total_revenue = sum([p["amount"] for p in payments_db if p["status"] == "Success"])
+    total_revenue = sum(p["amount"] for p in payments_db.find(status="Success"))
     return {
-        "total_users": len(users_db) if users_db else 0,
-        "total_drivers": len(drivers_db) if drivers_db else 0,
-        "total_rides": len(rides_db) if rides_db else 0,
+        "total_users": len(users_db),
+        "total_drivers": len(drivers_db),
+        "total_rides": len(rides_db),
         "total_revenue": total_revenue if total_revenue else 0
     }
 
 @app.get("/admin/users")
 def get_users():
-    return users_db if users_db else [
+    return users_db.all() if len(users_db) else [
         {"id": 1, "name": "Demo User", "email": "demo@example.com", "phone": "+91 9876543210", "status": "Active", "rides": 0}
     ]
 
 @app.get("/admin/drivers")
 def get_drivers():
-    return drivers_db if drivers_db else [
+    return drivers_db.all() if len(drivers_db) else [
         {"id": 1, "name": "Demo Driver", "phone": "+91 9876543220", "vehicle": "Demo Car", "license": "DL000000", "status": "Pending", "rating": 0.0}
     ]
 
 @app.get("/admin/rides")
 def get_rides():
-    return rides_db if rides_db else [
+    return rides_db.all() if len(rides_db) else [
         {"id": 1, "user": "Demo User", "driver": "Demo Driver", "pickup": "Demo Pickup", "destination": "Demo Destination", "fare": 0, "status": "Demo", "date": datetime.now().strftime("%Y-%m-%d")}
     ]
 
 @app.get("/admin/payments")
 def get_payments():
-    return payments_db if payments_db else [
+    return payments_db.all() if len(payments_db) else [
         {"id": 1, "ride_id": 1, "user": "Demo User", "amount": 0, "method": "Demo", "status": "Demo", "date": datetime.now().strftime("%Y-%m-%d")}
     ]
\ No newline at end of file
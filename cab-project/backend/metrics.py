@@ -0,0 +1,208 @@
+# Prometheus metrics: request latency, DB pools, realtime sockets, outbound calls and caches
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+from fastapi import APIRouter, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from starlette.routing import Match
+
+# With several workers (uvicorn --workers), point this at an empty
+# directory shared by them so any worker's /metrics reports all of them
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to the end of the response body, by route template",
+    ["method", "route"],
+)
+REQUESTS = Counter("http_requests_total", "Responses by route template and status", ["method", "route", "status"])
+
+DB_POOL_WAIT = Histogram(
+    "db_pool_checkout_seconds", "Time to get a connection from the pool, including opening one",
+    ["engine"], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DB_POOL_HELD = Histogram(
+    "db_pool_connection_held_seconds", "Time a connection stays checked out", ["engine"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections", "Connections checked out right now", ["engine"], multiprocess_mode="livesum",
+)
+
+SOCKET_CONNECTIONS = Gauge(
+    "realtime_connections", "Open realtime connections", ["transport"], multiprocess_mode="livesum",
+)
+SOCKET_EVENTS = Counter("realtime_events_total", "Socket.IO events received, by event name", ["event"])
+
+EXTERNAL_LATENCY = Histogram(
+    "external_request_duration_seconds", "Calls to third-party services", ["service", "operation", "outcome"],
+)
+
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+
+
+class QueueDepths:
+    """Depths of outbound queues, read when scraped.
+
+    Each queue is a callable returning its current length, so nothing is
+    counted on the hot path. Depths are per process; with several
+    workers each scrape reports the worker that served it.
+    """
+
+    def __init__(self):
+        self._queues: Dict[str, Callable[[], int]] = {}
+        self._lock = threading.Lock()
+
+    def track(self, name: str, depth: Callable[[], int]):
+        with self._lock:
+            self._queues[name] = depth
+
+    def describe(self):
+        yield GaugeMetricFamily("outbound_queue_depth", "Work waiting on an outbound resource", labels=["queue"])
+
+    def collect(self):
+        family = GaugeMetricFamily("outbound_queue_depth", "Work waiting on an outbound resource", labels=["queue"])
+        with self._lock:
+            queues = list(self._queues.items())
+        for name, depth in queues:
+            family.add_metric([name], depth())
+        yield family
+
+
+queue_depths = QueueDepths()
+REGISTRY.register(queue_depths)
+
+
+def cache_counters(cache: str) -> Tuple[Counter, Counter]:
+    """(hit, miss) counters of one cache, bound once so a lookup costs an increment"""
+    return CACHE_LOOKUPS.labels(cache, "hit"), CACHE_LOOKUPS.labels(cache, "miss")
+
+
+@contextmanager
+def external_call(service: str, operation: str):
+    """Times the block as a call to service; outcome is "error" if it raised"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        EXTERNAL_LATENCY.labels(service, operation, outcome).observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine, name: str):
+    """Pool wait and hold times of a SQLAlchemy engine (pass async_engine.sync_engine
+    for an async one).
+
+    The pool has no event before a checkout starts, so the wait is timed
+    by wrapping pool.connect(); dispose() swaps in a new pool, which is
+    wrapped again.
+    """
+    waits = DB_POOL_WAIT.labels(name)
+    held = DB_POOL_HELD.labels(name)
+    checked_out = DB_POOL_CHECKED_OUT.labels(name)
+
+    def wrap(pool):
+        connect = pool.connect
+
+        def timed_connect():
+            started = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                waits.observe(time.perf_counter() - started)
+
+        pool.connect = timed_connect
+
+    wrap(engine.pool)
+
+    @event.listens_for(engine, "engine_disposed")
+    def rewrap(engine):
+        wrap(engine.pool)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, record, proxy):
+        record.info["checked_out_at"] = time.perf_counter()
+        checked_out.inc()
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, record):
+        started = record.info.pop("checked_out_at", None)
+        if started is not None:
+            checked_out.dec()
+            held.observe(time.perf_counter() - started)
+
+
+class MetricsMiddleware:
+    """Latency and status of every HTTP request, labelled with the route
+    template ("/api/rides/{ride_id}") rather than the path, so label
+    values stay bounded.
+
+    Added outermost, so time spent in the other middleware (and responses
+    they answer themselves, like cache hits and 429s) is included.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._templates: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self.route_template(scope)
+            REQUEST_LATENCY.labels(scope["method"], route).observe(time.perf_counter() - started)
+            REQUESTS.labels(scope["method"], route, str(status)).inc()
+
+    def route_template(self, scope) -> str:
+        # The router leaves the matched endpoint in the scope
+        endpoint = scope.get("endpoint")
+        if endpoint is not None and endpoint in self._templates:
+            return self._templates[endpoint]
+        # First request to the endpoint, or answered before routing (cache
+        # hit, rate limit); a path matched for another method is a 405
+        partial = "unmatched"
+        for route in getattr(scope.get("app"), "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                if endpoint is not None and getattr(route, "endpoint", None) is endpoint:
+                    self._templates[endpoint] = route.path
+                return route.path
+            if match == Match.PARTIAL and partial == "unmatched":
+                partial = route.path
+        return partial
+
+
+def scrape_registry() -> CollectorRegistry:
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(queue_depths)
+    return registry
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    return Response(generate_latest(scrape_registry()), media_type=CONTENT_TYPE_LATEST)
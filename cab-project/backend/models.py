@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, JSON, Index, PrimaryKeyConstraint, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from db import Base
+from spatial import GeoPoint, register_driver_location_ddl
 
 # ------------------------
 # 1. Users Table
@@ -22,6 +23,10 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_users_role_id", "role", "id"),
+    )
+
 
 # ------------------------
 # 2. Drivers Table
@@ -37,11 +42,23 @@ class Driver(Base):
     verified = Column(Boolean, default=False)
     current_lat = Column(Float, nullable=True)
     current_lng = Column(Float, nullable=True)
+    current_location = Column(GeoPoint, nullable=True)  # maintained from current_lat/current_lng by trigger
     status = Column(String, default="offline")  # active/offline/busy
     socket_id = Column(String, nullable=True)  # for real-time updates
+    stripe_account_id = Column(String, nullable=True)  # Stripe Connect destination for payouts
     
     user = relationship("User", backref="driver_profile")
 
+    __table_args__ = (
+        Index(
+            "idx_drivers_current_location", "current_location", postgresql_using="gist"
+        ).ddl_if(dialect="postgresql"),
+        Index("ix_drivers_status_id", "status", "id"),
+    )
+
+
+register_driver_location_ddl(Driver.__table__)
+
 
 # ------------------------
 # 3. Rides Table
@@ -68,10 +85,20 @@ class Ride(Base):
     started_at = Column(DateTime, nullable=True)
     completed_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     rider = relationship("User", foreign_keys=[rider_id], backref="rides_as_rider")
     driver = relationship("User", foreign_keys=[driver_id], backref="rides_as_driver")
 
+    # (filter, id) indexes back the newest-first keyset pages in admin_routes
+    __table_args__ = (
+        Index("ix_rides_status_id", "status", "id"),
+        Index("ix_rides_rider_id_id", "rider_id", "id"),
+        Index("ix_rides_driver_id_id", "driver_id", "id"),
+        Index("ix_rides_created_at", "created_at"),
+        Index("ix_rides_updated_at", "updated_at"),
+    )
+
 
 # ------------------------
 # 4. Payments Table
@@ -88,9 +115,18 @@ class Payment(Base):
     status = Column(String, default="pending")  # pending/completed/failed/refunded
     webhook_received = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     ride = relationship("Ride", backref="payment")
 
+    __table_args__ = (
+        Index("ix_payments_status_id", "status", "id"),
+        Index("ix_payments_ride_id", "ride_id"),
+        Index("ix_payments_created_at", "created_at"),
+        Index("ix_payments_updated_at", "updated_at"),
+        Index("ix_payments_stripe_payment_intent_id", "stripe_payment_intent_id"),  # webhook lookups
+    )
+
 
 # ------------------------
 # 5. Reviews Table
@@ -110,6 +146,11 @@ class Review(Base):
     rater = relationship("User", foreign_keys=[rater_id], backref="reviews_given")
     rated = relationship("User", foreign_keys=[rated_id], backref="reviews_received")
 
+    __table_args__ = (
+        Index("ux_reviews_ride_id_rater_id", "ride_id", "rater_id", unique=True),  # one review per ride and rater
+        Index("ix_reviews_rated_id_id", "rated_id", "id"),
+    )
+
 
 # ------------------------
 # 6. Notifications Table
@@ -128,6 +169,10 @@ class Notification(Base):
     
     user = relationship("User", backref="notifications")
 
+    __table_args__ = (
+        Index("ix_notifications_user_id_id", "user_id", "id"),  # newest-first pages per user
+    )
+
 
 # ------------------------
 # 7. Ride Tracking Table
@@ -141,4 +186,147 @@ class RideTracking(Base):
     driver_lng = Column(Float, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
     
-    ride = relationship("Ride", backref="tracking_points")
\ No newline at end of file
+    ride = relationship("Ride", backref="tracking_points")
+
+
+# ------------------------
+# 8. Stat Counters Table
+# ------------------------
+class StatCounter(Base):
+    __tablename__ = "stat_counters"
+
+    name = Column(String, nullable=False)  # e.g. users, rides:completed, revenue:2024-01-15:delhi
+    shard = Column(Integer, nullable=False, default=0)  # spreads hot counters over several rows
+    value = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("name", "shard"),
+    )
+
+
+# ------------------------
+# 9. Ride Hourly Aggregates Table
+# ------------------------
+class RideHourlyAggregate(Base):
+    __tablename__ = "ride_hourly_aggregates"
+
+    bucket_start = Column(DateTime, nullable=False)  # hour the rides were created in
+    vehicle_type = Column(String, nullable=False)
+    zone = Column(String, nullable=False)  # service city, see spatial.city_for
+    rides = Column(Integer, default=0)
+    completed = Column(Integer, default=0)
+    cancelled = Column(Integer, default=0)
+    fare_sum = Column(Float, default=0.0)  # fares of completed rides
+    revenue = Column(Float, default=0.0)  # completed payments for these rides
+    refreshed_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("bucket_start", "vehicle_type", "zone"),
+    )
+
+
+# ------------------------
+# 10. Aggregate Watermarks Table
+# ------------------------
+class AggregateWatermark(Base):
+    __tablename__ = "aggregate_watermarks"
+
+    name = Column(String, primary_key=True)  # aggregate table name
+    refreshed_to = Column(DateTime, nullable=False)  # source rows updated before this are applied
+
+
+# ------------------------
+# 11. Webhook Events Table
+# ------------------------
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+
+    id = Column(String, primary_key=True)  # Stripe event id, the dedupe key for retries
+    type = Column(String, nullable=False)  # e.g. payment_intent.succeeded
+    payload = Column(JSON, nullable=False)
+    status = Column(String, default="pending")  # pending/processed/ignored/failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_webhook_events_status_attempts", "status", "attempts", "received_at"),
+    )
+
+
+# ------------------------
+# 12. Driver Earnings Table
+# ------------------------
+class DriverEarning(Base):
+    __tablename__ = "driver_earnings"
+
+    id = Column(Integer, primary_key=True, index=True)
+    ride_id = Column(Integer, ForeignKey("rides.id"), nullable=False, unique=True)  # one accrual per ride
+    driver_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # same as rides.driver_id
+    gross = Column(Integer, nullable=False)  # paise
+    commission = Column(Integer, nullable=False)  # paise
+    net = Column(Integer, nullable=False)  # paise owed to the driver
+    payout_id = Column(Integer, ForeignKey("payouts.id"), nullable=True)  # set once settled
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_driver_earnings_unpaid", "payout_id", "driver_id"),
+    )
+
+
+# ------------------------
+# 13. Payouts Table
+# ------------------------
+class Payout(Base):
+    __tablename__ = "payouts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    batch = Column(String, nullable=False)  # settlement run, e.g. 2024-01-15
+    driver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    destination = Column(String, nullable=False)  # Stripe connected account
+    amount = Column(Integer, nullable=False)  # paise
+    currency = Column(String, default="inr")
+    status = Column(String, default="pending")  # pending/paid/failed
+    idempotency_key = Column(String, nullable=False, unique=True)  # kept across network retries, replaced after a decline
+    stripe_transfer_id = Column(String, nullable=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    paid_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("batch", "driver_id"),
+        Index("ix_payouts_batch_status", "batch", "status"),
+    )
+
+
+# ------------------------
+# 14. Rating Aggregates Table
+# ------------------------
+class RatingAggregate(Base):
+    __tablename__ = "rating_aggregates"
+
+    rated_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=False, default=0)  # sum of stars
+    # Forward-decayed sums: each review weighted 2^((created_at - RATING_DECAY_EPOCH) / half-life),
+    # relative to the start of decay_period. Newer reviews weigh more and the sums stay
+    # additive (see ratings.py).
+    decayed_total = Column(Float, nullable=False, default=0.0)
+    decayed_count = Column(Float, nullable=False, default=0.0)
+    decay_period = Column(Integer, nullable=False, default=0)
+    score = Column(Float, nullable=False, default=0.0)  # Bayesian-smoothed mean used for ranking
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# ------------------------
+# 15. Notification Counters Table
+# ------------------------
+class NotificationCounter(Base):
+    __tablename__ = "notification_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    unread = Column(Integer, nullable=False, default=0)  # kept in step with notifications.read
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -1,5 +1,5 @@
 # Week 2 Advanced Models - Promo codes, Wallet, Receipts
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, JSON, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from db import Base
@@ -11,8 +11,11 @@ class Wallet(Base):
     __tablename__ = "wallets"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
-    balance = Column(Float, default=0.0)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, unique=True)  # null for house accounts
+    account = Column(String, nullable=False, unique=True)  # user:<id> or house:<name>
+    is_house = Column(Boolean, default=False)  # platform account, balance derived from the ledger
+    balance = Column(Integer, default=0)  # paise; for house accounts the snapshot below
+    snapshot_entry_id = Column(Integer, default=0)  # house balance includes ledger rows up to this id
     currency = Column(String, default="INR")
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -27,14 +30,21 @@ class WalletTransaction(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     wallet_id = Column(Integer, ForeignKey("wallets.id"), nullable=False)
-    type = Column(String, nullable=False)  # credit/debit/refund
-    amount = Column(Float, nullable=False)
+    entry_id = Column(String, nullable=False)  # shared by both legs of a posting, the idempotency key
+    type = Column(String, nullable=False)  # credit/debit
+    amount = Column(Integer, nullable=False)  # paise, signed: credits positive, debits negative
+    balance_after = Column(Integer, nullable=True)  # user wallets only
     description = Column(String, nullable=False)
     reference_id = Column(String, nullable=True)  # ride_id, payment_id, etc.
     created_at = Column(DateTime, default=datetime.utcnow)
     
     wallet = relationship("Wallet", backref="transactions")
 
+    __table_args__ = (
+        UniqueConstraint("entry_id", "wallet_id"),
+        Index("ix_wallet_transactions_wallet_id_id", "wallet_id", "id"),
+    )
+
 # ------------------------
 # 10. Promo Codes Table
 # ------------------------
@@ -49,11 +59,13 @@ class PromoCode(Base):
     min_ride_amount = Column(Float, default=0.0)
     max_discount = Column(Float, nullable=True)
     usage_limit = Column(Integer, nullable=True)
-    used_count = Column(Integer, default=0)
+    used_count = Column(Integer, default=0)  # campaign codes count in promo_counters instead
+    counter_shards = Column(Integer, default=1)  # >1 spreads usage_limit over that many counter rows
     valid_from = Column(DateTime, nullable=False)
     valid_until = Column(DateTime, nullable=False)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # promo index version
 
 # ------------------------
 # 11. Promo Usage Table
@@ -72,6 +84,10 @@ class PromoUsage(Base):
     user = relationship("User", backref="promo_usage")
     ride = relationship("Ride", backref="promo_applied")
 
+    __table_args__ = (
+        Index("ux_promo_usage_promo_id_ride_id", "promo_id", "ride_id", unique=True),
+    )
+
 # ------------------------
 # 12. Receipts Table
 # ------------------------
@@ -83,6 +99,7 @@ class Receipt(Base):
     receipt_number = Column(String, unique=True, nullable=False)
     pdf_path = Column(String, nullable=True)
     email_sent = Column(Boolean, default=False)
+    email_claimed_at = Column(DateTime, nullable=True)  # set while an email run is sending it
     generated_at = Column(DateTime, default=datetime.utcnow)
     
     ride = relationship("Ride", backref="receipt")
@@ -98,4 +115,20 @@ class RateLimit(Base):
     endpoint = Column(String, nullable=False)
     request_count = Column(Integer, default=1)
     window_start = Column(DateTime, default=datetime.utcnow)
-    created_at = Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# ------------------------
+# 14. Promo Counters Table
+# ------------------------
+class PromoCounter(Base):
+    __tablename__ = "promo_counters"
+
+    id = Column(Integer, primary_key=True, index=True)
+    promo_id = Column(Integer, ForeignKey("promo_codes.id"), nullable=False)
+    shard = Column(Integer, nullable=False)
+    used = Column(Integer, default=0)
+    capacity = Column(Integer, nullable=False)  # this shard's slice of the code's usage_limit
+
+    __table_args__ = (
+        UniqueConstraint("promo_id", "shard"),
+    )
@@ -3,7 +3,8 @@ from sqlmodel import SQLModel, Field, Relationship
 from typing import Optional, List
 from datetime import datetime
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, JSON
+from sqlalchemy import Column, JSON, Index
+from spatial import GeoPoint, register_driver_location_ddl
 
 # ------------------------
 # SQLModel Base Classes
@@ -55,11 +56,21 @@ class Driver(DriverBase, table=True):
     
     id: Optional[int] = Field(default=None, primary_key=True)
     vehicle_info: dict = Field(sa_column=Column(JSON))
-    current_location: Optional[str] = Field(sa_column=Column(Geometry('POINT'), index=True))
+    current_lat: Optional[float] = None
+    current_lng: Optional[float] = None
+    current_location: Optional[str] = Field(sa_column=Column(GeoPoint, nullable=True))
     
     # Relationships
     user: User = Relationship(back_populates="driver_profile")
 
+    __table_args__ = (
+        Index(
+            "idx_drivers_current_location", "current_location", postgresql_using="gist"
+        ).ddl_if(dialect="postgresql"),
+    )
+
+register_driver_location_ddl(Driver.__table__)
+
 # ------------------------
 # Ride Model
 # ------------------------
@@ -0,0 +1,357 @@
+# Notification pipeline: batched writes, unread counters, chunked fan-out and live push
+import asyncio
+import json
+import os
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import Boolean, DateTime, Integer, String, Text, JSON, event, literal, null, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from metrics import queue_depths
+from models import User, Ride, Payment, Notification, NotificationCounter
+
+NOTIFICATION_TYPES = {"ride_request", "ride_update", "payment", "promotion", "system"}
+FANOUT_CHUNK_SIZE = int(os.getenv("NOTIFICATION_FANOUT_CHUNK_SIZE", "5000"))
+# Set to relay pushes from other processes (e.g. Celery workers) to the web process
+REDIS_URL = os.getenv("REDIS_URL")
+RELAY_CHANNEL = "notifications:push"
+
+
+def notification_event(user_id: int, title: str, message: str, type: str = "system",
+                       data: Optional[Dict] = None) -> Dict:
+    if type not in NOTIFICATION_TYPES:
+        raise ValueError(f"Unknown notification type: {type}")
+    return {"user_id": user_id, "title": title, "message": message, "type": type, "data": data}
+
+
+def ride_update_event(ride: Ride, message: str) -> Dict:
+    return notification_event(ride.rider_id, f"Ride {ride.status.replace('_', ' ')}", message,
+                              "ride_update", {"ride_id": ride.id, "status": ride.status})
+
+
+def payment_event(payment: Payment, ride: Optional[Ride]) -> Optional[Dict]:
+    if ride is None:
+        return None
+    titles = {"completed": "Payment received", "failed": "Payment failed", "refunded": "Payment refunded"}
+    if payment.status not in titles:
+        return None
+    return notification_event(ride.rider_id, titles[payment.status],
+                              f"₹{payment.amount:.2f} for ride #{ride.id}", "payment",
+                              {"ride_id": ride.id, "payment_id": payment.id, "status": payment.status})
+
+
+def to_payload(notification: Dict) -> Dict:
+    created_at = notification["created_at"]
+    return {
+        "id": notification.get("id"),
+        "title": notification["title"],
+        "message": notification["message"],
+        "type": notification["type"],
+        "data": notification.get("data"),
+        "timestamp": created_at.isoformat() if created_at else None,
+        "read": bool(notification.get("read")),
+    }
+
+
+# ------------------------
+# Live delivery
+# ------------------------
+class NotificationHub:
+    """Live connections by user id, in this process.
+
+    register() is called from the connection's event loop; deliver() may
+    be called from any thread (e.g. a sync endpoint's threadpool) and
+    schedules the sends on that loop.
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex  # tags relayed pushes so we skip our own
+        self._connections: Dict[int, Set[Callable]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self.pending = 0  # sends scheduled on the loop and not finished
+
+    def register(self, user_id: int, send: Callable):
+        """send is an async callable taking a JSON string, e.g. websocket.send_text"""
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            self._connections.setdefault(user_id, set()).add(send)
+
+    def unregister(self, user_id: int, send: Callable):
+        with self._lock:
+            sends = self._connections.get(user_id)
+            if sends:
+                sends.discard(send)
+                if not sends:
+                    del self._connections[user_id]
+
+    def deliver(self, pushes: List[Dict]) -> int:
+        """Send {"user_id", "notification"} pushes to users connected here"""
+        if self._loop is None or self._loop.is_closed():
+            return 0
+        scheduled = 0
+        for push in pushes:
+            with self._lock:
+                sends = list(self._connections.get(push["user_id"], ()))
+            message = json.dumps({"type": "notification", "notification": push["notification"]})
+            for send in sends:
+                with self._lock:
+                    self.pending += 1
+                asyncio.run_coroutine_threadsafe(self._send(push["user_id"], send, message), self._loop)
+                scheduled += 1
+        return scheduled
+
+    def deliver_to(self, user_ids: Iterable[int], notification: Dict) -> int:
+        """Send one notification to whichever of user_ids are connected here"""
+        with self._lock:
+            online = [user_id for user_id in user_ids if user_id in self._connections]
+        return self.deliver([{"user_id": user_id, "notification": notification} for user_id in online])
+
+    async def _send(self, user_id: int, send: Callable, message: str):
+        try:
+            await send(message)
+        except Exception:
+            self.unregister(user_id, send)  # closed socket; the client reloads on reconnect
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def relay_from_redis(self, url: str = REDIS_URL):
+        """Forward pushes published by other processes to connections in this one"""
+        import redis.asyncio as redis
+
+        client = redis.Redis.from_url(url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(RELAY_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                relayed = json.loads(message["data"])
+                if relayed["origin"] == self.origin:
+                    continue
+                if "user_ids" in relayed:
+                    self.deliver_to(relayed["user_ids"], relayed["notification"])
+                else:
+                    self.deliver(relayed["pushes"])
+        finally:
+            await pubsub.close()
+            await client.close()
+
+
+hub = NotificationHub()
+queue_depths.track("notification_push", lambda: hub.pending)
+
+
+_relay_client = None
+
+
+def relay(message: Dict):
+    """Publish pushes for the hubs of the other processes to deliver"""
+    global _relay_client
+    if not REDIS_URL:
+        return
+    import redis
+
+    try:
+        if _relay_client is None:
+            _relay_client = redis.Redis.from_url(REDIS_URL)
+        _relay_client.publish(RELAY_CHANNEL, json.dumps({"origin": hub.origin, **message}))
+    except redis.RedisError:
+        pass  # live push is best effort; the notification is already stored
+
+
+def push_to_users(pushes: List[Dict]):
+    if not pushes:
+        return
+    hub.deliver(pushes)
+    relay({"pushes": pushes})
+
+
+def push_to_all(user_ids: List[int], notification: Dict):
+    """One notification for many users; every process pushes to the ones connected to it"""
+    if not user_ids:
+        return
+    hub.deliver_to(user_ids, notification)
+    relay({"user_ids": user_ids, "notification": notification})
+
+
+# ------------------------
+# Batched writes
+# ------------------------
+def add_unread(db: Session, unread: Dict[int, int]):
+    """Add to per-user unread counters (one upsert per user, in user id order)"""
+    if not unread:
+        return
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    table = NotificationCounter.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={"unread": table.c.unread + statement.excluded.unread, "updated_at": statement.excluded.updated_at}
+    )
+    now = datetime.utcnow()
+    db.execute(statement, [
+        {"user_id": user_id, "unread": delta, "updated_at": now}
+        for user_id, delta in sorted(unread.items())
+    ])
+
+
+def stage(db: Session, events: Iterable[Optional[Dict]]):
+    """Queue notifications to be written with the session's next commit.
+
+    They are batch-inserted in the same transaction as whatever caused
+    them (a ride or payment change) and pushed live once it commits.
+    """
+    db.info.setdefault("notifications", []).extend(event for event in events if event)
+
+
+def publish(db: Session, events: Iterable[Optional[Dict]]) -> int:
+    """Write and push notifications now; returns how many were stored"""
+    events = [event for event in events if event]
+    stage(db, events)
+    db.commit()
+    return len(events)
+
+
+@event.listens_for(Session, "before_commit")
+def write_staged_notifications(session: Session):
+    staged = session.info.pop("notifications", None)
+    if not staged:
+        return
+    now = datetime.utcnow()
+    rows = [{**staged_event, "read": False, "created_at": now} for staged_event in staged]
+    table = Notification.__table__
+    # Unordered RETURNING of the payload columns lets every dialect write
+    # the batch as one multi-row INSERT
+    stored = session.execute(table.insert().returning(
+        table.c.id, table.c.user_id, table.c.title, table.c.message, table.c.type,
+        table.c.data, table.c.created_at
+    ), rows).mappings().all()
+    add_unread(session, Counter(row["user_id"] for row in rows))
+    session.info.setdefault("notification_pushes", []).extend(
+        {"user_id": row["user_id"], "notification": to_payload(row)} for row in stored
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def push_committed_notifications(session: Session):
+    pushes = session.info.pop("notification_pushes", None)
+    if pushes:
+        push_to_users(pushes)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_staged_notifications(session: Session):
+    session.info.pop("notifications", None)
+    session.info.pop("notification_pushes", None)
+
+
+# ------------------------
+# Campaign fan-out
+# ------------------------
+def fan_out(db: Session, title: str, message: str, type: str = "promotion", data: Optional[Dict] = None,
+            conditions: Iterable = (), chunk_size: int = FANOUT_CHUNK_SIZE, after_id: int = 0) -> Dict:
+    """Notify every user matching conditions, chunk_size users per transaction.
+
+    Each chunk is a users id range found by keyset, and both the
+    notifications and the counter increments are INSERT ... SELECT over
+    that range. Only the chunk's user ids are read back, for the live
+    push, so a million-user campaign costs memory for one chunk. The
+    push goes over the Redis relay too: the Celery worker running a
+    campaign has no connections of its own. Pass the returned last_id
+    as after_id to resume a run that stopped with an error.
+    """
+    notification_event(0, title, message, type)  # validates the type
+    conditions = list(conditions)
+    summary = {"notified": 0, "chunks": 0, "last_id": after_id}
+    try:
+        while fan_out_chunk(db, title, message, type, data, conditions, chunk_size, summary):
+            pass
+    except Exception as e:
+        # Chunks up to last_id are committed; resume from there
+        db.rollback()
+        summary["error"] = str(e)
+    return summary
+
+
+def fan_out_chunk(db: Session, title: str, message: str, type: str, data: Optional[Dict],
+                  conditions: List, chunk_size: int, summary: Dict) -> bool:
+    """Notify the next chunk after summary["last_id"]; False once none are left"""
+    after_id = summary["last_id"]
+    upto = db.query(User.id).filter(*conditions, User.id > after_id).order_by(User.id).offset(
+        chunk_size - 1
+    ).limit(1).scalar()
+    in_chunk = [*conditions, User.id > after_id] + ([User.id <= upto] if upto is not None else [])
+
+    now = datetime.utcnow()
+    notifications = select(
+        User.id, literal(title, String), literal(message, Text), literal(type, String),
+        literal(False, Boolean), literal(data, JSON) if data is not None else null(),
+        literal(now, DateTime)
+    ).where(*in_chunk)
+    inserted = db.execute(Notification.__table__.insert().from_select(
+        ["user_id", "title", "message", "type", "read", "data", "created_at"], notifications
+    )).rowcount
+    if not inserted:
+        db.rollback()
+        return False
+
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    table = NotificationCounter.__table__
+    counters = insert(table).from_select(
+        ["user_id", "unread", "updated_at"],
+        select(User.id, literal(1, Integer), literal(now, DateTime)).where(*in_chunk)
+    )
+    db.execute(counters.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={"unread": table.c.unread + counters.excluded.unread, "updated_at": counters.excluded.updated_at}
+    ))
+
+    user_ids = [user_id for user_id, in db.query(User.id).filter(*in_chunk).order_by(User.id)]
+    db.commit()
+    summary["notified"] += inserted
+    summary["chunks"] += 1
+    summary["last_id"] = user_ids[-1]
+    payload = to_payload({"title": title, "message": message, "type": type, "data": data, "created_at": now})
+    push_to_all(user_ids, payload)
+    return upto is not None
+
+
+# ------------------------
+# Reads
+# ------------------------
+def unread_count(db: Session, user_id: int) -> int:
+    """Primary key lookup instead of COUNT(*) over the user's notifications"""
+    unread = db.query(NotificationCounter.unread).filter(NotificationCounter.user_id == user_id).scalar()
+    return max(unread or 0, 0)
+
+
+def list_notifications(db: Session, user_id: int, before_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+    """Newest first; pass the last id seen as before_id for the next page"""
+    query = db.query(
+        Notification.id, Notification.title, Notification.message, Notification.type,
+        Notification.data, Notification.read, Notification.created_at
+    ).filter(Notification.user_id == user_id)
+    if before_id is not None:
+        query = query.filter(Notification.id < before_id)
+    return [to_payload(row._asdict()) for row in query.order_by(Notification.id.desc()).limit(limit)]
+
+
+def mark_read(db: Session, user_id: int, ids: Optional[List[int]] = None) -> int:
+    """Mark some (or all) of a user's notifications read, moving the counter by
+    exactly the rows that changed"""
+    statement = update(Notification).where(Notification.user_id == user_id, Notification.read.is_(False))
+    if ids is not None:
+        statement = statement.where(Notification.id.in_(ids))
+    changed = db.execute(statement.values(read=True).execution_options(synchronize_session=False)).rowcount
+    if changed:
+        add_unread(db, {user_id: -changed})
+    db.commit()
+    return changed
@@ -0,0 +1,207 @@
+# Monthly range partitions and cold-partition archival (PostgreSQL)
+import csv
+import gzip
+import os
+from datetime import date
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archives")
+PARTITIONS_AHEAD = 3  # months of empty partitions kept ready for inserts
+HOT_MONTHS = 6  # partitions newer than this stay in the database
+
+# table -> partition key column
+PARTITIONED_TABLES = {
+    "ride_tracking": "timestamp",
+    "notifications": "created_at",
+}
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, month_index + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+def partition_month(table: str, name: str) -> Optional[date]:
+    suffix = name[len(table) + 1:]
+    if not (suffix.startswith("y") and "m" in suffix):
+        return None
+    year, month = suffix[1:].split("m", 1)
+    return date(int(year), int(month), 1)
+
+
+def default_partition_name(table: str) -> str:
+    return f"{table}_default"
+
+
+def create_default_partition(conn: Connection, table: str):
+    """Catch-all partition, so inserts outside the monthly ranges never fail"""
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {default_partition_name(table)} PARTITION OF {table} DEFAULT"
+    ))
+
+
+def table_exists(conn: Connection, name: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None
+
+
+def create_partition(conn: Connection, table: str, month: date):
+    """Create a month's partition, moving in any of its rows held by the
+    default partition.
+
+    PostgreSQL refuses a new range while the default partition holds rows
+    in it, so the default partition is detached while they are moved.
+    """
+    partition = partition_name(table, month)
+    if table_exists(conn, partition):
+        return
+
+    default = default_partition_name(table)
+    key = PARTITIONED_TABLES[table]
+    in_month = f"{key} >= :start AND {key} < :end"
+    bounds = {"start": month, "end": add_months(month, 1)}
+    stray = table_exists(conn, default) and conn.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {in_month})"), bounds
+    ).scalar()
+
+    if stray:
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+    conn.execute(text(
+        f"CREATE TABLE {partition} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+    if stray:
+        conn.execute(text(f"INSERT INTO {table} SELECT * FROM {default} WHERE {in_month}"), bounds)
+        conn.execute(text(f"DELETE FROM {default} WHERE {in_month}"), bounds)
+        conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+
+
+def default_partition_months(conn: Connection, table: str) -> List[date]:
+    """Months with rows in the default partition"""
+    if not table_exists(conn, default_partition_name(table)):
+        return []
+    key = PARTITIONED_TABLES[table]
+    rows = conn.execute(text(
+        f"SELECT DISTINCT date_trunc('month', {key}) FROM {default_partition_name(table)}"
+    ))
+    return sorted(month.date() for month, in rows)
+
+
+def ensure_partitions(conn: Connection, table: str, first_month: Optional[date] = None,
+                      months_ahead: int = PARTITIONS_AHEAD):
+    """Create monthly partitions from first_month (default: this month) to
+    months_ahead, plus the default partition, and give rows that fell into
+    the default partition a monthly partition of their own"""
+    last_month = add_months(month_start(date.today()), months_ahead)
+    month = month_start(first_month or date.today())
+    while month <= last_month:
+        create_partition(conn, table, month)
+        month = add_months(month, 1)
+    for month in default_partition_months(conn, table):
+        create_partition(conn, table, month)
+    create_default_partition(conn, table)
+
+
+def list_partitions(conn: Connection, table: str) -> Dict[date, str]:
+    """Attached monthly partitions of a table, oldest first"""
+    rows = conn.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = :table
+    """), {"table": table})
+    partitions = {}
+    for name, in rows:
+        month = partition_month(table, name)
+        if month:
+            partitions[month] = name
+    return dict(sorted(partitions.items()))
+
+
+# ------------------------
+# Archival
+# ------------------------
+def archive_path(table: str, month: date, archive_dir: str = ARCHIVE_DIR) -> str:
+    return os.path.join(archive_dir, table, f"{month:%Y-%m}.csv.gz")
+
+
+def archive_partition(conn: Connection, table: str, month: date,
+                      archive_dir: str = ARCHIVE_DIR) -> str:
+    """Copy a partition to a gzip CSV file, then detach and drop it.
+
+    The file is written under a temporary name and renamed only once it is
+    complete, so a crash never leaves a partial archive behind a dropped
+    partition.
+    """
+    partition = partition_name(table, month)
+    path = archive_path(table, month, archive_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = f"{path}.tmp"
+    cursor = conn.connection.cursor()
+    try:
+        with gzip.open(temp_path, "wt", newline="") as archive:
+            cursor.copy_expert(f"COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)", archive)
+    finally:
+        cursor.close()
+    os.replace(temp_path, path)
+
+    conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {partition}"))
+    conn.execute(text(f"DROP TABLE {partition}"))
+    return path
+
+
+def list_archives(table: str, archive_dir: str = ARCHIVE_DIR) -> List[str]:
+    """Archived months of a table (YYYY-MM), oldest first"""
+    directory = os.path.join(archive_dir, table)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len(".csv.gz")] for name in os.listdir(directory) if name.endswith(".csv.gz"))
+
+
+def read_archive(table: str, month: str, filters: Optional[Dict[str, str]] = None,
+                 archive_dir: str = ARCHIVE_DIR) -> Iterator[Dict[str, str]]:
+    """Stream rows of an archived month, keeping those matching every filter"""
+    path = os.path.join(archive_dir, table, f"{month}.csv.gz")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No archive for {table} {month}")
+
+    with gzip.open(path, "rt", newline="") as archive:
+        for row in csv.DictReader(archive):
+            if not filters or all(row.get(column) == value for column, value in filters.items()):
+                yield row
+
+
+# ------------------------
+# Maintenance job
+# ------------------------
+def maintain_partitions(engine: Engine, hot_months: int = HOT_MONTHS,
+                        archive_dir: str = ARCHIVE_DIR) -> Dict:
+    """Create upcoming partitions and archive the ones older than hot_months"""
+    if engine.dialect.name != "postgresql":
+        return {"status": "skipped", "reason": f"partitioning needs PostgreSQL, not {engine.dialect.name}"}
+
+    cutoff = add_months(month_start(date.today()), -hot_months)
+    summary = {"status": "success", "archived": []}
+    for table in PARTITIONED_TABLES:
+        with engine.begin() as conn:
+            ensure_partitions(conn, table)
+            partitions = list_partitions(conn, table)
+        for month in partitions:
+            if month >= cutoff:
+                break
+            # one transaction per partition so a failure only retries that month
+            with engine.begin() as conn:
+                summary["archived"].append(archive_partition(conn, table, month, archive_dir))
+    return summary
@@ -0,0 +1,155 @@
+# Password hashing in a bounded process pool, upgraded on login when the cost changes
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from metrics import queue_depths
+
+# Changing BCRYPT_ROUNDS re-hashes each password at its owner's next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# Hashes waiting beyond this are refused with 503 rather than queued for
+# minutes behind a login storm
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", str(PASSWORD_HASH_WORKERS * 16)))
+
+
+@lru_cache(maxsize=None)
+def password_context(rounds: int) -> CryptContext:
+    """bcrypt at exactly rounds; anything else (another cost, or "plaintext"
+    from before passwords were hashed) verifies but needs an update"""
+    return CryptContext(schemes=["bcrypt", "plaintext"], deprecated="auto", bcrypt__default_rounds=rounds,
+                        bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds)
+
+
+pwd_context = password_context(BCRYPT_ROUNDS)
+
+
+def hash_in_worker(password: str, rounds: int) -> str:
+    return password_context(rounds).hash(password)
+
+
+def verify_in_worker(password: str, stored: str, rounds: int) -> Tuple[bool, Optional[str]]:
+    return password_context(rounds).verify_and_update(password, stored)
+
+
+class PasswordHasher:
+    """Runs bcrypt on a pool of worker processes, started on first use.
+
+    A hash is ~100 ms of CPU at cost 12. Processes keep that off the
+    event loop and off the GIL, so logins scale with cores and every
+    other request keeps being served. At most `queue` hashes are in
+    flight; past that callers get 503 with Retry-After.
+
+    Celery's prefork children are daemonic and can't start a pool, so
+    there the hashes run on threads (bcrypt releases the GIL).
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue: int = PASSWORD_HASH_QUEUE,
+                 rounds: int = BCRYPT_ROUNDS):
+        self.workers = workers
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(queue)
+        self.in_flight = 0
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if multiprocessing.current_process().daemon:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix="password-hash")
+                else:
+                    # spawn: forking a process that runs threads can copy held locks
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    async def run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HTTPException(status_code=503, detail="Too many logins in progress",
+                                headers={"Retry-After": "1"})
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor(), function, *args)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_in_worker, password, self.rounds)
+
+    async def verify(self, password: str, stored: str) -> Tuple[bool, Optional[str]]:
+        """(matches, replacement hash to store or None)"""
+        return await self.run(verify_in_worker, password, stored, self.rounds)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+hasher = PasswordHasher()
+queue_depths.track("password_hash", lambda: hasher.in_flight)
+
+
+async def hash_password(password: str) -> str:
+    return await hasher.hash(password)
+
+
+async def verify_password(password: str, stored: str) -> Tuple[bool, Optional[str]]:
+    return await hasher.verify(password, stored)
+
+
+async def run_benchmark(logins: int, workers: int, rounds: int) -> Dict:
+    """A login storm: every verify queued at once, while measuring how late
+    the event loop runs a 10 ms timer"""
+    storm = PasswordHasher(workers=workers, queue=logins, rounds=rounds)
+    stored = hash_in_worker("correct horse battery staple", rounds)
+    await storm.verify("warm up", stored)  # start the workers before timing
+
+    lag = []
+
+    async def ticker():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag.append(time.perf_counter() - started - 0.01)
+
+    ticking = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    results = await asyncio.gather(*(storm.verify("correct horse battery staple", stored) for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    ticking.cancel()
+    storm.close()
+
+    return {
+        "logins": logins,
+        "workers": workers,
+        "rounds": rounds,
+        "verified": sum(1 for valid, _ in results if valid),
+        "logins_per_second": round(logins / elapsed, 1),
+        "logins_per_second_per_worker": round(logins / elapsed / workers, 1),
+        "max_event_loop_lag_ms": round(max(lag, default=0) * 1000, 2),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark password verification throughput")
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=PASSWORD_HASH_WORKERS)
+    parser.add_argument("--rounds", type=int, default=BCRYPT_ROUNDS)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_benchmark(args.logins, args.workers, args.rounds)), indent=2))
@@ -2,9 +2,10 @@ from fastapi import APIRouter, HTTPException, Request, Depends
 from pydantic import BaseModel
 from typing import Optional, Dict
 import stripe
-from stripe_integration import stripe_service, process_webhook_event
+from stripe_integration import stripe_service
+from webhooks import ingest_webhook
 from payment_service import payment_service
-from db import get_db
+from db import get_db, get_read_db
 from sqlalchemy.orm import Session
 import os
 
@@ -116,7 +117,7 @@ async def confirm_payment(payment_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/status/{payment_id}")
-async def get_payment_status(payment_id: int, db: Session = Depends(get_db)):
+async def get_payment_status(payment_id: int, db: Session = Depends(get_read_db)):
     """Get payment status"""
     try:
         result = await payment_service.get_payment_status(db=db, payment_id=payment_id)
@@ -139,20 +140,6 @@ async def refund_payment(payment_id: int, amount: Optional[float] = None, db: Se
 
 @router.post("/webhooks/stripe")
 async def stripe_webhook(request: Request):
-    """Handle Stripe webhooks"""
-    try:
-        payload = await request.body()
-        signature = request.headers.get("stripe-signature")
-        
-        if not signature:
-            raise HTTPException(status_code=400, detail="Missing signature")
-        
-        # Verify webhook signature
-        event = stripe_service.verify_webhook_signature(payload, signature)
-        
-        # Process the event
-        await process_webhook_event(event)
-        
-        return {"status": "success"}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+    """Verify and queue Stripe webhooks (applied by the webhook worker)"""
+    payload = await request.body()
+    return await ingest_webhook(payload, request.headers.get("stripe-signature"))
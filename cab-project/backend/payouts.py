@@ -0,0 +1,227 @@
+# Driver earnings ledger and batched Stripe payouts
+import asyncio
+import os
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import Integer, DateTime, cast, func, literal, select, update
+from sqlalchemy.orm import Session
+
+from models import Ride, Driver, DriverEarning, Payout
+from stripe_integration import stripe_service
+
+PLATFORM_COMMISSION = float(os.getenv("PLATFORM_COMMISSION", "0.20"))
+PAYOUT_CONCURRENCY = int(os.getenv("PAYOUT_CONCURRENCY", "16"))
+PAYOUT_CHUNK_SIZE = 500  # results are committed after every chunk of transfers
+MAX_PAYOUT_ATTEMPTS = 5
+
+
+# ------------------------
+# Earnings ledger
+# ------------------------
+def accrue_earnings(db: Session) -> int:
+    """Record earnings for completed rides not yet in the ledger.
+
+    A single INSERT ... SELECT; the unique ride_id makes a rerun (or a
+    concurrent run) skip rides that were already accrued.
+    """
+    fare = func.coalesce(Ride.fare_actual, Ride.fare_estimate)
+    gross = cast(func.round(fare * 100), Integer)
+    commission = cast(func.round(fare * 100 * PLATFORM_COMMISSION), Integer)
+    accrued = select(DriverEarning.ride_id)
+    pending = select(
+        Ride.id, Ride.driver_id, gross, commission, gross - commission,
+        literal(datetime.utcnow(), DateTime)
+    ).where(
+        Ride.status == "completed",
+        Ride.driver_id.isnot(None),
+        Ride.id.not_in(accrued)
+    )
+    result = db.execute(
+        DriverEarning.__table__.insert().from_select(
+            ["ride_id", "driver_id", "gross", "commission", "net", "created_at"], pending
+        )
+    )
+    db.commit()
+    return result.rowcount
+
+
+def unpaid_balance(db: Session, driver_id: int) -> int:
+    """Net earnings in paise not yet attached to a payout"""
+    return db.query(func.coalesce(func.sum(DriverEarning.net), 0)).filter(
+        DriverEarning.driver_id == driver_id, DriverEarning.payout_id.is_(None)
+    ).scalar()
+
+
+# ------------------------
+# Payout planning
+# ------------------------
+def idempotency_key(batch: str, driver_id: int, attempt: int = 0) -> str:
+    """Stripe replays the stored response of a key for 24h, declines included,
+    so a payout gets a fresh key for each attempt after an API error"""
+    return f"payout-{batch}-{driver_id}" + (f"-{attempt}" if attempt else "")
+
+
+def create_payouts(db: Session, batch: Optional[str] = None) -> int:
+    """Group unpaid earnings into one payout per driver for the batch.
+
+    Runs in one transaction: the payouts and the earnings they settle are
+    written together. Earnings are capped at the highest id seen when the
+    totals were taken so rows accrued meanwhile wait for the next batch.
+    Calling it again for a batch that already has payouts does nothing.
+    """
+    batch = batch or date.today().isoformat()
+    if db.query(Payout.id).filter(Payout.batch == batch).first():
+        return 0
+
+    last_earning = db.query(func.max(DriverEarning.id)).scalar()
+    if last_earning is None:
+        return 0
+
+    totals = db.query(
+        DriverEarning.driver_id, Driver.stripe_account_id, func.sum(DriverEarning.net)
+    ).join(Driver, Driver.user_id == DriverEarning.driver_id).filter(
+        DriverEarning.payout_id.is_(None),
+        DriverEarning.id <= last_earning,
+        Driver.stripe_account_id.isnot(None)
+    ).group_by(DriverEarning.driver_id, Driver.stripe_account_id).having(
+        func.sum(DriverEarning.net) > 0
+    ).all()
+    if not totals:
+        return 0
+
+    now = datetime.utcnow()
+    db.execute(Payout.__table__.insert(), [
+        {
+            "batch": batch, "driver_id": driver_id, "destination": destination,
+            "amount": amount, "currency": "inr", "status": "pending",
+            "idempotency_key": idempotency_key(batch, driver_id), "attempts": 0,
+            "created_at": now
+        }
+        for driver_id, destination, amount in totals
+    ])
+
+    payout_for_driver = select(Payout.id).where(
+        Payout.batch == batch, Payout.driver_id == DriverEarning.driver_id
+    ).scalar_subquery()
+    db.execute(
+        update(DriverEarning)
+        .where(
+            DriverEarning.payout_id.is_(None),
+            DriverEarning.id <= last_earning,
+            DriverEarning.driver_id.in_(select(Payout.driver_id).where(Payout.batch == batch))
+        )
+        .values(payout_id=payout_for_driver)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return len(totals)
+
+
+# ------------------------
+# Transfers
+# ------------------------
+async def send_transfer(payout: Dict, limit: asyncio.Semaphore) -> Dict:
+    """One Stripe transfer; the payout's idempotency key makes retries safe.
+
+    After a network error or timeout the transfer may exist, so the key is
+    kept for the retry. An API error means Stripe refused it, and since
+    the refusal would be replayed for the same key the retry gets a new one.
+    """
+    async with limit:
+        try:
+            transfer = await stripe_service.create_transfer(
+                payout["amount"] / 100,
+                payout["destination"],
+                metadata={"payout_id": str(payout["id"]), "batch": payout["batch"]},
+                idempotency_key=payout["idempotency_key"]
+            )
+            return {"id": payout["id"], "status": "paid", "stripe_transfer_id": transfer["transfer_id"]}
+        except HTTPException as e:
+            result = {"id": payout["id"], "status": "failed", "last_error": str(e.detail)}
+            if e.status_code != 503:
+                result["idempotency_key"] = idempotency_key(payout["batch"], payout["driver_id"],
+                                                            payout["attempts"] + 1)
+            return result
+        except Exception as e:
+            return {"id": payout["id"], "status": "failed", "last_error": str(e)}
+
+
+def due_payouts(db: Session, batch: Optional[str], after_id: int, limit: int) -> List[Dict]:
+    """Unsettled payouts of one batch, or of every batch when batch is None"""
+    query = db.query(
+        Payout.id, Payout.batch, Payout.driver_id, Payout.destination, Payout.amount, Payout.idempotency_key,
+        Payout.attempts
+    ).filter(
+        Payout.status.in_(["pending", "failed"]),
+        Payout.attempts < MAX_PAYOUT_ATTEMPTS,
+        Payout.id > after_id
+    )
+    if batch is not None:
+        query = query.filter(Payout.batch == batch)
+    return [row._asdict() for row in query.order_by(Payout.id).limit(limit)]
+
+
+def record_results(db: Session, results: List[Dict]):
+    now = datetime.utcnow()
+    for result in results:
+        values = {"status": result["status"], "attempts": Payout.attempts + 1}
+        if result["status"] == "paid":
+            values.update(stripe_transfer_id=result["stripe_transfer_id"], paid_at=now, last_error=None)
+        else:
+            values["last_error"] = result["last_error"]
+            if "idempotency_key" in result:
+                values["idempotency_key"] = result["idempotency_key"]
+        db.execute(update(Payout).where(Payout.id == result["id"]).values(**values))
+    db.commit()
+
+
+async def execute_payouts(db: Session, batch: Optional[str] = None, concurrency: int = PAYOUT_CONCURRENCY,
+                          chunk_size: int = PAYOUT_CHUNK_SIZE) -> Dict[str, int]:
+    """Send outstanding transfers, of one batch or (batch=None) of every
+    batch, at most `concurrency` at a time.
+
+    Transfers are sent with the idempotency key stored on the payout.
+    Progress is committed per chunk, so a crashed run resumes with the
+    payouts that are still pending or failed; any transfer that reached
+    Stripe before the crash is answered from its idempotency key.
+
+    The session is only used on this (the event loop's) thread, between
+    chunks, when no transfer is in flight: a Session is not thread-safe.
+    """
+    limit = asyncio.Semaphore(concurrency)
+    summary = {"paid": 0, "failed": 0}
+    last_id = 0
+    while True:
+        chunk = due_payouts(db, batch, last_id, chunk_size)
+        if not chunk:
+            return summary
+        results = await asyncio.gather(*(send_transfer(payout, limit) for payout in chunk))
+        record_results(db, results)
+        for result in results:
+            summary[result["status"]] += 1
+        last_id = chunk[-1]["id"]
+
+
+def payout_summary(db: Session, batch: str) -> Dict:
+    rows = db.query(Payout.status, func.count(Payout.id), func.sum(Payout.amount)).filter(
+        Payout.batch == batch
+    ).group_by(Payout.status)
+    return {
+        "batch": batch,
+        "by_status": {
+            status: {"payouts": count, "amount": (amount or 0) / 100}
+            for status, count, amount in rows
+        }
+    }
+
+
+def run_payouts(db: Session, batch: Optional[str] = None) -> Dict:
+    """Nightly settlement: accrue, plan the batch and send every unsettled
+    payout, including those left over from earlier batches (safe to rerun)"""
+    batch = batch or date.today().isoformat()
+    accrued = accrue_earnings(db)
+    planned = create_payouts(db, batch)
+    sent = asyncio.run(execute_payouts(db))
+    return {"batch": batch, "accrued": accrued, "planned": planned, **sent}
@@ -0,0 +1,308 @@
+# Promo code engine: cached rule index and atomic usage counting
+import random
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import event, func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+
+import models  # noqa: F401  (users and rides tables for the promo_usage foreign keys)
+from db import SessionLocal
+from metrics import cache_counters
+from models_advanced import PromoCode, PromoUsage, PromoCounter
+
+# How often a lookup checks whether promo_codes changed in another process.
+# Changes committed in this process invalidate the index immediately.
+PROMO_REFRESH_SECONDS = 5
+# Shards for campaign codes created through create_promo without an explicit count
+CAMPAIGN_SHARDS = 16
+# A miss is a lookup that had to reload the index first
+PROMO_HIT, PROMO_MISS = cache_counters("promo_index")
+
+RULE_COLUMNS = [
+    PromoCode.id, PromoCode.code, PromoCode.discount_type, PromoCode.discount_value,
+    PromoCode.min_ride_amount, PromoCode.max_discount, PromoCode.usage_limit,
+    PromoCode.used_count, PromoCode.counter_shards, PromoCode.valid_from, PromoCode.valid_until
+]
+
+
+class PromoRejected(ValueError):
+    pass
+
+
+def normalize(code: str) -> str:
+    return code.strip().upper()
+
+
+def is_sharded(rule: Dict) -> bool:
+    return rule["usage_limit"] is not None and (rule["counter_shards"] or 1) > 1
+
+
+# ------------------------
+# Rule evaluation
+# ------------------------
+def evaluate(rule: Dict, ride_amount: Optional[float] = None, now: Optional[datetime] = None) -> float:
+    """Discount (rupees) the rule gives on ride_amount; raises PromoRejected.
+
+    Pure function of the cached rule, so validation needs no query. The
+    usage check uses the count seen when the rule was loaded: counts only
+    grow, so a code that was used up stays used up until it is edited.
+    """
+    now = now or datetime.utcnow()
+    if now < rule["valid_from"]:
+        raise PromoRejected("Promo code is not active yet")
+    if now > rule["valid_until"]:
+        raise PromoRejected("Promo code has expired")
+    if rule["usage_limit"] is not None and not is_sharded(rule) and rule["used_count"] >= rule["usage_limit"]:
+        raise PromoRejected("Promo code usage limit reached")
+    if ride_amount is None:
+        return 0.0
+    if ride_amount < (rule["min_ride_amount"] or 0):
+        raise PromoRejected(f"Minimum ride amount is ₹{rule['min_ride_amount']:g}")
+
+    if rule["discount_type"] == "percentage":
+        discount = ride_amount * rule["discount_value"] / 100
+    else:
+        discount = rule["discount_value"]
+    if rule["max_discount"] is not None:
+        discount = min(discount, rule["max_discount"])
+    return round(min(discount, ride_amount), 2)
+
+
+# ------------------------
+# In-memory index
+# ------------------------
+class PromoIndex:
+    """Active promo codes by code, reloaded only when promo_codes changes.
+
+    A lookup costs a dict access; at most every `refresh_every` seconds one
+    lookup also compares the table's (row count, latest updated_at) with the
+    loaded version and reloads on a difference.
+    """
+
+    def __init__(self, session_factory=None, refresh_every: float = PROMO_REFRESH_SECONDS):
+        self.session_factory = session_factory or SessionLocal
+        self.refresh_every = refresh_every
+        self._rules: Dict[str, Dict] = {}
+        self._version = None
+        self._checked_at = float("-inf")
+        self._exhausted = set()
+        self._sized = set()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._version = None
+        self._checked_at = float("-inf")
+
+    def mark_exhausted(self, promo_id: int):
+        """Reject the code locally once a redemption found no capacity left"""
+        self._exhausted.add(promo_id)
+
+    def lookup(self, code: str) -> Optional[Dict]:
+        reloaded = False
+        if time.monotonic() - self._checked_at >= self.refresh_every:
+            reloaded = self.refresh()
+        (PROMO_MISS if reloaded else PROMO_HIT).inc()
+        return self._rules.get(normalize(code))
+
+    def refresh(self, force: bool = False) -> bool:
+        """Whether the rules were reloaded"""
+        reloaded = False
+        with self._lock:
+            if not force and time.monotonic() - self._checked_at < self.refresh_every:
+                return False  # another thread just checked
+            db = self.session_factory()
+            try:
+                version = tuple(db.query(func.count(PromoCode.id), func.max(PromoCode.updated_at)).one())
+                if force or version != self._version:
+                    now = datetime.utcnow()
+                    rows = db.query(*RULE_COLUMNS).filter(
+                        PromoCode.is_active.is_(True), PromoCode.valid_until >= now
+                    )
+                    # Swap the whole dict so readers never see a half-loaded index
+                    self._rules = {normalize(row.code): row._asdict() for row in rows}
+                    self._exhausted = set()
+                    self._version = version
+                    reloaded = True
+            finally:
+                db.close()
+            self._checked_at = time.monotonic()
+        return reloaded
+
+    def validate(self, code: str, ride_amount: Optional[float] = None) -> Dict:
+        rule = self.lookup(code)
+        if rule is None:
+            raise PromoRejected("Invalid promo code")
+        if rule["id"] in self._exhausted:
+            raise PromoRejected("Promo code usage limit reached")
+        return {**rule, "discount_amount": evaluate(rule, ride_amount)}
+
+
+promo_index = PromoIndex()
+
+
+@event.listens_for(PromoCode, "after_insert")
+@event.listens_for(PromoCode, "after_update")
+@event.listens_for(PromoCode, "after_delete")
+def note_promo_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info["promo_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_on_commit(session):
+    if session.info.pop("promo_changed", False):
+        promo_index.invalidate()
+    for index, key in session.info.pop("sized_counters", ()):
+        index._sized.add(key)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_promo_change(session):
+    session.info.pop("promo_changed", None)
+    session.info.pop("sized_counters", None)
+
+
+# ------------------------
+# Usage counting
+# ------------------------
+def shard_capacities(usage_limit: int, shards: int):
+    """Split usage_limit over the shards; the slices add up to the limit exactly"""
+    base, extra = divmod(usage_limit, shards)
+    return [base + (1 if shard < extra else 0) for shard in range(shards)]
+
+
+def size_counters(db: Session, rule: Dict, index: PromoIndex):
+    """Create (or resize after an edit) the counter rows of a campaign code.
+
+    The rows are written in the caller's transaction; the index remembers
+    them as sized only once it commits.
+    """
+    key = (rule["id"], rule["usage_limit"], rule["counter_shards"])
+    if key in index._sized:
+        return
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    table = PromoCounter.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.promo_id, table.c.shard],
+        set_={"capacity": statement.excluded.capacity}
+    )
+    db.execute(statement, [
+        {"promo_id": rule["id"], "shard": shard, "used": 0, "capacity": capacity}
+        for shard, capacity in enumerate(shard_capacities(rule["usage_limit"], rule["counter_shards"]))
+    ])
+    db.info.setdefault("sized_counters", []).append((index, key))
+
+
+def claim_sharded(db: Session, rule: Dict) -> bool:
+    """Take one use from a random shard that still has capacity.
+
+    Each shard is its own row, so concurrent redemptions of a campaign code
+    mostly lock different rows. A shard's conditional UPDATE can't go past
+    its capacity, and the capacities add up to usage_limit.
+    """
+    shards = list(range(rule["counter_shards"]))
+    start = random.randrange(len(shards))
+    for shard in shards[start:] + shards[:start]:
+        claimed = db.execute(
+            update(PromoCounter)
+            .where(
+                PromoCounter.promo_id == rule["id"],
+                PromoCounter.shard == shard,
+                PromoCounter.used < PromoCounter.capacity
+            )
+            .values(used=PromoCounter.used + 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            return True
+    return False
+
+
+def claim(db: Session, rule: Dict) -> bool:
+    if is_sharded(rule):
+        return claim_sharded(db, rule)
+    condition = [PromoCode.id == rule["id"]]
+    if rule["usage_limit"] is not None:
+        condition.append(PromoCode.used_count < rule["usage_limit"])
+    return db.execute(
+        update(PromoCode)
+        .where(*condition)
+        # Keep updated_at so a redemption doesn't look like an edit to the index
+        .values(used_count=PromoCode.used_count + 1, updated_at=PromoCode.updated_at)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def usage_count(db: Session, promo_id: int) -> int:
+    promo = db.get(PromoCode, promo_id)
+    if promo is None:
+        return 0
+    if promo.usage_limit is not None and (promo.counter_shards or 1) > 1:
+        return db.query(func.coalesce(func.sum(PromoCounter.used), 0)).filter(
+            PromoCounter.promo_id == promo_id
+        ).scalar()
+    return promo.used_count or 0
+
+
+def redeem(db: Session, code: str, user_id: int, ride_id: int, ride_amount: float,
+           index: Optional[PromoIndex] = None) -> Dict:
+    """Apply a promo code to a ride, counting the use atomically.
+
+    The use and the promo_usage row commit together; redeeming the same
+    code for the same ride again returns the original discount with
+    duplicate=True. Raises PromoRejected when the code doesn't apply or
+    its usage limit is reached.
+    """
+    index = index or promo_index
+    rule = index.validate(code, ride_amount)
+    existing = db.query(PromoUsage.discount_amount).filter(
+        PromoUsage.promo_id == rule["id"], PromoUsage.ride_id == ride_id
+    ).scalar()
+    if existing is not None:
+        return {"code": rule["code"], "discount_amount": existing, "duplicate": True}
+
+    if is_sharded(rule):
+        size_counters(db, rule, index)
+    if not claim(db, rule):
+        db.rollback()
+        index.mark_exhausted(rule["id"])
+        raise PromoRejected("Promo code usage limit reached")
+
+    db.add(PromoUsage(promo_id=rule["id"], user_id=user_id, ride_id=ride_id,
+                      discount_amount=rule["discount_amount"], created_at=datetime.utcnow()))
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent request redeemed it for this ride first; our claim is rolled back
+        db.rollback()
+        existing = db.query(PromoUsage.discount_amount).filter(
+            PromoUsage.promo_id == rule["id"], PromoUsage.ride_id == ride_id
+        ).scalar()
+        return {"code": rule["code"], "discount_amount": existing, "duplicate": True}
+    return {"code": rule["code"], "discount_amount": rule["discount_amount"], "duplicate": False}
+
+
+# ------------------------
+# Admin
+# ------------------------
+def create_promo(db: Session, code: str, description: str, discount_type: str, discount_value: float,
+                 valid_from: datetime, valid_until: datetime, campaign: bool = False, **rules) -> PromoCode:
+    """Add a promo code; campaign codes with a usage_limit get sharded counters"""
+    if discount_type not in ("percentage", "fixed"):
+        raise ValueError("discount_type must be percentage or fixed")
+    promo = PromoCode(
+        code=normalize(code), description=description, discount_type=discount_type,
+        discount_value=discount_value, valid_from=valid_from, valid_until=valid_until,
+        counter_shards=CAMPAIGN_SHARDS if campaign else 1, **rules
+    )
+    db.add(promo)
+    db.commit()
+    return promo
@@ -0,0 +1,261 @@
+# Incremental rating aggregates: running totals, decayed and Bayesian scores
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import case, event, func, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from models import User, Review, RatingAggregate
+from stats import status_change
+
+# A review's weight in the decayed sums halves every RATING_HALF_LIFE
+RATING_HALF_LIFE = timedelta(days=int(os.getenv("RATING_HALF_LIFE_DAYS", "180")))
+RATING_DECAY_EPOCH = datetime(2020, 1, 1)
+# Decayed sums are kept relative to the start of the current decay period
+# and rescaled when the next one starts, so weights stay below 2^256
+# instead of growing until they overflow a float (at 2^1024).
+RATING_DECAY_PERIOD = 256  # half-lives
+# Bayesian prior: every user starts as if they had RATING_PRIOR_WEIGHT
+# reviews of RATING_PRIOR_MEAN stars, so one 5-star review can't outrank
+# a hundred 4.9s
+RATING_PRIOR_MEAN = float(os.getenv("RATING_PRIOR_MEAN", "4.0"))
+RATING_PRIOR_WEIGHT = float(os.getenv("RATING_PRIOR_WEIGHT", "5"))
+
+
+def half_lives(at: datetime) -> float:
+    return (at - RATING_DECAY_EPOCH) / RATING_HALF_LIFE
+
+
+def decay_period(at: datetime) -> int:
+    return math.floor(half_lives(at) / RATING_DECAY_PERIOD)
+
+
+def decay_weight(at: datetime, period: int) -> float:
+    """Forward decay: weight grows with time instead of old weights shrinking.
+
+    Dividing the sums by decay_weight(now, period) gives the same result as
+    decaying every review to now, but adding a review never touches the
+    others, so updates stay O(1). Weights are relative to the start of
+    period, so the exponent stays below RATING_DECAY_PERIOD.
+    """
+    return 2.0 ** (half_lives(at) - period * RATING_DECAY_PERIOD)
+
+
+def rescale(period: int, to_period: int) -> float:
+    """Factor taking sums kept relative to one decay period to another"""
+    return 2.0 ** ((period - to_period) * RATING_DECAY_PERIOD)
+
+
+def bayesian(total: float, count: float) -> float:
+    return (RATING_PRIOR_WEIGHT * RATING_PRIOR_MEAN + total) / (RATING_PRIOR_WEIGHT + count)
+
+
+# ------------------------
+# Writes
+# ------------------------
+def apply_review(connection, rated_id: int, rating: int, created_at: Optional[datetime], sign: int):
+    """Add (sign=1) or remove (sign=-1) one review from rated_id's aggregate.
+
+    One upsert plus one primary-key UPDATE of users.rating_avg, on the
+    caller's connection so they commit with the review itself. Sums kept
+    for the previous decay period are rescaled to the current one on the
+    way; anything older has decayed to nothing.
+    """
+    now = datetime.utcnow()
+    period = decay_period(now)
+    weight = decay_weight(created_at or now, period)
+    insert = pg_insert if connection.dialect.name == "postgresql" else sqlite_insert
+    table = RatingAggregate.__table__
+    statement = insert(table).values(
+        rated_id=rated_id, count=sign, total=sign * rating,
+        decayed_total=sign * rating * weight, decayed_count=sign * weight, decay_period=period,
+        score=bayesian(sign * rating, sign), updated_at=now
+    )
+    count = table.c.count + statement.excluded.count
+    total = table.c.total + statement.excluded.total
+
+    def carried(column):
+        return case(
+            (table.c.decay_period == period, column),
+            (table.c.decay_period == period - 1, column * rescale(period - 1, period)),
+            # Another process still in the previous period (clock skew at the boundary)
+            (table.c.decay_period == period + 1, column * rescale(period + 1, period)),
+            else_=0.0
+        )
+
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.rated_id],
+        set_={
+            "count": count,
+            "total": total,
+            "decayed_total": carried(table.c.decayed_total) + statement.excluded.decayed_total,
+            "decayed_count": carried(table.c.decayed_count) + statement.excluded.decayed_count,
+            "decay_period": period,
+            "score": (RATING_PRIOR_WEIGHT * RATING_PRIOR_MEAN + total) / (RATING_PRIOR_WEIGHT + count),
+            "updated_at": statement.excluded.updated_at,
+        }
+    ))
+    sync_rating_avg(connection, rated_id)
+
+
+def sync_rating_avg(connection, rated_id: int):
+    aggregate = select(
+        func.coalesce(RatingAggregate.total * 1.0 / func.nullif(RatingAggregate.count, 0), 0.0)
+    ).where(RatingAggregate.rated_id == rated_id).scalar_subquery()
+    connection.execute(update(User).where(User.id == rated_id).values(rating_avg=aggregate))
+
+
+def load_previous_rating(target, value, oldvalue, initiator):
+    """No-op; active_history lets rating edits see the old value (as in stats.py)"""
+    return value
+
+
+for tracked in (Review.rating, Review.rated_id):
+    event.listen(tracked, "set", load_previous_rating, active_history=True, retval=True)
+
+
+@event.listens_for(Review, "after_insert")
+def count_review_insert(mapper, connection, target):
+    apply_review(connection, target.rated_id, target.rating, target.created_at, 1)
+
+
+@event.listens_for(Review, "after_delete")
+def count_review_delete(mapper, connection, target):
+    apply_review(connection, target.rated_id, target.rating, target.created_at, -1)
+
+
+@event.listens_for(Review, "after_update")
+def count_review_update(mapper, connection, target):
+    rating = status_change(target, "rating")
+    rated = status_change(target, "rated_id")
+    if not rating and not rated:
+        return
+    old_rating = rating[0] if rating else target.rating
+    old_rated = rated[0] if rated else target.rated_id
+    apply_review(connection, old_rated, old_rating, target.created_at, -1)
+    apply_review(connection, target.rated_id, target.rating, target.created_at, 1)
+
+
+# ------------------------
+# Reads
+# ------------------------
+def summarize(aggregate: Optional[RatingAggregate], now: Optional[datetime] = None) -> Dict:
+    """Plain, Bayesian and time-decayed views of one aggregate row"""
+    if aggregate is None or not aggregate.count:
+        return {"count": 0, "average": None, "score": RATING_PRIOR_MEAN,
+                "recent_average": None, "recent_score": RATING_PRIOR_MEAN}
+    # Dividing by decay_weight(now) as a multiplication, which underflows
+    # to 0 for long-idle rows rather than overflowing
+    scale = 2.0 ** -(half_lives(now or datetime.utcnow()) - aggregate.decay_period * RATING_DECAY_PERIOD)
+    recent_total = aggregate.decayed_total * scale
+    recent_count = aggregate.decayed_count * scale
+    return {
+        "count": aggregate.count,
+        "average": round(aggregate.total / aggregate.count, 2),
+        "score": round(aggregate.score, 3),
+        "recent_average": (round(aggregate.decayed_total / aggregate.decayed_count, 2)
+                           if aggregate.decayed_count else None),
+        "recent_score": round(bayesian(recent_total, recent_count), 3),
+    }
+
+
+def get_rating(db: Session, rated_id: int) -> Dict:
+    return summarize(db.get(RatingAggregate, rated_id))
+
+
+def get_ratings(db: Session, rated_ids: Iterable[int]) -> Dict[int, Dict]:
+    """Summaries for several users in one primary-key lookup (e.g. dispatch candidates)"""
+    rated_ids = list(rated_ids)
+    rows = {
+        aggregate.rated_id: aggregate
+        for aggregate in db.query(RatingAggregate).filter(RatingAggregate.rated_id.in_(rated_ids))
+    }
+    now = datetime.utcnow()
+    return {rated_id: summarize(rows.get(rated_id), now) for rated_id in rated_ids}
+
+
+# ------------------------
+# Reconciliation
+# ------------------------
+def review_totals(reviews: Iterable, period: int) -> Dict[int, Dict]:
+    """Aggregate values per rated user from (rated_id, rating, created_at) rows"""
+    now = datetime.utcnow()
+    totals: Dict[int, Dict] = {}
+    for rated_id, rating, created_at in reviews:
+        weight = decay_weight(created_at or now, period)
+        row = totals.setdefault(rated_id, {"count": 0, "total": 0, "decayed_total": 0.0, "decayed_count": 0.0})
+        row["count"] += 1
+        row["total"] += rating
+        row["decayed_total"] += rating * weight
+        row["decayed_count"] += weight
+    return totals
+
+
+def rebuild_aggregate(db: Session, rated_id: int):
+    """Recompute one user's aggregate from their reviews"""
+    period = decay_period(datetime.utcnow())
+    reviews = db.query(Review.rated_id, Review.rating, Review.created_at).filter(Review.rated_id == rated_id)
+    totals = review_totals(reviews, period).get(
+        rated_id, {"count": 0, "total": 0, "decayed_total": 0.0, "decayed_count": 0.0}
+    )
+
+    values = {
+        **totals, "decay_period": period,
+        "score": bayesian(totals["total"], totals["count"]), "updated_at": datetime.utcnow()
+    }
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    statement = insert(RatingAggregate.__table__).values(rated_id=rated_id, **values)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[RatingAggregate.__table__.c.rated_id],
+        set_={name: statement.excluded[name] for name in values}
+    ))
+    sync_rating_avg(db.connection(), rated_id)
+
+
+def drifted_sums(expected: Optional[Dict], stored: Optional[Dict]) -> bool:
+    expected = expected or {"count": 0, "total": 0, "decayed_total": 0.0, "decayed_count": 0.0}
+    stored = stored or {"count": 0, "total": 0, "decayed_total": 0.0, "decayed_count": 0.0}
+    if (expected["count"], expected["total"]) != (stored["count"], stored["total"]):
+        return True
+    return not all(
+        math.isclose(expected[name], stored[name], rel_tol=1e-6, abs_tol=1e-9)
+        for name in ("decayed_total", "decayed_count")
+    )
+
+
+def reconcile_ratings(db: Session, rated_ids: Optional[Iterable[int]] = None) -> Dict:
+    """Compare running totals and decayed sums with the reviews and rebuild any that drifted.
+
+    Catches reviews written without the ORM events (bulk imports, raw SQL)
+    and backfills aggregates for reviews that predate them. The decayed
+    sums are recomputed in Python (SQL has no portable power()), streaming
+    the reviews once.
+    """
+    period = decay_period(datetime.utcnow())
+    reviews = db.query(Review.rated_id, Review.rating, Review.created_at)
+    stored_query = db.query(
+        RatingAggregate.rated_id, RatingAggregate.count, RatingAggregate.total,
+        RatingAggregate.decayed_total, RatingAggregate.decayed_count, RatingAggregate.decay_period
+    )
+    if rated_ids is not None:
+        rated_ids = list(rated_ids)
+        reviews = reviews.filter(Review.rated_id.in_(rated_ids))
+        stored_query = stored_query.filter(RatingAggregate.rated_id.in_(rated_ids))
+
+    expected = review_totals(reviews.yield_per(5000), period)
+    stored = {}
+    for rated_id, count, total, decayed_total, decayed_count, stored_period in stored_query:
+        if count or total:
+            factor = rescale(stored_period, period)
+            stored[rated_id] = {"count": count, "total": total, "decayed_total": decayed_total * factor,
+                                "decayed_count": decayed_count * factor}
+    drifted = sorted(rated_id for rated_id in expected.keys() | stored.keys()
+                     if drifted_sums(expected.get(rated_id), stored.get(rated_id)))
+    for rated_id in drifted:
+        rebuild_aggregate(db, rated_id)
+    db.commit()
+    return {"checked": len(expected.keys() | stored.keys()), "rebuilt": len(drifted), "rated_ids": drifted}
@@ -0,0 +1,173 @@
+# Read-replica session routing with lag checks and read-your-writes stickiness
+import hashlib
+import math
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.requests import HTTPConnection
+from starlette.responses import Response
+
+MAX_REPLICA_LAG_SECONDS = 2.0
+STICKY_SECONDS = 5.0  # reads stay on the primary this long after a client's write
+LAG_CHECK_INTERVAL = 1.0  # the lag probe runs at most once per interval
+STICKY_COOKIE = "read_primary_until"
+# Lets callers without a cookie jar or a token keep their own stickiness
+CLIENT_ID_HEADER = "x-client-id"
+
+
+# ------------------------
+# Lag probes
+# ------------------------
+def postgres_replica_lag(connection: Connection) -> float:
+    """Seconds a streaming standby is behind, 0 when fully replayed"""
+    lag = connection.execute(text("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """)).scalar()
+    return float(lag or 0.0)
+
+
+def default_lag_probe(connection: Connection) -> float:
+    # Other dialects have no replication status to ask; treat them as caught up.
+    if connection.dialect.name == "postgresql":
+        return postgres_replica_lag(connection)
+    return 0.0
+
+
+def client_key(connection: Optional[HTTPConnection]) -> Optional[str]:
+    """Identify the caller by bearer token or X-Client-ID header.
+
+    Not by address: behind a proxy or NAT every anonymous caller shares one,
+    and a single write would pin all of their reads to the primary. Other
+    anonymous callers are tracked by the sticky cookie alone.
+    """
+    if connection is None:
+        return None
+    authorization = connection.headers.get("authorization")
+    if authorization:
+        return "token:" + hashlib.sha256(authorization.encode()).hexdigest()[:16]
+    client_id = connection.headers.get(CLIENT_ID_HEADER)
+    if client_id and len(client_id) <= 128:
+        return "client:" + client_id
+    return None
+
+
+# ------------------------
+# Router
+# ------------------------
+class SessionRouter:
+    """Hand out primary sessions for writes and replica sessions for reads.
+
+    Reads fall back to the primary when no replica is configured, when the
+    replica is further behind than max_lag (or cannot be probed), and for
+    sticky_for seconds after the same client committed a write, so a rider
+    polling right after booking sees their own ride.
+    """
+
+    def __init__(self, primary: sessionmaker, replica: Optional[sessionmaker] = None,
+                 max_lag: float = MAX_REPLICA_LAG_SECONDS, sticky_for: float = STICKY_SECONDS,
+                 lag_probe: Callable[[Connection], float] = default_lag_probe):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.sticky_for = sticky_for
+        self.lag_probe = lag_probe
+
+        self._sticky_until: Dict[str, float] = {}
+        self._lag = 0.0
+        self._lag_checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+        event.listen(primary, "after_flush", self._record_flush)
+        event.listen(primary, "after_commit", self._record_commit)
+        event.listen(primary, "after_rollback", self._discard_flush)
+        if replica is not None:
+            event.listen(replica, "before_flush", self._refuse_flush)
+
+    # Sessions
+    def write_session(self, connection: Optional[HTTPConnection] = None,
+                      response: Optional[Response] = None) -> Session:
+        session = self.primary()
+        session.info["client_key"] = client_key(connection)
+        session.info["response"] = response
+        return session
+
+    def read_session(self, connection: Optional[HTTPConnection] = None) -> Session:
+        if self.use_replica(connection):
+            return self.replica()
+        return self.primary()
+
+    def use_replica(self, connection: Optional[HTTPConnection] = None) -> bool:
+        if self.replica is None or self.is_sticky(connection):
+            return False
+        return self.replica_lag() <= self.max_lag
+
+    # Read-your-writes
+    def mark_write(self, key: Optional[str], response: Optional[Response] = None):
+        until = time.time() + self.sticky_for
+        if key:
+            with self._lock:
+                self._sticky_until[key] = until
+                if len(self._sticky_until) > 10000:
+                    now = time.time()
+                    self._sticky_until = {
+                        k: expiry for k, expiry in self._sticky_until.items() if expiry > now
+                    }
+        # The cookie carries stickiness to other workers behind the load balancer
+        if response is not None:
+            response.set_cookie(STICKY_COOKIE, f"{until:.3f}", max_age=math.ceil(self.sticky_for),
+                                httponly=True, samesite="lax")
+
+    def is_sticky(self, connection: Optional[HTTPConnection]) -> bool:
+        if connection is None:
+            return False
+        now = time.time()
+        key = client_key(connection)
+        if key and self._sticky_until.get(key, 0.0) > now:
+            return True
+        try:
+            return float(connection.cookies.get(STICKY_COOKIE, 0)) > now
+        except ValueError:
+            return False
+
+    # Replica lag
+    def replica_lag(self) -> float:
+        """Last measured replica lag in seconds (inf when the replica is unreachable)"""
+        now = time.monotonic()
+        with self._lock:
+            if self._lag_checked_at is not None and now - self._lag_checked_at < LAG_CHECK_INTERVAL:
+                return self._lag
+            # Claim this probe; concurrent callers keep using the previous value
+            self._lag_checked_at = now
+
+        try:
+            with self.replica() as session:
+                lag = self.lag_probe(session.connection())
+        except Exception:
+            lag = math.inf
+        self._lag = lag
+        return lag
+
+    # Session events
+    @staticmethod
+    def _record_flush(session, flush_context):
+        session.info["wrote"] = True
+
+    def _record_commit(self, session):
+        if session.info.pop("wrote", False):
+            self.mark_write(session.info.get("client_key"), session.info.get("response"))
+
+    @staticmethod
+    def _discard_flush(session):
+        session.info.pop("wrote", None)
+
+    @staticmethod
+    def _refuse_flush(session, flush_context, instances):
+        raise RuntimeError("Replica sessions are read-only; use get_db for writes")
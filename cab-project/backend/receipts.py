@@ -0,0 +1,431 @@
+# Receipt pipeline: cached templates, batch PDF rendering and the receipts table
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from typing import Dict, List, Optional
+
+from jinja2 import Environment
+from sqlalchemy import or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased
+
+from models import User, Ride
+from models_advanced import Receipt
+
+RECEIPTS_DIR = os.getenv("RECEIPTS_DIR", "receipts")
+RECEIPT_WORKERS = int(os.getenv("RECEIPT_WORKERS", str(os.cpu_count() or 1)))
+RECEIPT_BATCH_SIZE = 200  # receipts planned, rendered and recorded per round
+# An email run that has held its claim on a receipt this long is presumed dead
+RECEIPT_EMAIL_LEASE = timedelta(minutes=15)
+
+RECEIPT_CSS = """
+body { font-family: Arial, sans-serif; margin: 20px; }
+.header { text-align: center; margin-bottom: 30px; }
+.details { margin: 20px 0; }
+.total { font-weight: bold; font-size: 18px; }
+"""
+
+RECEIPT_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>Ride Receipt</title>
+</head>
+<body>
+    <div class="header">
+        <h1>Cab Booking Receipt</h1>
+        <p>Receipt #{{ receipt_number }}</p>
+    </div>
+
+    <div class="details">
+        <p><strong>Ride ID:</strong> {{ ride_id }}</p>
+        <p><strong>Date:</strong> {{ date }}</p>
+        <p><strong>From:</strong> {{ pickup_address }}</p>
+        <p><strong>To:</strong> {{ drop_address }}</p>
+        <p><strong>Driver:</strong> {{ driver_name }}</p>
+        <p><strong>Distance:</strong> {{ distance }} km</p>
+        <p><strong>Duration:</strong> {{ duration }} minutes</p>
+    </div>
+
+    <div class="total">
+        <p>Total Fare: ₹{{ fare_amount }}</p>
+    </div>
+</body>
+</html>
+"""
+
+
+def receipt_number(ride_id: int) -> str:
+    return f"RCPT-{ride_id:08d}"
+
+
+def receipt_path(number: str, directory: str = RECEIPTS_DIR) -> str:
+    return os.path.join(directory, f"{number}.pdf")
+
+
+# ------------------------
+# Rendering (once-per-process setup is cached)
+# ------------------------
+@lru_cache(maxsize=None)
+def receipt_template():
+    """Compiled once per process instead of once per receipt"""
+    return Environment(autoescape=True).from_string(RECEIPT_TEMPLATE)
+
+
+@lru_cache(maxsize=None)
+def receipt_stylesheet():
+    """The parsed stylesheet and font configuration, shared by every receipt"""
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    fonts = FontConfiguration()
+    return CSS(string=RECEIPT_CSS, font_config=fonts), fonts
+
+
+def render_html(context: Dict) -> str:
+    return receipt_template().render(**context)
+
+
+def write_receipt(context: Dict, directory: str = RECEIPTS_DIR) -> Dict:
+    """Render one receipt to <directory>/<receipt_number>.pdf.
+
+    Written to a temporary file and renamed, so a crash never leaves a
+    truncated PDF at the final path; the temporary file is removed if
+    rendering fails. Errors are returned, not raised, so one bad receipt
+    doesn't fail the rest of its batch.
+    """
+    from weasyprint import HTML
+
+    temporary = None
+    try:
+        stylesheet, fonts = receipt_stylesheet()
+        os.makedirs(directory, exist_ok=True)
+        path = receipt_path(context["receipt_number"], directory)
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix=".partial")
+        with os.fdopen(handle, "wb") as output:
+            HTML(string=render_html(context)).write_pdf(output, stylesheets=[stylesheet], font_config=fonts)
+        os.replace(temporary, path)
+        return {"ride_id": context["ride_id"], "status": "success", "pdf_path": path}
+    except Exception as e:
+        if temporary is not None and os.path.exists(temporary):
+            os.unlink(temporary)
+        return {"ride_id": context["ride_id"], "status": "error", "message": str(e)}
+
+
+def warm_worker():
+    """Pool initializer: pay for template compilation and CSS parsing up front"""
+    receipt_template()
+    receipt_stylesheet()
+
+
+def in_daemon_process() -> bool:
+    import billiard
+
+    return multiprocessing.current_process().daemon or billiard.current_process().daemon
+
+
+def render_pool(workers: int):
+    """A process pool that can start here.
+
+    Celery's prefork children are daemonic, and the standard library
+    won't start child processes from those; billiard, Celery's fork of
+    multiprocessing, does.
+    """
+    if in_daemon_process():
+        from billiard import Pool
+
+        return Pool(processes=workers, initializer=warm_worker)
+    return ProcessPoolExecutor(max_workers=workers, initializer=warm_worker)
+
+
+def render_batch(contexts: List[Dict], workers: int = RECEIPT_WORKERS,
+                 directory: str = RECEIPTS_DIR) -> List[Dict]:
+    """Render receipts across a process pool (PDF layout is CPU bound).
+
+    With workers=1 the batch is rendered in this process, still with the
+    cached template and stylesheet.
+    """
+    if not contexts:
+        return []
+    workers = min(workers, len(contexts))
+    if workers <= 1:
+        return [write_receipt(context, directory) for context in contexts]
+
+    chunksize = max(1, len(contexts) // (workers * 4))
+    with render_pool(workers) as pool:
+        return list(pool.map(partial(write_receipt, directory=directory), contexts, chunksize=chunksize))
+
+
+# ------------------------
+# Receipts table
+# ------------------------
+def plan_receipts(db: Session, limit: int = RECEIPT_BATCH_SIZE) -> int:
+    """Add receipt rows (without a PDF yet) for completed rides that have none.
+
+    The unique ride_id makes this safe to run from several workers: a
+    ride gets exactly one receipt row and one receipt number.
+    """
+    ride_ids = [
+        ride_id for ride_id, in db.query(Ride.id).outerjoin(Receipt, Receipt.ride_id == Ride.id).filter(
+            Ride.status == "completed", Receipt.id.is_(None)
+        ).order_by(Ride.id).limit(limit)
+    ]
+    if not ride_ids:
+        return 0
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    result = db.execute(insert(Receipt.__table__).on_conflict_do_nothing(index_elements=["ride_id"]), [
+        {"ride_id": ride_id, "receipt_number": receipt_number(ride_id), "email_sent": False,
+         "generated_at": None}
+        for ride_id in ride_ids
+    ])
+    db.commit()
+    return result.rowcount
+
+
+def pending_receipts(db: Session, after_id: int = 0, limit: int = RECEIPT_BATCH_SIZE) -> List[Dict]:
+    """Template contexts for receipt rows that have no PDF yet, oldest first"""
+    driver = aliased(User)
+    rows = db.query(Receipt.id, Receipt.receipt_number, Ride, driver.name).join(
+        Ride, Ride.id == Receipt.ride_id
+    ).outerjoin(driver, driver.id == Ride.driver_id).filter(
+        Receipt.pdf_path.is_(None), Receipt.id > after_id
+    ).order_by(Receipt.id).limit(limit)
+    return [
+        {**ride_context(ride, number, driver_name), "receipt_id": receipt_id}
+        for receipt_id, number, ride, driver_name in rows
+    ]
+
+
+def ride_context(ride: Ride, number: str, driver_name: Optional[str]) -> Dict:
+    finished = ride.completed_at or ride.created_at or datetime.utcnow()
+    return {
+        "ride_id": ride.id,
+        "receipt_number": number,
+        "date": finished.strftime("%d %b %Y, %H:%M"),
+        "pickup_address": ride.pickup_address or f"{ride.pickup_lat:.5f}, {ride.pickup_lng:.5f}",
+        "drop_address": ride.drop_address or f"{ride.drop_lat:.5f}, {ride.drop_lng:.5f}",
+        "driver_name": driver_name or "-",
+        "distance": round((ride.distance_meters or 0) / 1000, 1),
+        "duration": round((ride.duration_secs or 0) / 60),
+        "fare_amount": f"{ride.fare_actual if ride.fare_actual is not None else ride.fare_estimate:.2f}",
+    }
+
+
+def record_receipts(db: Session, results: List[Dict]) -> int:
+    """Store the PDF paths; a receipt another run already recorded is left alone"""
+    now = datetime.utcnow()
+    recorded = 0
+    for result in results:
+        if result["status"] != "success":
+            continue
+        recorded += db.execute(
+            update(Receipt)
+            .where(Receipt.ride_id == result["ride_id"], Receipt.pdf_path.is_(None))
+            .values(pdf_path=result["pdf_path"], generated_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    db.commit()
+    return recorded
+
+
+def generate_receipts(db: Session, limit: Optional[int] = None, workers: int = RECEIPT_WORKERS,
+                      batch_size: int = RECEIPT_BATCH_SIZE, directory: str = RECEIPTS_DIR) -> Dict[str, int]:
+    """Work through the receipt backlog in batches.
+
+    Each round plans rows for newly completed rides, renders the PDFs that
+    are missing on the pool and records them. Receipts that fail to render
+    keep pdf_path NULL and are picked up again by the next run.
+    """
+    summary = {"rendered": 0, "failed": 0}
+    last_id = 0
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        plan_receipts(db, size)
+        contexts = pending_receipts(db, last_id, size)
+        if not contexts:
+            break
+        results = render_batch(contexts, workers, directory)
+        summary["rendered"] += record_receipts(db, results)
+        summary["failed"] += sum(1 for result in results if result["status"] != "success")
+        last_id = contexts[-1]["receipt_id"]
+        if remaining is not None:
+            remaining -= len(contexts)
+    return summary
+
+
+def generate_receipt(db: Session, ride_id: int, directory: str = RECEIPTS_DIR) -> Dict:
+    """Receipt for one ride, rendered only if it doesn't have a PDF yet"""
+    ride = db.get(Ride, ride_id)
+    if ride is None:
+        return {"ride_id": ride_id, "status": "error", "message": "Ride not found"}
+
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    db.execute(insert(Receipt.__table__).values(
+        ride_id=ride_id, receipt_number=receipt_number(ride_id), email_sent=False, generated_at=None
+    ).on_conflict_do_nothing(index_elements=["ride_id"]))
+    db.commit()
+
+    receipt = db.query(Receipt).filter(Receipt.ride_id == ride_id).one()
+    if receipt.pdf_path and os.path.exists(receipt.pdf_path):
+        return {"ride_id": ride_id, "status": "success", "pdf_path": receipt.pdf_path, "duplicate": True}
+    driver = db.get(User, ride.driver_id) if ride.driver_id else None
+    result = write_receipt(ride_context(ride, receipt.receipt_number, driver and driver.name), directory)
+    if result["status"] == "success":
+        # Re-rendering a receipt whose file went missing replaces its path
+        receipt.pdf_path = result["pdf_path"]
+        receipt.generated_at = datetime.utcnow()
+        db.commit()
+    return {**result, "duplicate": False}
+
+
+# ------------------------
+# Receipt emails
+# ------------------------
+RECEIPT_EMAIL_BODY = """Dear Customer,
+
+Thank you for using our cab service. Please find your ride receipt attached.
+
+Ride Details:
+- From: {pickup_address}
+- To: {drop_address}
+- Fare: ₹{fare_amount}
+
+Best regards,
+Cab Booking Team
+"""
+
+
+def receipt_email(sender: str, user_email: str, pdf_path: str, ride_data: Dict):
+    from mailer import build_message
+
+    return build_message(sender, user_email, f"Ride Receipt - #{ride_data['receipt_number']}",
+                         RECEIPT_EMAIL_BODY.format(**ride_data), attachments=[pdf_path])
+
+
+def claim_receipt_emails(db: Session, limit: int) -> List[int]:
+    """Claim up to limit rendered, unsent receipts for this run; returns their ids.
+
+    The claim is a conditional UPDATE, so overlapping runs never take the
+    same receipt. A claim older than RECEIPT_EMAIL_LEASE is taken over.
+    """
+    now = datetime.utcnow()
+    unclaimed = or_(Receipt.email_claimed_at.is_(None), Receipt.email_claimed_at < now - RECEIPT_EMAIL_LEASE)
+    candidates = select(Receipt.id).where(
+        Receipt.pdf_path.isnot(None), Receipt.email_sent.is_(False), unclaimed
+    ).order_by(Receipt.id).limit(limit)
+    if db.get_bind().dialect.name == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+    ids = db.scalars(candidates).all()
+    if not ids:
+        return []
+    db.execute(
+        update(Receipt).where(Receipt.id.in_(ids), unclaimed).values(email_claimed_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return db.scalars(select(Receipt.id).where(Receipt.id.in_(ids), Receipt.email_claimed_at == now)).all()
+
+
+def email_receipts(db: Session, mailer, limit: int = RECEIPT_BATCH_SIZE) -> Dict[str, int]:
+    """Email rendered receipts that haven't been sent, one batch over the mailer's pool.
+
+    Only receipts this run claimed are sent. Each is marked sent as soon as
+    its message is delivered; a failed one is released for the next run.
+    """
+    claimed = claim_receipt_emails(db, limit)
+    if not claimed:
+        return {"sent": 0, "failed": 0}
+
+    rider = aliased(User)
+    driver = aliased(User)
+    rows = db.query(Receipt.id, Receipt.receipt_number, Receipt.pdf_path, Ride, rider.email, driver.name).join(
+        Ride, Ride.id == Receipt.ride_id
+    ).join(rider, rider.id == Ride.rider_id).outerjoin(driver, driver.id == Ride.driver_id).filter(
+        Receipt.id.in_(claimed)
+    ).order_by(Receipt.id).all()
+
+    messages = [
+        receipt_email(mailer.sender, email, pdf_path, ride_context(ride, number, driver_name))
+        for _, number, pdf_path, ride, email, driver_name in rows
+    ]
+    sent = 0
+    for (receipt_id, *_), result in zip(rows, mailer.send_each(messages)):
+        delivered = result["status"] == "sent"
+        db.execute(
+            update(Receipt).where(Receipt.id == receipt_id)
+            .values(**({"email_sent": True} if delivered else {"email_claimed_at": None}))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        sent += delivered
+    return {"sent": sent, "failed": len(rows) - sent}
+
+
+# ------------------------
+# Benchmark
+# ------------------------
+def render_unbatched(context: Dict, directory: str) -> str:
+    """The old per-ride path: new Template and inline CSS for every receipt"""
+    from jinja2 import Template
+    from weasyprint import HTML
+
+    html = Template(RECEIPT_TEMPLATE.replace("</head>", f"<style>{RECEIPT_CSS}</style></head>")).render(**context)
+    path = receipt_path(context["receipt_number"], directory)
+    HTML(string=html).write_pdf(path)
+    return path
+
+
+def run_benchmark(count: int, workers: int) -> Dict:
+    contexts = [
+        {
+            "ride_id": ride_id, "receipt_number": receipt_number(ride_id), "date": "15 Jan 2024, 18:30",
+            "pickup_address": "Connaught Place, New Delhi", "drop_address": "Sector 18, Noida",
+            "driver_name": "Ravi Kumar", "distance": 18.4, "duration": 42, "fare_amount": "320.50",
+        }
+        for ride_id in range(1, count + 1)
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        for context in contexts:
+            render_unbatched(context, directory)
+        unbatched = time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = render_batch(contexts, workers, directory)
+        batched = time.perf_counter() - started
+
+    return {
+        "receipts": count,
+        "workers": workers,
+        "failed": sum(1 for result in results if result["status"] != "success"),
+        "unbatched_per_second": round(count / unbatched, 1),
+        "batched_per_second": round(count / batched, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the receipt backlog, or benchmark receipt rendering")
+    parser.add_argument("--benchmark", action="store_true", help="render synthetic receipts and report receipts/sec")
+    parser.add_argument("--count", type=int, default=200, help="receipts to render in the benchmark")
+    parser.add_argument("--workers", type=int, default=RECEIPT_WORKERS)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(json.dumps(run_benchmark(args.count, args.workers), indent=2))
+    else:
+        from db import SessionLocal
+
+        db = SessionLocal()
+        try:
+            print(json.dumps(generate_receipts(db, workers=args.workers), indent=2))
+        finally:
+            db.close()
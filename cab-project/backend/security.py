@@ -1,54 +1,184 @@
 # Security middleware and rate limiting
 from fastapi import Request, HTTPException
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBearer
+import asyncio
+import ipaddress
+import math
+import os
 import redis
+import redis.asyncio as aioredis
 import time
 import hashlib
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+# Rate limits are shared across processes through Redis when a URL is set;
+# without one (or while Redis is unreachable) each process limits locally
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", os.getenv("REDIS_URL"))
+RATE_LIMIT_REDIS_TIMEOUT = float(os.getenv("RATE_LIMIT_REDIS_TIMEOUT", "0.05"))
+# After a Redis error, limit locally for this long before trying Redis again
+RATE_LIMIT_RETRY_SECONDS = 5.0
+# Addresses or networks of our own proxies, e.g. "10.0.0.0/8,127.0.0.1".
+# X-Forwarded-For is believed only from these: clients can send anything.
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.getenv("TRUSTED_PROXIES", "").split(",") if proxy.strip()
+]
+
+# Refill, take one token and set the expiry in a single atomic round trip
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+def retry_after(tokens: float, rate: float) -> float:
+    return max(1 - tokens, 0) / rate
+
+
+class LocalBuckets:
+    """Token buckets for this process, least recently used evicted first"""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> Tuple[bool, float]:
+        """(allowed, seconds until a token is available)"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0.0
+        return False, retry_after(bucket[0], rate)
+
+
+class RedisBuckets:
+    """Token buckets shared through Redis, one EVALSHA per check"""
+
+    def __init__(self, url: str, timeout: float = RATE_LIMIT_REDIS_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.down_until = 0.0
+        self._client = None
+        self._script = None
+        self._loop = None
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def mark_down(self):
+        self.down_until = time.monotonic() + RATE_LIMIT_RETRY_SECONDS
+
+    async def take(self, key: str, rate: float, burst: float, now: float) -> Tuple[bool, float]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # redis.asyncio connections belong to the loop that opened them
+            self._client = aioredis.Redis.from_url(self.url, socket_timeout=self.timeout,
+                                                   socket_connect_timeout=self.timeout)
+            self._script = self._client.register_script(TOKEN_BUCKET_SCRIPT)
+            self._loop = loop
+        allowed, tokens = await self._script(keys=[key], args=[rate, burst, now])
+        return bool(allowed), 0.0 if allowed else retry_after(float(tokens), rate)
+
+
+local_buckets = LocalBuckets()
+redis_buckets = RedisBuckets(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else None
 
-# Redis client for rate limiting
-redis_client = redis.Redis(host='localhost', port=6379, db=1, decode_responses=True)
 
 class RateLimiter:
-    def __init__(self, requests_per_minute: int = 60):
+    """Token bucket of requests_per_minute, allowing bursts of up to burst requests.
+
+    The local bucket is checked first: this process alone having used up
+    the limit means the shared one is used up too, so floods are turned
+    away without a Redis round trip. It is also what limits while Redis
+    is unreachable.
+    """
+
+    def __init__(self, requests_per_minute: int = 60, burst: Optional[int] = None):
         self.requests_per_minute = requests_per_minute
-        self.window_size = 60  # 1 minute window
-    
-    def is_allowed(self, identifier: str, endpoint: str) -> bool:
-        """Check if request is allowed based on rate limit"""
+        self.rate = requests_per_minute / 60
+        self.burst = burst or requests_per_minute
+
+    async def check(self, identifier: str, endpoint: str) -> Tuple[bool, float]:
+        """(allowed, seconds to wait before retrying)"""
         key = f"rate_limit:{identifier}:{endpoint}"
-        current_time = int(time.time())
-        window_start = current_time - (current_time % self.window_size)
-        
+        allowed, wait = local_buckets.take(key, self.rate, self.burst, time.monotonic())
+        if not allowed or redis_buckets is None or not redis_buckets.available():
+            return allowed, wait
         try:
-            # Get current count for this window
-            current_count = redis_client.get(f"{key}:{window_start}")
-            current_count = int(current_count) if current_count else 0
-            
-            if current_count >= self.requests_per_minute:
-                return False
-            
-            # Increment counter
-            redis_client.incr(f"{key}:{window_start}")
-            redis_client.expire(f"{key}:{window_start}", self.window_size)
-            
-            return True
-            
-        except Exception:
-            # If Redis is down, allow the request
-            return True
+            return await redis_buckets.take(key, self.rate, self.burst, time.time())
+        except (redis.RedisError, OSError, asyncio.TimeoutError):
+            redis_buckets.mark_down()
+            return allowed, wait
+
+    async def is_allowed(self, identifier: str, endpoint: str) -> bool:
+        """Check if request is allowed based on rate limit"""
+        allowed, _ = await self.check(identifier, endpoint)
+        return allowed
 
 # Rate limiter instances
 general_limiter = RateLimiter(requests_per_minute=60)
 auth_limiter = RateLimiter(requests_per_minute=10)  # Stricter for auth endpoints
 booking_limiter = RateLimiter(requests_per_minute=20)  # Moderate for bookings
 
-def get_client_ip(request: Request) -> str:
-    """Extract client IP from request"""
-    forwarded = request.headers.get("X-Forwarded-For")
-    if forwarded:
-        return forwarded.split(",")[0].strip()
-    return request.client.host
+# (method or None for any, path prefix or prefixes, limiter); the first match
+# applies, and the prefixes of a rule share one budget
+RateLimitRule = Tuple[Optional[str], Union[str, Tuple[str, ...]], RateLimiter]
+RATE_LIMIT_RULES: List[RateLimitRule] = [
+    # Not all of /api/auth/: /api/auth/session is checked on every page load
+    ("POST", ("/api/auth/login", "/api/auth/register"), auth_limiter),
+    ("POST", "/api/rides/request", booking_limiter),
+    ("POST", "/bookings", booking_limiter),
+]
+
+def is_trusted_proxy(address: str, trusted: Iterable = TRUSTED_PROXIES) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted)
+
+def get_client_ip(scope, trusted: Iterable = TRUSTED_PROXIES) -> str:
+    """The connecting peer's address, or when that is a trusted proxy, the
+    nearest X-Forwarded-For hop that is not one (read from the right: hops
+    left of the first untrusted one are whatever the client sent)"""
+    trusted = list(trusted)
+    client = scope.get("client")
+    address = client[0] if client else "unknown"
+    if not is_trusted_proxy(address, trusted):
+        return address
+    hops = [
+        hop.strip()
+        for name, value in scope.get("headers", ()) if name == b"x-forwarded-for"
+        for hop in value.decode("latin-1").split(",") if hop.strip()
+    ]
+    for hop in reversed(hops):
+        address = hop
+        if not is_trusted_proxy(hop, trusted):
+            break
+    return address
 
 def validate_input_security(data: str) -> bool:
     """Basic input validation for security"""
@@ -92,4 +222,73 @@ class SecurityMiddleware:
             
             await self.app(scope, receive, send_wrapper)
         else:
-            await self.app(scope, receive, send)
\ No newline at end of file
+            await self.app(scope, receive, send)
+
+
+class RateLimitMiddleware:
+    """Per-route rate limits by client IP, answering 429 with Retry-After"""
+
+    def __init__(self, app, rules: Iterable[RateLimitRule] = RATE_LIMIT_RULES,
+                 trusted_proxies: Iterable = TRUSTED_PROXIES):
+        self.app = app
+        # (method, prefixes, limiter, budget name)
+        self.rules = [
+            (method, (prefixes,) if isinstance(prefixes, str) else tuple(prefixes), limiter,
+             prefixes if isinstance(prefixes, str) else ",".join(prefixes))
+            for method, prefixes, limiter in rules
+        ]
+        self.trusted_proxies = list(trusted_proxies)
+
+    def match(self, method: str, path: str) -> Optional[Tuple[Optional[str], Tuple[str, ...], RateLimiter, str]]:
+        for rule in self.rules:
+            if (rule[0] is None or rule[0] == method) and path.startswith(rule[1]):
+                return rule
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            rule = self.match(scope["method"], scope["path"])
+            if rule is not None:
+                # Routes of one rule share a budget, e.g. login and register
+                allowed, wait = await rule[2].check(get_client_ip(scope, self.trusted_proxies), rule[3])
+                if not allowed:
+                    response = JSONResponse({"detail": "Too many requests"}, status_code=429,
+                                            headers={"Retry-After": str(math.ceil(wait))})
+                    await response(scope, receive, send)
+                    return
+        await self.app(scope, receive, send)
+
+
+async def measure_overhead(requests: int, clients: int) -> Dict:
+    async def app(scope, receive, send):
+        pass
+
+    limited = RateLimitMiddleware(app, [(None, "/", RateLimiter(requests_per_minute=10 ** 9))])
+    scopes = [
+        {"type": "http", "method": "POST", "path": "/bookings", "headers": [],
+         "client": (f"10.0.{index // 256}.{index % 256}", 50000)}
+        for index in range(clients)
+    ]
+    timings = {}
+    for name, handler in (("bare", app), ("limited", limited)):
+        started = time.perf_counter()
+        for index in range(requests):
+            await handler(scopes[index % clients], None, None)
+        timings[name] = time.perf_counter() - started
+    return {
+        "requests": requests,
+        "clients": clients,
+        "backend": "redis" if redis_buckets is not None else "local",
+        "overhead_ms_per_request": round((timings["limited"] - timings["bare"]) / requests * 1000, 4),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Measure the rate limiting middleware's per-request overhead")
+    parser.add_argument("--requests", type=int, default=100_000)
+    parser.add_argument("--clients", type=int, default=10_000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(measure_overhead(args.requests, args.clients)), indent=2))
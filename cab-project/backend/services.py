@@ -1,7 +1,13 @@
 # Map integration and business logic
+import structlog
+
 from leaflet_service import leaflet_service
+from tracing import traced
 from typing import Optional
 
+log = structlog.get_logger(__name__)
+
+@traced("maps.directions")
 def get_directions(pickup_lat: float, pickup_lng: float, drop_lat: float, drop_lng: float) -> Optional[dict]:
     """Get directions and distance using Leaflet service"""
     try:
@@ -14,9 +20,10 @@ def get_directions(pickup_lat: float, pickup_lng: float, drop_lat: float, drop_l
             "route": "Leaflet route data"
         }
     except Exception as e:
-        print(f"Directions API error: {e}")
+        log.warning("directions_failed", error=str(e))
         return None
 
+@traced("fare.estimate")
 def get_fare_estimate(distance_meters: int, duration_seconds: int) -> float:
     """Calculate fare based on distance and time"""
     base_fare = 50.0  # Base fare in rupees
@@ -29,6 +36,7 @@ def get_fare_estimate(distance_meters: int, duration_seconds: int) -> float:
     fare = base_fare + (distance_km * per_km_rate) + (duration_minutes * per_minute_rate)
     return round(fare, 2)
 
+@traced("maps.nearby_drivers")
 def find_nearby_drivers(pickup_lat: float, pickup_lng: float, radius_km: float = 5.0):
     """Find nearby available drivers using Leaflet service"""
     try:
@@ -42,5 +50,5 @@ def find_nearby_drivers(pickup_lat: float, pickup_lng: float, radius_km: float =
             for driver in drivers
         ]
     except Exception as e:
-        print(f"Driver search error: {e}")
+        log.warning("driver_search_failed", error=str(e))
         return []
\ No newline at end of file
@@ -2,9 +2,16 @@
 import socketio
 import asyncio
 import json
+from functools import wraps
 from typing import Dict, Set
 import redis.asyncio as redis
-from database import update_driver_location, find_nearby_drivers_query
+import structlog
+from db import SessionLocal
+from models import Driver
+from spatial import find_nearby_drivers
+from metrics import SOCKET_CONNECTIONS, SOCKET_EVENTS
+
+log = structlog.get_logger(__name__)
 
 # Create Socket.IO server
 sio = socketio.AsyncServer(
@@ -53,17 +60,49 @@ class RealTimeManager:
 
 rt_manager = RealTimeManager()
 
+# Location writes and proximity lookups go through the app's engine, so they
+# use PostGIS on PostgreSQL and the R*Tree on SQLite dev databases
+def save_driver_location(driver_id: int, lat: float, lng: float):
+    db = SessionLocal()
+    try:
+        db.query(Driver).filter(Driver.id == driver_id).update({"current_lat": lat, "current_lng": lng})
+        db.commit()
+    finally:
+        db.close()
+
+def lookup_nearby_drivers(lat: float, lng: float, radius_km: float):
+    db = SessionLocal()
+    try:
+        return find_nearby_drivers(db, lat, lng, radius_km)
+    finally:
+        db.close()
+
+connections = SOCKET_CONNECTIONS.labels("socketio")
+
+def event(handler):
+    """sio.event, counting calls by event name (rate() gives events per second)"""
+    calls = SOCKET_EVENTS.labels(handler.__name__)
+
+    @wraps(handler)
+    async def counted(*args):
+        calls.inc()
+        return await handler(*args)
+
+    return sio.event(counted)
+
 # Socket.IO Event Handlers
-@sio.event
+@event
 async def connect(sid, environ, auth):
     """Handle client connection"""
-    print(f"Client {sid} connected")
+    log.info("socket_connected", sid=sid)
+    connections.inc()
     await sio.emit('connected', {'status': 'success'}, room=sid)
 
-@sio.event
+@event
 async def disconnect(sid):
     """Handle client disconnection"""
-    print(f"Client {sid} disconnected")
+    log.info("socket_disconnected", sid=sid)
+    connections.dec()
     
     # Remove from all rooms
     for user_id, socket_id in list(active_drivers.items()):
@@ -78,7 +117,7 @@ async def disconnect(sid):
             await rt_manager.remove_from_room(sid, 'riders', user_id)
             break
 
-@sio.event
+@event
 async def join_as_driver(sid, data):
     """Driver joins the system"""
     driver_id = data.get('driver_id')
@@ -100,7 +139,7 @@ async def join_as_driver(sid, data):
         'message': 'Successfully joined as driver'
     }, room=sid)
 
-@sio.event
+@event
 async def join_as_rider(sid, data):
     """Rider joins the system"""
     rider_id = data.get('rider_id')
@@ -115,7 +154,7 @@ async def join_as_rider(sid, data):
         'message': 'Successfully joined as rider'
     }, room=sid)
 
-@sio.event
+@event
 async def update_location(sid, data):
     """Update driver location"""
     driver_id = data.get('driver_id')
@@ -128,7 +167,7 @@ async def update_location(sid, data):
     
     # Update location in database
     try:
-        await update_driver_location(driver_id, lat, lng)
+        await asyncio.to_thread(save_driver_location, int(driver_id), lat, lng)
         
         # Store in Redis for quick access
         location_data = {
@@ -149,7 +188,7 @@ async def update_location(sid, data):
     except Exception as e:
         await sio.emit('error', {'message': f'Failed to update location: {str(e)}'}, room=sid)
 
-@sio.event
+@event
 async def request_ride(sid, data):
     """Handle ride request from rider"""
     rider_id = data.get('rider_id')
@@ -162,7 +201,7 @@ async def request_ride(sid, data):
     
     try:
         # Find nearby drivers
-        nearby_drivers = await find_nearby_drivers_query(pickup_lat, pickup_lng, 5.0)
+        nearby_drivers = await asyncio.to_thread(lookup_nearby_drivers, pickup_lat, pickup_lng, 5.0)
         
         if not nearby_drivers:
             await sio.emit('no_drivers', {
@@ -194,7 +233,7 @@ async def request_ride(sid, data):
     except Exception as e:
         await sio.emit('error', {'message': f'Failed to process ride request: {str(e)}'}, room=sid)
 
-@sio.event
+@event
 async def accept_ride(sid, data):
     """Driver accepts ride request"""
     driver_id = data.get('driver_id')
@@ -224,7 +263,7 @@ async def accept_ride(sid, data):
         'status': 'accepted'
     }, room=sid)
 
-@sio.event
+@event
 async def ride_status_update(sid, data):
     """Update ride status (started, completed, etc.)"""
     ride_id = data.get('ride_id')
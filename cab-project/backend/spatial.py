@@ -0,0 +1,290 @@
+# Spatial column type and index DDL shared by the driver models
+import math
+import re
+from typing import Dict, List, Optional
+
+from sqlalchemy import DDL, String, event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.types import TypeDecorator
+from geoalchemy2 import Geography
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class GeoPoint(TypeDecorator):
+    """geography(Point, 4326) on PostgreSQL, plain text everywhere else.
+
+    SQLite dev databases have no PostGIS, so the column degrades to an
+    unused text column there and proximity lookups go through the R*Tree
+    maintained by the triggers below.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(
+                Geography(geometry_type="POINT", srid=4326, spatial_index=False)
+            )
+        return dialect.type_descriptor(String())
+
+
+# ------------------------
+# PostgreSQL: keep drivers.current_location in sync with lat/lng
+# ------------------------
+POSTGIS_EXTENSION = "CREATE EXTENSION IF NOT EXISTS postgis"
+
+PG_SYNC_FUNCTION = """
+CREATE OR REPLACE FUNCTION drivers_sync_location() RETURNS trigger AS $$
+BEGIN
+    IF NEW.current_lat IS NULL OR NEW.current_lng IS NULL THEN
+        NEW.current_location := NULL;
+    ELSE
+        NEW.current_location := ST_SetSRID(
+            ST_MakePoint(NEW.current_lng, NEW.current_lat), 4326
+        )::geography;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+PG_SYNC_TRIGGER = """
+CREATE TRIGGER drivers_sync_location
+BEFORE INSERT OR UPDATE OF current_lat, current_lng ON drivers
+FOR EACH ROW EXECUTE FUNCTION drivers_sync_location()
+"""
+
+PG_BACKFILL = """
+UPDATE drivers
+SET current_location = ST_SetSRID(ST_MakePoint(current_lng, current_lat), 4326)::geography
+WHERE current_lat IS NOT NULL AND current_lng IS NOT NULL
+"""
+
+# ------------------------
+# SQLite: R*Tree bounding boxes maintained by triggers
+# ------------------------
+SQLITE_RTREE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS drivers_location_rtree
+USING rtree(id, min_lat, max_lat, min_lng, max_lng)
+"""
+
+SQLITE_RTREE_INSERT = """
+CREATE TRIGGER IF NOT EXISTS drivers_location_rtree_insert
+AFTER INSERT ON drivers
+WHEN NEW.current_lat IS NOT NULL AND NEW.current_lng IS NOT NULL
+BEGIN
+    INSERT OR REPLACE INTO drivers_location_rtree
+    VALUES (NEW.id, NEW.current_lat, NEW.current_lat, NEW.current_lng, NEW.current_lng);
+END
+"""
+
+SQLITE_RTREE_UPDATE = """
+CREATE TRIGGER IF NOT EXISTS drivers_location_rtree_update
+AFTER UPDATE OF current_lat, current_lng ON drivers
+BEGIN
+    DELETE FROM drivers_location_rtree WHERE id = OLD.id;
+    INSERT INTO drivers_location_rtree
+    SELECT NEW.id, NEW.current_lat, NEW.current_lat, NEW.current_lng, NEW.current_lng
+    WHERE NEW.current_lat IS NOT NULL AND NEW.current_lng IS NOT NULL;
+END
+"""
+
+SQLITE_RTREE_DELETE = """
+CREATE TRIGGER IF NOT EXISTS drivers_location_rtree_delete
+AFTER DELETE ON drivers
+BEGIN
+    DELETE FROM drivers_location_rtree WHERE id = OLD.id;
+END
+"""
+
+SQLITE_BACKFILL = """
+INSERT OR REPLACE INTO drivers_location_rtree
+SELECT id, current_lat, current_lat, current_lng, current_lng
+FROM drivers
+WHERE current_lat IS NOT NULL AND current_lng IS NOT NULL
+"""
+
+POSTGRES_DDL = [PG_SYNC_FUNCTION, PG_SYNC_TRIGGER]
+SQLITE_DDL = [SQLITE_RTREE, SQLITE_RTREE_INSERT, SQLITE_RTREE_UPDATE, SQLITE_RTREE_DELETE]
+
+
+def register_driver_location_ddl(table):
+    """Attach the per-dialect location DDL to the drivers table create/drop"""
+    event.listen(table, "before_create", DDL(POSTGIS_EXTENSION).execute_if(dialect="postgresql"))
+    for statement in POSTGRES_DDL:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+    for statement in SQLITE_DDL:
+        event.listen(table, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+    event.listen(
+        table, "after_drop",
+        DDL("DROP TABLE IF EXISTS drivers_location_rtree").execute_if(dialect="sqlite")
+    )
+
+
+# ------------------------
+# Distance helpers
+# ------------------------
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two coordinates in kilometers"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lng = math.radians(lng2 - lng1)
+
+    a = (math.sin(delta_lat / 2) ** 2 +
+         math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lng / 2) ** 2)
+    return EARTH_RADIUS_KM * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def bounding_box(lat: float, lng: float, radius_km: float) -> Dict[str, float]:
+    """Lat/lng box that fully contains the circle of radius_km around a point.
+
+    Uses the same sphere as haversine_km, so nothing the distance check
+    would keep falls outside the box. The longitude extent is that of the
+    circle's widest point (asin), not of its center's parallel.
+    """
+    angular = radius_km / EARTH_RADIUS_KM
+    lat_delta = math.degrees(angular)
+    ratio = math.sin(angular) / max(math.cos(math.radians(lat)), 1e-12)
+    lng_delta = math.degrees(math.asin(ratio)) if ratio < 1 else 180.0
+    return {
+        "min_lat": lat - lat_delta,
+        "max_lat": lat + lat_delta,
+        "min_lng": lng - lng_delta,
+        "max_lng": lng + lng_delta,
+    }
+
+
+CITY_CENTERS = {
+    'jaipur': (26.9124, 75.7873),
+    'indore': (22.7196, 75.8577),
+    'mumbai': (19.0760, 72.8777),
+    'delhi': (28.6139, 77.2090),
+    'bangalore': (12.9716, 77.5946),
+    'chennai': (13.0827, 80.2707),
+    'kolkata': (22.5726, 88.3639),
+    'hyderabad': (17.3850, 78.4867),
+    'pune': (18.5204, 73.8567),
+    'ahmedabad': (23.0225, 72.5714)
+}
+
+CITY_RADIUS_KM = 60.0
+
+
+def city_for(lat: Optional[float], lng: Optional[float]) -> str:
+    """Service city (zone) for a coordinate, 'other' outside every city radius"""
+    if lat is None or lng is None:
+        return "other"
+    city, center = min(CITY_CENTERS.items(), key=lambda item: haversine_km(lat, lng, *item[1]))
+    return city if haversine_km(lat, lng, *center) <= CITY_RADIUS_KM else "other"
+
+
+# ------------------------
+# Proximity queries
+# ------------------------
+REFERENCE_POINT = "ST_SetSRID(ST_MakePoint($2, $1), 4326)::geography"
+
+def build_nearby_drivers_query(vehicle_type: Optional[str] = None,
+                               verified_only: bool = False) -> str:
+    """PostGIS proximity query over drivers.current_location.
+
+    Parameters: $1 lat, $2 lng, $3 radius in meters, $4 limit and, when
+    vehicle_type is given, $5 vehicle type. ST_DWithin on geography and
+    the KNN ``<->`` ordering both run off idx_drivers_current_location,
+    so neither the filter nor the sort needs a computed expression.
+    Ratings come from the precomputed rating_aggregates row (a primary
+    key lookup per candidate), never from an AVG over reviews.
+    """
+    conditions = [
+        "d.status = 'active'",
+        f"ST_DWithin(d.current_location, {REFERENCE_POINT}, $3)",
+    ]
+    if vehicle_type:
+        conditions.append("d.vehicle_type = $5")
+    if verified_only:
+        conditions.append("d.verified")
+
+    return f"""
+    SELECT d.id, d.user_id, u.name, d.vehicle_type, d.verified,
+           ra.score AS rating, COALESCE(ra.count, 0) AS rating_count,
+           ST_Distance(d.current_location, {REFERENCE_POINT}) AS distance_meters
+    FROM drivers d
+    JOIN users u ON d.user_id = u.id
+    LEFT JOIN rating_aggregates ra ON ra.rated_id = d.user_id
+    WHERE {" AND ".join(conditions)}
+    ORDER BY d.current_location <-> {REFERENCE_POINT}
+    LIMIT $4;
+    """
+
+
+def nearby_drivers_args(lat: float, lng: float, radius_km: float, limit: int,
+                        vehicle_type: Optional[str] = None) -> list:
+    """Positional arguments matching build_nearby_drivers_query"""
+    args = [lat, lng, radius_km * 1000, limit]
+    if vehicle_type:
+        args.append(vehicle_type)
+    return args
+
+
+def find_nearby_drivers_sqlite(db: Session, lat: float, lng: float,
+                               radius_km: float = 5.0, limit: int = 10,
+                               vehicle_type: Optional[str] = None,
+                               verified_only: bool = False) -> List[Dict]:
+    """Find nearby active drivers on SQLite using the R*Tree bounding box.
+
+    The R*Tree narrows candidates to the bounding box, the exact
+    great-circle distance is then applied in Python.
+    """
+    conditions = [
+        "r.min_lat >= :min_lat AND r.max_lat <= :max_lat",
+        "r.min_lng >= :min_lng AND r.max_lng <= :max_lng",
+        "d.status = 'active'",
+    ]
+    params = bounding_box(lat, lng, radius_km)
+    if vehicle_type:
+        conditions.append("d.vehicle_type = :vehicle_type")
+        params["vehicle_type"] = vehicle_type
+    if verified_only:
+        conditions.append("d.verified = 1")
+
+    query = text(f"""
+    SELECT d.id, d.user_id, u.name, d.vehicle_type, d.verified, d.current_lat, d.current_lng,
+           ra.score AS rating, COALESCE(ra.count, 0) AS rating_count
+    FROM drivers_location_rtree r
+    JOIN drivers d ON d.id = r.id
+    JOIN users u ON d.user_id = u.id
+    LEFT JOIN rating_aggregates ra ON ra.rated_id = d.user_id
+    WHERE {" AND ".join(conditions)}
+    """)
+
+    drivers = []
+    for row in db.execute(query, params).mappings():
+        distance_km = haversine_km(lat, lng, row["current_lat"], row["current_lng"])
+        if distance_km <= radius_km:
+            drivers.append({
+                "id": row["id"],
+                "user_id": row["user_id"],
+                "name": row["name"],
+                "vehicle_type": row["vehicle_type"],
+                "verified": bool(row["verified"]),
+                "rating": row["rating"],  # Bayesian score, None until the first review
+                "rating_count": row["rating_count"],
+                "distance_km": round(distance_km, 3)
+            })
+
+    drivers.sort(key=lambda driver: driver["distance_km"])
+    return drivers[:limit]
+
+
+def find_nearby_drivers(db: Session, lat: float, lng: float, radius_km: float = 5.0, limit: int = 10,
+                        vehicle_type: Optional[str] = None, verified_only: bool = False) -> List[Dict]:
+    """Nearby active drivers, nearest first: PostGIS on PostgreSQL, the R*Tree on SQLite"""
+    if db.get_bind().dialect.name != "postgresql":
+        return find_nearby_drivers_sqlite(db, lat, lng, radius_km, limit, vehicle_type, verified_only)
+    # Same query as the asyncpg path, with $n placeholders as named binds
+    query = re.sub(r"\$(\d+)", r":p\1", build_nearby_drivers_query(vehicle_type, verified_only))
+    args = nearby_drivers_args(lat, lng, radius_km, limit, vehicle_type)
+    rows = db.execute(text(query), {f"p{position}": value for position, value in enumerate(args, 1)})
+    return [{**row, "distance_km": round(row["distance_meters"] / 1000, 3)} for row in rows.mappings()]
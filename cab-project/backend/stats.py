@@ -0,0 +1,287 @@
+# Incremental rollup counters behind the admin dashboard
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import delete, event, inspect, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from models import User, Driver, Ride, Payment, StatCounter
+from spatial import city_for
+
+# Hot counters (rides, revenue) are spread over this many rows so concurrent
+# writers rarely wait on the same row lock; reads sum the shards.
+STAT_SHARDS = 8
+STATS_STALE_AFTER = timedelta(minutes=15)
+RECONCILED_AT = "meta:reconciled_at"  # value holds seconds since EPOCH
+EPOCH = datetime(1970, 1, 1)
+
+RIDE_STATUSES = ["requested", "accepted", "in_progress", "completed", "cancelled"]
+DASHBOARD_COUNTERS = ["users", "drivers:active", "rides", "revenue"] + [
+    f"rides:{status}" for status in RIDE_STATUSES
+]
+
+
+def revenue_counter(day, city: str) -> str:
+    return f"revenue:{day.isoformat()}:{city}"
+
+
+# ------------------------
+# Writes
+# ------------------------
+def apply_deltas(connection, deltas: Dict[str, float]):
+    """Atomically add deltas to counters on the given connection.
+
+    Runs inside the caller's transaction, so counters commit or roll back
+    together with the row change that produced them.
+    """
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    insert = pg_insert if connection.dialect.name == "postgresql" else sqlite_insert
+    table = StatCounter.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.name, table.c.shard],
+        set_={
+            "value": table.c.value + statement.excluded.value,
+            "updated_at": statement.excluded.updated_at,
+        }
+    )
+
+    shard = random.randrange(STAT_SHARDS)
+    now = datetime.utcnow()
+    # Sorted so concurrent transactions lock counter rows in the same order
+    connection.execute(statement, [
+        {"name": name, "shard": shard, "value": delta, "updated_at": now}
+        for name, delta in sorted(deltas.items())
+    ])
+
+
+def status_change(target, attribute: str = "status"):
+    """(old, new) for a flushed attribute change, or None when unchanged"""
+    history = inspect(target).attrs[attribute].history
+    if not history.has_changes():
+        return None
+    old = history.deleted[0] if history.deleted else None
+    new = history.added[0] if history.added else None
+    return old, new
+
+
+def payment_revenue_deltas(connection, payment: Payment, sign: int) -> Dict[str, float]:
+    """Revenue deltas for a payment entering (+1) or leaving (-1) completed.
+
+    Revenue is booked against the payment's creation day so the
+    incremental counters and reconcile_stats agree on the bucket.
+    """
+    pickup = connection.execute(
+        select(Ride.pickup_lat, Ride.pickup_lng).where(Ride.id == payment.ride_id)
+    ).first()
+    city = city_for(*pickup) if pickup else "other"
+    day = (payment.created_at or datetime.utcnow()).date()
+    amount = sign * (payment.amount or 0.0)
+    return {"revenue": amount, revenue_counter(day, city): amount}
+
+
+def load_previous_status(target, value, oldvalue, initiator):
+    """No-op; registered with active_history so status_change sees the old
+    value even when status was expired (e.g. after a commit) before being set."""
+    return value
+
+
+for tracked in (Driver, Ride, Payment):
+    event.listen(tracked.status, "set", load_previous_status, active_history=True, retval=True)
+
+
+@event.listens_for(User, "after_insert")
+def count_user_insert(mapper, connection, target):
+    apply_deltas(connection, {"users": 1})
+
+
+@event.listens_for(User, "after_delete")
+def count_user_delete(mapper, connection, target):
+    apply_deltas(connection, {"users": -1})
+
+
+@event.listens_for(Driver, "after_insert")
+def count_driver_insert(mapper, connection, target):
+    if target.status == "active":
+        apply_deltas(connection, {"drivers:active": 1})
+
+
+@event.listens_for(Driver, "after_delete")
+def count_driver_delete(mapper, connection, target):
+    if target.status == "active":
+        apply_deltas(connection, {"drivers:active": -1})
+
+
+@event.listens_for(Driver, "after_update")
+def count_driver_update(mapper, connection, target):
+    change = status_change(target)
+    if change:
+        old, new = change
+        apply_deltas(connection, {"drivers:active": (new == "active") - (old == "active")})
+
+
+@event.listens_for(Ride, "after_insert")
+def count_ride_insert(mapper, connection, target):
+    apply_deltas(connection, {"rides": 1, f"rides:{target.status or 'requested'}": 1})
+
+
+@event.listens_for(Ride, "after_delete")
+def count_ride_delete(mapper, connection, target):
+    apply_deltas(connection, {"rides": -1, f"rides:{target.status or 'requested'}": -1})
+
+
+@event.listens_for(Ride, "after_update")
+def count_ride_update(mapper, connection, target):
+    change = status_change(target)
+    if change:
+        old, new = change
+        apply_deltas(connection, {f"rides:{old}": -1, f"rides:{new}": 1})
+
+
+@event.listens_for(Payment, "after_insert")
+def count_payment_insert(mapper, connection, target):
+    if target.status == "completed":
+        apply_deltas(connection, payment_revenue_deltas(connection, target, 1))
+
+
+@event.listens_for(Payment, "after_delete")
+def count_payment_delete(mapper, connection, target):
+    if target.status == "completed":
+        apply_deltas(connection, payment_revenue_deltas(connection, target, -1))
+
+
+@event.listens_for(Payment, "after_update")
+def count_payment_update(mapper, connection, target):
+    change = status_change(target)
+    if change:
+        old, new = change
+        sign = (new == "completed") - (old == "completed")
+        if sign:
+            apply_deltas(connection, payment_revenue_deltas(connection, target, sign))
+
+
+# ------------------------
+# Reads
+# ------------------------
+def read_counters(db: Session, names: Iterable[str]) -> Dict[str, float]:
+    """Sum the shards of the named counters (primary key lookups only)"""
+    rows = db.query(StatCounter.name, func.sum(StatCounter.value)).filter(
+        StatCounter.name.in_(list(names))
+    ).group_by(StatCounter.name)
+    return {name: value for name, value in rows}
+
+
+def reconciled_at(db: Session) -> Optional[datetime]:
+    value = read_counters(db, [RECONCILED_AT]).get(RECONCILED_AT)
+    return EPOCH + timedelta(seconds=value) if value else None
+
+
+def dashboard_stats(db: Session) -> Dict:
+    """Dashboard totals from the rollup plus how fresh they are"""
+    counters = read_counters(db, DASHBOARD_COUNTERS)
+    last_reconciled = reconciled_at(db)
+    return {
+        "total_users": int(counters.get("users", 0)),
+        "active_drivers": int(counters.get("drivers:active", 0)),
+        "total_rides": int(counters.get("rides", 0)),
+        "total_revenue": round(counters.get("revenue", 0.0), 2),
+        "rides_by_status": {
+            status: int(counters.get(f"rides:{status}", 0)) for status in RIDE_STATUSES
+        },
+        "reconciled_at": last_reconciled,
+        "stale": last_reconciled is None or datetime.utcnow() - last_reconciled > STATS_STALE_AFTER
+    }
+
+
+def revenue_by_day(db: Session, days: int = 7) -> Dict[str, Dict[str, float]]:
+    """Revenue per day and city for the last `days` days ({day: {city: amount}})"""
+    since = (datetime.utcnow() - timedelta(days=days - 1)).date()
+    rows = db.query(StatCounter.name, func.sum(StatCounter.value)).filter(
+        StatCounter.name >= revenue_counter(since, ""),
+        StatCounter.name < "revenue;"  # ';' sorts right after ':'
+    ).group_by(StatCounter.name)
+
+    breakdown: Dict[str, Dict[str, float]] = {}
+    for name, value in rows:
+        _, day, city = name.split(":", 2)
+        breakdown.setdefault(day, {})[city] = round(value, 2)
+    return breakdown
+
+
+# ------------------------
+# Reconciliation
+# ------------------------
+def compute_stats_from_tables(db: Session) -> Dict[str, float]:
+    """Full recount from the base tables (what the counters should hold)"""
+    stats = {
+        "users": db.query(func.count(User.id)).scalar(),
+        "drivers:active": db.query(func.count(Driver.id)).filter(Driver.status == "active").scalar(),
+        "rides": 0,
+        "revenue": 0.0,
+    }
+    for status, count in db.query(Ride.status, func.count(Ride.id)).group_by(Ride.status):
+        stats[f"rides:{status}"] = count
+        stats["rides"] += count
+
+    completed = select(
+        Payment.amount, Payment.created_at, Ride.pickup_lat, Ride.pickup_lng
+    ).join(Ride, Payment.ride_id == Ride.id).where(Payment.status == "completed")
+    result = db.execute(completed.execution_options(stream_results=True, yield_per=1000))
+    for amount, created_at, pickup_lat, pickup_lng in result:
+        name = revenue_counter(created_at.date(), city_for(pickup_lat, pickup_lng))
+        stats[name] = stats.get(name, 0.0) + amount
+        stats["revenue"] += amount
+    return stats
+
+
+def reconcile_stats(db: Session) -> Dict[str, float]:
+    """Correct the counters from the base tables and return the drift found.
+
+    The recount and the counter sums are read from one snapshot, and the
+    listeners write counters in the same transaction as the rows they
+    count, so the difference is exactly the drift. It is then added like
+    any other delta: increments committed while the recount ran are kept,
+    and no counter row is locked beyond the ones being corrected.
+
+    On PostgreSQL the snapshot is a REPEATABLE READ transaction. SQLite
+    has no such isolation level for a read followed by writes, so there
+    the recount holds the write lock instead (BEGIN IMMEDIATE).
+    """
+    db.commit()  # the snapshot has to start with a fresh transaction
+    postgresql = db.get_bind().dialect.name == "postgresql"
+    if postgresql:
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    else:
+        db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+
+    actual = compute_stats_from_tables(db)
+    current = {
+        name: value
+        for name, value in db.query(StatCounter.name, func.sum(StatCounter.value))
+        .filter(StatCounter.name != RECONCILED_AT)
+        .group_by(StatCounter.name)
+    }
+
+    drift = {}
+    for name in set(actual) | set(current):
+        difference = actual.get(name, 0) - current.get(name, 0)
+        if abs(difference) > 1e-6:
+            drift[name] = difference
+
+    if postgresql:
+        db.commit()  # apply the deltas at READ COMMITTED, after the snapshot
+    apply_deltas(db.connection(), drift)
+    now = datetime.utcnow()
+    db.execute(delete(StatCounter).where(StatCounter.name == RECONCILED_AT))
+    db.add(StatCounter(
+        name=RECONCILED_AT, shard=0, value=(now - EPOCH).total_seconds(), updated_at=now
+    ))
+    db.commit()
+    return drift
@@ -1,18 +1,59 @@
 # Stripe payment integration
 import stripe
 import os
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Optional
 from fastapi import HTTPException
 import asyncio
-import aiohttp
+import structlog
+
+from metrics import external_call, queue_depths
+from tracing import span
+
+log = structlog.get_logger(__name__)
 
 # Configure Stripe
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Point at fake_stripe.py for tests and benchmarks
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE")
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_MAX_WORKERS = int(os.getenv("STRIPE_MAX_WORKERS", "16"))
+
+if STRIPE_API_BASE:
+    stripe.api_base = STRIPE_API_BASE
+# Each pool thread keeps its own keep-alive requests.Session
+stripe.default_http_client = stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS)
+# POST retries reuse an auto-generated idempotency key, so they are safe
+stripe.max_network_retries = 2
 
 class StripePaymentService:
-    def __init__(self):
+    """Async facade over the blocking Stripe SDK.
+
+    SDK calls run on a bounded thread pool so a slow Stripe response only
+    occupies a pool thread instead of stalling the event loop (and every
+    socket served by it). Calls beyond max_workers queue for a free thread.
+    """
+
+    def __init__(self, max_workers: int = STRIPE_MAX_WORKERS):
         self.api_key = stripe.api_key
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stripe")
+        self.in_flight = 0  # calls queued or running on the pool
+
+    async def call(self, method: Callable, *args, **kwargs):
+        """Run a blocking Stripe SDK call on the pool and await its result"""
+        loop = asyncio.get_running_loop()
+        operation = getattr(method, "__qualname__", "call")
+        self.in_flight += 1
+        try:
+            with span("payment.stripe", operation=operation), external_call("stripe", operation):
+                return await loop.run_in_executor(self.executor, partial(method, *args, **kwargs))
+        except stripe.error.StripeError as e:
+            log.warning("stripe_call_failed", operation=operation, error=str(e), code=getattr(e, "code", None))
+            raise
+        finally:
+            self.in_flight -= 1
     
     async def create_payment_intent(
         self, 
@@ -25,7 +66,7 @@ class StripePaymentService:
             # Convert to smallest currency unit (paise for INR)
             amount_in_paise = int(amount * 100)
             
-            payment_intent = stripe.PaymentIntent.create(
+            payment_intent = await self.call(stripe.PaymentIntent.create,
                 amount=amount_in_paise,
                 currency=currency,
                 metadata=metadata or {},
@@ -48,7 +89,7 @@ class StripePaymentService:
     async def confirm_payment_intent(self, payment_intent_id: str) -> Dict:
         """Confirm payment intent"""
         try:
-            payment_intent = stripe.PaymentIntent.confirm(payment_intent_id)
+            payment_intent = await self.call(stripe.PaymentIntent.confirm, payment_intent_id)
             return {
                 "id": payment_intent.id,
                 "status": payment_intent.status,
@@ -61,7 +102,7 @@ class StripePaymentService:
     async def create_customer(self, email: str, name: str, phone: str) -> Dict:
         """Create Stripe customer"""
         try:
-            customer = stripe.Customer.create(
+            customer = await self.call(stripe.Customer.create,
                 email=email,
                 name=name,
                 phone=phone,
@@ -82,7 +123,7 @@ class StripePaymentService:
     async def create_setup_intent(self, customer_id: str) -> Dict:
         """Create SetupIntent for saving payment methods"""
         try:
-            setup_intent = stripe.SetupIntent.create(
+            setup_intent = await self.call(stripe.SetupIntent.create,
                 customer=customer_id,
                 payment_method_types=['card'],
             )
@@ -98,7 +139,7 @@ class StripePaymentService:
     async def get_payment_methods(self, customer_id: str) -> Dict:
         """Get customer's saved payment methods"""
         try:
-            payment_methods = stripe.PaymentMethod.list(
+            payment_methods = await self.call(stripe.PaymentMethod.list,
                 customer=customer_id,
                 type="card",
             )
@@ -129,7 +170,7 @@ class StripePaymentService:
             if amount:
                 refund_data["amount"] = int(amount * 100)  # Convert to paise
             
-            refund = stripe.Refund.create(**refund_data)
+            refund = await self.call(stripe.Refund.create, **refund_data)
             
             return {
                 "refund_id": refund.id,
@@ -141,14 +182,20 @@ class StripePaymentService:
         except stripe.error.StripeError as e:
             raise HTTPException(status_code=400, detail=f"Refund failed: {str(e)}")
     
-    async def create_transfer(self, amount: float, destination_account: str, metadata: Dict = None) -> Dict:
-        """Create transfer to driver's account (for marketplace model)"""
+    async def create_transfer(self, amount: float, destination_account: str, metadata: Dict = None,
+                              idempotency_key: Optional[str] = None) -> Dict:
+        """Create transfer to driver's account (for marketplace model).
+
+        Retrying with the same idempotency_key returns the original transfer
+        instead of paying twice.
+        """
         try:
-            transfer = stripe.Transfer.create(
-                amount=int(amount * 100),  # Convert to paise
+            transfer = await self.call(stripe.Transfer.create,
+                amount=round(amount * 100),  # Convert to paise
                 currency="inr",
                 destination=destination_account,
-                metadata=metadata or {}
+                metadata=metadata or {},
+                idempotency_key=idempotency_key
             )
             
             return {
@@ -158,6 +205,9 @@ class StripePaymentService:
                 "status": "succeeded"
             }
             
+        except stripe.error.APIConnectionError as e:
+            # Network error or timeout: the transfer may or may not exist, retry with the same key
+            raise HTTPException(status_code=503, detail=f"Transfer not confirmed: {str(e)}")
         except stripe.error.StripeError as e:
             raise HTTPException(status_code=400, detail=f"Transfer failed: {str(e)}")
     
@@ -175,43 +225,16 @@ class StripePaymentService:
 
 # Global service instance
 stripe_service = StripePaymentService()
+queue_depths.track("stripe", lambda: stripe_service.in_flight)
 
-# Webhook event handlers
-async def handle_payment_succeeded(event_data: Dict):
-    """Handle successful payment"""
-    payment_intent = event_data['object']
-    
-    # Update payment status in database
-    # Send confirmation to user
-    # Update ride status
-    # Trigger receipt generation
-    
-    print(f"Payment succeeded: {payment_intent['id']}")
-
-async def handle_payment_failed(event_data: Dict):
-    """Handle failed payment"""
-    payment_intent = event_data['object']
-    
-    # Update payment status in database
-    # Notify user of failure
-    # Cancel ride if applicable
-    
-    print(f"Payment failed: {payment_intent['id']}")
+# Webhook events are queued durably and applied in batches by the webhook
+# worker (see webhooks.py), so Stripe only waits for the insert.
+async def process_webhook_event(event: Dict) -> bool:
+    """Enqueue a verified webhook event; False when Stripe already delivered it"""
+    from webhooks import store_event  # webhooks imports stripe_service from here
 
-# Webhook event mapping
-WEBHOOK_HANDLERS = {
-    'payment_intent.succeeded': handle_payment_succeeded,
-    'payment_intent.payment_failed': handle_payment_failed,
-}
-
-async def process_webhook_event(event: Dict):
-    """Process incoming webhook event"""
-    event_type = event['type']
-    
-    if event_type in WEBHOOK_HANDLERS:
-        await WEBHOOK_HANDLERS[event_type](event['data'])
-    else:
-        print(f"Unhandled webhook event: {event_type}")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, store_event, event)
 
 # Utility functions for common payment flows
 async def process_ride_payment(ride_id: int, amount: float, customer_id: str) -> Dict:
@@ -226,8 +249,9 @@ async def process_ride_payment(ride_id: int, amount: float, customer_id: str) ->
         metadata=metadata
     )
 
-async def process_wallet_topup(user_id: int, amount: float, customer_id: str) -> Dict:
-    """Process wallet top-up payment"""
+async def process_wallet_topup(user_id: int, amount: float, customer_id: Optional[str] = None) -> Dict:
+    """Start a wallet top-up payment; the wallet is credited by the
+    payment_intent.succeeded webhook (see webhooks.apply_wallet_topup)"""
     metadata = {
         "user_id": str(user_id),
         "type": "wallet_topup"
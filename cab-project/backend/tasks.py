@@ -1,13 +1,7 @@
 # Celery tasks for background processing
 from celery import Celery
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+from celery.signals import worker_process_shutdown
 import os
-from weasyprint import HTML, CSS
-from jinja2 import Template
 
 # Initialize Celery
 celery_app = Celery(
@@ -16,129 +10,270 @@ celery_app = Celery(
     backend="redis://localhost:6379/0"
 )
 
+celery_app.conf.beat_schedule = {
+    "reconcile-admin-stats": {
+        "task": "tasks.reconcile_admin_stats",
+        "schedule": 600.0,  # every 10 minutes
+    },
+    "refresh-ride-aggregates": {
+        "task": "tasks.refresh_ride_aggregates",
+        "schedule": 300.0,  # every 5 minutes
+    },
+    "maintain-partitions": {
+        "task": "tasks.maintain_partitions",
+        "schedule": 86400.0,  # daily
+    },
+    "process-webhook-events": {
+        "task": "tasks.process_webhook_events",
+        "schedule": 5.0,
+    },
+    "run-driver-payouts": {
+        "task": "tasks.run_driver_payouts",
+        "schedule": 86400.0,  # nightly settlement
+    },
+    "snapshot-wallet-balances": {
+        "task": "tasks.snapshot_wallet_balances",
+        "schedule": 300.0,  # every 5 minutes
+    },
+    "generate-pending-receipts": {
+        "task": "tasks.generate_pending_receipts",
+        "schedule": 600.0,  # keeps the end-of-day backlog small
+    },
+    "send-pending-receipt-emails": {
+        "task": "tasks.send_pending_receipt_emails",
+        "schedule": 60.0,
+    },
+    "reconcile-ratings": {
+        "task": "tasks.reconcile_ratings",
+        "schedule": 86400.0,  # daily
+    },
+}
+
 @celery_app.task
-def generate_receipt_pdf(ride_id: int, ride_data: dict):
-    """Generate PDF receipt for completed ride"""
+def generate_receipt_pdf(ride_id: int):
+    """Generate PDF receipt for completed ride (once; reruns return the stored PDF)"""
+    from db import SessionLocal
+    import receipts
     
-    # HTML template for receipt
-    receipt_template = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>Ride Receipt</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            .header { text-align: center; margin-bottom: 30px; }
-            .details { margin: 20px 0; }
-            .total { font-weight: bold; font-size: 18px; }
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>Cab Booking Receipt</h1>
-            <p>Receipt #{{ receipt_number }}</p>
-        </div>
-        
-        <div class="details">
-            <p><strong>Ride ID:</strong> {{ ride_id }}</p>
-            <p><strong>Date:</strong> {{ date }}</p>
-            <p><strong>From:</strong> {{ pickup_address }}</p>
-            <p><strong>To:</strong> {{ drop_address }}</p>
-            <p><strong>Driver:</strong> {{ driver_name }}</p>
-            <p><strong>Distance:</strong> {{ distance }} km</p>
-            <p><strong>Duration:</strong> {{ duration }} minutes</p>
-        </div>
-        
-        <div class="total">
-            <p>Total Fare: ₹{{ fare_amount }}</p>
-        </div>
-    </body>
-    </html>
-    """
+    db = SessionLocal()
+    try:
+        return receipts.generate_receipt(db, ride_id)
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def generate_pending_receipts(limit: int = 5000):
+    """Render receipts for completed rides that don't have one yet"""
+    from db import SessionLocal
+    import receipts
     
+    db = SessionLocal()
     try:
-        # Render template
-        template = Template(receipt_template)
-        html_content = template.render(**ride_data)
-        
-        # Generate PDF
-        pdf_path = f"receipts/receipt_{ride_id}.pdf"
-        os.makedirs("receipts", exist_ok=True)
-        
-        HTML(string=html_content).write_pdf(pdf_path)
-        
-        return {"status": "success", "pdf_path": pdf_path}
-        
+        return {"status": "success", **receipts.generate_receipts(db, limit=limit)}
     except Exception as e:
+        db.rollback()
         return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
 
 @celery_app.task
 def send_receipt_email(user_email: str, pdf_path: str, ride_data: dict):
-    """Send receipt via email"""
+    """Send receipt via email over this worker's pooled SMTP connections"""
+    from mailer import get_mailer
+    import receipts
     
     try:
-        # Email configuration
-        smtp_server = "smtp.gmail.com"
-        smtp_port = 587
-        sender_email = os.getenv("SMTP_EMAIL")
-        sender_password = os.getenv("SMTP_PASSWORD")
-        
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = user_email
-        msg['Subject'] = f"Ride Receipt - #{ride_data['receipt_number']}"
-        
-        # Email body
-        body = f"""
-        Dear Customer,
-        
-        Thank you for using our cab service. Please find your ride receipt attached.
-        
-        Ride Details:
-        - From: {ride_data['pickup_address']}
-        - To: {ride_data['drop_address']}
-        - Fare: ₹{ride_data['fare_amount']}
-        
-        Best regards,
-        Cab Booking Team
-        """
-        
-        msg.attach(MIMEText(body, 'plain'))
-        
-        # Attach PDF
-        with open(pdf_path, "rb") as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-            encoders.encode_base64(part)
-            part.add_header(
-                'Content-Disposition',
-                f'attachment; filename= receipt_{ride_data["ride_id"]}.pdf'
-            )
-            msg.attach(part)
-        
-        # Send email
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.send_message(msg)
-        server.quit()
-        
+        mailer = get_mailer()
+        result = mailer.send(receipts.receipt_email(mailer.sender, user_email, pdf_path, ride_data))
+        if result["status"] != "sent":
+            return {"status": "error", "message": result["error"]}
         return {"status": "success", "message": "Email sent successfully"}
         
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@celery_app.task
+def send_pending_receipt_emails(limit: int = 500):
+    """Email rendered receipts in one batch over the pooled connections"""
+    from db import SessionLocal
+    from mailer import get_mailer
+    import receipts
+    
+    db = SessionLocal()
+    try:
+        return {"status": "success", **receipts.email_receipts(db, get_mailer(), limit)}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@worker_process_shutdown.connect
+def close_smtp_connections(**kwargs):
+    from mailer import close_mailer
+    close_mailer()
+
+@celery_app.task
+def reconcile_admin_stats():
+    """Rebuild the admin rollup counters from the base tables"""
+    from db import SessionLocal
+    from stats import reconcile_stats
+    
+    db = SessionLocal()
+    try:
+        drift = reconcile_stats(db)
+        return {"status": "success", "drift": drift}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def refresh_ride_aggregates():
+    """Fold recent ride/payment changes into the hourly analytics aggregates"""
+    from db import SessionLocal
+    import analytics
+    
+    db = SessionLocal()
+    try:
+        result = analytics.refresh_ride_aggregates(db)
+        return {"status": "success", "buckets_refreshed": result["buckets_refreshed"]}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def maintain_partitions():
+    """Create upcoming monthly partitions and archive cold ones to disk"""
+    from db import engine
+    import partitions
+    
+    try:
+        return partitions.maintain_partitions(engine)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@celery_app.task
+def run_driver_payouts(batch: str = None):
+    """Accrue driver earnings, plan the batch and send every unsettled payout (rerun to resume)"""
+    from db import SessionLocal
+    import payouts
+    
+    db = SessionLocal()
+    try:
+        return {"status": "success", **payouts.run_payouts(db, batch)}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def process_webhook_events(max_batches: int = 20):
+    """Apply queued Stripe webhook events to payments and rides"""
+    from db import SessionLocal
+    import webhooks
+    
+    db = SessionLocal()
+    try:
+        totals = {}
+        for _ in range(max_batches):
+            summary = webhooks.process_pending_events(db)
+            for key, count in summary.items():
+                totals[key] = totals.get(key, 0) + count
+            # Unmatched events wait for the next run instead of burning attempts now
+            if summary["retried"] or sum(summary.values()) < webhooks.WEBHOOK_BATCH_SIZE:
+                break
+        return {"status": "success", **totals}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
 @celery_app.task
 def update_driver_ratings(driver_id: int):
-    """Update driver average rating after new review"""
-    # This would calculate and update driver's average rating
-    # Implementation would query all reviews for driver and calculate average
-    pass
+    """Check one driver's running rating totals against their reviews (reviews
+    saved through the ORM already keep them current)"""
+    from db import SessionLocal
+    import ratings
+    
+    db = SessionLocal()
+    try:
+        summary = ratings.reconcile_ratings(db, [driver_id])
+        return {"status": "success", **summary, "rating": ratings.get_rating(db, driver_id)}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def reconcile_ratings():
+    """Rebuild rating aggregates that drifted from COUNT/SUM over reviews"""
+    from db import SessionLocal
+    import ratings
+    
+    db = SessionLocal()
+    try:
+        return {"status": "success", **ratings.reconcile_ratings(db)}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def send_campaign_notifications(title: str, message: str, role: str = "rider", data: dict = None,
+                                after_id: int = 0):
+    """Notify every user with the role, in chunks (rerun with the last_id returned to resume)"""
+    from db import SessionLocal
+    from models import User
+    import notifications
+    
+    db = SessionLocal()
+    try:
+        summary = notifications.fan_out(db, title, message, "promotion", data,
+                                        conditions=[User.role == role], after_id=after_id)
+        return {"status": "error" if "error" in summary else "success", **summary}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
 
 @celery_app.task
 def process_wallet_topup(user_id: int, amount: float, payment_intent_id: str):
     """Process wallet top-up after successful Stripe payment"""
-    # This would add money to user's wallet after payment confirmation
-    pass
\ No newline at end of file
+    from db import SessionLocal
+    import wallet
+    
+    db = SessionLocal()
+    try:
+        # Keyed on the payment intent, so a redelivered task credits once
+        result = wallet.topup(db, user_id, wallet.to_minor(amount), payment_intent_id)
+        return {"status": "success", **result}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
+
+@celery_app.task
+def snapshot_wallet_balances():
+    """Fold recent ledger rows into the house account balance snapshots"""
+    from db import SessionLocal
+    import wallet
+    
+    db = SessionLocal()
+    try:
+        return {"status": "success", "balances": wallet.snapshot_house_balances(db)}
+    except Exception as e:
+        db.rollback()
+        return {"status": "error", "message": str(e)}
+    finally:
+        db.close()
\ No newline at end of file
@@ -0,0 +1,166 @@
+# Admin endpoints: keyset pages, X-Next-Cursor, filters and streamed exports
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import admin_routes
+import db as database
+from admin_routes import router as admin_router, stream_export
+from models import Base, User, Driver, Ride, Payment
+from read_routing import SessionRouter
+
+START = datetime(2024, 1, 15, 8, 0)
+
+
+@pytest.fixture
+def factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'admin.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with factory() as session:
+        riders = [User(name=f"Rider {n}", email=f"rider{n}@example.com", phone="+911234567890", role="rider",
+                       password="x", is_active=n != 2) for n in range(1, 6)]
+        driver_user = User(name="Jane Smith", email="jane@example.com", phone="+911234567891", role="driver",
+                           password="x")
+        session.add_all(riders + [driver_user])
+        session.flush()
+        session.add(Driver(user_id=driver_user.id, vehicle_info={"model": "Honda City"}, vehicle_type="sedan",
+                           license_number="DL1234567890", verified=True, status="active"))
+        for n in range(7):
+            ride = Ride(rider_id=riders[n % 5].id, driver_id=driver_user.id if n % 2 else None,
+                        pickup_lat=28.61, pickup_lng=77.20, drop_lat=28.53, drop_lng=77.39,
+                        fare_estimate=100.0 + n, status="completed" if n % 2 else "requested",
+                        created_at=START + timedelta(hours=n))
+            session.add(ride)
+            session.flush()
+            session.add(Payment(ride_id=ride.id, amount=100.0 + n, payment_method="card" if n % 3 else "cash",
+                                status="completed" if n % 2 else "pending", created_at=START + timedelta(hours=n)))
+        session.commit()
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def client(factory):
+    app = FastAPI()
+    app.include_router(admin_router)
+
+    def get_test_db():
+        with factory() as session:
+            yield session
+
+    app.dependency_overrides[database.get_read_db] = get_test_db
+    return TestClient(app)
+
+
+@pytest.fixture
+def export_sessions(factory, monkeypatch):
+    """Exports open their own read session rather than taking the request's"""
+    monkeypatch.setattr(admin_routes, "session_router", SessionRouter(factory))
+    monkeypatch.setattr(admin_routes, "EXPORT_CHUNK_ROWS", 2)
+
+
+def walk(client, path, **params):
+    """Every page of a listing, following X-Next-Cursor"""
+    pages = []
+    cursor = None
+    while True:
+        response = client.get(path, params={**params, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        pages.append([row["id"] for row in response.json()])
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            return pages
+
+
+def test_pages_are_newest_first_and_end_without_a_cursor(client):
+    assert walk(client, "/admin/rides", limit=3) == [[7, 6, 5], [4, 3, 2], [1]]
+
+
+def test_a_full_last_page_has_no_cursor(client):
+    response = client.get("/admin/rides", params={"limit": 7})
+    assert len(response.json()) == 7 and "x-next-cursor" not in response.headers
+
+    response = client.get("/admin/rides", params={"limit": 6})
+    assert response.headers["x-next-cursor"] == "2"
+    assert [ride["id"] for ride in client.get("/admin/rides", params={"cursor": 2}).json()] == [1]
+
+
+def test_filters_apply_across_pages(client):
+    assert walk(client, "/admin/rides", limit=2, status="completed") == [[6, 4], [2]]
+    assert walk(client, "/admin/payments", limit=2, payment_method="cash") == [[7, 4], [1]]
+    assert walk(client, "/admin/users", role="rider", is_active=False) == [[2]]
+
+
+def test_rows_carry_only_the_listed_columns(client):
+    ride = client.get("/admin/rides", params={"limit": 1}).json()[0]
+    assert ride == {
+        "id": 7, "rider_name": "Rider 2", "driver_name": "Not assigned",
+        "pickup_address": None, "drop_address": None, "fare_estimate": 106.0,
+        "status": "requested", "created_at": "2024-01-15T14:00:00",
+    }
+    driver = client.get("/admin/drivers").json()[0]
+    assert driver["name"] == "Jane Smith" and driver["verified"] is True
+
+
+def test_database_errors_are_503_not_sample_rows(tmp_path):
+    empty = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'empty.db'}"))  # no tables
+    app = FastAPI()
+    app.include_router(admin_router)
+
+    def get_test_db():
+        with empty() as session:
+            yield session
+
+    app.dependency_overrides[database.get_read_db] = get_test_db
+    client = TestClient(app)
+
+    for path in ("/admin/users", "/admin/drivers", "/admin/rides", "/admin/payments"):
+        assert client.get(path).status_code == 503
+
+
+def test_page_size_is_bounded(client):
+    assert client.get("/admin/rides", params={"limit": 0}).status_code == 422
+    assert client.get("/admin/rides", params={"limit": 501}).status_code == 422
+
+
+def test_ndjson_export_filters_by_window_and_status(client, export_sessions):
+    response = client.get("/admin/export/rides", params={
+        "start": "2024-01-15T09:00:00", "end": "2024-01-15T14:00:00", "status": "completed",
+    })
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.headers["content-disposition"].startswith('attachment; filename="rides_')
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == [2, 4, 6]
+    assert rows[0]["created_at"] == "2024-01-15T09:00:00" and rows[0]["fare_actual"] is None
+
+
+def test_csv_export_has_a_header_and_one_line_per_row(client, export_sessions):
+    response = client.get("/admin/export/payments", params={"format": "csv", "status": "pending"})
+
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["id", "ride_id", "amount", "currency", "payment_method", "status",
+                       "stripe_payment_intent_id", "created_at"]
+    assert [row[0] for row in rows[1:]] == ["1", "3", "5", "7"]
+
+
+def test_unknown_export_format_is_rejected(client, export_sessions):
+    assert client.get("/admin/export/rides", params={"format": "xlsx"}).status_code == 400
+
+
+def test_exports_are_streamed_a_chunk_at_a_time(export_sessions):
+    chunks = stream_export(select(Ride.id).order_by(Ride.id), "ndjson")
+
+    # Each chunk holds one fetch of EXPORT_CHUNK_ROWS rows, yielded before the next fetch
+    first = next(chunks)
+    assert first.splitlines() == ['{"id": 1}', '{"id": 2}']
+    assert [chunk.count("\n") for chunk in chunks] == [2, 2, 1]
@@ -0,0 +1,136 @@
+# Hourly ride aggregates: incremental refresh and the bucketed, grouped time series
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import db as database
+from admin_routes import router as admin_router
+from analytics import refresh_ride_aggregates, ride_timeseries
+from models import Base, User, Ride, Payment, RideHourlyAggregate
+
+DAY = datetime(2024, 1, 15)
+DELHI = (28.6139, 77.2090)
+MUMBAI = (19.0760, 72.8777)
+# (hour offset from DAY, vehicle type, pickup, status, fare, paid)
+RIDES = [
+    (8, "sedan", DELHI, "completed", 200.0, 200.0),
+    (8, "mini", DELHI, "completed", 100.0, 100.0),
+    (8, "sedan", MUMBAI, "cancelled", 150.0, None),
+    (9, "sedan", DELHI, "requested", 180.0, None),
+    (34, "suv", MUMBAI, "completed", 400.0, 400.0),
+]
+
+
+@pytest.fixture
+def factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'analytics.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with factory() as session:
+        rider = User(name="Rider", email="rider@example.com", phone="+911234567890", role="rider", password="x")
+        session.add(rider)
+        session.flush()
+        for hours, vehicle_type, pickup, status, fare, paid in RIDES:
+            created_at = DAY + timedelta(hours=hours, minutes=30)
+            ride = Ride(rider_id=rider.id, vehicle_type=vehicle_type, pickup_lat=pickup[0], pickup_lng=pickup[1],
+                        drop_lat=28.53, drop_lng=77.39, fare_estimate=fare, status=status,
+                        created_at=created_at, updated_at=created_at)
+            session.add(ride)
+            session.flush()
+            if paid:
+                session.add(Payment(ride_id=ride.id, amount=paid, payment_method="card", status="completed",
+                                    created_at=created_at, updated_at=created_at))
+        session.commit()
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def db(factory):
+    with factory() as session:
+        yield session
+
+
+def test_first_refresh_builds_every_bucket(db):
+    assert refresh_ride_aggregates(db)["buckets_refreshed"] == 3
+    assert db.query(RideHourlyAggregate).count() == 5
+
+
+def test_later_refreshes_only_recompute_changed_buckets(db):
+    refresh_ride_aggregates(db)
+    assert refresh_ride_aggregates(db)["buckets_refreshed"] == 0
+
+    ride = db.query(Ride).filter(Ride.status == "requested").one()
+    ride.status = "completed"
+    db.commit()
+    assert refresh_ride_aggregates(db)["buckets_refreshed"] == 1
+    point, = ride_timeseries(db, DAY + timedelta(hours=9), DAY + timedelta(hours=10))
+    assert (point["rides"], point["completed"], point["avg_fare"]) == (1, 1, 180.0)
+
+    db.add(Payment(ride_id=ride.id, amount=180.0, payment_method="cash", status="completed"))
+    db.commit()
+    assert refresh_ride_aggregates(db)["buckets_refreshed"] == 1
+    point, = ride_timeseries(db, DAY + timedelta(hours=9), DAY + timedelta(hours=10))
+    assert point["revenue"] == 180.0
+
+
+def test_hourly_series(db):
+    refresh_ride_aggregates(db)
+
+    points = ride_timeseries(db, DAY, DAY + timedelta(days=2))
+
+    assert [point["bucket"] for point in points] == [
+        DAY + timedelta(hours=8), DAY + timedelta(hours=9), DAY + timedelta(hours=34)
+    ]
+    assert points[0] == {"bucket": DAY + timedelta(hours=8), "rides": 3, "completed": 2, "cancelled": 1,
+                         "revenue": 300.0, "avg_fare": 150.0}
+    assert points[1]["avg_fare"] is None
+
+
+def test_daily_series_grouped_by_zone(db):
+    refresh_ride_aggregates(db)
+
+    points = ride_timeseries(db, DAY, DAY + timedelta(days=2), granularity="day", group_by="zone")
+
+    by_key = {(point["bucket"], point["zone"]): (point["rides"], point["revenue"]) for point in points}
+    assert by_key == {
+        (DAY, "delhi"): (3, 300.0),
+        (DAY, "mumbai"): (1, 0.0),
+        (DAY + timedelta(days=1), "mumbai"): (1, 400.0),
+    }
+
+
+def test_series_filters_and_vehicle_type_grouping(db):
+    refresh_ride_aggregates(db)
+
+    points = ride_timeseries(db, DAY, DAY + timedelta(days=2), granularity="day", group_by="vehicle_type",
+                             zone="delhi")
+    assert {point["vehicle_type"]: point["rides"] for point in points} == {"sedan": 2, "mini": 1}
+
+    points = ride_timeseries(db, DAY, DAY + timedelta(days=2), vehicle_type="suv")
+    assert [(point["bucket"], point["revenue"]) for point in points] == [(DAY + timedelta(hours=34), 400.0)]
+
+
+def test_analytics_endpoints(factory):
+    app = FastAPI()
+    app.include_router(admin_router)
+
+    def get_test_db():
+        with factory() as session:
+            yield session
+
+    app.dependency_overrides[database.get_db] = get_test_db
+    app.dependency_overrides[database.get_read_db] = get_test_db
+    client = TestClient(app)
+    window = {"start": "2024-01-15T00:00:00", "end": "2024-01-17T00:00:00"}
+
+    assert client.get("/admin/analytics/rides", params=window).json() == {"series": [], "refreshed_to": None}
+    assert client.post("/admin/analytics/refresh").json()["buckets_refreshed"] == 3
+    body = client.get("/admin/analytics/rides", params={**window, "granularity": "day"}).json()
+    assert [point["rides"] for point in body["series"]] == [4, 1] and body["refreshed_to"]
+    assert client.get("/admin/analytics/rides", params={**window, "granularity": "week"}).status_code == 400
+    assert client.get("/admin/analytics/rides", params={**window, "group_by": "driver"}).status_code == 400
@@ -0,0 +1,144 @@
+# Access token tests: signed claims, key rotation, the verified-token cache and password login
+import jwt
+import pytest
+from datetime import timedelta
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import auth
+import db as database
+import main
+import main_simple
+import passwords
+import security
+from models import Base, User
+
+NEW_SECRET = "rotated-secret-of-at-least-32-bytes"
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(auth, "token_cache", auth.TokenCache())
+    monkeypatch.setattr(security, "local_buckets", security.LocalBuckets())
+
+
+def test_tokens_carry_the_claims_authorization_needs():
+    token = auth.create_access_token(7, "driver", "ravi@example.com", "Ravi Kumar")
+
+    claims = auth.decode_token(token)
+    assert (claims["sub"], claims["role"], claims["name"]) == ("7", "driver", "Ravi Kumar")
+    assert jwt.get_unverified_header(token)["kid"] == "test"  # set in conftest.py
+    with pytest.raises(HTTPException):
+        auth.decode_token(token[:-2] + "xx")
+
+
+def test_signing_keys_must_be_configured(monkeypatch):
+    monkeypatch.delenv("JWT_SIGNING_KEYS", raising=False)
+    monkeypatch.delenv("JWT_ALLOW_DEV_KEY", raising=False)
+    with pytest.raises(RuntimeError):
+        auth.configured_signing_keys()
+
+    # The public development key only behind the explicit flag
+    monkeypatch.setenv("JWT_ALLOW_DEV_KEY", "1")
+    assert auth.configured_signing_keys() == auth.DEV_SIGNING_KEYS
+    monkeypatch.setenv("JWT_SIGNING_KEYS", f"next:{NEW_SECRET}")
+    assert auth.configured_signing_keys() == f"next:{NEW_SECRET}"
+
+
+def test_verified_tokens_are_served_from_the_cache(monkeypatch):
+    token = auth.create_access_token(7, "rider")
+    decode = jwt.decode
+    calls = []
+    monkeypatch.setattr(jwt, "decode", lambda *args, **kwargs: calls.append(1) or decode(*args, **kwargs))
+
+    for _ in range(3):
+        auth.decode_token(token)
+    assert len(calls) == 1
+
+
+def test_rotated_keys_still_verify_until_removed(monkeypatch):
+    old_token = auth.create_access_token(7, "rider")
+    monkeypatch.setattr(auth, "key_ring", auth.KeyRing(f"next:{NEW_SECRET},{auth.JWT_SIGNING_KEYS}"))
+    new_token = auth.create_access_token(8, "rider")
+
+    assert jwt.get_unverified_header(new_token)["kid"] == "next"
+    assert auth.decode_token(old_token)["sub"] == "7"
+
+    auth.token_cache.clear()
+    monkeypatch.setattr(auth, "key_ring", auth.KeyRing(f"next:{NEW_SECRET}"))
+    assert auth.decode_token(new_token)["sub"] == "8"
+    with pytest.raises(HTTPException):
+        auth.decode_token(old_token)
+
+
+def test_expired_tokens_are_rejected_even_when_cached(monkeypatch):
+    monkeypatch.setattr(auth, "ACCESS_TOKEN_TTL", timedelta(seconds=-1))
+    with pytest.raises(HTTPException):
+        auth.decode_token(auth.create_access_token(7, "rider"))
+
+    monkeypatch.setattr(auth, "ACCESS_TOKEN_TTL", timedelta(minutes=5))
+    token = auth.create_access_token(7, "rider")
+    auth.token_cache.put(token, {**auth.decode_token(token), "exp": 0})
+    assert auth.token_cache.get(token, now=1) is None
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    hasher = passwords.PasswordHasher(workers=1, rounds=4)
+    monkeypatch.setattr(passwords, "hasher", hasher)
+    engine = create_engine(f"sqlite:///{tmp_path / 'auth.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_test_db():
+        session = factory()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    main.app.dependency_overrides[database.get_db] = get_test_db
+    yield TestClient(main.app), factory
+    main.app.dependency_overrides.clear()
+    hasher.close()
+    engine.dispose()
+
+
+def test_register_hashes_and_login_issues_a_token(client):
+    client, factory = client
+    registered = client.post("/api/auth/register", json={
+        "name": "John Doe", "email": "john@example.com", "phone": "+911234567890",
+        "role": "rider", "password": "hunter22"
+    })
+    assert registered.status_code == 200
+    with factory() as session:
+        assert session.query(User.password).scalar().startswith("$2b$04$")
+
+    assert client.post("/api/auth/login", json={"email": "john@example.com", "password": "nope"}).status_code == 401
+    login = client.post("/api/auth/login", json={"email": "john@example.com", "password": "hunter22"})
+    session = client.post("/api/auth/session", params={"token": login.json()["access_token"]})
+    assert session.json() == {"user_id": registered.json()["user_id"], "role": "rider", "name": "John Doe"}
+
+
+def test_plaintext_passwords_are_upgraded_on_login(client):
+    client, factory = client
+    with factory() as session:
+        session.add(User(name="Old User", email="old@example.com", phone="+911234567891",
+                         role="rider", password="legacy-pass"))
+        session.commit()
+
+    assert client.post("/api/auth/login", json={"email": "old@example.com", "password": "legacy-pass"}).status_code == 200
+    with factory() as session:
+        stored = session.query(User.password).scalar()
+    assert stored.startswith("$2b$04$") and passwords.pwd_context.verify("legacy-pass", stored)
+
+
+def test_demo_login_issues_no_api_token():
+    response = TestClient(main_simple.app).post("/api/auth/login",
+                                                json={"email": "admin@example.com", "password": "anything"})
+
+    token = response.json()["access_token"]
+    with pytest.raises(HTTPException):
+        auth.decode_token(token)
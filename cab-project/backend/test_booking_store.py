@@ -0,0 +1,67 @@
+# Booking store tests: indexed lookups, id allocation and the SQLite backend
+import threading
+
+import pytest
+
+from booking_store import MemoryRepository, SQLiteRepository
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def repository(request, tmp_path):
+    if request.param == "memory":
+        return MemoryRepository(indexes=("user_name", "status"))
+    return SQLiteRepository(str(tmp_path / "store.db"), "bookings", indexes=("user_name", "status"))
+
+
+def booking(user_name, status="confirmed", cab_id=1):
+    return {"user_name": user_name, "status": status, "cab_id": cab_id, "fare": 150.0}
+
+
+def test_records_are_found_by_id_and_index(repository):
+    first = repository.add(booking("asha"))
+    repository.add(booking("ravi", cab_id=2))
+    repository.add(booking("asha", status="cancelled", cab_id=2))
+
+    assert [first["id"], len(repository)] == [1, 3]
+    assert repository.get(1)["user_name"] == "asha" and repository.get(99) is None
+    assert [b["id"] for b in repository.find(user_name="asha")] == [1, 3]
+    assert [b["id"] for b in repository.find(user_name="asha", status="confirmed")] == [1]
+    # Fields without an index still filter
+    assert [b["id"] for b in repository.find(cab_id=2)] == [2, 3]
+    assert [b["id"] for b in repository.all(offset=1, limit=1)] == [2]
+
+
+def test_updates_move_records_between_index_entries(repository):
+    repository.add(booking("asha"))
+
+    assert repository.update(1, status="completed", fare=180.0)["fare"] == 180.0
+    assert repository.find(status="confirmed") == []
+    assert repository.first(status="completed")["fare"] == 180.0
+    assert repository.update(2, status="completed") is None
+    # Returned records are copies
+    repository.get(1)["status"] = "tampered"
+    assert repository.get(1)["status"] == "completed"
+
+
+def test_concurrent_adds_get_distinct_ids(repository):
+    def add_many():
+        for _ in range(200):
+            repository.add(booking("load"))
+
+    threads = [threading.Thread(target=add_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ids = [b["id"] for b in repository.find(user_name="load")]
+    assert sorted(ids) == list(range(1, 801))
+
+
+def test_sqlite_records_survive_a_restart(tmp_path):
+    path = str(tmp_path / "store.db")
+    SQLiteRepository(path, "bookings", indexes=("status",)).add(booking("asha"))
+
+    reopened = SQLiteRepository(path, "bookings", indexes=("status",))
+    assert reopened.first(status="confirmed")["user_name"] == "asha"
+    assert reopened.add(booking("ravi"))["id"] == 2
@@ -0,0 +1,90 @@
+# Compression middleware: encoding negotiation, size/type thresholds and streaming
+import gzip
+
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+import compression
+from compression import CompressionMiddleware, choose_encoding
+
+requires_brotli = pytest.mark.skipif(compression.brotli is None, reason="brotli is not installed")
+
+ROWS = [{"id": index, "pickup_address": "Connaught Place, New Delhi", "status": "completed"} for index in range(200)]
+
+
+def make_client():
+    app = FastAPI(default_response_class=ORJSONResponse)
+    app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+    @app.get("/rides")
+    def rides():
+        return Response(ORJSONResponse(ROWS).body, media_type="application/json", headers={"ETag": '"v1"'})
+
+    @app.get("/small")
+    def small():
+        return {"ok": True}
+
+    @app.get("/image")
+    def image():
+        return Response(b"\x89PNG" * 1000, media_type="image/png")
+
+    @app.get("/export")
+    def export():
+        return StreamingResponse((b'{"id": %d}\n' % index for index in range(500)),
+                                 media_type="application/x-ndjson")
+
+    return TestClient(app)
+
+
+@requires_brotli
+def test_negotiation_prefers_brotli_and_respects_q():
+    assert choose_encoding("gzip, deflate, br") == "br"
+    assert choose_encoding("gzip, br;q=0") == "gzip"
+    assert choose_encoding("identity") is None
+    assert choose_encoding("*") == "br"
+
+
+@requires_brotli
+def test_large_json_is_compressed_with_a_weak_etag():
+    client = make_client()
+
+    br = client.get("/rides", headers={"Accept-Encoding": "br"})
+    gz = client.get("/rides", headers={"Accept-Encoding": "gzip"})
+
+    assert br.headers["content-encoding"] == "br" and gz.headers["content-encoding"] == "gzip"
+    assert br.json() == gz.json() == ROWS
+    assert br.headers["etag"] == 'W/"v1"' and br.headers["vary"] == "Accept-Encoding"
+    assert int(gz.headers["content-length"]) < len(ORJSONResponse(ROWS).body) / 4
+
+
+def test_small_and_binary_responses_are_left_alone():
+    client = make_client()
+
+    small = client.get("/small", headers={"Accept-Encoding": "br"})
+    image = client.get("/image", headers={"Accept-Encoding": "br"})
+
+    assert "content-encoding" not in small.headers and small.headers["vary"] == "Accept-Encoding"
+    assert "content-encoding" not in image.headers and "vary" not in image.headers
+
+
+def test_streamed_responses_are_compressed_as_they_go(monkeypatch):
+    client = make_client()
+    monkeypatch.setattr(compression, "brotli", None)  # as if brotli weren't installed
+
+    with client.stream("GET", "/export", headers={"Accept-Encoding": "gzip, br"}) as response:
+        raw = b"".join(response.iter_raw())
+    assert response.headers["content-encoding"] == "gzip" and "content-length" not in response.headers
+    assert gzip.decompress(raw).count(b"\n") == 500
+
+    identity = client.get("/export", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identity.headers and identity.content.count(b"\n") == 500
+
+
+@requires_brotli
+def test_brotli_round_trip():
+    client = make_client()
+    with client.stream("GET", "/rides", headers={"Accept-Encoding": "br"}) as response:
+        raw = b"".join(response.iter_raw())
+    assert compression.brotli.decompress(raw) == ORJSONResponse(ROWS).body
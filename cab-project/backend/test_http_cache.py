@@ -0,0 +1,128 @@
+# Pre-serialized static responses and conditional GET: ETags, 304s and handler bypass
+from datetime import datetime
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from fastapi.testclient import TestClient
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import db as database
+import main
+from http_cache import StaticResponseCache, etag_matches
+from models import Base, User, Ride
+
+
+def make_client(**options):
+    app = FastAPI(default_response_class=ORJSONResponse)
+    app.add_middleware(StaticResponseCache, paths=["/types", "/config", "/missing"], **options)
+    calls = []
+
+    @app.get("/types")
+    def types():
+        calls.append("types")
+        return {"mini": {"base_fare": 40}}
+
+    @app.get("/config")
+    def config(zoom: int = 13):
+        calls.append(zoom)
+        return {"zoom": zoom}
+
+    return TestClient(app), calls
+
+
+def test_repeat_requests_skip_the_handler():
+    client, calls = make_client()
+
+    first = client.get("/types")
+    second = client.get("/types")
+
+    assert first.json() == {"mini": {"base_fare": 40}} and second.content == first.content
+    assert first.headers["etag"] == second.headers["etag"]
+    assert calls == ["types"]
+
+
+def test_matching_etags_get_304():
+    client, calls = make_client()
+    etag = client.get("/types").headers["etag"]
+
+    not_modified = client.get("/types", headers={"If-None-Match": f'"other", W/{etag}'})
+    assert not_modified.status_code == 304 and not_modified.content == b""
+    assert not_modified.headers["etag"] == etag
+    assert client.get("/types", headers={"If-None-Match": '"other"'}).status_code == 200
+    assert calls == ["types"]
+
+
+def test_entries_are_per_query_string_and_bounded():
+    client, calls = make_client(max_entries=2)
+
+    for zoom in (10, 11, 10, 12, 10, 11):
+        assert client.get("/config", params={"zoom": zoom}).json() == {"zoom": zoom}
+    # 11 was evicted by 12, then rendered again
+    assert calls == [10, 11, 12, 11]
+
+
+def test_errors_are_not_cached():
+    client, _ = make_client()
+    assert client.get("/missing").status_code == 404
+    assert "etag" not in client.get("/missing").headers
+
+
+def test_weak_and_wildcard_validators():
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+@pytest.fixture
+def ride_client(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'rides.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with factory() as session:
+        rider = User(name="John Doe", email="john@example.com", phone="+911234567890", role="rider", password="x")
+        session.add(rider)
+        session.flush()
+        session.add_all([
+            Ride(rider_id=rider.id, pickup_lat=28.61, pickup_lng=77.20, drop_lat=28.53, drop_lng=77.39,
+                 fare_estimate=250.0, status="requested", updated_at=datetime(2024, 1, 15, 18, 30, 5, 250000))
+            for _ in range(3)
+        ])
+        session.commit()
+
+    def get_test_db():
+        with factory() as session:
+            yield session
+
+    main.app.dependency_overrides[database.get_read_db] = get_test_db
+    yield TestClient(main.app), factory
+    main.app.dependency_overrides.clear()
+    engine.dispose()
+
+
+def test_unchanged_ride_status_polls_get_304(ride_client):
+    client, factory = ride_client
+
+    first = client.get("/api/rides/1/status")
+    assert first.headers["last-modified"] == "Mon, 15 Jan 2024 18:30:05 GMT"
+    assert client.get("/api/rides/1/status", headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+    assert client.get("/api/rides/1/status",
+                      headers={"If-Modified-Since": first.headers["last-modified"]}).status_code == 304
+
+    with factory() as session:
+        session.get(Ride, 1).status = "accepted"
+        session.commit()
+    changed = client.get("/api/rides/1/status", headers={"If-None-Match": first.headers["etag"]})
+    assert changed.status_code == 200 and changed.json()["status"] == "accepted"
+
+
+def test_admin_pages_revalidate_with_their_cursor(ride_client):
+    client, _ = ride_client
+
+    page = client.get("/admin/rides", params={"limit": 2})
+    assert [ride["id"] for ride in page.json()] == [3, 2] and page.headers["x-next-cursor"] == "2"
+
+    again = client.get("/admin/rides", params={"limit": 2}, headers={"If-None-Match": page.headers["etag"]})
+    assert again.status_code == 304 and again.headers["x-next-cursor"] == "2"
@@ -0,0 +1,175 @@
+# Pooled SMTP mailer against the local debugging SMTP server
+import smtplib
+import socket
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import receipts
+from fake_smtp import FakeSMTPServer
+from mailer import SMTPPool, RateLimiter, build_message, is_transient
+from models import Base, User, Ride
+from models_advanced import Receipt
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSMTPServer(credentials=("rides@example.com", "secret")).start()
+    yield server
+    server.stop()
+
+
+def make_pool(server, **options):
+    options = {"size": 2, "rate_per_second": 0, "retry_backoff": 0.01, **options}
+    return SMTPPool(host="127.0.0.1", port=server.port, username="rides@example.com",
+                    password="secret", starttls=False, **options)
+
+
+def messages(count):
+    return [
+        build_message("rides@example.com", f"rider{index}@example.com", f"Receipt {index}", "Thanks!")
+        for index in range(count)
+    ]
+
+
+def test_batch_reuses_authenticated_connections(smtp_server):
+    pool = make_pool(smtp_server)
+
+    results = pool.send_batch(messages(20))
+    pool.close()
+
+    assert [result["status"] for result in results] == ["sent"] * 20
+    assert len(smtp_server.messages) == 20
+    assert smtp_server.connections <= 2 and smtp_server.logins == smtp_server.connections
+
+
+def test_transient_failures_are_retried_and_permanent_ones_are_not(smtp_server):
+    pool = make_pool(smtp_server, size=1)
+
+    smtp_server.fail_next("451 4.3.0 try again later", times=2)
+    retried = pool.send(messages(1)[0])
+    smtp_server.fail_next("550 5.1.0 sender rejected")
+    rejected = pool.send(messages(1)[0])
+
+    assert retried["status"] == "sent" and retried["attempts"] == 3
+    assert rejected["status"] == "failed" and rejected["attempts"] == 1
+    # Rejections don't cost a reconnect
+    assert smtp_server.connections == 1
+
+
+@pytest.mark.parametrize("error,transient", [
+    (smtplib.SMTPServerDisconnected("Connection unexpectedly closed"), True),
+    (socket.timeout("timed out"), True),
+    (ConnectionRefusedError(111, "Connection refused"), True),
+    (smtplib.SMTPResponseException(421, b"closing"), True),
+    (smtplib.SMTPAuthenticationError(535, b"bad credentials"), False),
+    (smtplib.SMTPNotSupportedError("SMTPUTF8 not supported by server"), False),
+    (smtplib.SMTPException("No suitable authentication method found."), False),
+])
+def test_only_network_errors_and_4xx_replies_are_transient(error, transient):
+    assert is_transient(error) is transient
+
+
+def test_dropped_sessions_are_replaced(smtp_server):
+    smtp_server.max_messages_per_connection = 3
+    pool = make_pool(smtp_server, size=1)
+
+    results = [pool.send(message) for message in messages(7)]
+
+    assert all(result["status"] == "sent" for result in results)
+    assert len(smtp_server.messages) == 7
+    assert smtp_server.connections == 3
+
+
+def test_rate_limiter_shapes_sends():
+    limiter = RateLimiter(rate=50, burst=1)
+    started = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    assert time.monotonic() - started >= 0.18
+
+
+def test_receipt_emails_are_sent_once(smtp_server, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'mail.db'}")
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    rider = User(name="John Doe", email="john@example.com", phone="+911234567890",
+                 role="rider", password="x")
+    db.add(rider)
+    db.flush()
+    ride = Ride(rider_id=rider.id, pickup_lat=28.6139, pickup_lng=77.2090, drop_lat=28.5355,
+                drop_lng=77.3910, fare_estimate=250.0, status="completed", pickup_address="Connaught Place")
+    db.add(ride)
+    db.flush()
+    pdf_path = tmp_path / "RCPT-00000001.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 receipt")
+    db.add(Receipt(ride_id=ride.id, receipt_number="RCPT-00000001", pdf_path=str(pdf_path), email_sent=False))
+    db.commit()
+    pool = make_pool(smtp_server)
+
+    assert receipts.email_receipts(db, pool) == {"sent": 1, "failed": 0}
+    assert receipts.email_receipts(db, pool) == {"sent": 0, "failed": 0}
+
+    message = smtp_server.messages[0]["message"]
+    assert message["To"] == "john@example.com"
+    assert message["Subject"] == "Ride Receipt - #RCPT-00000001"
+    attachment = next(message.iter_attachments())
+    assert attachment.get_filename() == "RCPT-00000001.pdf"
+    assert attachment.get_payload(decode=True) == b"%PDF-1.4 receipt"
+    db.close()
+    engine.dispose()
+
+
+class CrashingMailer:
+    """Delivers the first message, then the run dies"""
+    sender = "rides@example.com"
+
+    def __init__(self):
+        self.sent = []
+
+    def send_each(self, messages):
+        self.sent.append(messages[0]["To"])
+        yield {"to": messages[0]["To"], "status": "sent", "attempts": 1}
+        raise RuntimeError("worker killed")
+
+
+def test_receipt_emails_are_claimed_and_marked_one_by_one(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'mail.db'}")
+    Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    rider = User(name="John Doe", email="john@example.com", phone="+911234567890",
+                 role="rider", password="x")
+    db.add(rider)
+    db.flush()
+    pdf_path = tmp_path / "receipt.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 receipt")
+    for index in range(3):
+        ride = Ride(rider_id=rider.id, pickup_lat=28.6139, pickup_lng=77.2090, drop_lat=28.5355,
+                    drop_lng=77.3910, fare_estimate=250.0, status="completed")
+        db.add(ride)
+        db.flush()
+        db.add(Receipt(ride_id=ride.id, receipt_number=f"RCPT-{index}", pdf_path=str(pdf_path), email_sent=False))
+    db.commit()
+    # Another run is sending the first receipt right now
+    first = db.query(Receipt).filter(Receipt.receipt_number == "RCPT-0").one()
+    first.email_claimed_at = datetime.utcnow()
+    db.commit()
+
+    mailer = CrashingMailer()
+    with pytest.raises(RuntimeError):
+        receipts.email_receipts(db, mailer)
+
+    db.expire_all()
+    assert {receipt.receipt_number: receipt.email_sent for receipt in db.query(Receipt)} == {
+        "RCPT-0": False, "RCPT-1": True, "RCPT-2": False
+    }
+    # Claims held by live runs are skipped; those of dead runs are taken over after the lease
+    assert receipts.claim_receipt_emails(db, 10) == []
+    db.query(Receipt).update({Receipt.email_claimed_at: datetime.utcnow() - receipts.RECEIPT_EMAIL_LEASE * 2})
+    db.commit()
+    assert receipts.claim_receipt_emails(db, 10) == [first.id, first.id + 2]
+    db.close()
+    engine.dispose()
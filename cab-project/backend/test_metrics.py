@@ -0,0 +1,124 @@
+# Prometheus instrumentation: route-template labels, pool timings, outbound calls, caches and queues
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY, CollectorRegistry
+from sqlalchemy import create_engine, text
+
+import auth
+import main_simple
+from http_cache import StaticResponseCache
+from metrics import MetricsMiddleware, QueueDepths, external_call, instrument_engine
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def make_client():
+    app = FastAPI()
+    app.add_middleware(StaticResponseCache, paths=["/types"])
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/rides/{ride_id}")
+    def ride(ride_id: int):
+        return {"id": ride_id}
+
+    @app.get("/types")
+    def types():
+        return {"mini": {"base_fare": 40}}
+
+    return TestClient(app)
+
+
+def test_requests_are_labelled_by_route_template():
+    client = make_client()
+    before = sample("http_requests_total", method="GET", route="/rides/{ride_id}", status="200")
+    latency_before = sample("http_request_duration_seconds_count", method="GET", route="/rides/{ride_id}")
+
+    client.get("/rides/1")
+    client.get("/rides/2")
+    client.get("/nowhere")
+
+    assert sample("http_requests_total", method="GET", route="/rides/{ride_id}", status="200") == before + 2
+    assert sample("http_request_duration_seconds_count", method="GET", route="/rides/{ride_id}") == latency_before + 2
+    assert sample("http_requests_total", method="GET", route="unmatched", status="404") >= 1
+
+
+def test_responses_served_before_routing_keep_their_route():
+    client = make_client()
+    client.get("/types")
+    before = sample("http_requests_total", method="GET", route="/types", status="200")
+    hits = sample("cache_lookups_total", cache="static_response", result="hit")
+
+    client.get("/types")
+
+    assert sample("http_requests_total", method="GET", route="/types", status="200") == before + 1
+    assert sample("cache_lookups_total", cache="static_response", result="hit") == hits + 1
+
+
+def test_pool_wait_and_hold_times_are_recorded():
+    engine = create_engine("sqlite://")
+    instrument_engine(engine, "test_pool")
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        assert sample("db_pool_checked_out_connections", engine="test_pool") == 1
+
+    assert sample("db_pool_checked_out_connections", engine="test_pool") == 0
+    assert sample("db_pool_checkout_seconds_count", engine="test_pool") == 1
+    assert sample("db_pool_connection_held_seconds_count", engine="test_pool") == 1
+
+    engine.dispose()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    assert sample("db_pool_checkout_seconds_count", engine="test_pool") == 2
+
+
+def test_external_calls_record_their_outcome():
+    with external_call("test_service", "lookup"):
+        pass
+    with pytest.raises(TimeoutError):
+        with external_call("test_service", "lookup"):
+            raise TimeoutError
+
+    assert sample("external_request_duration_seconds_count",
+                  service="test_service", operation="lookup", outcome="ok") == 1
+    assert sample("external_request_duration_seconds_count",
+                  service="test_service", operation="lookup", outcome="error") == 1
+
+
+def test_token_cache_hits_are_counted():
+    token = auth.create_access_token(1, "rider")
+    hits = sample("cache_lookups_total", cache="access_token", result="hit")
+    misses = sample("cache_lookups_total", cache="access_token", result="miss")
+
+    auth.decode_token(token)
+    auth.decode_token(token)
+
+    assert sample("cache_lookups_total", cache="access_token", result="miss") == misses + 1
+    assert sample("cache_lookups_total", cache="access_token", result="hit") == hits + 1
+
+
+def test_queue_depths_are_read_at_scrape_time():
+    registry = CollectorRegistry()
+    depths = QueueDepths()
+    registry.register(depths)
+    pending = [1, 2, 3]
+    depths.track("test_queue", lambda: len(pending))
+
+    assert registry.get_sample_value("outbound_queue_depth", {"queue": "test_queue"}) == 3
+    pending.clear()
+    assert registry.get_sample_value("outbound_queue_depth", {"queue": "test_queue"}) == 0
+
+
+def test_metrics_endpoint_serves_the_exposition_format():
+    client = TestClient(main_simple.app)
+    client.get("/")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_requests_total{method="GET",route="/",status="200"}' in response.text
+    assert "# TYPE outbound_queue_depth gauge" in response.text
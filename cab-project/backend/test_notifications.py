@@ -0,0 +1,203 @@
+# Notification pipeline tests: batched writes, unread counters, chunked fan-out and live push
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import notifications
+from models import Base, User, Notification, NotificationCounter
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'notifications.db'}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+def add_users(db, count, role="rider"):
+    users = [
+        User(name=f"User {index}", email=f"{role}{index}@example.com", phone=f"+91{role[0]}{index:09d}",
+             role=role, password="x")
+        for index in range(count)
+    ]
+    db.add_all(users)
+    db.commit()
+    return [user.id for user in users]
+
+
+def count_statements(engine):
+    statements = []
+    event.listen(engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, *args: statements.append(statement))
+    return statements
+
+
+def test_publish_writes_a_batch_and_counts_unread(db, engine):
+    first, second = add_users(db, 2)
+    statements = count_statements(engine)
+
+    stored = notifications.publish(db, [
+        notifications.notification_event(first, "Welcome", "Hello"),
+        notifications.notification_event(first, "Promo", "20% off", "promotion"),
+        notifications.notification_event(second, "Welcome", "Hello"),
+        None,
+    ])
+
+    assert stored == 3
+    assert sum("INSERT INTO notifications" in statement for statement in statements) == 1
+    assert notifications.unread_count(db, first) == 2
+    page = notifications.list_notifications(db, first)
+    assert [n["title"] for n in page] == ["Promo", "Welcome"]
+    assert [n["title"] for n in notifications.list_notifications(db, first, before_id=page[0]["id"])] == ["Welcome"]
+
+
+def test_mark_read_moves_the_counter_by_rows_changed(db):
+    user_id, = add_users(db, 1)
+    notifications.publish(db, [notifications.notification_event(user_id, f"N{index}", "m") for index in range(3)])
+    oldest = notifications.list_notifications(db, user_id)[-1]["id"]
+
+    assert notifications.mark_read(db, user_id, [oldest]) == 1
+    assert notifications.mark_read(db, user_id, [oldest]) == 0
+    assert notifications.unread_count(db, user_id) == 2
+    assert notifications.mark_read(db, user_id) == 2
+    assert notifications.unread_count(db, user_id) == 0
+
+
+def test_staged_notifications_are_dropped_on_rollback(db):
+    user_id, = add_users(db, 1)
+    notifications.stage(db, [notifications.notification_event(user_id, "Ride accepted", "m", "ride_update")])
+    db.rollback()
+    db.commit()
+
+    assert db.query(Notification).count() == 0
+    assert notifications.unread_count(db, user_id) == 0
+    with pytest.raises(ValueError):
+        notifications.notification_event(user_id, "t", "m", "carrier_pigeon")
+
+
+def test_fan_out_chunks_and_resumes(db, engine):
+    riders = add_users(db, 7)
+    drivers = add_users(db, 2, role="driver")
+    notifications.publish(db, [notifications.notification_event(riders[0], "Earlier", "m")])
+
+    summary = notifications.fan_out(db, "Weekend offer", "20% off", data={"code": "WEEKEND20"},
+                                    conditions=[User.role == "rider"], chunk_size=3)
+
+    assert summary == {"notified": 7, "chunks": 3, "last_id": riders[-1]}
+    assert notifications.unread_count(db, riders[0]) == 2
+    assert notifications.unread_count(db, riders[-1]) == 1
+    assert notifications.unread_count(db, drivers[0]) == 0
+    assert notifications.list_notifications(db, riders[3])[0]["data"] == {"code": "WEEKEND20"}
+
+    # Resuming after the last notified user has nothing left to do
+    resumed = notifications.fan_out(db, "Weekend offer", "20% off", conditions=[User.role == "rider"],
+                                    chunk_size=3, after_id=summary["last_id"])
+    assert resumed["notified"] == 0
+    assert db.query(Notification).count() == 8
+
+
+def test_fan_out_reports_where_it_stopped(db, monkeypatch):
+    riders = add_users(db, 5)
+    push_to_all = notifications.push_to_all
+    calls = []
+
+    def fail_second_chunk(user_ids, notification):
+        calls.append(user_ids)
+        if len(calls) == 2:
+            raise RuntimeError("push failed")
+        push_to_all(user_ids, notification)
+
+    monkeypatch.setattr(notifications, "push_to_all", fail_second_chunk)
+    summary = notifications.fan_out(db, "Offer", "m", chunk_size=2)
+    assert summary["error"] == "push failed" and summary["last_id"] == riders[3]
+
+    monkeypatch.setattr(notifications, "push_to_all", push_to_all)
+    # The second chunk was committed before its push failed; resuming skips it
+    resumed = notifications.fan_out(db, "Offer", "m", chunk_size=2, after_id=summary["last_id"])
+    assert resumed["notified"] == 1
+    assert db.query(Notification).count() == 5
+
+
+def test_connected_users_get_live_pushes(engine, monkeypatch):
+    hub = notifications.NotificationHub()
+    monkeypatch.setattr(notifications, "hub", hub)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with factory() as db:
+        online, offline = add_users(db, 2)
+
+    async def scenario():
+        received = []
+
+        async def send(message):
+            received.append(json.loads(message))
+
+        hub.register(online, send)
+
+        def write():
+            # Sync endpoints commit from a worker thread
+            with factory() as db:
+                notifications.publish(db, [
+                    notifications.notification_event(online, "Driver arriving", "2 min", "ride_update"),
+                    notifications.notification_event(offline, "Driver arriving", "2 min", "ride_update"),
+                ])
+                return notifications.fan_out(db, "Offer", "m", chunk_size=1)
+
+        summary = await asyncio.get_running_loop().run_in_executor(None, write)
+        await asyncio.sleep(0.05)
+        return summary, received
+
+    summary, received = asyncio.run(scenario())
+
+    assert summary["notified"] == 2
+    assert [push["notification"]["title"] for push in received] == ["Driver arriving", "Offer"]
+    assert received[0]["type"] == "notification" and received[0]["notification"]["id"]
+
+
+def test_fan_out_is_relayed_to_other_processes(db, monkeypatch):
+    # As in a Celery worker: nobody is connected to this process's hub
+    monkeypatch.setattr(notifications, "hub", notifications.NotificationHub())
+    relayed = []
+    monkeypatch.setattr(notifications, "relay", relayed.append)
+    riders = add_users(db, 3)
+    add_users(db, 1, role="driver")
+
+    notifications.fan_out(db, "Offer", "m", conditions=[User.role == "rider"], chunk_size=2)
+
+    assert [message["user_ids"] for message in relayed] == [riders[:2], riders[2:]]
+    assert relayed[0]["notification"]["title"] == "Offer"
+
+
+def test_relayed_fan_out_reaches_only_users_connected_here():
+    hub = notifications.NotificationHub()
+
+    async def scenario():
+        received = []
+
+        async def send(message):
+            received.append((1, json.loads(message)))
+
+        async def other(message):
+            received.append((3, json.loads(message)))
+
+        hub.register(1, send)
+        hub.register(3, other)
+        scheduled = hub.deliver_to([1, 2], {"title": "Offer"})
+        await asyncio.sleep(0.05)
+        return scheduled, received
+
+    scheduled, received = asyncio.run(scenario())
+
+    assert scheduled == 1
+    assert received == [(1, {"type": "notification", "notification": {"title": "Offer"}})]
@@ -0,0 +1,120 @@
+# Monthly partitions: naming, the default partition, archival and reading archives back
+import csv
+import gzip
+import os
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from partitions import (
+    add_months, archive_partition, archive_path, create_partition, default_partition_name, ensure_partitions,
+    list_archives, list_partitions, maintain_partitions, month_start, partition_month, partition_name,
+    read_archive
+)
+
+POSTGRES_TEST_URL = os.getenv("POSTGRES_TEST_URL")
+
+
+def write_archive(archive_dir, table, month, rows):
+    path = archive_path(table, month, str(archive_dir))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, "wt", newline="") as archive:
+        writer = csv.DictWriter(archive, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@pytest.mark.parametrize("month,months,expected", [
+    (date(2024, 1, 1), 1, date(2024, 2, 1)),
+    (date(2024, 11, 1), 3, date(2025, 2, 1)),
+    (date(2024, 1, 1), -1, date(2023, 12, 1)),
+    (date(2024, 3, 1), -15, date(2022, 12, 1)),
+])
+def test_add_months(month, months, expected):
+    assert add_months(month, months) == expected
+
+
+def test_partition_names_round_trip():
+    month = month_start(date(2024, 7, 19))
+    assert partition_name("ride_tracking", month) == "ride_tracking_y2024m07"
+    assert partition_month("ride_tracking", "ride_tracking_y2024m07") == month
+    # The default partition is not a month and is never archived
+    assert partition_month("ride_tracking", default_partition_name("ride_tracking")) is None
+
+
+def test_archives_are_listed_and_filtered(tmp_path):
+    rows = [{"id": "1", "ride_id": "7", "driver_lat": "28.6"}, {"id": "2", "ride_id": "8", "driver_lat": "28.7"}]
+    write_archive(tmp_path, "ride_tracking", date(2024, 2, 1), rows)
+    write_archive(tmp_path, "ride_tracking", date(2023, 12, 1), rows)
+
+    assert list_archives("ride_tracking", str(tmp_path)) == ["2023-12", "2024-02"]
+    assert list_archives("notifications", str(tmp_path)) == []
+    assert list(read_archive("ride_tracking", "2024-02", {"ride_id": "8"}, str(tmp_path))) == [rows[1]]
+    with pytest.raises(FileNotFoundError):
+        list(read_archive("ride_tracking", "2024-03", archive_dir=str(tmp_path)))
+
+
+def test_maintenance_needs_postgres():
+    assert maintain_partitions(create_engine("sqlite://"))["status"] == "skipped"
+
+
+@pytest.mark.skipif(not POSTGRES_TEST_URL, reason="POSTGRES_TEST_URL not set")
+class TestPostgresPartitions:
+    SCHEMA = "partitions_test"
+
+    @pytest.fixture
+    def engine(self):
+        admin = create_engine(POSTGRES_TEST_URL)
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {self.SCHEMA} CASCADE"))
+            conn.execute(text(f"CREATE SCHEMA {self.SCHEMA}"))
+        engine = create_engine(POSTGRES_TEST_URL, connect_args={"options": f"-csearch_path={self.SCHEMA}"})
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE ride_tracking (id serial, ride_id integer NOT NULL, "
+                "driver_lat double precision, driver_lng double precision, "
+                "timestamp timestamp NOT NULL, PRIMARY KEY (id, timestamp)) PARTITION BY RANGE (timestamp)"
+            ))
+            ensure_partitions(conn, "ride_tracking")
+        yield engine
+        engine.dispose()
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {self.SCHEMA} CASCADE"))
+        admin.dispose()
+
+    def insert(self, conn, moment):
+        conn.execute(text(
+            "INSERT INTO ride_tracking (ride_id, driver_lat, driver_lng, timestamp) VALUES (1, 28.6, 77.2, :at)"
+        ), {"at": moment})
+
+    def test_rows_outside_the_monthly_ranges_land_in_the_default_partition(self, engine):
+        with engine.begin() as conn:
+            self.insert(conn, datetime(2020, 5, 3))
+            assert conn.execute(text("SELECT count(*) FROM ride_tracking_default")).scalar() == 1
+
+            ensure_partitions(conn, "ride_tracking")
+
+            assert conn.execute(text("SELECT count(*) FROM ride_tracking_default")).scalar() == 0
+            assert conn.execute(text("SELECT count(*) FROM ride_tracking_y2020m05")).scalar() == 1
+            assert date(2020, 5, 1) in list_partitions(conn, "ride_tracking")
+
+    def test_creating_a_month_moves_its_rows_out_of_the_default_partition(self, engine):
+        with engine.begin() as conn:
+            self.insert(conn, datetime(2019, 1, 9))
+            self.insert(conn, datetime(2019, 2, 9))
+            create_partition(conn, "ride_tracking", date(2019, 1, 1))
+
+            assert conn.execute(text("SELECT count(*) FROM ride_tracking_y2019m01")).scalar() == 1
+            assert conn.execute(text("SELECT count(*) FROM ride_tracking_default")).scalar() == 1
+            assert conn.execute(text("SELECT count(*) FROM ride_tracking")).scalar() == 2
+
+    def test_archived_partitions_are_dropped(self, engine, tmp_path):
+        with engine.begin() as conn:
+            self.insert(conn, datetime(2018, 6, 1))
+            ensure_partitions(conn, "ride_tracking")
+            path = archive_partition(conn, "ride_tracking", date(2018, 6, 1), str(tmp_path))
+
+            assert date(2018, 6, 1) not in list_partitions(conn, "ride_tracking")
+        rows = list(read_archive("ride_tracking", "2018-06", archive_dir=str(tmp_path)))
+        assert path.endswith("2018-06.csv.gz") and [row["ride_id"] for row in rows] == ["1"]
@@ -0,0 +1,49 @@
+# Password hashing service tests: process pool, cost upgrades and the in-flight bound
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+from fastapi import HTTPException
+
+from passwords import PasswordHasher, hash_in_worker
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(workers=2, rounds=5)
+    yield hasher
+    hasher.close()
+
+
+def test_hashes_run_in_worker_processes(hasher):
+    stored = asyncio.run(hasher.hash("hunter22"))
+
+    assert isinstance(hasher.executor(), ProcessPoolExecutor)
+    assert stored.startswith("$2b$05$")
+    assert asyncio.run(hasher.verify("hunter22", stored)) == (True, None)
+    assert asyncio.run(hasher.verify("hunter23", stored)) == (False, None)
+
+
+def test_hashes_at_another_cost_are_upgraded(hasher):
+    cheaper = hash_in_worker("hunter22", 4)
+
+    valid, replacement = asyncio.run(hasher.verify("hunter22", cheaper))
+    assert valid and replacement.startswith("$2b$05$")
+    assert asyncio.run(hasher.verify("hunter22", "hunter22"))[1].startswith("$2b$05$")
+
+
+def test_logins_beyond_the_queue_are_refused():
+    hasher = PasswordHasher(workers=1, queue=2, rounds=4)
+    stored = hash_in_worker("hunter22", 4)
+
+    async def storm():
+        return await asyncio.gather(*(hasher.verify("hunter22", stored) for _ in range(3)),
+                                    return_exceptions=True)
+
+    try:
+        results = asyncio.run(storm())
+    finally:
+        hasher.close()
+    refused = [result for result in results if isinstance(result, HTTPException)]
+    assert len(refused) == 1 and refused[0].status_code == 503
+    assert results.count((True, None)) == 2
@@ -0,0 +1,176 @@
+# Payout engine tests: earnings accrual, batch planning and resumable transfers
+import asyncio
+
+import pytest
+import stripe
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import payouts
+from fake_stripe import FakeStripeServer
+from models import Base, User, Driver, Ride, DriverEarning, Payout
+
+BATCH = "2024-01-15"
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'payouts.db'}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    server = FakeStripeServer(latency=0.05).start()
+    monkeypatch.setattr(stripe, "api_base", server.url)
+    monkeypatch.setattr(stripe, "api_key", "sk_test_fake")
+    yield server
+    server.stop()
+
+
+def add_driver(db, index, account=True):
+    user = User(name=f"Driver {index}", email=f"driver{index}@example.com",
+                phone=f"+91{index:010d}", role="driver", password="x")
+    db.add(user)
+    db.flush()
+    db.add(Driver(user_id=user.id, vehicle_info={}, license_number=f"DL{index}",
+                  stripe_account_id=f"acct_{index}" if account else None))
+    return user
+
+
+def add_ride(db, rider, driver, fare, status="completed"):
+    db.add(Ride(rider_id=rider.id, driver_id=driver.id, pickup_lat=28.61, pickup_lng=77.20,
+                drop_lat=28.53, drop_lng=77.39, fare_estimate=fare, status=status))
+
+
+@pytest.fixture
+def rider(db):
+    rider = User(name="John Doe", email="john@example.com", phone="+911234567890",
+                 role="rider", password="x")
+    db.add(rider)
+    db.flush()
+    return rider
+
+
+def test_accrual_is_idempotent_and_in_paise(db, rider):
+    driver = add_driver(db, 1)
+    add_ride(db, rider, driver, 250.0)
+    add_ride(db, rider, driver, 99.99)
+    add_ride(db, rider, driver, 500.0, status="cancelled")
+    db.commit()
+
+    assert payouts.accrue_earnings(db) == 2
+    assert payouts.accrue_earnings(db) == 0
+    # 20% commission, rounded per ride
+    assert payouts.unpaid_balance(db, driver.id) == 20000 + 7999
+
+
+def test_batch_pays_each_driver_once(db, rider, fake_stripe):
+    drivers = [add_driver(db, index) for index in range(1, 41)]
+    no_account = add_driver(db, 99, account=False)
+    for driver in drivers + [no_account]:
+        add_ride(db, rider, driver, 100.0)
+        add_ride(db, rider, driver, 150.0)
+    db.commit()
+
+    payouts.accrue_earnings(db)
+    assert payouts.create_payouts(db, BATCH) == 40
+    assert payouts.create_payouts(db, BATCH) == 0
+
+    summary = asyncio.run(payouts.execute_payouts(db, BATCH, concurrency=8, chunk_size=15))
+
+    assert summary == {"paid": 40, "failed": 0}
+    transfers = [obj for obj in fake_stripe.objects.values() if obj["object"] == "transfer"]
+    assert len(transfers) == 40
+    assert {transfer["amount"] for transfer in transfers} == {20000}
+    # Earnings of drivers without a connected account stay unpaid
+    assert payouts.unpaid_balance(db, no_account.id) == 20000
+    assert db.query(DriverEarning).filter(DriverEarning.payout_id.is_(None)).count() == 2
+
+
+def test_resumed_run_reuses_idempotency_keys(db, rider, fake_stripe):
+    for index in range(1, 6):
+        add_ride(db, rider, add_driver(db, index), 100.0)
+    db.commit()
+    payouts.accrue_earnings(db)
+    payouts.create_payouts(db, BATCH)
+
+    # Simulate a crash after the transfers reached Stripe but before results were saved
+    async def send_without_recording():
+        limit = asyncio.Semaphore(5)
+        due = payouts.due_payouts(db, BATCH, 0, 100)
+        await asyncio.gather(*(payouts.send_transfer(payout, limit) for payout in due))
+
+    asyncio.run(send_without_recording())
+    assert db.query(Payout).filter(Payout.status == "pending").count() == 5
+
+    summary = asyncio.run(payouts.execute_payouts(db, BATCH))
+
+    assert summary == {"paid": 5, "failed": 0}
+    transfers = [obj for obj in fake_stripe.objects.values() if obj["object"] == "transfer"]
+    assert len(transfers) == 5
+
+
+def test_failed_transfers_are_retried_on_the_next_run(db, rider, fake_stripe, monkeypatch):
+    add_ride(db, rider, add_driver(db, 1), 100.0)
+    db.commit()
+    payouts.accrue_earnings(db)
+    payouts.create_payouts(db, BATCH)
+
+    monkeypatch.setattr(stripe, "api_base", "http://127.0.0.1:9")  # nothing listens here
+    monkeypatch.setattr(stripe, "max_network_retries", 0)
+    assert asyncio.run(payouts.execute_payouts(db, BATCH)) == {"paid": 0, "failed": 1}
+
+    # The transfer may have been made: the retry keeps the key
+    key = db.query(Payout.idempotency_key).scalar()
+    assert key == payouts.idempotency_key(BATCH, db.query(Payout.driver_id).scalar())
+
+    monkeypatch.setattr(stripe, "api_base", fake_stripe.url)
+    assert asyncio.run(payouts.execute_payouts(db, BATCH)) == {"paid": 1, "failed": 0}
+    payout = db.query(Payout).one()
+    assert payout.attempts == 2 and payout.stripe_transfer_id
+    assert key in fake_stripe.idempotent
+
+
+def test_declined_transfers_are_retried_with_a_new_key(db, rider, fake_stripe):
+    add_ride(db, rider, add_driver(db, 1), 100.0)
+    db.commit()
+    payouts.accrue_earnings(db)
+    payouts.create_payouts(db, BATCH)
+    first_key = db.query(Payout.idempotency_key).scalar()
+
+    fake_stripe.declined_destinations.add("acct_1")
+    assert asyncio.run(payouts.execute_payouts(db, BATCH)) == {"paid": 0, "failed": 1}
+    payout = db.query(Payout).one()
+    assert "insufficient available funds" in payout.last_error
+    assert payout.idempotency_key == payouts.idempotency_key(BATCH, payout.driver_id, 1) != first_key
+
+    # Stripe would replay the decline for the first key; the new one is sent for real
+    fake_stripe.declined_destinations.clear()
+    assert asyncio.run(payouts.execute_payouts(db, BATCH)) == {"paid": 1, "failed": 0}
+    db.refresh(payout)
+    assert payout.status == "paid" and payout.attempts == 2
+
+
+def test_nightly_run_settles_payouts_left_from_earlier_batches(db, rider, fake_stripe):
+    add_ride(db, rider, add_driver(db, 1), 100.0)
+    db.commit()
+    payouts.accrue_earnings(db)
+    payouts.create_payouts(db, BATCH)  # the run crashed before sending
+    key = db.query(Payout.idempotency_key).scalar()
+
+    add_ride(db, rider, add_driver(db, 2), 150.0)
+    db.commit()
+    summary = payouts.run_payouts(db, "2024-01-16")
+
+    assert summary == {"batch": "2024-01-16", "accrued": 1, "planned": 1, "paid": 2, "failed": 0}
+    assert {payout.batch: payout.status for payout in db.query(Payout)} == {
+        BATCH: "paid", "2024-01-16": "paid"
+    }
+    assert db.query(Payout).filter(Payout.batch == BATCH).one().idempotency_key == key
+    assert key in fake_stripe.idempotent
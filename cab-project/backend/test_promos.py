@@ -0,0 +1,182 @@
+# Promo engine tests: cached rule evaluation, index refresh and atomic usage limits
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import main_advanced
+import promos
+from auth import verify_token
+from db import get_db
+from models import Base, User, Ride
+from models_advanced import PromoCode, PromoUsage, PromoCounter
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'promos.db'}",
+                           connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def index(session_factory, monkeypatch):
+    index = promos.PromoIndex(session_factory, refresh_every=3600)
+    # Commits in this process invalidate the module index; point it at ours
+    monkeypatch.setattr(promos, "promo_index", index)
+    return index
+
+
+def add_promo(db, code, discount_type="percentage", value=50, days=30, **rules):
+    now = datetime.utcnow()
+    return promos.create_promo(db, code, code, discount_type, value,
+                               valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=days),
+                               **rules)
+
+
+def test_rules_are_evaluated_from_the_index(db, index):
+    add_promo(db, "first50", max_discount=100, min_ride_amount=150)
+    add_promo(db, "SAVE20", discount_type="fixed", value=20)
+
+    assert index.validate("FIRST50", 300)["discount_amount"] == 100
+    assert index.validate("save20", 15)["discount_amount"] == 15
+    with pytest.raises(promos.PromoRejected, match="Minimum ride amount"):
+        index.validate("FIRST50", 100)
+    with pytest.raises(promos.PromoRejected, match="Invalid"):
+        index.validate("NOPE", 100)
+
+
+def test_index_reloads_on_change(session_factory, db, index):
+    promo = add_promo(db, "SAVE20", discount_type="fixed", value=20)
+    assert index.validate("SAVE20", 500)["discount_amount"] == 20
+
+    # Edited in this process: picked up on the next lookup
+    promo.discount_value = 40
+    db.commit()
+    assert index.validate("SAVE20", 500)["discount_amount"] == 40
+
+    # Edited elsewhere: picked up once the version check runs
+    other = session_factory()
+    other.query(PromoCode).update({"is_active": False, "updated_at": datetime.utcnow() + timedelta(seconds=1)})
+    other.commit()
+    other.close()
+    assert index.lookup("SAVE20") is not None
+    index.refresh(force=True)
+    assert index.lookup("SAVE20") is None
+
+
+def test_redemption_is_idempotent_per_ride(db, index):
+    add_promo(db, "SAVE20", discount_type="fixed", value=20, usage_limit=5)
+
+    first = promos.redeem(db, "SAVE20", 1, 7, 250.0)
+    again = promos.redeem(db, "SAVE20", 1, 7, 250.0)
+
+    assert first == {"code": "SAVE20", "discount_amount": 20, "duplicate": False}
+    assert again == {"code": "SAVE20", "discount_amount": 20, "duplicate": True}
+    assert db.query(PromoUsage).count() == 1
+    assert promos.usage_count(db, db.query(PromoCode.id).scalar()) == 1
+
+
+def test_redeem_endpoint_applies_promos_to_the_callers_own_rides(session_factory, db, index):
+    add_promo(db, "SAVE20", discount_type="fixed", value=20, usage_limit=5)
+    riders = [User(name=f"Rider {n}", email=f"rider{n}@example.com", phone="+911234567890", role="rider",
+                   password="x") for n in range(2)]
+    db.add_all(riders)
+    db.flush()
+    ride = Ride(rider_id=riders[0].id, pickup_lat=28.61, pickup_lng=77.20, drop_lat=28.53, drop_lng=77.39,
+                fare_estimate=250.0)
+    db.add(ride)
+    db.commit()
+    caller = {"id": riders[1].id}
+
+    def get_test_db():
+        with session_factory() as session:
+            yield session
+
+    app = main_advanced.app
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[verify_token] = lambda: caller["id"]
+    try:
+        client = TestClient(app)
+        body = {"code": "SAVE20", "ride_id": ride.id, "ride_amount": 250.0}
+
+        # Someone else's ride: neither their per-user limit nor the ride is touched
+        assert client.post("/promo/redeem", json=body).status_code == 403
+        assert client.post("/promo/redeem", json={**body, "ride_id": ride.id + 1}).status_code == 404
+        assert db.query(PromoUsage).count() == 0
+
+        caller["id"] = riders[0].id
+        response = client.post("/promo/redeem", json={**body, "user_id": riders[1].id})
+        assert response.json()["final_amount"] == 230.0
+        assert db.query(PromoUsage.user_id).scalar() == riders[0].id
+    finally:
+        app.dependency_overrides.clear()
+
+
+def test_redemptions_do_not_bump_the_index_version(db, index):
+    add_promo(db, "SAVE20", discount_type="fixed", value=20)
+    index.validate("SAVE20")
+    version = index._version
+
+    promos.redeem(db, "SAVE20", 1, 7, 250.0)
+    index.refresh(force=False)
+
+    assert index._version == version
+
+
+@pytest.mark.parametrize("campaign", [False, True])
+def test_concurrent_redemptions_respect_usage_limit(session_factory, db, index, campaign):
+    promo = add_promo(db, "MEGA", usage_limit=25, campaign=campaign)
+    outcomes = []
+
+    def redeem(ride_id):
+        session = session_factory()
+        try:
+            promos.redeem(session, "MEGA", ride_id, ride_id, 200.0)
+            outcomes.append("applied")
+        except promos.PromoRejected:
+            outcomes.append("rejected")
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=redeem, args=(ride_id,)) for ride_id in range(1, 41)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outcomes.count("applied") == 25 and outcomes.count("rejected") == 15
+    assert promos.usage_count(db, promo.id) == 25
+    assert db.query(PromoUsage).count() == 25
+    assert db.query(PromoCounter).count() == (promos.CAMPAIGN_SHARDS if campaign else 0)
+
+
+def test_shard_capacities_add_up_to_the_limit():
+    assert promos.shard_capacities(25, 16) == [2] * 9 + [1] * 7
+    assert sum(promos.shard_capacities(1000, 16)) == 1000
+
+
+def test_counter_sizing_commits_with_the_caller(db, index):
+    add_promo(db, "MEGA", usage_limit=25, campaign=True)
+    rule = index.validate("MEGA")
+
+    promos.size_counters(db, rule, index)
+    db.rollback()
+    assert db.query(PromoCounter).count() == 0 and not index._sized
+
+    promos.size_counters(db, rule, index)
+    db.commit()
+    assert db.query(PromoCounter).count() == promos.CAMPAIGN_SHARDS and len(index._sized) == 1
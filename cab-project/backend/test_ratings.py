@@ -0,0 +1,161 @@
+# Rating aggregate tests: O(1) running totals, decayed/Bayesian scores and reconciliation
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import ratings
+from models import Base, User, Driver, Ride, Review, RatingAggregate
+from spatial import find_nearby_drivers_sqlite
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'ratings.db'}")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def driver(db):
+    driver = User(name="Ravi Kumar", email="ravi@example.com", phone="+911234567891",
+                  role="driver", password="x")
+    db.add(driver)
+    db.commit()
+    return driver
+
+
+def review(db, driver, rating, rater_index, days_ago=0):
+    rater = User(name=f"Rider {rater_index}", email=f"rider{rater_index}@example.com",
+                 phone=f"+91{rater_index:010d}", role="rider", password="x")
+    db.add(rater)
+    db.flush()
+    ride = Ride(rider_id=rater.id, driver_id=driver.id, pickup_lat=28.61, pickup_lng=77.20,
+                drop_lat=28.53, drop_lng=77.39, fare_estimate=250.0, status="completed")
+    db.add(ride)
+    db.flush()
+    added = Review(ride_id=ride.id, rater_id=rater.id, rated_id=driver.id, rating=rating,
+                   created_at=datetime.utcnow() - timedelta(days=days_ago))
+    db.add(added)
+    db.commit()
+    return added
+
+
+def test_reviews_update_running_totals(db, driver):
+    for index, rating in enumerate([5, 4, 3], start=1):
+        review(db, driver, rating, index)
+
+    aggregate = db.get(RatingAggregate, driver.id)
+    assert (aggregate.count, aggregate.total) == (3, 12)
+    db.refresh(driver)
+    assert driver.rating_avg == 4.0
+    assert ratings.get_rating(db, driver.id)["average"] == 4.0
+
+
+def test_edits_and_deletes_move_the_totals(db, driver):
+    first = review(db, driver, 5, 1)
+    second = review(db, driver, 2, 2)
+
+    db.expire_all()  # the old rating must still be seen after expiry
+    second.rating = 4
+    db.commit()
+    assert ratings.get_rating(db, driver.id)["average"] == 4.5
+
+    db.delete(first)
+    db.commit()
+    aggregate = db.get(RatingAggregate, driver.id)
+    db.refresh(aggregate)
+    assert (aggregate.count, aggregate.total) == (1, 4)
+    assert aggregate.decayed_count == pytest.approx(ratings.decay_weight(second.created_at, aggregate.decay_period))
+
+
+def test_bayesian_score_needs_volume_to_rank_high(db, driver):
+    other = User(name="Asha", email="asha@example.com", phone="+911234567899", role="driver", password="x")
+    db.add(other)
+    db.commit()
+    review(db, driver, 5, 1)
+    for index in range(2, 42):
+        review(db, other, 5 if index % 5 else 4, index)
+
+    scores = ratings.get_ratings(db, [driver.id, other.id])
+    assert scores[driver.id]["average"] == 5.0
+    assert scores[driver.id]["score"] == pytest.approx(ratings.bayesian(5, 1), abs=1e-3)
+    assert scores[other.id]["score"] > scores[driver.id]["score"]
+
+
+def test_old_reviews_decay(db, driver):
+    review(db, driver, 1, 1, days_ago=730)
+    review(db, driver, 5, 2)
+
+    summary = ratings.get_rating(db, driver.id)
+    assert summary["average"] == 3.0
+    assert summary["recent_average"] > 4.7
+
+
+def test_reconciliation_rebuilds_drifted_totals(db, driver):
+    review(db, driver, 5, 1)
+    # A review written without the ORM events (e.g. a bulk import)
+    db.execute(Review.__table__.insert().values(ride_id=1, rater_id=driver.id, rated_id=driver.id,
+                                                 rating=1, created_at=datetime.utcnow()))
+    db.commit()
+
+    summary = ratings.reconcile_ratings(db)
+    assert summary["rebuilt"] == 1 and summary["rated_ids"] == [driver.id]
+    assert ratings.get_rating(db, driver.id)["average"] == 3.0
+    db.refresh(driver)
+    assert driver.rating_avg == 3.0
+    assert ratings.reconcile_ratings(db)["rebuilt"] == 0
+
+
+def test_short_half_lives_do_not_overflow(db, driver, monkeypatch):
+    # Years of one-hour half-lives: 2 ** half-lives since the epoch overflows a float
+    monkeypatch.setattr(ratings, "RATING_HALF_LIFE", timedelta(hours=1))
+    review(db, driver, 1, 1, days_ago=1)
+    review(db, driver, 5, 2)
+
+    summary = ratings.get_rating(db, driver.id)
+    assert summary["average"] == 3.0 and summary["recent_average"] == 5.0
+    assert db.get(RatingAggregate, driver.id).decay_period > 0
+
+
+def test_sums_from_the_previous_period_are_rescaled(db, driver):
+    review(db, driver, 1, 1, days_ago=180)
+    # The same sums, kept relative to the previous decay period
+    factor = ratings.rescale(0, -1)
+    db.execute(RatingAggregate.__table__.update().values(
+        decay_period=RatingAggregate.decay_period - 1,
+        decayed_total=RatingAggregate.decayed_total * factor,
+        decayed_count=RatingAggregate.decayed_count * factor,
+    ))
+    db.commit()
+    review(db, driver, 5, 2)
+
+    aggregate = db.get(RatingAggregate, driver.id)
+    db.refresh(aggregate)
+    assert aggregate.decay_period == ratings.decay_period(datetime.utcnow())
+    assert ratings.summarize(aggregate)["recent_average"] == pytest.approx(11 / 3, abs=0.01)
+    assert ratings.reconcile_ratings(db)["rebuilt"] == 0
+
+
+def test_reconciliation_checks_the_decayed_sums(db, driver):
+    review(db, driver, 5, 1)
+    db.execute(RatingAggregate.__table__.update().values(decayed_total=RatingAggregate.decayed_total * 2))
+    db.commit()
+
+    assert ratings.reconcile_ratings(db)["rated_ids"] == [driver.id]
+    assert ratings.get_rating(db, driver.id)["recent_average"] == 5.0
+
+
+def test_dispatch_candidates_carry_ratings(db, driver):
+    db.add(Driver(user_id=driver.id, vehicle_info={}, license_number="DL1", vehicle_type="sedan",
+                  status="active", current_lat=28.6139, current_lng=77.2090))
+    db.commit()
+    review(db, driver, 5, 1)
+
+    nearby = find_nearby_drivers_sqlite(db, 28.6140, 77.2091)
+    assert nearby[0]["rating_count"] == 1
+    assert nearby[0]["rating"] == pytest.approx(ratings.bayesian(5, 1))
@@ -0,0 +1,145 @@
+# Read-replica routing tests with two SQLite files standing in for primary and replica
+import math
+
+import pytest
+from fastapi import Depends, FastAPI, Response
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.requests import HTTPConnection
+
+from models import Base, User
+from read_routing import CLIENT_ID_HEADER, SessionRouter, STICKY_COOKIE
+
+
+def make_sessionmaker(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def databases(tmp_path):
+    primary = make_sessionmaker(tmp_path / "primary.db")
+    replica = make_sessionmaker(tmp_path / "replica.db")
+    # Tell the two apart: the replica never sees writes, so it only holds its seed row
+    with replica() as db:
+        db.add(User(name="Replica Copy", email="replica@example.com", phone="+910000000000",
+                    role="rider", password="x"))
+        db.commit()
+    yield primary, replica
+    primary.kw["bind"].dispose()
+    replica.kw["bind"].dispose()
+
+
+def make_app(router: SessionRouter) -> TestClient:
+    app = FastAPI()
+
+    def get_db(connection: HTTPConnection, response: Response):
+        db = router.write_session(connection, response)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def get_read_db(connection: HTTPConnection):
+        db = router.read_session(connection)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @app.post("/users")
+    def create_user(db: Session = Depends(get_db)):
+        db.add(User(name="John Doe", email="john@example.com", phone="+911234567890",
+                    role="rider", password="x"))
+        db.commit()
+        return {"ok": True}
+
+    @app.get("/users")
+    def list_users(db: Session = Depends(get_read_db)):
+        return [user.name for user in db.query(User).order_by(User.id)]
+
+    return TestClient(app)
+
+
+def test_reads_go_to_replica(databases):
+    primary, replica = databases
+    client = make_app(SessionRouter(primary, replica))
+
+    assert client.get("/users").json() == ["Replica Copy"]
+
+
+def test_reads_stick_to_primary_after_own_write(databases):
+    primary, replica = databases
+    client = make_app(SessionRouter(primary, replica))
+    rider = {"Authorization": "Bearer token_7_rider@example.com"}
+
+    response = client.post("/users", headers=rider)
+    assert STICKY_COOKIE in response.cookies
+
+    assert client.get("/users", headers=rider).json() == ["John Doe"]
+    # Another client without the cookie keeps reading from the replica
+    other = TestClient(client.app)
+    assert other.get("/users", headers={"Authorization": "Bearer token_8"}).json() == ["Replica Copy"]
+
+
+def test_anonymous_callers_sharing_an_address_stick_separately(databases):
+    primary, replica = databases
+    client = make_app(SessionRouter(primary, replica))
+
+    client.post("/users")
+    assert client.get("/users").json() == ["John Doe"]
+    # Same address (as behind a proxy), but no cookie: still on the replica
+    assert TestClient(client.app).get("/users").json() == ["Replica Copy"]
+
+
+def test_client_id_header_keeps_stickiness_without_cookies(databases):
+    primary, replica = databases
+    client = make_app(SessionRouter(primary, replica))
+
+    client.post("/users", headers={CLIENT_ID_HEADER: "device-1"})
+    client.cookies.clear()
+
+    assert client.get("/users", headers={CLIENT_ID_HEADER: "device-1"}).json() == ["John Doe"]
+    assert client.get("/users", headers={CLIENT_ID_HEADER: "device-2"}).json() == ["Replica Copy"]
+
+
+def test_sticky_window_expires(databases):
+    primary, replica = databases
+    client = make_app(SessionRouter(primary, replica, sticky_for=0.0))
+    rider = {"Authorization": "Bearer token_7_rider@example.com"}
+
+    client.post("/users", headers=rider)
+    client.cookies.clear()
+    assert client.get("/users", headers=rider).json() == ["Replica Copy"]
+
+
+@pytest.mark.parametrize("lag", [10.0, math.inf])
+def test_lagging_replica_falls_back_to_primary(databases, lag):
+    primary, replica = databases
+    client = make_app(SessionRouter(primary, replica, max_lag=2.0, lag_probe=lambda _: lag))
+
+    assert client.get("/users").json() == []
+
+
+def test_unreachable_replica_falls_back_to_primary(databases):
+    primary, replica = databases
+
+    def broken_probe(connection):
+        raise ConnectionError("replica down")
+
+    router = SessionRouter(primary, replica, lag_probe=broken_probe)
+    assert router.replica_lag() == math.inf
+    assert not router.use_replica()
+
+
+def test_replica_sessions_refuse_writes(databases):
+    primary, replica = databases
+    router = SessionRouter(primary, replica)
+
+    with router.read_session() as db:
+        db.add(User(name="Nope", email="nope@example.com", phone="+910000000001",
+                    role="rider", password="x"))
+        with pytest.raises(RuntimeError):
+            db.commit()
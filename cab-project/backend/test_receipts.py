@@ -0,0 +1,141 @@
+# Receipt pipeline tests: cached templates, receipt row dedupe and batch rendering
+import multiprocessing
+import os
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import receipts
+from models import Base, User, Ride
+from models_advanced import Receipt
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'receipts.db'}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def weasyprint():
+    try:
+        import weasyprint
+    except (ImportError, OSError) as e:  # OSError: pango/cairo libraries missing
+        pytest.skip(f"WeasyPrint unavailable: {e}")
+    return weasyprint
+
+
+@pytest.fixture
+def rides(db):
+    rider = User(name="John Doe", email="john@example.com", phone="+911234567890",
+                 role="rider", password="x")
+    driver = User(name="Ravi <Kumar>", email="ravi@example.com", phone="+911234567891",
+                  role="driver", password="x")
+    db.add_all([rider, driver])
+    db.flush()
+    rides = [
+        Ride(rider_id=rider.id, driver_id=driver.id, pickup_lat=28.6139, pickup_lng=77.2090,
+             drop_lat=28.5355, drop_lng=77.3910, fare_estimate=250.0, fare_actual=262.5,
+             distance_meters=18400, duration_secs=2520, pickup_address="Connaught Place",
+             status=status)
+        for status in ["completed", "completed", "cancelled", "completed"]
+    ]
+    db.add_all(rides)
+    db.commit()
+    return rides
+
+
+def test_template_is_compiled_once_and_escapes_input(db, rides):
+    assert receipts.receipt_template() is receipts.receipt_template()
+
+    context = receipts.ride_context(rides[0], receipts.receipt_number(rides[0].id), "Ravi <Kumar>")
+    html = receipts.render_html(context)
+
+    assert "Receipt #RCPT-00000001" in html
+    assert "Total Fare: ₹262.50" in html
+    assert "Ravi &lt;Kumar&gt;" in html
+    assert "28.53550, 77.39100" in html  # no drop address: coordinates instead
+
+
+def test_completed_rides_get_one_receipt_row(db, rides):
+    assert receipts.plan_receipts(db) == 3
+    assert receipts.plan_receipts(db) == 0
+
+    pending = receipts.pending_receipts(db)
+    assert [context["ride_id"] for context in pending] == [1, 2, 4]
+    assert pending[0]["driver_name"] == "Ravi <Kumar>"
+    assert pending[0]["distance"] == 18.4 and pending[0]["duration"] == 42
+
+
+def test_first_recorded_pdf_wins(db, rides):
+    receipts.plan_receipts(db)
+    first = {"ride_id": 1, "status": "success", "pdf_path": "receipts/a.pdf"}
+    late = {"ride_id": 1, "status": "success", "pdf_path": "receipts/b.pdf"}
+    failed = {"ride_id": 2, "status": "error", "message": "boom"}
+
+    assert receipts.record_receipts(db, [first, failed]) == 1
+    assert receipts.record_receipts(db, [late]) == 0
+
+    assert db.query(Receipt).filter(Receipt.ride_id == 1).one().pdf_path == "receipts/a.pdf"
+    assert [context["ride_id"] for context in receipts.pending_receipts(db)] == [2, 4]
+
+
+def test_backlog_is_rendered_in_batches(db, rides, weasyprint, tmp_path):
+    summary = receipts.generate_receipts(db, workers=2, batch_size=2, directory=str(tmp_path))
+
+    assert summary == {"rendered": 3, "failed": 0}
+    paths = [receipt.pdf_path for receipt in db.query(Receipt).order_by(Receipt.ride_id)]
+    assert all(open(path, "rb").read(5) == b"%PDF-" for path in paths)
+    assert receipts.generate_receipts(db, directory=str(tmp_path)) == {"rendered": 0, "failed": 0}
+
+
+def test_single_receipt_is_not_rendered_twice(db, rides, weasyprint, tmp_path):
+    first = receipts.generate_receipt(db, rides[0].id, directory=str(tmp_path))
+    again = receipts.generate_receipt(db, rides[0].id, directory=str(tmp_path))
+
+    assert first["status"] == "success" and not first["duplicate"]
+    assert again["duplicate"] and again["pdf_path"] == first["pdf_path"]
+    assert os.listdir(tmp_path) == ["RCPT-00000001.pdf"]
+
+
+def test_failed_render_leaves_no_partial_file(weasyprint, tmp_path, monkeypatch):
+    def broken(context):
+        raise ValueError("bad template data")
+
+    monkeypatch.setattr(receipts, "render_html", broken)
+    result = receipts.write_receipt({"ride_id": 1, "receipt_number": "RCPT-00000001"}, str(tmp_path))
+
+    assert result == {"ride_id": 1, "status": "error", "message": "bad template data"}
+    assert os.listdir(tmp_path) == []
+
+
+def pool_in_daemon(results):
+    # As in a Celery prefork child; nothing to warm up for abs()
+    receipts.warm_worker = lambda: None
+    with receipts.render_pool(2) as pool:
+        results.put((type(pool).__module__, pool.map(abs, [-1, -2, -3])))
+
+
+def test_daemonic_workers_still_get_a_process_pool():
+    # Spawned: forking the test run, with its threads, can deadlock the child
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    worker = context.Process(target=pool_in_daemon, args=(results,), daemon=True)
+    worker.start()
+    module, mapped = results.get(timeout=30)
+    worker.join(timeout=30)
+
+    assert module.startswith("billiard") and mapped == [1, 2, 3]
+
+
+def test_unknown_ride_gets_no_receipt_row(db, tmp_path):
+    result = receipts.generate_receipt(db, 999, directory=str(tmp_path))
+
+    assert result == {"ride_id": 999, "status": "error", "message": "Ride not found"}
+    assert db.query(Receipt).count() == 0
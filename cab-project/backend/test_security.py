@@ -0,0 +1,123 @@
+# Rate limiting tests: token buckets, per-route middleware and the local fallback
+import asyncio
+import ipaddress
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import security
+from security import LocalBuckets, RateLimiter, RateLimitMiddleware, RedisBuckets, get_client_ip
+
+PROXIES = [ipaddress.ip_network("10.0.0.0/8")]
+
+
+@pytest.fixture(autouse=True)
+def fresh_buckets(monkeypatch):
+    monkeypatch.setattr(security, "local_buckets", LocalBuckets())
+    monkeypatch.setattr(security, "redis_buckets", None)
+
+
+def test_bucket_allows_a_burst_then_refills():
+    buckets = LocalBuckets()
+    results = [buckets.take("k", rate=1.0, burst=3, now=100.0)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+    assert buckets.take("k", rate=1.0, burst=3, now=100.5) == (False, pytest.approx(0.5))
+    assert buckets.take("k", rate=1.0, burst=3, now=101.0)[0]
+
+
+def test_least_recently_used_buckets_are_evicted():
+    buckets = LocalBuckets(max_keys=2)
+    for key in ("a", "b", "a", "c"):
+        buckets.take(key, rate=1.0, burst=5, now=0.0)
+    # "a" was used again after "b", so "b" goes first
+    assert buckets._buckets.keys() == {"a", "c"}
+
+
+def connecting_from(app, host):
+    """The app as reached from host, which the test client cannot set"""
+    async def asgi(scope, receive, send):
+        await app({**scope, "client": (host, 50000)}, receive, send)
+    return asgi
+
+
+def make_client(host="198.51.100.1"):
+    app = FastAPI()
+    app.add_middleware(RateLimitMiddleware, rules=[
+        ("POST", ("/api/auth/login", "/api/auth/register"), RateLimiter(requests_per_minute=2)),
+        ("POST", "/bookings", RateLimiter(requests_per_minute=3)),
+    ], trusted_proxies=PROXIES)
+
+    @app.post("/api/auth/login")
+    def login():
+        return {"ok": True}
+
+    @app.post("/api/auth/register")
+    def register():
+        return {"ok": True}
+
+    @app.post("/api/auth/session")
+    def session():
+        return {"ok": True}
+
+    @app.get("/bookings")
+    @app.post("/bookings")
+    def bookings():
+        return {"ok": True}
+
+    return TestClient(connecting_from(app, host))
+
+
+def test_routes_have_their_own_limits():
+    client = make_client()
+
+    assert client.post("/api/auth/login").status_code == 200
+    assert client.post("/api/auth/register").status_code == 200
+    rejected = client.post("/api/auth/login")
+    assert rejected.status_code == 429 and int(rejected.headers["Retry-After"]) >= 1
+
+    assert [client.post("/bookings").status_code for _ in range(4)] == [200, 200, 200, 429]
+    # Unlisted routes and methods are not limited, session checks included
+    assert all(client.get("/bookings").status_code == 200 for _ in range(10))
+    assert all(client.post("/api/auth/session").status_code == 200 for _ in range(10))
+    # A forged X-Forwarded-For does not buy a fresh budget
+    assert client.post("/api/auth/login", headers={"X-Forwarded-For": "203.0.113.9"}).status_code == 429
+    # Other clients have their own budget
+    assert make_client("198.51.100.2").post("/api/auth/login").status_code == 200
+
+
+def test_clients_behind_a_trusted_proxy_have_their_own_budget():
+    client = make_client("10.0.0.2")
+    first = {"X-Forwarded-For": "203.0.113.9"}
+
+    assert [client.post("/api/auth/login", headers=first).status_code for _ in range(3)] == [200, 200, 429]
+    # Hops the client prepends are ignored; the proxy appended the real address
+    forged = {"X-Forwarded-For": "192.0.2.77, 203.0.113.9"}
+    assert client.post("/api/auth/login", headers=forged).status_code == 429
+    assert client.post("/api/auth/login", headers={"X-Forwarded-For": "203.0.113.10"}).status_code == 200
+
+
+@pytest.mark.parametrize("peer,forwarded,expected", [
+    ("198.51.100.1", [b"203.0.113.9"], "198.51.100.1"),
+    ("10.0.0.2", [], "10.0.0.2"),
+    ("10.0.0.2", [b"203.0.113.9"], "203.0.113.9"),
+    ("10.0.0.2", [b"192.0.2.77, 203.0.113.9, 10.0.0.5"], "203.0.113.9"),
+    ("10.0.0.2", [b"192.0.2.77", b"203.0.113.9"], "203.0.113.9"),
+    ("10.0.0.2", [b"10.0.0.7, 10.0.0.5"], "10.0.0.7"),
+])
+def test_client_ip_trusts_forwarded_for_only_from_proxies(peer, forwarded, expected):
+    scope = {"client": (peer, 50000), "headers": [(b"x-forwarded-for", value) for value in forwarded]}
+    assert get_client_ip(scope, PROXIES) == expected
+
+
+def test_unreachable_redis_falls_back_to_local_limits(monkeypatch):
+    unreachable = RedisBuckets("redis://127.0.0.1:1", timeout=0.05)
+    monkeypatch.setattr(security, "redis_buckets", unreachable)
+    limiter = RateLimiter(requests_per_minute=2)
+
+    async def requests():
+        return [await limiter.is_allowed("198.51.100.1", "/api/auth/") for _ in range(3)]
+
+    assert asyncio.run(requests()) == [True, True, False]
+    # Redis is skipped until the retry interval passes
+    assert not unreachable.available()
@@ -0,0 +1,176 @@
+# Proximity search tests: SQLite R*Tree fallback and PostGIS query plan
+import asyncio
+import json
+import os
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, User, Driver
+from spatial import (
+    bounding_box, build_nearby_drivers_query, nearby_drivers_args, find_nearby_drivers,
+    find_nearby_drivers_sqlite, haversine_km
+)
+
+POSTGIS_TEST_URL = os.getenv("POSTGIS_TEST_URL")
+
+PICKUP = (28.6139, 77.2090)  # Connaught Place, New Delhi
+
+
+@pytest.fixture
+def sqlite_session():
+    """In-memory SQLite database with the drivers R*Tree"""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def add_driver(db, user, lat, lng, vehicle_type="sedan", verified=True, status="active"):
+    driver = Driver(
+        user_id=user.id,
+        vehicle_info={"model": "Honda City"},
+        vehicle_type=vehicle_type,
+        license_number="DL1234567890",
+        verified=verified,
+        status=status,
+        current_lat=lat,
+        current_lng=lng
+    )
+    db.add(driver)
+    db.commit()
+    return driver
+
+
+class TestSQLiteFallback:
+    """R*Tree bounding box search used on SQLite dev databases"""
+
+    @pytest.fixture
+    def user(self, sqlite_session):
+        user = User(name="Jane Smith", email="jane@example.com", phone="+911234567890",
+                    role="driver", password="secret")
+        sqlite_session.add(user)
+        sqlite_session.commit()
+        return user
+
+    def test_orders_by_distance_and_drops_outside_radius(self, sqlite_session, user):
+        far = add_driver(sqlite_session, user, 28.7041, 77.1025)   # ~14 km away
+        near = add_driver(sqlite_session, user, 28.6150, 77.2100)
+        mid = add_driver(sqlite_session, user, 28.6300, 77.2200)
+
+        drivers = find_nearby_drivers_sqlite(sqlite_session, *PICKUP, radius_km=5.0)
+
+        assert [d["id"] for d in drivers] == [near.id, mid.id]
+        assert far.id not in [d["id"] for d in drivers]
+
+    def test_location_updates_move_the_index_entry(self, sqlite_session, user):
+        driver = add_driver(sqlite_session, user, 28.7041, 77.1025)
+        assert find_nearby_drivers_sqlite(sqlite_session, *PICKUP, radius_km=2.0) == []
+
+        driver.current_lat, driver.current_lng = 28.6140, 77.2091
+        sqlite_session.commit()
+
+        drivers = find_nearby_drivers_sqlite(sqlite_session, *PICKUP, radius_km=2.0)
+        assert [d["id"] for d in drivers] == [driver.id]
+
+    def test_vehicle_type_and_verified_filters(self, sqlite_session, user):
+        add_driver(sqlite_session, user, 28.6150, 77.2100, vehicle_type="suv", verified=False)
+        verified_suv = add_driver(sqlite_session, user, 28.6160, 77.2110, vehicle_type="suv")
+        add_driver(sqlite_session, user, 28.6140, 77.2095, vehicle_type="mini")
+        add_driver(sqlite_session, user, 28.6141, 77.2096, vehicle_type="suv", status="offline")
+
+        drivers = find_nearby_drivers_sqlite(
+            sqlite_session, *PICKUP, vehicle_type="suv", verified_only=True
+        )
+        assert [d["id"] for d in drivers] == [verified_suv.id]
+
+    def test_drivers_just_inside_the_radius_are_kept(self, sqlite_session, user):
+        # 4.998 km due north and due east: outside the old 111.32 km/degree box
+        north = add_driver(sqlite_session, user, PICKUP[0] + 0.04495, PICKUP[1])
+        east = add_driver(sqlite_session, user, PICKUP[0], PICKUP[1] + 0.05121)
+
+        drivers = find_nearby_drivers(sqlite_session, *PICKUP, radius_km=5.0)
+
+        assert {d["id"] for d in drivers} == {north.id, east.id}
+
+
+@pytest.mark.parametrize("lat", [0.0, 28.6139, 70.0, -45.0])
+def test_bounding_box_contains_the_circle(lat):
+    box = bounding_box(lat, 77.2, 5.0)
+    assert haversine_km(lat, 77.2, box["max_lat"], 77.2) == pytest.approx(5.0)
+    assert haversine_km(lat, 77.2, lat, box["max_lng"]) >= 5.0 - 1e-9
+
+
+@pytest.mark.skipif(not POSTGIS_TEST_URL, reason="POSTGIS_TEST_URL not set")
+class TestPostGISQueryPlan:
+    """EXPLAIN checks that the GiST index drives both the filter and the sort"""
+
+    SCHEMA = "nearby_drivers_test"
+
+    @pytest.fixture(scope="class")
+    def pg_engine(self):
+        admin = create_engine(POSTGIS_TEST_URL)
+        with admin.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {self.SCHEMA} CASCADE"))
+            conn.execute(text(f"CREATE SCHEMA {self.SCHEMA}"))
+
+        engine = create_engine(
+            POSTGIS_TEST_URL, connect_args={"options": f"-csearch_path={self.SCHEMA},public"}
+        )
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(text(
+                "INSERT INTO users (name, email, phone, role, password) "
+                "VALUES ('Jane Smith', 'jane@example.com', '+911234567890', 'driver', 'x')"
+            ))
+            conn.execute(text("""
+                INSERT INTO drivers (user_id, vehicle_info, vehicle_type, license_number,
+                                     verified, status, current_lat, current_lng)
+                SELECT 1, '{}', (ARRAY['mini', 'sedan', 'suv'])[1 + g % 3], 'DL' || g,
+                       g % 2 = 0, 'active', 28.0 + random(), 77.0 + random()
+                FROM generate_series(1, 20000) g
+            """))
+            conn.execute(text("ANALYZE drivers"))
+        yield engine
+
+        engine.dispose()
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {self.SCHEMA} CASCADE"))
+        admin.dispose()
+
+    def explain(self, vehicle_type=None, verified_only=False):
+        import asyncpg
+
+        async def run():
+            connection = await asyncpg.connect(
+                POSTGIS_TEST_URL,
+                server_settings={"search_path": f"{self.SCHEMA},public", "enable_seqscan": "off"}
+            )
+            try:
+                query = build_nearby_drivers_query(vehicle_type, verified_only)
+                args = nearby_drivers_args(*PICKUP, 5.0, 10, vehicle_type)
+                return await connection.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+            finally:
+                await connection.close()
+
+        plan = asyncio.run(run())
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    @staticmethod
+    def plan_nodes(node):
+        yield node
+        for child in node.get("Plans", []):
+            yield from TestPostGISQueryPlan.plan_nodes(child)
+
+    @pytest.mark.parametrize("vehicle_type,verified_only", [(None, False), ("suv", True)])
+    def test_gist_index_drives_filter_and_order(self, pg_engine, vehicle_type, verified_only):
+        nodes = list(self.plan_nodes(self.explain(vehicle_type, verified_only)[0]["Plan"]))
+
+        index_scans = [n for n in nodes if n.get("Index Name") == "idx_drivers_current_location"]
+        assert index_scans, "expected idx_drivers_current_location to be used"
+        assert "Order By" in index_scans[0], "expected KNN ordering from the GiST index"
+        assert not [n for n in nodes if n["Node Type"] == "Sort"]
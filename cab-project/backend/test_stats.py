@@ -0,0 +1,132 @@
+# Rollup counters: kept by the ORM listeners, read by the dashboard, corrected by reconcile_stats
+from datetime import datetime
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import db as database
+from admin_routes import router as admin_router
+from models import Base, User, Driver, Ride, Payment, StatCounter
+from stats import apply_deltas, dashboard_stats, reconcile_stats, revenue_by_day, revenue_counter
+
+DELHI = (28.6139, 77.2090)
+MUMBAI = (19.0760, 72.8777)
+
+
+@pytest.fixture
+def factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'stats.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(factory):
+    with factory() as session:
+        yield session
+
+
+def add_user(db, n, role="rider"):
+    user = User(name=f"User {n}", email=f"user{n}@example.com", phone="+911234567890", role=role, password="x")
+    db.add(user)
+    db.commit()
+    return user
+
+
+def add_ride(db, rider, pickup=DELHI, status="requested"):
+    ride = Ride(rider_id=rider.id, pickup_lat=pickup[0], pickup_lng=pickup[1], drop_lat=28.53, drop_lng=77.39,
+                fare_estimate=250.0, status=status)
+    db.add(ride)
+    db.commit()
+    return ride
+
+
+def pay(db, ride, amount, status="completed"):
+    payment = Payment(ride_id=ride.id, amount=amount, payment_method="card", status=status)
+    db.add(payment)
+    db.commit()
+    return payment
+
+
+def test_counters_follow_inserts_updates_and_deletes(db):
+    rider = add_user(db, 1)
+    driver = Driver(user_id=add_user(db, 2, "driver").id, vehicle_info={}, license_number="DL1", status="active")
+    db.add(driver)
+    db.commit()
+    first = add_ride(db, rider)
+    second = add_ride(db, rider)
+    pay(db, first, 300.0)
+    pending = pay(db, second, 120.0, status="pending")
+
+    second.status = "completed"
+    pending.status = "completed"
+    db.commit()
+    stats = dashboard_stats(db)
+    assert (stats["total_users"], stats["active_drivers"], stats["total_rides"]) == (2, 1, 2)
+    assert stats["rides_by_status"]["requested"] == 1 and stats["rides_by_status"]["completed"] == 1
+    assert stats["total_revenue"] == 420.0
+
+    db.delete(pending)
+    db.delete(second)
+    db.delete(driver)
+    db.commit()
+    stats = dashboard_stats(db)
+    assert (stats["active_drivers"], stats["total_rides"], stats["total_revenue"]) == (0, 1, 300.0)
+    assert stats["rides_by_status"]["completed"] == 0
+
+
+def test_revenue_is_split_by_day_and_city(db):
+    rider = add_user(db, 1)
+    pay(db, add_ride(db, rider, DELHI), 300.0)
+    pay(db, add_ride(db, rider, MUMBAI), 200.0)
+    pay(db, add_ride(db, rider, (0.0, 0.0)), 50.0)
+
+    today = datetime.utcnow().date().isoformat()
+    assert revenue_by_day(db, days=1) == {today: {"delhi": 300.0, "mumbai": 200.0, "other": 50.0}}
+
+
+def test_reconcile_corrects_drift_with_deltas(db):
+    rider = add_user(db, 1)
+    pay(db, add_ride(db, rider), 300.0)
+    # Drift, as left by writes that bypassed the ORM
+    apply_deltas(db.connection(), {"rides": 5, "users": -1, "rides:bogus": 2})
+    db.commit()
+    shards = db.query(func.count(StatCounter.name)).scalar()
+
+    drift = reconcile_stats(db)
+
+    assert drift == {"rides": -5, "users": 1, "rides:bogus": -2}
+    stats = dashboard_stats(db)
+    assert (stats["total_users"], stats["total_rides"], stats["total_revenue"]) == (1, 1, 300.0)
+    assert stats["stale"] is False
+    # Corrected in place: existing counter rows are kept, not rewritten
+    assert db.query(func.count(StatCounter.name)).scalar() >= shards
+    assert reconcile_stats(db) == {}
+
+
+def test_admin_stats_endpoints(factory, db):
+    rider = add_user(db, 1)
+    pay(db, add_ride(db, rider), 300.0)
+    app = FastAPI()
+    app.include_router(admin_router)
+
+    def get_test_db():
+        with factory() as session:
+            yield session
+
+    app.dependency_overrides[database.get_db] = get_test_db
+    app.dependency_overrides[database.get_read_db] = get_test_db
+    client = TestClient(app)
+
+    assert client.get("/admin/stats").json()["stale"] is True
+    assert client.post("/admin/stats/reconcile").json() == {"message": "Statistics reconciled", "drift": {}}
+    stats = client.get("/admin/stats").json()
+    assert stats["total_rides"] == 1 and stats["stale"] is False
+    today = datetime.utcnow().date().isoformat()
+    assert client.get("/admin/stats/revenue", params={"days": 3}).json() == {today: {"delhi": 300.0}}
+    assert client.get("/admin/stats/revenue", params={"days": 91}).status_code == 422
+    assert revenue_counter(datetime.utcnow().date(), "delhi") == f"revenue:{today}:delhi"
@@ -0,0 +1,64 @@
+# StripePaymentService against the local fake Stripe server
+import asyncio
+import time
+
+import pytest
+import stripe
+
+from fake_stripe import FakeStripeServer, measure_loop_stall
+from stripe_integration import StripePaymentService
+
+
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    server = FakeStripeServer(latency=0.2).start()
+    monkeypatch.setattr(stripe, "api_base", server.url)
+    monkeypatch.setattr(stripe, "api_key", "sk_test_fake")
+    yield server
+    server.stop()
+
+
+def test_payment_flow_round_trips(fake_stripe):
+    service = StripePaymentService()
+
+    async def flow():
+        intent = await service.create_payment_intent(amount=250.5, metadata={"ride_id": "7"})
+        confirmed = await service.confirm_payment_intent(intent["payment_intent_id"])
+        refund = await service.process_refund(intent["payment_intent_id"], amount=100.0)
+        return intent, confirmed, refund
+
+    intent, confirmed, refund = asyncio.run(flow())
+
+    assert intent["status"] == "requires_payment_method"
+    assert fake_stripe.objects[intent["payment_intent_id"]]["metadata"] == {"ride_id": "7"}
+    assert confirmed == {"id": intent["payment_intent_id"], "status": "succeeded",
+                         "amount": 250.5, "currency": "inr"}
+    assert refund["amount"] == 100.0
+
+
+def test_stripe_errors_surface_as_http_errors(fake_stripe):
+    from fastapi import HTTPException
+
+    service = StripePaymentService()
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(service.confirm_payment_intent("pi_missing"))
+    assert error.value.status_code == 400
+
+
+def test_slow_calls_run_concurrently_without_stalling_the_loop(fake_stripe):
+    service = StripePaymentService(max_workers=10)
+
+    async def burst():
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(measure_loop_stall(stop))
+        started = time.perf_counter()
+        await asyncio.gather(*(service.create_payment_intent(amount=100.0) for _ in range(10)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        return elapsed, await ticker
+
+    elapsed, stall = asyncio.run(burst())
+
+    # Ten 200 ms calls back to back would take 2 s on a blocked loop
+    assert elapsed < 1.0
+    assert stall < 0.1
@@ -0,0 +1,129 @@
+# Request tracing: request IDs, per-stage spans, DB query spans and the Chrome trace export
+import asyncio
+import json
+import threading
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from tracing import ChromeTraceExporter, Trace, TracingMiddleware, _trace, span, trace_engine, traced
+
+
+@traced("test.geocode")
+async def geocode():
+    await asyncio.sleep(0)
+    return (28.6, 77.2)
+
+
+@traced("test.fare")
+def fare():
+    return 120.0
+
+
+def make_client(tmp_path):
+    engine = create_engine("sqlite://")
+    trace_engine(engine)
+    exporter = ChromeTraceExporter(str(tmp_path / "trace.json"))
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, exporter=exporter)
+
+    @app.post("/rides")
+    async def request_ride():
+        await geocode()
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return {"fare": fare()}
+
+    @app.get("/fail")
+    def fail():
+        with span("test.stage"):
+            raise ValueError("boom")
+
+    return TestClient(app, raise_server_exceptions=False), exporter
+
+
+def load_events(exporter):
+    # Written by the exporter's thread; the file is an unterminated array, as the format allows
+    exporter.flush()
+    with open(exporter.path) as trace_file:
+        return json.loads(trace_file.read().rstrip().rstrip(",") + "]")
+
+
+def test_requests_get_an_id_unless_they_bring_one(tmp_path):
+    client, _ = make_client(tmp_path)
+
+    generated = client.post("/rides").headers["x-request-id"]
+    echoed = client.post("/rides", headers={"X-Request-ID": "req-42"}).headers["x-request-id"]
+
+    assert len(generated) == 32 and echoed == "req-42"
+
+
+def test_spans_of_a_request_are_exported_on_its_row(tmp_path):
+    client, exporter = make_client(tmp_path)
+
+    client.post("/rides", headers={"X-Request-ID": "req-1"})
+
+    events = load_events(exporter)
+    names = [item["name"] for item in events if item["ph"] == "X"]
+    assert names[0] == "POST /rides"
+    assert {"test.geocode", "test.fare", "db.query"} <= set(names)
+    assert {item["tid"] for item in events} == {events[0]["tid"]}
+    assert events[0]["args"]["name"] == "POST /rides [req-1]"
+    query = next(item for item in events if item["name"] == "db.query")
+    assert query["args"]["statement"] == "SELECT 1"
+
+
+def test_failed_stages_record_the_error(tmp_path):
+    client, exporter = make_client(tmp_path)
+
+    assert client.get("/fail").status_code == 500
+
+    events = load_events(exporter)
+    assert events[1]["args"] == {"status": 500}
+    assert next(item for item in events if item["name"] == "test.stage")["args"]["error"] == "ValueError"
+
+
+def test_stage_totals_add_up_repeated_spans():
+    trace = Trace("req")
+    token = _trace.set(trace)
+    try:
+        for _ in range(3):
+            fare()
+        with span("test.payment", operation="PaymentIntent.create"):
+            pass
+    finally:
+        _trace.reset(token)
+
+    assert set(trace.stage_ms()) == {"test.fare", "test.payment"}
+    assert len([recorded for recorded in trace.spans if recorded["name"] == "test.fare"]) == 3
+    assert trace.spans[-1]["attributes"] == {"operation": "PaymentIntent.create"}
+
+
+def test_spans_outside_a_request_are_not_recorded():
+    assert fare() == 120.0
+    assert _trace.get() is None
+
+
+def test_exports_are_written_off_the_request_thread(tmp_path):
+    exporter = ChromeTraceExporter(str(tmp_path / "trace.json"), queue_size=2)
+    writing = threading.Event()
+    release = threading.Event()
+    writers = []
+
+    def slow_write(trace, label):
+        writers.append(threading.current_thread().name)
+        writing.set()
+        release.wait(5)
+
+    exporter.write = slow_write
+    exporter.export(Trace("req-0"), "GET /")
+    assert writing.wait(5)
+    for number in range(1, 4):
+        exporter.export(Trace(f"req-{number}"), "GET /")
+    # One trace is being written and two wait; the fourth found the queue full
+    assert exporter.dropped == 1
+
+    release.set()
+    exporter.flush()
+    assert writers == ["trace-export"] * 3
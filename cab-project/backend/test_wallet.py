@@ -0,0 +1,116 @@
+# Wallet ledger tests: double entry, idempotency and concurrent debits
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import wallet
+from models import Base, User
+from models_advanced import Wallet, WalletTransaction
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'wallet.db'}",
+                           connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def rider(db):
+    rider = User(name="John Doe", email="john@example.com", phone="+911234567890",
+                 role="rider", password="x")
+    db.add(rider)
+    db.commit()
+    return rider
+
+
+def test_to_minor_rounds_instead_of_truncating():
+    assert wallet.to_minor(0.29) == 29
+    assert wallet.to_minor(199.995) == 20000
+
+
+def test_postings_balance_to_zero(db, rider):
+    wallet.topup(db, rider.id, 50000, "pi_1")
+    wallet.charge_ride(db, rider.id, 7, 32050)
+    wallet.refund_ride(db, rider.id, 7, 5000, "re_1")
+
+    assert wallet.get_balance(db, wallet.user_account(rider.id)) == 22950
+    assert wallet.get_balance(db, wallet.RIDE_REVENUE) == 27050
+    assert wallet.get_balance(db, wallet.STRIPE_CLEARING) == -50000
+    # Every entry has a debit and a credit leg
+    assert db.query(func.sum(WalletTransaction.amount)).scalar() == 0
+    assert db.query(WalletTransaction).count() == 6
+
+
+def test_replayed_entries_do_not_move_money(db, rider):
+    first = wallet.topup(db, rider.id, 10000, "pi_1")
+    again = wallet.topup(db, rider.id, 10000, "pi_1")
+
+    assert first["balances"] == {wallet.user_account(rider.id): 10000}
+    assert again == {"entry_id": "topup:pi_1", "duplicate": True}
+    assert wallet.get_balance(db, wallet.user_account(rider.id)) == 10000
+
+
+def test_insufficient_funds_leave_no_trace(db, rider):
+    wallet.topup(db, rider.id, 1000, "pi_1")
+
+    with pytest.raises(wallet.InsufficientFunds):
+        wallet.charge_ride(db, rider.id, 7, 1001)
+
+    assert wallet.get_balance(db, wallet.user_account(rider.id)) == 1000
+    assert db.query(WalletTransaction).filter(WalletTransaction.entry_id == "ride:7").count() == 0
+
+
+def test_concurrent_debits_never_overdraw(session_factory, db, rider):
+    wallet.topup(db, rider.id, 1000, "pi_1")
+    outcomes = []
+
+    def charge(ride_id):
+        session = session_factory()
+        try:
+            wallet.charge_ride(session, rider.id, ride_id, 100)
+            outcomes.append("paid")
+        except wallet.InsufficientFunds:
+            outcomes.append("declined")
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=charge, args=(ride_id,)) for ride_id in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert outcomes.count("paid") == 10 and outcomes.count("declined") == 10
+    assert wallet.get_balance(db, wallet.user_account(rider.id)) == 0
+    assert wallet.get_balance(db, wallet.RIDE_REVENUE) == 1000
+
+
+def test_house_snapshots_keep_the_same_balance(db, rider):
+    wallet.topup(db, rider.id, 5000, "pi_1")
+    wallet.charge_ride(db, rider.id, 1, 2000)
+    # Age the rows past the snapshot lag
+    db.query(WalletTransaction).update(
+        {"created_at": datetime.utcnow() - wallet.SNAPSHOT_LAG - timedelta(seconds=1)}
+    )
+    db.commit()
+    wallet.charge_ride(db, rider.id, 2, 1000)
+
+    snapshots = wallet.snapshot_house_balances(db)
+
+    revenue = db.query(Wallet).filter(Wallet.account == wallet.RIDE_REVENUE).one()
+    assert snapshots[wallet.RIDE_REVENUE] == revenue.balance == 2000
+    assert wallet.get_balance(db, wallet.RIDE_REVENUE) == 3000
@@ -0,0 +1,163 @@
+# Webhook queue tests: signed ingestion, dedupe and idempotent batch application
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import stripe_integration
+import wallet
+import webhooks
+import notifications
+from models import Base, User, Ride, Payment, WebhookEvent
+from stats import read_counters
+
+SECRET = "whsec_test"
+
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'webhooks.db'}",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(webhooks, "SessionLocal", factory)
+    monkeypatch.setattr(stripe_integration, "STRIPE_WEBHOOK_SECRET", SECRET)
+    yield factory
+    engine.dispose()
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def payment(db):
+    rider = User(name="John Doe", email="john@example.com", phone="+911234567890",
+                 role="rider", password="x")
+    db.add(rider)
+    db.flush()
+    ride = Ride(rider_id=rider.id, pickup_lat=28.6139, pickup_lng=77.2090,
+                drop_lat=28.5355, drop_lng=77.3910, fare_estimate=250.0, status="in_progress")
+    db.add(ride)
+    db.flush()
+    payment = Payment(ride_id=ride.id, amount=250.0, currency="inr", status="pending",
+                      stripe_payment_intent_id="pi_123")
+    db.add(payment)
+    db.commit()
+    return payment
+
+
+def stripe_event(event_id, event_type, intent_id="pi_123", created=1700000000):
+    return {
+        "id": event_id, "object": "event", "type": event_type, "created": created,
+        "data": {"object": {"id": intent_id, "object": "payment_intent"}}
+    }
+
+
+def signed(event):
+    payload = json.dumps(event).encode()
+    timestamp = int(time.time())
+    digest = hmac.new(SECRET.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return payload, f"t={timestamp},v1={digest}"
+
+
+def test_ingest_acknowledges_and_dedupes_retries(db):
+    payload, signature = signed(stripe_event("evt_1", "payment_intent.succeeded"))
+
+    first = asyncio.run(webhooks.ingest_webhook(payload, signature))
+    retry = asyncio.run(webhooks.ingest_webhook(payload, signature))
+
+    assert first == {"status": "received", "duplicate": False}
+    assert retry == {"status": "received", "duplicate": True}
+    assert db.query(WebhookEvent).count() == 1
+
+
+def test_ingest_rejects_bad_signatures(db):
+    payload, _ = signed(stripe_event("evt_1", "payment_intent.succeeded"))
+    with pytest.raises(HTTPException):
+        asyncio.run(webhooks.ingest_webhook(payload, "t=1,v1=forged"))
+    with pytest.raises(HTTPException):
+        asyncio.run(webhooks.ingest_webhook(payload, None))
+    assert db.query(WebhookEvent).count() == 0
+
+
+def test_batch_applies_success_once(db, payment):
+    webhooks.enqueue_event(db, stripe_event("evt_1", "payment_intent.succeeded"))
+    webhooks.enqueue_event(db, stripe_event("evt_2", "charge.updated"))
+
+    assert webhooks.process_pending_events(db) == {
+        "processed": 1, "ignored": 1, "retried": 0, "failed": 0
+    }
+    db.refresh(payment)
+    assert payment.status == "completed" and payment.webhook_received
+    assert payment.ride.status == "completed"
+    assert read_counters(db, ["revenue"]) == {"revenue": 250.0}
+    rider_id = payment.ride.rider_id
+    assert [n["title"] for n in notifications.list_notifications(db, rider_id)] == ["Payment received"]
+
+    # A replayed success under a new event id changes nothing
+    webhooks.enqueue_event(db, stripe_event("evt_3", "payment_intent.succeeded"))
+    webhooks.process_pending_events(db)
+    assert read_counters(db, ["revenue"]) == {"revenue": 250.0}
+    assert notifications.unread_count(db, rider_id) == 1
+
+
+def test_late_failure_does_not_undo_success(db, payment):
+    webhooks.enqueue_event(db, stripe_event("evt_2", "payment_intent.payment_failed", created=1700000001))
+    webhooks.enqueue_event(db, stripe_event("evt_1", "payment_intent.succeeded", created=1700000002))
+    webhooks.process_pending_events(db)
+
+    db.refresh(payment)
+    assert payment.status == "completed"
+
+
+def test_unmatched_events_retry_then_fail(db):
+    webhooks.enqueue_event(db, stripe_event("evt_1", "payment_intent.succeeded", intent_id="pi_unknown"))
+
+    for _ in range(webhooks.MAX_ATTEMPTS - 1):
+        assert webhooks.process_pending_events(db)["retried"] == 1
+    assert webhooks.process_pending_events(db)["failed"] == 1
+
+    event = db.get(WebhookEvent, "evt_1")
+    assert event.status == "failed" and event.attempts == webhooks.MAX_ATTEMPTS
+
+
+def test_a_failing_event_is_rolled_back_alone(db, payment, monkeypatch):
+    def broken_handler(intent, payments, rides):
+        payments[intent["id"]].status = "canceled"
+        raise ValueError("unexpected payload")
+
+    monkeypatch.setitem(webhooks.EVENT_HANDLERS, "payment_intent.canceled", broken_handler)
+    webhooks.enqueue_event(db, stripe_event("evt_1", "payment_intent.canceled", created=1700000002))
+    webhooks.enqueue_event(db, stripe_event("evt_2", "payment_intent.succeeded", created=1700000001))
+
+    assert webhooks.process_pending_events(db) == {
+        "processed": 1, "ignored": 0, "retried": 1, "failed": 0
+    }
+    db.refresh(payment)
+    assert payment.status == "completed"
+    event = db.get(WebhookEvent, "evt_1")
+    assert (event.status, event.attempts) == ("pending", 1)
+    assert event.last_error == "ValueError: unexpected payload"
+
+
+def test_wallet_topups_are_credited_once_from_the_intent(db, payment):
+    topup = stripe_event("evt_1", "payment_intent.succeeded", intent_id="pi_topup")
+    topup["data"]["object"].update(amount=50000, amount_received=50000,
+                                   metadata={"type": "wallet_topup", "user_id": str(payment.ride.rider_id)})
+    replay = {**topup, "id": "evt_2"}
+    webhooks.enqueue_event(db, topup)
+    webhooks.enqueue_event(db, replay)
+
+    assert webhooks.process_pending_events(db)["processed"] == 2
+    assert wallet.get_balance(db, wallet.user_account(payment.ride.rider_id)) == 50000
+    assert wallet.get_balance(db, wallet.STRIPE_CLEARING) == -50000
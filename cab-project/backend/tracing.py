@@ -0,0 +1,272 @@
+# Request tracing: request IDs, timed spans and JSON logs, with optional Chrome trace export
+import functools
+import inspect
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+import orjson
+import structlog
+from sqlalchemy import event
+
+TRACE_LOG_LEVEL = os.getenv("TRACE_LOG_LEVEL", "INFO")
+# Set to append every request's spans to this file in Chrome's trace event
+# format, for chrome://tracing or ui.perfetto.dev
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+TRACE_EXPORT_QUEUE_SIZE = 10_000  # traces waiting for the writer thread; more are dropped
+REQUEST_ID_HEADER = b"x-request-id"
+
+# perf_counter() times the spans; this turns them into wall clock for exports
+WALL_CLOCK_OFFSET = time.time() - time.perf_counter()
+
+log = structlog.get_logger("tracing")
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional[str]] = ContextVar("span", default=None)
+
+
+def configure_logging(level: str = TRACE_LOG_LEVEL):
+    """One JSON object per line on stdout, carrying the request_id of the
+    request being served. Spans are logged at debug, requests at info."""
+    structlog.configure(
+        processors=[
+            structlog.contextvars.merge_contextvars,
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt="iso", utc=True),
+            structlog.processors.format_exc_info,
+            structlog.processors.JSONRenderer(serializer=orjson.dumps),
+        ],
+        wrapper_class=structlog.make_filtering_bound_logger(logging.getLevelName(level.upper())),
+        logger_factory=structlog.BytesLoggerFactory(),
+        cache_logger_on_first_use=True,
+    )
+
+
+class Trace:
+    """Spans finished while serving one request.
+
+    Spans can finish on threadpool threads (sync endpoints, DB queries),
+    so recording takes a lock.
+    """
+
+    _numbers = itertools.count(1)
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.number = next(self._numbers)
+        self.spans: List[Dict] = []
+        self.stages: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, started: float, duration: float, attributes: Dict, error: Optional[str]):
+        with self._lock:
+            self.spans.append({"name": name, "started": started, "duration": duration,
+                               "attributes": attributes, "error": error})
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    def stage_ms(self) -> Dict[str, float]:
+        """Total time per span name, e.g. {"db.query": 4.2, "maps.route": 310.5}"""
+        with self._lock:
+            return {name: round(total * 1000, 3) for name, total in self.stages.items()}
+
+
+def finish_span(name: str, started: float, attributes: Dict, error: Optional[str] = None):
+    duration = time.perf_counter() - started
+    log.debug("span", span=name, parent=_span.get(), duration_ms=round(duration * 1000, 3), error=error,
+              **attributes)
+    trace = _trace.get()
+    if trace is not None:
+        trace.record(name, started, duration, attributes, error)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the block as a stage of the current request. The yielded dict
+    takes attributes learned inside the block."""
+    started = time.perf_counter()
+    parent = _span.set(name)
+    error = None
+    try:
+        yield attributes
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        _span.reset(parent)
+        finish_span(name, started, attributes, error)
+
+
+def traced(name: str):
+    """Decorator running each call of a function (sync or async) in a span"""
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def run_async(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return run
+    return decorate
+
+
+def trace_engine(engine):
+    """A db.query span per statement run on engine (pass async_engine.sync_engine
+    for an async one)"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        finish_span("db.query", conn.info["query_started"].pop(), {"statement": statement[:500]})
+
+    @event.listens_for(engine, "handle_error")
+    def failed(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            finish_span("db.query", started.pop(), {"statement": (context.statement or "")[:500]},
+                        type(context.original_exception).__name__)
+
+
+class ChromeTraceExporter:
+    """Appends traces to a file as Chrome trace events, one row per request.
+
+    The format allows the JSON array to be left unterminated, so each
+    trace is a plain append and several workers can share the file.
+    Requests only queue their trace: one writer thread serializes and
+    writes, so a slow disk never stalls the event loop.
+    """
+
+    def __init__(self, path: str, queue_size: int = TRACE_EXPORT_QUEUE_SIZE):
+        self.path = path
+        self.pid = os.getpid()
+        self.dropped = 0
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def event(self, trace: Trace, name: str, started: float, duration: float, args: Dict) -> Dict:
+        return {
+            "name": name, "ph": "X", "pid": self.pid, "tid": trace.number,
+            "ts": round((started + WALL_CLOCK_OFFSET) * 1e6), "dur": round(duration * 1e6), "args": args,
+        }
+
+    def export(self, trace: Trace, label: str):
+        """Queue the trace for the writer thread"""
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._queue.put_nowait((trace, label))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until every queued trace is written"""
+        self._queue.join()
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is None:
+                # Started on first use, so a worker forked after import gets its own
+                self.pid = os.getpid()
+                self._writer = threading.Thread(target=self._write_queued, name="trace-export", daemon=True)
+                self._writer.start()
+
+    def _write_queued(self):
+        while True:
+            trace, label = self._queue.get()
+            try:
+                self.write(trace, label)
+            except OSError as e:
+                log.warning("trace_export_failed", path=self.path, error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def write(self, trace: Trace, label: str):
+        events = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": trace.number,
+                   "args": {"name": f"{label} [{trace.request_id}]"}}]
+        with trace._lock:
+            spans = list(trace.spans)
+        for recorded in spans:
+            args = dict(recorded["attributes"])
+            if recorded["error"]:
+                args["error"] = recorded["error"]
+            events.append(self.event(trace, recorded["name"], recorded["started"], recorded["duration"], args))
+        data = b"".join(orjson.dumps(item, default=str) + b",\n" for item in events)
+        with open(self.path, "ab") as output:
+            if output.tell() == 0:
+                output.write(b"[\n")
+            output.write(data)
+
+
+def incoming_request_id(scope) -> Optional[str]:
+    """The caller's X-Request-ID, when it looks like one"""
+    for header, value in scope["headers"]:
+        if header == REQUEST_ID_HEADER:
+            request_id = value.decode("latin-1")
+            if 0 < len(request_id) <= 128 and request_id.isprintable():
+                return request_id
+    return None
+
+
+class TracingMiddleware:
+    """Gives every request an ID (the caller's X-Request-ID or a new one),
+    echoed in the response and bound to every log line written while
+    serving it, and logs the request with its time per stage.
+
+    With an exporter, the request and its spans are written to the trace
+    file as well.
+    """
+
+    def __init__(self, app, exporter: Optional[ChromeTraceExporter] = None):
+        self.app = app
+        if exporter is None and TRACE_EXPORT_PATH:
+            exporter = ChromeTraceExporter(TRACE_EXPORT_PATH)
+        self.exporter = exporter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = incoming_request_id(scope) or uuid.uuid4().hex
+        trace = Trace(request_id)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = [*message.get("headers", []), (REQUEST_ID_HEADER, request_id.encode("latin-1"))]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _trace.set(trace)
+        started = time.perf_counter()
+        try:
+            with structlog.contextvars.bound_contextvars(request_id=request_id):
+                try:
+                    await self.app(scope, receive, send_with_request_id)
+                finally:
+                    duration = time.perf_counter() - started
+                    log.info("request", method=scope["method"], path=scope["path"], status=status,
+                             duration_ms=round(duration * 1000, 3), stages=trace.stage_ms())
+        finally:
+            _trace.reset(token)
+            if self.exporter is not None:
+                label = f"{scope['method']} {scope['path']}"
+                trace.spans.insert(0, {"name": label, "started": started, "duration": duration,
+                                       "attributes": {"status": status}, "error": None})
+                self.exporter.export(trace, label)
@@ -0,0 +1,208 @@
+# Double-entry wallet ledger with atomic conditional balance updates
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Optional
+
+from sqlalchemy import func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models  # noqa: F401  (users table for the wallet foreign keys)
+from models_advanced import Wallet, WalletTransaction
+
+# House accounts take the other leg of every posting. They never get a
+# row update per posting (so they are not a hot row); their balance is the
+# last snapshot plus the ledger rows written since.
+STRIPE_CLEARING = "house:stripe_clearing"  # money received from Stripe for top-ups
+RIDE_REVENUE = "house:ride_revenue"  # rides paid from wallets
+# Snapshots skip the newest rows so a posting still committing (with a
+# lower id than rows already visible) is never folded past
+SNAPSHOT_LAG = timedelta(minutes=1)
+
+
+class InsufficientFunds(ValueError):
+    pass
+
+
+def to_minor(amount: float) -> int:
+    """Rupees to paise, rounded half up (avoids float truncation like 0.29 * 100)"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def to_major(minor: int) -> float:
+    return minor / 100
+
+
+def user_account(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+# ------------------------
+# Accounts
+# ------------------------
+def wallet_id_for(db: Session, account: str) -> int:
+    """Id of the account's wallet, creating it on first use (race-safe)"""
+    wallet_id = db.query(Wallet.id).filter(Wallet.account == account).scalar()
+    if wallet_id is not None:
+        return wallet_id
+
+    is_house = account.startswith("house:")
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    now = datetime.utcnow()
+    db.execute(insert(Wallet.__table__).values(
+        account=account,
+        user_id=None if is_house else int(account.split(":", 1)[1]),
+        is_house=is_house,
+        balance=0,
+        snapshot_entry_id=0,
+        currency="INR",
+        created_at=now,
+        updated_at=now
+    ).on_conflict_do_nothing(index_elements=["account"]))
+    return db.query(Wallet.id).filter(Wallet.account == account).scalar()
+
+
+def get_balance(db: Session, account: str) -> int:
+    """Balance in paise (0 for an account that has no wallet yet)"""
+    wallet = db.query(Wallet.id, Wallet.is_house, Wallet.balance, Wallet.snapshot_entry_id).filter(
+        Wallet.account == account
+    ).first()
+    if wallet is None:
+        return 0
+    if not wallet.is_house:
+        return wallet.balance
+    since_snapshot = db.query(func.coalesce(func.sum(WalletTransaction.amount), 0)).filter(
+        WalletTransaction.wallet_id == wallet.id,
+        WalletTransaction.id > wallet.snapshot_entry_id
+    ).scalar()
+    return wallet.balance + since_snapshot
+
+
+def snapshot_house_balances(db: Session) -> Dict[str, int]:
+    """Fold new ledger rows into each house account's snapshot balance.
+
+    Keeps get_balance on house accounts to a short index range scan no
+    matter how long the ledger grows.
+    """
+    cutoff = datetime.utcnow() - SNAPSHOT_LAG
+    snapshots = {}
+    for wallet in db.query(Wallet).filter(Wallet.is_house.is_(True)):
+        last_id = db.query(func.max(WalletTransaction.id)).filter(
+            WalletTransaction.wallet_id == wallet.id,
+            WalletTransaction.id > wallet.snapshot_entry_id,
+            WalletTransaction.created_at < cutoff
+        ).scalar()
+        if last_id is not None:
+            wallet.balance += db.query(func.sum(WalletTransaction.amount)).filter(
+                WalletTransaction.wallet_id == wallet.id,
+                WalletTransaction.id > wallet.snapshot_entry_id,
+                WalletTransaction.id <= last_id
+            ).scalar()
+            wallet.snapshot_entry_id = last_id
+        snapshots[wallet.account] = wallet.balance
+    db.commit()
+    return snapshots
+
+
+# ------------------------
+# Postings
+# ------------------------
+def apply_delta(db: Session, wallet_id: int, delta: int) -> Optional[int]:
+    """Add delta to a user wallet in one conditional UPDATE.
+
+    The balance check and the write are the same statement, so concurrent
+    postings can't both spend the same paise and nothing is read first.
+    Returns the new balance, or None when it would go negative.
+    """
+    return db.execute(
+        update(Wallet)
+        .where(Wallet.id == wallet_id, Wallet.balance + delta >= 0)
+        .values(balance=Wallet.balance + delta, updated_at=datetime.utcnow())
+        .returning(Wallet.balance)
+        .execution_options(synchronize_session=False)
+    ).scalar()
+
+
+def post(db: Session, entry_id: str, debit_account: str, credit_account: str, amount: int,
+         description: str, reference_id: Optional[str] = None, commit: bool = True) -> Dict:
+    """Move amount paise from debit_account to credit_account as two ledger rows.
+
+    entry_id is the idempotency key: posting the same entry twice returns
+    the original result with duplicate=True instead of moving money again.
+    Raises InsufficientFunds if a user wallet would go negative.
+
+    With commit=False the rows are only flushed, for a caller posting inside
+    its own transaction; it handles the rollback when this raises.
+    """
+    if amount <= 0:
+        raise ValueError("Amount must be positive")
+    if debit_account == credit_account:
+        raise ValueError("Cannot post an entry to a single account")
+    if db.query(WalletTransaction.id).filter(WalletTransaction.entry_id == entry_id).first():
+        return {"entry_id": entry_id, "duplicate": True}
+
+    legs = [(wallet_id_for(db, debit_account), -amount), (wallet_id_for(db, credit_account), amount)]
+    house = {
+        wallet_id for wallet_id, in db.query(Wallet.id).filter(
+            Wallet.id.in_([wallet_id for wallet_id, _ in legs]), Wallet.is_house.is_(True)
+        )
+    }
+
+    balances = {}
+    # Lock user wallets in id order so two-user postings can't deadlock
+    for wallet_id, delta in sorted(legs):
+        if wallet_id in house:
+            continue
+        balance = apply_delta(db, wallet_id, delta)
+        if balance is None:
+            if commit:
+                db.rollback()
+            raise InsufficientFunds(f"{debit_account} has insufficient balance")
+        balances[wallet_id] = balance
+
+    now = datetime.utcnow()
+    db.add_all([
+        WalletTransaction(
+            wallet_id=wallet_id, entry_id=entry_id, type="credit" if delta > 0 else "debit",
+            amount=delta, balance_after=balances.get(wallet_id), description=description,
+            reference_id=reference_id, created_at=now
+        )
+        for wallet_id, delta in legs
+    ])
+    if not commit:
+        db.flush()
+    else:
+        try:
+            db.commit()
+        except IntegrityError:
+            # A concurrent request posted the same entry first; its result stands
+            db.rollback()
+            return {"entry_id": entry_id, "duplicate": True}
+
+    accounts = {legs[0][0]: debit_account, legs[1][0]: credit_account}
+    return {
+        "entry_id": entry_id,
+        "duplicate": False,
+        "amount": amount,
+        "balances": {accounts[wallet_id]: balance for wallet_id, balance in balances.items()}
+    }
+
+
+def topup(db: Session, user_id: int, amount: int, payment_reference: str, commit: bool = True) -> Dict:
+    """Credit a user wallet after a successful payment (idempotent per payment)"""
+    return post(db, f"topup:{payment_reference}", STRIPE_CLEARING, user_account(user_id),
+                amount, "Wallet top-up", payment_reference, commit)
+
+
+def charge_ride(db: Session, user_id: int, ride_id: int, amount: int) -> Dict:
+    """Pay a ride from the rider's wallet"""
+    return post(db, f"ride:{ride_id}", user_account(user_id), RIDE_REVENUE,
+                amount, f"Ride #{ride_id}", str(ride_id))
+
+
+def refund_ride(db: Session, user_id: int, ride_id: int, amount: int, refund_reference: str) -> Dict:
+    """Return (part of) a wallet-paid ride fare to the rider, once per refund_reference"""
+    return post(db, f"refund:{refund_reference}", RIDE_REVENUE, user_account(user_id),
+                amount, f"Refund for ride #{ride_id}", str(ride_id))
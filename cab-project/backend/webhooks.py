@@ -0,0 +1,196 @@
+# Durable Stripe webhook queue: acknowledge fast, apply in idempotent batches
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+import notifications
+import wallet
+from db import SessionLocal
+from models import Payment, Ride, WebhookEvent
+from stripe_integration import stripe_service
+
+WEBHOOK_BATCH_SIZE = 100
+MAX_ATTEMPTS = 5  # events still unmatched after this many batches are marked failed
+
+
+# ------------------------
+# Ingestion
+# ------------------------
+def enqueue_event(db: Session, event: Dict) -> bool:
+    """Store a verified event once; returns False when Stripe re-delivered it"""
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    statement = insert(WebhookEvent.__table__).values(
+        id=event["id"],
+        type=event["type"],
+        payload=event,
+        status="pending",
+        attempts=0,
+        received_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=["id"])
+    created = db.execute(statement).rowcount == 1
+    db.commit()
+    return created
+
+
+def store_event(event: Dict) -> bool:
+    db = SessionLocal()
+    try:
+        return enqueue_event(db, event)
+    finally:
+        db.close()
+
+
+async def ingest_webhook(payload: bytes, signature: Optional[str]) -> Dict:
+    """Verify the signature and durably enqueue the event.
+
+    Only the insert runs before Stripe gets its 2xx (on a worker thread, off
+    the event loop); the Payment/Ride changes happen later in
+    process_pending_events.
+    """
+    if not signature:
+        raise HTTPException(status_code=400, detail="Missing signature")
+    event = stripe_service.verify_webhook_signature(payload, signature)
+    created = await run_in_threadpool(store_event, event)
+    return {"status": "received", "duplicate": not created}
+
+
+# ------------------------
+# Event handlers
+# ------------------------
+# Each handler gets the event's data.object plus the batch's preloaded
+# payments (by intent id) and rides (by id). It returns False when the
+# payment isn't known yet so the event is retried on a later batch.
+# Handlers only move rows forward, so replays and out-of-order delivery
+# leave the same end state.
+def apply_payment_succeeded(intent: Dict, payments: Dict[str, Payment], rides: Dict[int, Ride]) -> bool:
+    payment = payments.get(intent["id"])
+    if payment is None:
+        return False
+    if payment.status != "refunded":
+        payment.status = "completed"
+    payment.webhook_received = True
+
+    ride = rides.get(payment.ride_id)
+    if ride:
+        ride.status = "completed"
+    return True
+
+
+def apply_payment_failed(intent: Dict, payments: Dict[str, Payment], rides: Dict[int, Ride]) -> bool:
+    payment = payments.get(intent["id"])
+    if payment is None:
+        return False
+    if payment.status == "pending":
+        payment.status = "failed"
+    payment.webhook_received = True
+    return True
+
+
+EVENT_HANDLERS: Dict[str, Callable[[Dict, Dict, Dict], bool]] = {
+    "payment_intent.succeeded": apply_payment_succeeded,
+    "payment_intent.payment_failed": apply_payment_failed,
+}
+
+
+def is_wallet_topup(intent: Dict) -> bool:
+    return (intent.get("metadata") or {}).get("type") == "wallet_topup"
+
+
+def apply_wallet_topup(db: Session, event_type: str, intent: Dict) -> bool:
+    """Credit a succeeded top-up intent to its user's wallet.
+
+    The amount is what Stripe received and the intent id is the ledger
+    reference, so a replayed event credits nothing twice. Failed top-ups
+    have nothing to undo.
+    """
+    if event_type == "payment_intent.succeeded":
+        amount = intent.get("amount_received") or intent["amount"]
+        wallet.topup(db, int(intent["metadata"]["user_id"]), amount, intent["id"], commit=False)
+    return True
+
+
+# ------------------------
+# Worker
+# ------------------------
+def claim_pending(db: Session, batch_size: int):
+    query = db.query(WebhookEvent).filter(WebhookEvent.status == "pending").order_by(
+        WebhookEvent.attempts, WebhookEvent.received_at
+    ).limit(batch_size)
+    if db.get_bind().dialect.name == "postgresql":
+        # Concurrent workers take disjoint batches instead of queueing on row locks
+        query = query.with_for_update(skip_locked=True)
+    return query.all()
+
+
+def process_pending_events(db: Session, batch_size: int = WEBHOOK_BATCH_SIZE) -> Dict[str, int]:
+    """Apply one batch of queued events in a single transaction.
+
+    Payments and rides for the whole batch are loaded with one query each
+    and changed through the ORM, so the stats listeners still see every
+    status change; wallet top-ups are credited to the ledger. Each event is applied in its own savepoint: one that
+    raises is rolled back alone and retried on a later batch, behind events
+    with fewer attempts. Riders are notified of payment status changes in
+    the same transaction.
+    """
+    events = claim_pending(db, batch_size)
+    summary = {"processed": 0, "ignored": 0, "retried": 0, "failed": 0}
+    if not events:
+        return summary
+
+    intent_ids = {
+        event.payload["data"]["object"]["id"]
+        for event in events if event.type in EVENT_HANDLERS
+    }
+    payments = {
+        payment.stripe_payment_intent_id: payment
+        for payment in db.query(Payment).filter(Payment.stripe_payment_intent_id.in_(intent_ids))
+    } if intent_ids else {}
+    ride_ids = {payment.ride_id for payment in payments.values()}
+    rides = {
+        ride.id: ride for ride in db.query(Ride).filter(Ride.id.in_(ride_ids))
+    } if ride_ids else {}
+
+    now = datetime.utcnow()
+    # Stripe's created timestamp, so a batch applies events in the order they happened
+    for event in sorted(events, key=lambda event: event.payload.get("created", 0)):
+        event.attempts += 1
+        handler = EVENT_HANDLERS.get(event.type)
+        if handler is None:
+            event.status, event.processed_at = "ignored", now
+            summary["ignored"] += 1
+            continue
+
+        intent = event.payload["data"]["object"]
+        payment = payments.get(intent["id"])
+        previous_status = payment.status if payment else None
+        try:
+            with db.begin_nested():
+                if is_wallet_topup(intent):
+                    applied = apply_wallet_topup(db, event.type, intent)
+                else:
+                    applied = handler(intent, payments, rides)
+                db.flush()
+        except Exception as exc:
+            applied, error = False, f"{type(exc).__name__}: {exc}"
+        else:
+            error = "No payment matches this payment intent"
+
+        if applied:
+            event.status, event.processed_at, event.last_error = "processed", now, None
+            summary["processed"] += 1
+            if payment is not None and payment.status != previous_status:
+                notifications.stage(db, [notifications.payment_event(payment, rides.get(payment.ride_id))])
+        elif event.attempts >= MAX_ATTEMPTS:
+            event.status, event.last_error = "failed", error
+            summary["failed"] += 1
+        else:
+            event.last_error = error
+            summary["retried"] += 1
+
+    db.commit()
+    return summary